@@ -19,6 +19,7 @@ from numpy import sin, cos, tan
 
 import Python_Classes4MAD.metaclass
 import utils.bpm
+import utils.shared_pool
 import compensate_ac_effect
 import os
 import re
@@ -75,6 +76,22 @@ class MeasuredValues:
         self.use_it = use_it
         
         
+class _TRow(object):
+    '''
+    Non-zero entries of the rows of the T-matrices (beta and alfa) for one combination of three BPMs.
+    The rows of all the combinations of a probed BPM are assembled at once by _build_T_matrices.
+    '''
+    def __init__(self, bpm_indices, phase_errors, phase_errors_alf, denomalf):
+        self.bpm_indices = bpm_indices  # bi1, bi2, bi3
+        self.phase_errors = phase_errors
+        self.phase_errors_alf = phase_errors_alf
+        self.denomalf = denomalf
+        # For each kind of error (quad field errors, sext transversal and quad longitudinal missalignments) two terms:
+        # (first BPM, last BPM, BPM of the reference phase, frac, sin(phase advance) ** 2, alfa factor 1, alfa factor 2)
+        self.error_terms = ((), (), ())
+        self.bpm_errors = {}  # BPM index -> T entry of the BPM missalignment
+        
+        
 class BetaData(object):
     """ File for storing results from beta computations. """
 
@@ -1302,52 +1319,11 @@ def scan_all_BPMs_withsystematicerrors(madTwiss, errorfile, phase, plane, getllm
     '''
     
     print_("INFO: errorfile given. Create list_of_Ks")
-    list_of_Ks = []
     
     errors_method = "Analytical Formula"
     print_("Errors from " + errors_method)
    
-    #---- create list of Ks, i.e. assign to each BPM a vector with all the errore lements that come after the bpm
-    # and their respective errors
-    # and model phases so that list_of_Ks[n] yields the error elements between BPM[n] and BPM[n+1]
-    # update 2016-07-28: list_of_Ks[n][k], n: BPM number, k=0: quadrupole field errors,
-    # k=1: transversal sextupole missalignments
-    # k=2: longitudinal quadrupole missalignments
-    for n in range(len(commonbpms) + getllm_d.range_of_bpms + 1):
-        index_n = errorfile.indx[commonbpms[n % len(commonbpms)][1]]
-        index_nplus1 = errorfile.indx[commonbpms[(n + 1) % len(commonbpms)][1]]
-              
-        quad_fields = []
-        sext_trans = []
-        quad_missal = []
-               
-        if index_n < index_nplus1:
-            for i in range(index_n + 1, index_nplus1):
-                if errorfile.dK1[i] != 0:
-                    quad_fields.append(i)
-                if errorfile.dX[i] != 0:
-                    sext_trans.append(i)
-                if errorfile.dS[i] != 0:
-                    quad_missal.append(i)
-                    
-        else:
-            for i in range(index_n + 1, len(errorfile.NAME)):
-                if errorfile.dK1[i] != 0:
-                    quad_fields.append(i)
-                if errorfile.dX[i] != 0:
-                    sext_trans.append(i)
-                if errorfile.dS[i] != 0:
-                    quad_missal.append(i)
-                    
-            for i in range(index_nplus1):  # ums Eck
-                if errorfile.dK1[i] != 0:
-                    quad_fields.append(i)
-                if errorfile.dX[i] != 0:
-                    sext_trans.append(i)
-                if errorfile.dS[i] != 0:
-                    quad_missal.append(i)
-       
-        list_of_Ks.append([quad_fields, sext_trans, quad_missal])
+    list_of_Ks = _get_list_of_Ks(errorfile, commonbpms, getllm_d.range_of_bpms)
               
     width = getllm_d.range_of_bpms / 2
     left_bpm = range(-width, 0)
@@ -1360,32 +1336,21 @@ def scan_all_BPMs_withsystematicerrors(madTwiss, errorfile, phase, plane, getllm
     def collect(row):
         if row[11]:
             result[row[0]] = row[1:]
-        
-    def collectblock(block):
-        for row in block:
-            if row[11]:
-                result[row[0]] = row[1:]
                 
     st = time.time()
     if getllm_d.parallel and not DEBUG:
-        
-        chunksize = int(len(commonbpms) / getllm_d.nprocesses) + 1
-        pool = multiprocessing.Pool()
-        n = int(len(commonbpms) / chunksize)
-        
-        for i in range(n):
-            pool.apply_async(scan_several_BPMs_withsystematicerrors,
-                             (madTwiss, errorfile,
-                              phase, plane, getllm_d.range_of_bpms, commonbpms, debugfile, list_of_Ks,
-                              i * chunksize, (i + 1) * chunksize, BBA_combo, ABB_combo, BAB_combo),
-                             callback=collectblock)
-        pool.apply_async(scan_several_BPMs_withsystematicerrors,
-                         (madTwiss, errorfile,
-                          phase, plane, getllm_d.range_of_bpms, commonbpms, debugfile, list_of_Ks,
-                          n * chunksize, len(commonbpms), BBA_combo, ABB_combo, BAB_combo),
-                         callback=collectblock)
-        pool.close()
-        pool.join()
+        scan_data = (madTwiss, errorfile, phase, plane, getllm_d.range_of_bpms, commonbpms, list_of_Ks,
+                     BBA_combo, ABB_combo, BAB_combo)
+        # The workers get the scan data once, when they start, and write their rows into a shared array
+        with utils.shared_pool.SharedArrayPool(getllm_d.nprocesses, initializer=_init_scan_worker,
+                                               initargs=scan_data) as pool:
+            rows = pool.empty((len(commonbpms), 11), np.float64)
+            pool.map_row_blocks(_scan_BPM_rows, len(commonbpms), (rows,))
+            rows = np.array(rows.array)
+        probed_index = int((getllm_d.range_of_bpms - 1) / 2.)
+        for i, row in enumerate(rows):
+            probed_bpm_name = str.upper(commonbpms[(i + probed_index) % len(commonbpms)][1])
+            collect([probed_bpm_name] + list(row[:10]) + [int(row[10])])
     else:
         startProgress("Scan all BPMs")
         for i in range(0, len(commonbpms)):
@@ -1405,15 +1370,54 @@ def scan_all_BPMs_withsystematicerrors(madTwiss, errorfile, phase, plane, getllm
     return rmsbb, errors_method, result
 
 
-def scan_several_BPMs_withsystematicerrors(madTwiss, errorfile,
-                                           phase, plane, range_of_bpms, commonbpms, debugfile, list_of_Ks,
-                                           begin, end, BBA_combo, ABB_combo, BAB_combo):
-    block = []
+def _get_list_of_Ks(errorfile, commonbpms, range_of_bpms):
+    '''
+    Assigns to each BPM the indices of the error elements that come after it, so that list_of_Ks[n] yields the error
+    elements between BPM[n] and BPM[n+1].
+    list_of_Ks[n][k], n: BPM number, k=0: quadrupole field errors,
+    k=1: transversal sextupole missalignments
+    k=2: longitudinal quadrupole missalignments
+    The error elements are found with binary searches in the sorted indices of the non zero errors.
+    '''
+    bpm_indices = np.array([errorfile.indx[commonbpms[n % len(commonbpms)][1]]
+                            for n in range(len(commonbpms) + range_of_bpms + 2)])
+    list_of_Ks = [[] for _ in range(len(bpm_indices) - 1)]
+    for errors in (errorfile.dK1, errorfile.dX, errorfile.dS):
+        error_indices = np.flatnonzero(np.asarray(errors) != 0)
+        firsts = np.searchsorted(error_indices, bpm_indices[:-1], side="right")
+        lasts = np.searchsorted(error_indices, bpm_indices[1:], side="left")
+        for n in range(len(list_of_Ks)):
+            if bpm_indices[n] < bpm_indices[n + 1]:
+                list_of_Ks[n].append(error_indices[firsts[n]:lasts[n]])
+            else:  # ums Eck
+                list_of_Ks[n].append(np.concatenate((error_indices[firsts[n]:], error_indices[:lasts[n]])))
+    return list_of_Ks
+
+
+_scan_data = None
+
+
+def _init_scan_worker(*scan_data):
+    ''' Keeps the data needed to scan the BPMs in the worker process, it is sent only once. '''
+    global _scan_data
+    _scan_data = scan_data
+
+
+def _scan_BPM_rows(begin, end, rows):
+    ''' Scans the BPMs begin to end and writes the results (without name) in the shared array rows. '''
+    madTwiss, errorfile, phase, plane, range_of_bpms, commonbpms, list_of_Ks, BBA_combo, ABB_combo, BAB_combo = _scan_data
+    values = rows.array
     for i in range(begin, end):
-        block.append(scan_one_BPM_withsystematicerrors(madTwiss, errorfile, phase, plane, range_of_bpms, commonbpms,
-                                                       debugfile, list_of_Ks, i,
-                                                       BBA_combo, ABB_combo, BAB_combo))
-    return block
+        try:
+            row = scan_one_BPM_withsystematicerrors(madTwiss, errorfile, phase, plane, range_of_bpms, commonbpms,
+                                                    None, list_of_Ks, i,
+                                                    BBA_combo, ABB_combo, BAB_combo)
+        except:
+            print "\33[31;1m Could not calculate beta for BPM {0:d}\33[0m".format(i)
+            traceback.print_exc()
+            continue  # The row keeps 0 used BPMs and is not collected
+        values[i] = row[1:]
+    rows.flush()
     
 
 def get_beta_from_phase_3bpm(madTwiss, phase, plane, range_of_bpms, commonbpms, debugfile, i, probed_bpm_name_):
@@ -1472,7 +1476,7 @@ def scan_one_BPM_withsystematicerrors(madTwiss, errorfile,
             
             printMatrix(debugfile, T_Beta, "T_b")
             printMatrix(debugfile, T_Alfa, "T_Alfa")
-            printMatrix(debugfile, M, "M")
+            printMatrix(debugfile, np.diag(M), "M")
             debugfile.write("MUX: {0:.10e}\n".format(phase[probed_bpm_name][0]))
             debugfile.write("end\n")
             
@@ -1487,9 +1491,9 @@ def scan_one_BPM_withsystematicerrors(madTwiss, errorfile,
         alfas = np.array([x.alfa for x in alfa_beta])
         len_w = len(betas)
     
-        #--- calculate V and its inverse
-        V_Beta = T_Beta * M * np.transpose(T_Beta)
-        V_Alfa = T_Alfa * M * np.transpose(T_Alfa)
+        #--- calculate V and its inverse, M is diagonal
+        V_Beta = np.multiply(T_Beta, M) * np.transpose(T_Beta)
+        V_Alfa = np.multiply(T_Alfa, M) * np.transpose(T_Alfa)
     except:
         print "\33[31;1m SOMETHING WENT WRONG\33[0m Use 3 BPM method"
         probed_bpm_name, beti, betstat, betsys, beterr, alfi, alfstat, alfsys, alferr = get_beta_from_phase_3bpm(madTwiss, phase, plane, range_of_bpms, commonbpms, debugfile, Index, probed_bpm_name)
@@ -1503,7 +1507,7 @@ def scan_one_BPM_withsystematicerrors(madTwiss, errorfile,
             
             printMatrix(debugfile, T_Beta, "T_b")
             printMatrix(debugfile, T_Alfa, "T_Alfa")
-            printMatrix(debugfile, M, "M")
+            printMatrix(debugfile, np.diag(M), "M")
             printMatrix(debugfile, V_Beta, "Vb")
             printMatrix(debugfile, V_Alfa, "Va")
             debugfile.write("\ncombinations:\t")
@@ -1579,7 +1583,7 @@ def scan_one_BPM_withsystematicerrors(madTwiss, errorfile,
         debugfile.write("\n\nbegin BPM " + probed_bpm_name + " :\n")
         printMatrix(debugfile, T_Beta, "T_b")
         printMatrix(debugfile, T_Alfa, "T_Alfa")
-        printMatrix(debugfile, M, "M")
+        printMatrix(debugfile, np.diag(M), "M")
         printMatrix(debugfile, V_Beta, "Vb")
         printMatrix(debugfile, V_Beta_inv, "Vb_inv")
         printMatrix(debugfile, V_Alfa, "Va")
@@ -1653,8 +1657,8 @@ def get_beta_from_phase_systematic_errors(madTwiss, errorfile, phase, plane, com
             consists of: betafunction, name of first used bpm, name of second used bpm, patternstring
             the pattern string is primarily for debugging purposes, to see which combination got which weight
             should be discarded afterwards
-        'M':np-matrix
-            variance matrix for all error kinds.
+        'M':np-array
+            diagonal of the variance matrix for all error kinds.
     '''
        
     RANGE = int(range_of_bpms)
@@ -1702,35 +1706,29 @@ def get_beta_from_phase_systematic_errors(madTwiss, errorfile, phase, plane, com
 
         #---- assign field errors
     for j in range(RANGE):
-        index = (CurrentIndex + j) % len(list_of_Ks)
-        for k in range(len(list_of_Ks[index][0])):
-            err_diagonal[k + position] = errorfile.dK1[list_of_Ks[index][0][k]] ** 2
-        position += len(list_of_Ks[index][0])
+        quad_fields = list_of_Ks[(CurrentIndex + j) % len(list_of_Ks)][0]
+        err_diagonal[position:position + len(quad_fields)] = np.asarray(errorfile.dK1)[quad_fields] ** 2
+        position += len(quad_fields)
         
         #---- assign sextupole transversal missalignments
     for j in range(RANGE):
-        index = (CurrentIndex + j) % len(list_of_Ks)
-        for k in range(len(list_of_Ks[index][1])):
-            err_diagonal[k + position] = errorfile.dX[list_of_Ks[index][1][k]] ** 2
-        position += len(list_of_Ks[index][1])
+        sext_trans = list_of_Ks[(CurrentIndex + j) % len(list_of_Ks)][1]
+        err_diagonal[position:position + len(sext_trans)] = np.asarray(errorfile.dX)[sext_trans] ** 2
+        position += len(sext_trans)
         
         #---- assign longitudinal missalignments
     for j in range(RANGE):
-        index = (CurrentIndex + j) % len(list_of_Ks)
-        for k in range(len(list_of_Ks[index][2])):
-            err_diagonal[k + position] = errorfile.dS[list_of_Ks[index][2][k]] ** 2
-        position += len(list_of_Ks[index][2])
+        quad_missal = list_of_Ks[(CurrentIndex + j) % len(list_of_Ks)][2]
+        err_diagonal[position:position + len(quad_missal)] = np.asarray(errorfile.dS)[quad_missal] ** 2
+        position += len(quad_missal)
         
         #---- assign BPM missalignments
     for j in range(RANGE):
         err_diagonal[j + position] = errorfile.dS[errorfile.indx[bpm_name[j]]] ** 2
-        
-    M = np.diag(err_diagonal)
                
     #---- calculate betas_from_phase for the three cases.
-    #     and add matrix_row for the given combination
-    matrix_rows_Beta = []
-    matrix_rows_Alfa = []
+    #     and add the T-matrix rows for the given combination
+    t_rows = []
     
     beta_alfa = []
     
@@ -1738,46 +1736,39 @@ def get_beta_from_phase_systematic_errors(madTwiss, errorfile, phase, plane, com
         n0 = probed_index + n[0]
         n1 = probed_index + n[1]
 
-        measured, TrowBeta, TrowAlfa = _beta_from_phase_BPM_BBA_with_systematicerrors(CurrentIndex,
-                                                                                      bpm_name[n0], bpm_name[n1], bpm_name[probed_index], n0, n1, probed_index,
-                                                                                      madTwiss, errorfile, phase, plane,
-                                                                                      list_of_Ks, sizeOfMatrix, RANGE)
+        measured, t_row = _beta_from_phase_BPM_BBA_with_systematicerrors(bpm_name[n0], bpm_name[n1], bpm_name[probed_index], n0, n1, probed_index,
+                                                                          madTwiss, errorfile, phase, plane, RANGE)
                             
         if measured.use_it:
             beta_alfa.append(measured)
-            matrix_rows_Beta.append(TrowBeta)
-            matrix_rows_Alfa.append(TrowAlfa)
+            t_rows.append(t_row)
 
     for n in BAB_combo:
         n0 = probed_index + n[0]
         n1 = probed_index + n[1]
 
-        measured, TrowBeta, TrowAlfa = _beta_from_phase_BPM_BAB_with_systematicerrors(CurrentIndex,
-                                                                                      bpm_name[n0], bpm_name[probed_index], bpm_name[n1], n0, probed_index, n1,
-                                                                                      madTwiss, errorfile, phase, plane,
-                                                                                      list_of_Ks, sizeOfMatrix, RANGE)
+        measured, t_row = _beta_from_phase_BPM_BAB_with_systematicerrors(bpm_name[n0], bpm_name[probed_index], bpm_name[n1], n0, probed_index, n1,
+                                                                          madTwiss, errorfile, phase, plane, RANGE)
         if measured.use_it:
             beta_alfa.append(measured)
-            matrix_rows_Alfa.append(TrowAlfa)
-            matrix_rows_Beta.append(TrowBeta)
+            t_rows.append(t_row)
              
     for n in ABB_combo:
         n0 = probed_index + n[0]
         n1 = probed_index + n[1]
         
-        measured, TrowBeta, TrowAlfa = _beta_from_phase_BPM_ABB_with_systematicerrors(CurrentIndex,
-                                                                                      bpm_name[probed_index], bpm_name[n0], bpm_name[n1], probed_index, n0, n1,
-                                                                                      madTwiss, errorfile, phase, plane,
-                                                                                      list_of_Ks, sizeOfMatrix, RANGE)
+        measured, t_row = _beta_from_phase_BPM_ABB_with_systematicerrors(bpm_name[probed_index], bpm_name[n0], bpm_name[n1], probed_index, n0, n1,
+                                                                          madTwiss, errorfile, phase, plane, RANGE)
         if measured.use_it:
             beta_alfa.append(measured)
-            matrix_rows_Alfa.append(TrowAlfa)
-            matrix_rows_Beta.append(TrowBeta)
+            t_rows.append(t_row)
     
-    return np.matrix(matrix_rows_Alfa), np.matrix(matrix_rows_Beta), beta_alfa, bpm_name[probed_index], M
+    T_Alfa, T_Beta = _build_T_matrices(t_rows, bpm_name, madTwiss, errorfile, plane, list_of_Ks, CurrentIndex,
+                                       sizeOfMatrix, RANGE)
+    return np.matrix(T_Alfa), np.matrix(T_Beta), beta_alfa, bpm_name[probed_index], err_diagonal
 
 
-def _beta_from_phase_BPM_ABB_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, bi3, madTwiss, errorfile, phase, plane, list_of_Ks, matrixSize, RANGE):
+def _beta_from_phase_BPM_ABB_with_systematicerrors(bn1, bn2, bn3, bi1, bi2, bi3, madTwiss, errorfile, phase, plane, RANGE):
     '''
        Calculates the beta/alfa function and their errors using the
     phase advance between three BPMs for the case that the probed BPM is left of the other two BPMs (case ABB)
@@ -1797,8 +1788,6 @@ def _beta_from_phase_BPM_ABB_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
         'list_of_Ks':vector (of vectors)
             contains information about the errors the i-th entry in list_of_Ks yields the errors of all the lattice
             elements that come after the i-th BPM
-        'matrixSize':int
-            the size of the T-matrix
         'RANGE':int
             the range of BPMs
     :Return:tupel (bet,betstd,alf,alfstd)
@@ -1808,10 +1797,8 @@ def _beta_from_phase_BPM_ABB_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
             calculated error on beta function at probed BPM
         '0':float
             0
-        'T':numpy matrix
-            column of the T-matrix
-        'T_Alf':numpy matrix
-            column of the T-matrix for alfa
+        't_row':_TRow
+            non-zero entries of the row of the T-matrices for beta and alfa
         'patternstring':string
             [For Debugging] string which represents the combination used
             For example AxxBxB
@@ -1842,7 +1829,7 @@ def _beta_from_phase_BPM_ABB_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
         print >> sys.stderr, "Some of the off-momentum betas are negative, change the dpp unit"
         sys.exit(1)
     if (bad_phase(phmdl12) or bad_phase(phmdl13) or bad_phase(phmdl12 - phmdl13)) or bad_phase(ph2pi12) or bad_phase(ph2pi13) or bad_phase(ph2pi12 - ph2pi13):
-        return MeasuredValues(0, 0), [], []
+        return MeasuredValues(0, 0), None
    
     phmdl12 *= TWOPI
     phmdl13 *= TWOPI
@@ -1870,18 +1857,6 @@ def _beta_from_phase_BPM_ABB_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
     
     alf = 0.5 * (denomalf * bet - numeralf)
     
-    T = [0] * matrixSize
-    T_Alf = [0] * matrixSize
-    
-    phi_2 = madTwiss.MUX[I2] * TWOPI
-    phi_3 = madTwiss.MUX[I3] * TWOPI
-    
-    frac = 1.0 / denom
-    if plane == 'V':
-        frac *= -1.0
-        phi_2 = madTwiss.MUY[I2] * TWOPI
-        phi_3 = madTwiss.MUY[I3] * TWOPI
-     
     s_i2 = sin(phmdl12) ** 2
     s_i3 = sin(phmdl13) ** 2
           
@@ -1890,94 +1865,47 @@ def _beta_from_phase_BPM_ABB_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
     phi_err2 = (-1.0 / s_i2) / denom
     phi_err3 = 1.0 / s_i3 / denom
     
-    T[bi1] = phi_err1
-    T[bi2] = phi_err2
-    T[bi3] = phi_err3
+    t_row = _TRow((bi1, bi2, bi3), (phi_err1, phi_err2, phi_err3),
+                  (A_FACT * (-1.0 / s_i2 - 1.0 / s_i3 + phi_err1 * denomalf),
+                   A_FACT * (1.0 / s_i2 + phi_err2 * denomalf),
+                   A_FACT * (1.0 / s_i3 + phi_err3 * denomalf)),
+                  denomalf)
     
-    T_Alf[bi1] = A_FACT * (-1.0 / s_i2 - 1.0 / s_i3 + phi_err1 * denomalf)
-    T_Alf[bi2] = A_FACT * (1.0 / s_i2 + phi_err2 * denomalf)
-    T_Alf[bi3] = A_FACT * (1.0 / s_i3 + phi_err3 * denomalf)
+    frac = 1.0 / denom
+    if plane == 'V':
+        frac *= -1.0
     
-    # the first columns belong to the phase errors:
-    K_offset = RANGE
-        
-    # then we jump to the first non-zero column in the K1 errors
-    for k in range(bi1):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][0])
-       
-    #--- Quad Fielderrors
-    _assign_quaderrors(I, bi1, bi2,
-                       errorfile, list_of_Ks,
-                       denomalf, s_i2, T, T_Alf, phi_2, -frac, K_offset,
-                       .5, .5)
-       
-    K_offset = _assign_quaderrors(I, bi1, bi3,
-                                  errorfile, list_of_Ks,
-                                  denomalf, s_i3, T, T_Alf, phi_3, frac, K_offset,
-                                  .5, .5)
-            
-    #--- Sext Transverse Missalignments
-    for k in range(bi3, RANGE):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][0])
-    for k in range(bi1):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][1])
-        
-    _assign_sext_errors(I, bi1, bi2,
-                        errorfile, list_of_Ks,
-                        denomalf, s_i2, T, T_Alf, phi_2, frac, K_offset,
-                        -.5, .5)
-    
-    K_offset = _assign_sext_errors(I, bi1, bi3,
-                                   errorfile, list_of_Ks,
-                                   denomalf, s_i3, T, T_Alf, phi_3, -frac, K_offset,
-                                   -.5, .5)
-
-    #--- Quad Longitudinal Missalignments
-    for k in range(bi3, RANGE):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][1])
-    for k in range(bi1):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][2])
-
-    _assign_quadlongmissal(I, bi1, bi2,
-                           errorfile, list_of_Ks,
-                           denomalf, s_i2, T, T_Alf, phi_2, -frac, K_offset,
-                           .5, .5)
-       
-    K_offset = _assign_quadlongmissal(I, bi1, bi3,
-                                      errorfile, list_of_Ks,
-                                      denomalf, s_i3, T, T_Alf, phi_3, frac, K_offset,
-                                      .5, .5)
+    t_row.error_terms = (
+        #--- Quad Fielderrors
+        ((bi1, bi2, bi2, -frac, s_i2, .5, .5), (bi1, bi3, bi3, frac, s_i3, .5, .5)),
+        #--- Sext Transverse Missalignments
+        ((bi1, bi2, bi2, frac, s_i2, -.5, .5), (bi1, bi3, bi3, -frac, s_i3, -.5, .5)),
+        #--- Quad Longitudinal Missalignments
+        ((bi1, bi2, bi2, -frac, s_i2, .5, .5), (bi1, bi3, bi3, frac, s_i3, .5, .5)),
+    )
     
     #--- BPM Missalignments
-    # jump to end of RANGE
-    for k in range(bi3, RANGE):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][2])
-          
-    errindx1 = errorfile.indx[bn1]
-    errindx2 = errorfile.indx[bn2]
-    errindx3 = errorfile.indx[bn3]
-      
-    if errorfile.dS[errindx1] != 0:
+    if errorfile.dS[errorfile.indx[bn1]] != 0:
         numerphi = -1.0 / (betmdl2 * sin(phmdl12) ** 2) + 1.0 / (betmdl3 * sin(phmdl13) ** 2)
-        T[K_offset + bi1] = numerphi / denom
+        t_row.bpm_errors[bi1] = numerphi / denom
           
-    if errorfile.dS[errindx2] != 0:
+    if errorfile.dS[errorfile.indx[bn2]] != 0:
         numerphi = 1.0 / (betmdl2 * sin(phmdl12) ** 2)
-        T[K_offset + bi2] = numerphi / denom
+        t_row.bpm_errors[bi2] = numerphi / denom
        
-    if errorfile.dS[errindx3] != 0:
+    if errorfile.dS[errorfile.indx[bn3]] != 0:
         numerphi = -1.0 / (betmdl3 * sin(phmdl13) ** 2)
-        T[K_offset + bi3] = numerphi / denom
+        t_row.bpm_errors[bi3] = numerphi / denom
          
     patternstr = ["x"] * RANGE
     patternstr[bi1] = "A"
     patternstr[bi2] = "B"
     patternstr[bi3] = "B"
  
-    return MeasuredValues(alf, bet, "".join(patternstr), True), T, T_Alf
+    return MeasuredValues(alf, bet, "".join(patternstr), True), t_row
 
 
-def _beta_from_phase_BPM_BAB_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, bi3, madTwiss, errorfile, phase, plane, list_of_Ks, matrixSize, RANGE):
+def _beta_from_phase_BPM_BAB_with_systematicerrors(bn1, bn2, bn3, bi1, bi2, bi3, madTwiss, errorfile, phase, plane, RANGE):
     '''
     Calculates the beta/alfa function and their errors using the
     phase advance between three BPMs for the case that the probed BPM is betweeb the other two BPMs (case BAB)
@@ -1994,8 +1922,6 @@ def _beta_from_phase_BPM_BAB_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
             measured phase advances
         'plane':string
             'H' or 'V'
-        'matrixSize':int
-            the size of the T-matrix
         'RANGE':int
             the range of BPMs
     :Return:tupel (bet,betstd,alf,alfstd)
@@ -2005,10 +1931,8 @@ def _beta_from_phase_BPM_BAB_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
             calculated error on beta function at probed BPM
         '0':float
             0
-        'T':numpy matrix
-            column of the T-matrix
-        'T_Alf':numpy matrix
-            column of the T-matrix for alfa
+        't_row':_TRow
+            non-zero entries of the row of the T-matrices for beta and alfa
         'patternstring':string
             [For Debugging] string which represents the combination used
             For example AxxBxB
@@ -2039,7 +1963,7 @@ def _beta_from_phase_BPM_BAB_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
         print >> sys.stderr, "Some of the off-momentum betas are negative, change the dpp unit"
         sys.exit(1)
     if bad_phase(phmdl21) or bad_phase(phmdl23) or bad_phase(phmdl23 - phmdl21) or bad_phase(ph2pi21) or bad_phase(ph2pi23) or bad_phase(ph2pi21 - ph2pi23):
-        return MeasuredValues(0, 0), [], []
+        return MeasuredValues(0, 0), None
     
     phmdl21 *= TWOPI
     phmdl23 *= TWOPI
@@ -2062,111 +1986,53 @@ def _beta_from_phase_BPM_BAB_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
       
     s_i1 = sin(phmdl21) ** 2
     s_i3 = sin(phmdl23) ** 2
-     
-    T = [0] * (matrixSize)
-    T_Alf = [0] * matrixSize
     
     #--- Phase Advance
     phi_err1 = (-1.0 / s_i1) / denom
     phi_err2 = (1.0 / s_i1 - 1.0 / s_i3) / denom
     phi_err3 = 1.0 / s_i3 / denom
     
-    T[bi1] = phi_err1
-    T[bi2] = phi_err2
-    T[bi3] = phi_err3
-    
-    T_Alf[bi1] = A_FACT * (1.0 / s_i1 + phi_err1 * denomalf)
-    T_Alf[bi2] = A_FACT * (-1.0 / s_i1 - 1.0 / s_i3 + phi_err2 * denomalf)
-    T_Alf[bi3] = A_FACT * (1.0 / s_i3 + phi_err3 * denomalf)
+    t_row = _TRow((bi1, bi2, bi3), (phi_err1, phi_err2, phi_err3),
+                  (A_FACT * (1.0 / s_i1 + phi_err1 * denomalf),
+                   A_FACT * (-1.0 / s_i1 - 1.0 / s_i3 + phi_err2 * denomalf),
+                   A_FACT * (1.0 / s_i3 + phi_err3 * denomalf)),
+                  denomalf)
         
-    phi_1 = madTwiss.MUX[I1] * TWOPI
-    phi_3 = madTwiss.MUX[I3] * TWOPI
-    
     frac = 1.0 / denom
     if plane == 'V':
         frac *= -1.0
-        phi_1 = madTwiss.MUY[I1] * TWOPI
-        phi_3 = madTwiss.MUY[I3] * TWOPI
-    # the first columns belong to the phase errors:
     
-    K_offset = RANGE
+    t_row.error_terms = (
+        #--- Quad Fielderrors
+        ((bi1, bi2, bi1, frac, s_i1, -.5, .5), (bi2, bi3, bi3, frac, s_i3, .5, .5)),
+        #--- Sext Transverse Missalignments
+        ((bi1, bi2, bi1, frac, s_i1, .5, .5), (bi2, bi3, bi3, frac, s_i3, -.5, .5)),
+        #--- Quad Longitudinal Missalignments
+        ((bi1, bi2, bi1, frac, s_i1, -.5, .5), (bi2, bi3, bi3, frac, s_i3, .5, .5)),
+    )
     
-    for k in range(bi1):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][0])
-        
-    #--- Quad Fielderrors
-    K_offset = _assign_quaderrors(I, bi1, bi2,
-                                  errorfile, list_of_Ks,
-                                  denomalf, s_i1, T, T_Alf, phi_1, frac,
-                                  K_offset,
-                                  -.5, .5)
-     
-    K_offset = _assign_quaderrors(I, bi2, bi3,
-                                  errorfile, list_of_Ks,
-                                  denomalf, s_i3, T, T_Alf, phi_3, frac,
-                                  K_offset,
-                                  .5, .5)
-     
-    #--- Sext Transverse Missalignments
-    for k in range(bi3, RANGE):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][0])
-    for k in range(bi1):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][1])
-        
-    K_offset = _assign_sext_errors(I, bi1, bi2,
-                                   errorfile, list_of_Ks,
-                                   denomalf, s_i1, T, T_Alf, phi_1, frac, K_offset,
-                                   .5, .5)
-                
-    K_offset = _assign_sext_errors(I, bi2, bi3,
-                                   errorfile, list_of_Ks,
-                                   denomalf, s_i3, T, T_Alf, phi_3, frac, K_offset,
-                                   -.5, .5)
-    #--- Quad Longitudinal Missalignments
-    for k in range(bi3, RANGE):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][1])
-    for k in range(bi1):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][2])
-
-    K_offset = _assign_quadlongmissal(I, bi1, bi2,
-                                      errorfile, list_of_Ks,
-                                      denomalf, s_i1, T, T_Alf, phi_1, frac, K_offset,
-                                      -.5, .5)
-    
-    K_offset = _assign_quadlongmissal(I, bi2, bi3,
-                                      errorfile, list_of_Ks,
-                                      denomalf, s_i3, T, T_Alf, phi_3, frac, K_offset,
-                                      .5, .5)
     #--- BPM Missalignments
-    # jump to end of RANGE
-    for k in range(bi3, RANGE):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][2])
-          
-    errindx1 = errorfile.indx[bn1]
-    errindx2 = errorfile.indx[bn2]
-    errindx3 = errorfile.indx[bn3]
-      
-    if errorfile.dS[errindx2] != 0:
+    if errorfile.dS[errorfile.indx[bn2]] != 0:
         numerphi = -1.0 / (betmdl1 * sin(phmdl21) ** 2) + 1.0 / (betmdl3 * sin(phmdl23) ** 2)
-        T[K_offset + bi2] = numerphi / denom
+        t_row.bpm_errors[bi2] = numerphi / denom
           
-    if errorfile.dS[errindx1] != 0:
+    if errorfile.dS[errorfile.indx[bn1]] != 0:
         numerphi = 1.0 / (betmdl1 * sin(phmdl21) ** 2)
-        T[K_offset + bi1] = numerphi / denom
+        t_row.bpm_errors[bi1] = numerphi / denom
        
-    if errorfile.dS[errindx3] != 0:
+    if errorfile.dS[errorfile.indx[bn3]] != 0:
         numerphi = -1.0 / (betmdl3 * sin(phmdl23) ** 2)
-        T[K_offset + bi3] = numerphi / denom
+        t_row.bpm_errors[bi3] = numerphi / denom
      
     patternstr = ["x"] * RANGE
     patternstr[bi1] = "B"
     patternstr[bi2] = "A"
     patternstr[bi3] = "B"
     
-    return MeasuredValues(alf, bet, "".join(patternstr), True), T, T_Alf
+    return MeasuredValues(alf, bet, "".join(patternstr), True), t_row
 
 
-def _beta_from_phase_BPM_BBA_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, bi3, madTwiss, errorfile, phase, plane, list_of_Ks, matrixSize, RANGE):
+def _beta_from_phase_BPM_BBA_with_systematicerrors(bn1, bn2, bn3, bi1, bi2, bi3, madTwiss, errorfile, phase, plane, RANGE):
     '''
         Calculates the beta/alfa function and their errors using the
     phase advance between three BPMs for the case that the probed BPM is right of the other two BPMs (case BBA)
@@ -2183,8 +2049,6 @@ def _beta_from_phase_BPM_BBA_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
             measured phase advances
         'plane':string
             'H' or 'V'
-        'matrixSize':int
-            the size of the T-matrix
         'RANGE':int
             the range of BPMs
     :Return:tupel (bet,betstd,alf,alfstd)
@@ -2194,10 +2058,8 @@ def _beta_from_phase_BPM_BBA_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
             calculated error on beta function at probed BPM
         '0':float
             0
-        'T':numpy matrix
-            column of the T-matrix
-        'T_Alf':numpy matrix
-            column of the T-matrix for alfa
+        't_row':_TRow
+            non-zero entries of the row of the T-matrices for beta and alfa
         'patternstring':string
             [For Debugging] string which represents the combination used
             For example AxxBxB
@@ -2229,7 +2091,7 @@ def _beta_from_phase_BPM_BBA_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
         print >> sys.stderr, "Some of the off-momentum betas are negative, change the dpp unit"
         sys.exit(1)
     if bad_phase(phmdl32) or bad_phase(phmdl31) or bad_phase(phmdl31 - phmdl32) or bad_phase(ph2pi31) or bad_phase(ph2pi32) or bad_phase(ph2pi31 - ph2pi32):
-        return MeasuredValues(0, 0), [], []
+        return MeasuredValues(0, 0), None
     
     phmdl31 *= TWOPI
     phmdl32 *= TWOPI
@@ -2252,212 +2114,115 @@ def _beta_from_phase_BPM_BBA_with_systematicerrors(I, bn1, bn2, bn3, bi1, bi2, b
     
     s_i2 = sin(phmdl32) ** 2
     s_i1 = sin(phmdl31) ** 2
-    
-    T = [0] * matrixSize
-    T_Alf = [0] * matrixSize
         
     #--- Phase Advance
     phi_err1 = 1.0 / s_i1 / denom
     phi_err2 = -1.0 / s_i2 / denom
     phi_err3 = -(1.0 / s_i1 - 1.0 / s_i2) / denom
-   
-    T[bi1] = phi_err1
-    T[bi2] = phi_err2
-    T[bi3] = phi_err3
     
-    T_Alf[bi1] = A_FACT * (1.0 / s_i1 + phi_err1 * denomalf)
-    T_Alf[bi2] = A_FACT * (1.0 / s_i2 + phi_err2 * denomalf)
-    T_Alf[bi3] = A_FACT * (-1.0 / s_i1 - 1.0 / s_i2 + phi_err3 * denomalf)
-                               
-    phi_2 = madTwiss.MUX[I2] * TWOPI
-    phi_1 = madTwiss.MUX[I1] * TWOPI
+    t_row = _TRow((bi1, bi2, bi3), (phi_err1, phi_err2, phi_err3),
+                  (A_FACT * (1.0 / s_i1 + phi_err1 * denomalf),
+                   A_FACT * (1.0 / s_i2 + phi_err2 * denomalf),
+                   A_FACT * (-1.0 / s_i1 - 1.0 / s_i2 + phi_err3 * denomalf)),
+                  denomalf)
     
     frac = 1.0 / denom
     if plane == 'V':
         frac *= -1.0
-        phi_2 = madTwiss.MUY[I2] * TWOPI
-        phi_1 = madTwiss.MUY[I1] * TWOPI
-           
-    # the first columns belong to the phase errors:
     
-    K_offset = RANGE
-        
-    #--- Quad Fielderrors
-    # then we jump to the first non-zero column in the K1 errors
-    for k in range(bi1):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][0])
-    K_begin = K_offset
-    #K_offset = RANGE
-    
-    # assign T matrix elements for phase errors between BPM 1 and 3
-    for k in range(bi1, bi3):
-        which_k = (k + I) % len(list_of_Ks)
-        for w in range(len(list_of_Ks[which_k][0])):
-            idx_k = list_of_Ks[which_k][0][w]
-            err_beta = -frac * errorfile.BET[idx_k] * (sin(errorfile.MU[idx_k] * TWOPI - phi_1) ** 2 / s_i1)
-            T[K_offset + w] += err_beta
-            T_Alf[K_offset + w] += -.5 * errorfile.BET[idx_k] * (sin(errorfile.MU[idx_k] * TWOPI - phi_1) ** 2 / s_i1)
-            T_Alf[K_offset + w] += .5 * err_beta * denomalf
-        K_offset += len(list_of_Ks[which_k][0])
-    
-    # go back because the second h_ij begins at 2
-    # so we have to find the position of BPM2 in the matrix
-    K_offset = K_begin
-    for k in range(bi1, bi2):
-        which_k = (k + I) % len(list_of_Ks)
-        K_offset += len(list_of_Ks[which_k][0])
-    # and assign the T matrix alements between BPM 1 and 3
-    for k in range(bi2, bi3):
-        which_k = (k + I) % len(list_of_Ks)
-        
-        for w in range(len(list_of_Ks[which_k][0])):
-            idx_k = list_of_Ks[which_k][0][w]
-            err_beta = frac * errorfile.BET[idx_k] * (sin(errorfile.MU[idx_k] * TWOPI - phi_2) ** 2 / s_i2)
-            T[K_offset + w] += err_beta
-            T_Alf[K_offset + w] += -.5 * errorfile.BET[idx_k] * (sin(errorfile.MU[idx_k] * TWOPI - phi_2) ** 2 / s_i2)
-            T_Alf[K_offset + w] += .5 * err_beta * denomalf
-        K_offset += len(list_of_Ks[which_k][0])
-    
-    #--- Sext Trasverse Missalignments
-    # jump to the end of RANGE then to b1
-    for k in range(bi3, RANGE):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][0])
-    for k in range(bi1):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][1])
-    K_begin = K_offset
-    
-    for k in range(bi1, bi3):
-        which_k = (k + I) % len(list_of_Ks)
-        for w in range(len(list_of_Ks[which_k][1])):
-            idx_k = list_of_Ks[which_k][1][w]
-            err_beta = SEXT_FACT * frac * errorfile.K2L[idx_k] * errorfile.BET[idx_k] * (sin(errorfile.MU[idx_k] * TWOPI - phi_1) ** 2 / s_i1)
-            T[K_offset + w] += err_beta
-            T_Alf[K_offset + w] += .5 * SEXT_FACT * errorfile.K2L[idx_k] * errorfile.BET[idx_k] * (sin(errorfile.MU[idx_k] * TWOPI - phi_1) ** 2 / s_i1)
-            T_Alf[K_offset + w] += .5 * err_beta * denomalf
-        K_offset += len(list_of_Ks[which_k][1])
-        
-    K_offset = K_begin
-    for k in range(bi1, bi2):
-        which_k = (k + I) % len(list_of_Ks)
-        K_offset += len(list_of_Ks[which_k][1])
-    # and assign the T matrix alements between BPM 1 and 3
-    for k in range(bi2, bi3):
-        which_k = (k + I) % len(list_of_Ks)
-        
-        for w in range(len(list_of_Ks[which_k][1])):
-            idx_k = list_of_Ks[which_k][1][w]
-            err_beta = -SEXT_FACT * frac * errorfile.K2L[idx_k] * errorfile.BET[idx_k] * (sin(errorfile.MU[idx_k] * TWOPI - phi_2) ** 2 / s_i2)
-            T[K_offset + w] += err_beta
-            T_Alf[K_offset + w] += .5 * SEXT_FACT * errorfile.K2L[idx_k] * errorfile.BET[idx_k] * (sin(errorfile.MU[idx_k] * TWOPI - phi_2) ** 2 / s_i2)
-            T_Alf[K_offset + w] += .5 * err_beta * denomalf
-        K_offset += len(list_of_Ks[which_k][1])
-    
-    #--- Quad Longitudinal Missalignments
-    # jump to the end of RANGE then to b1
-    for k in range(bi3, RANGE):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][1])
-    for k in range(bi1):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][2])
-    K_begin = K_offset
-      
-    for k in range(bi1, bi3):
-        which_k = (k + I) % len(list_of_Ks)
-        for w in range(len(list_of_Ks[which_k][2])):
-            idx_k = list_of_Ks[which_k][2][w]
-            err_beta = -frac * errorfile.K1LEND[idx_k] * errorfile.BETEND[idx_k] * (sin(errorfile.MUEND[idx_k] * TWOPI - phi_1) ** 2 / s_i1)
-            T[K_offset + w] += err_beta
-            T_Alf[K_offset + w] += -.5 * errorfile.K1LEND[idx_k] * errorfile.BETEND[idx_k] * (sin(errorfile.MUEND[idx_k] * TWOPI - phi_1) ** 2 / s_i1)
-            T_Alf[K_offset + w] += .5 * err_beta * denomalf
-        K_offset += len(list_of_Ks[which_k][2])
-        
-    K_offset = K_begin
-    for k in range(bi1, bi2):
-        which_k = (k + I) % len(list_of_Ks)
-        K_offset += len(list_of_Ks[which_k][2])
-    # and assign the T matrix alements between BPM 1 and 3
-    for k in range(bi2, bi3):
-        which_k = (k + I) % len(list_of_Ks)
-        
-        for w in range(len(list_of_Ks[which_k][2])):
-            idx_k = list_of_Ks[which_k][2][w]
-            err_beta = frac * errorfile.K1LEND[idx_k] * errorfile.BETEND[idx_k] * (sin(errorfile.MUEND[idx_k] * TWOPI - phi_2) ** 2 / s_i2)
-            T[K_offset + w] += err_beta
-            T_Alf[K_offset + w] += -.5 * errorfile.K1LEND[idx_k] * errorfile.BETEND[idx_k] * (sin(errorfile.MUEND[idx_k] * TWOPI - phi_2) ** 2 / s_i2)
-            T_Alf[K_offset + w] += .5 * err_beta * denomalf
-        K_offset += len(list_of_Ks[which_k][2])
+    # the first h_ij goes from BPM 1 to 3, the second one from BPM 2 to 3
+    t_row.error_terms = (
+        #--- Quad Fielderrors
+        ((bi1, bi3, bi1, -frac, s_i1, -.5, .5), (bi2, bi3, bi2, frac, s_i2, -.5, .5)),
+        #--- Sext Transverse Missalignments
+        ((bi1, bi3, bi1, -frac, s_i1, .5, .5), (bi2, bi3, bi2, frac, s_i2, .5, .5)),
+        #--- Quad Longitudinal Missalignments
+        ((bi1, bi3, bi1, -frac, s_i1, -.5, .5), (bi2, bi3, bi2, frac, s_i2, -.5, .5)),
+    )
         
     #--- BPM Missalignments
-    # jump to end of RANGE
-    for k in range(bi3, RANGE):
-        K_offset += len(list_of_Ks[(k + I) % len(list_of_Ks)][2])
-          
-    errindx1 = errorfile.indx[bn1]
-    errindx2 = errorfile.indx[bn2]
-    errindx3 = errorfile.indx[bn3]
-      
-    if errorfile.dS[errindx3] != 0:
+    if errorfile.dS[errorfile.indx[bn3]] != 0:
         numerphi = -1.0 / (betmdl2 * sin(phmdl32) ** 2) + 1.0 / (betmdl1 * sin(phmdl31) ** 2)
-        T[K_offset + bi3] = numerphi / denom
+        t_row.bpm_errors[bi3] = numerphi / denom
           
-    if errorfile.dS[errindx2] != 0:
+    if errorfile.dS[errorfile.indx[bn2]] != 0:
         numerphi = 1.0 / (betmdl2 * sin(phmdl32) ** 2)
-        T[K_offset + bi2] = numerphi / denom
+        t_row.bpm_errors[bi2] = numerphi / denom
        
-    if errorfile.dS[errindx1] != 0:
+    if errorfile.dS[errorfile.indx[bn1]] != 0:
         numerphi = -1.0 / (betmdl1 * sin(phmdl31) ** 2)
-        T[K_offset + bi1] = numerphi / denom
+        t_row.bpm_errors[bi1] = numerphi / denom
             
     patternstr = ["x"] * RANGE
     patternstr[bi1] = "B"
     patternstr[bi2] = "B"
     patternstr[bi3] = "A"
 
-    return MeasuredValues(alf, bet, "".join(patternstr), True), T, T_Alf
+    return MeasuredValues(alf, bet, "".join(patternstr), True), t_row
 
 
-def _assign_quaderrors(I, bi1, bi2, errorfile, list_of_Ks, denomalf, sinus_ij_squared, T_Bet, T_Alf, reference_phi, frac, K_offset, Alf_fact_1, Alf_fact_2):
-    for k in range(bi1, bi2):
-        whichK = (k + I) % len(list_of_Ks)
-        for w in range(len(list_of_Ks[whichK][0])):
-            idx_k = list_of_Ks[whichK][0][w]
-            err_beta = frac * errorfile.BET[idx_k] * (sin(errorfile.MU[idx_k] * TWOPI - reference_phi) ** 2 / sinus_ij_squared)
-            T_Bet[K_offset + w] += err_beta
-            T_Alf[K_offset + w] += Alf_fact_1 * errorfile.BET[idx_k] * (sin(errorfile.MU[idx_k] * TWOPI - reference_phi) ** 2 / sinus_ij_squared)
-            T_Alf[K_offset + w] += Alf_fact_2 * err_beta * denomalf
-        
-        K_offset += len(list_of_Ks[whichK][0])
+def _build_T_matrices(t_rows, bpm_name, madTwiss, errorfile, plane, list_of_Ks, CurrentIndex, matrixSize, RANGE):
+    '''
+    Builds the T-matrices for beta and alfa, with one row per combination in t_rows.
+    The columns are the same as in the variance matrix M: the phase errors of the RANGE BPMs, then for each kind of
+    error the error elements of the RANGE-1 segments between the BPMs and finally the BPM missalignments.
+    The entries of the error elements are computed for all the combinations at once.
+    '''
+    T_Beta = np.zeros((len(t_rows), matrixSize))
+    T_Alfa = np.zeros((len(t_rows), matrixSize))
+    if len(t_rows) == 0:
+        return T_Alfa, T_Beta
     
-    return K_offset
-
-
-def _assign_sext_errors(I, bi1, bi2, errorfile, list_of_Ks, denomalf, s_i1, T, T_Alf, phi_1, frac, K_offset, Alf_fact_1, Alf_fact_2):
-    for k in range(bi1, bi2):
-        whichK = (k + I) % len(list_of_Ks)
-        for w in range(len(list_of_Ks[whichK][1])):
-            idx_k = list_of_Ks[whichK][1][w]
-            err_beta = -SEXT_FACT * frac * errorfile.K2L[idx_k] * errorfile.BET[idx_k] * (sin(errorfile.MU[idx_k] * TWOPI - phi_1) ** 2 / s_i1)
-            T[K_offset + w] += err_beta
-            T_Alf[K_offset + w] += Alf_fact_1 * SEXT_FACT * errorfile.K2L[idx_k] * errorfile.BET[idx_k] * (sin(errorfile.MU[idx_k] * TWOPI - phi_1) ** 2 / s_i1)
-            T_Alf[K_offset + w] += Alf_fact_2 * err_beta * denomalf
-        
-        K_offset += len(list_of_Ks[whichK][1])
+    rows = np.arange(len(t_rows))[:, np.newaxis]
+    bpm_indices = np.array([t_row.bpm_indices for t_row in t_rows])
+    T_Beta[rows, bpm_indices] = [t_row.phase_errors for t_row in t_rows]
+    T_Alfa[rows, bpm_indices] = [t_row.phase_errors_alf for t_row in t_rows]
+    denomalf = np.array([t_row.denomalf for t_row in t_rows])[:, np.newaxis]
     
-    return K_offset
-
-
-def _assign_quadlongmissal(I, bi1, bi2, errorfile, list_of_Ks, denomalf, s_i1, T, T_Alf, phi_1, frac, K_offset, Alf_fact_1, Alf_fact_2):
-    for k in range(bi1, bi2):
-        whichK = (k + I) % len(list_of_Ks)
-        for w in range(len(list_of_Ks[whichK][2])):
-            idx_k = list_of_Ks[whichK][2][w]
-            err_beta = frac * errorfile.K1LEND[idx_k] * errorfile.BETEND[idx_k] * (sin(errorfile.MUEND[idx_k] * TWOPI - phi_1) ** 2 / s_i1)
-            T[K_offset + w] += err_beta
-            T_Alf[K_offset + w] += Alf_fact_1 * errorfile.K1LEND[idx_k] * errorfile.BETEND[idx_k] * (sin(errorfile.MUEND[idx_k] * TWOPI - phi_1) ** 2 / s_i1)
-            T_Alf[K_offset + w] += Alf_fact_2 * err_beta * denomalf
-        
-        K_offset += len(list_of_Ks[whichK][2])
+    if plane == 'H':
+        model_mu = madTwiss.MUX
+    elif plane == 'V':
+        model_mu = madTwiss.MUY
+    bpm_phi = np.array([model_mu[madTwiss.indx[name]] for name in bpm_name]) * TWOPI
     
-    return K_offset
+    K_offset = RANGE
+    for kind in range(3):
+        segments = [list_of_Ks[(CurrentIndex + k) % len(list_of_Ks)][kind] for k in range(RANGE)]
+        elements = np.concatenate(segments).astype(int)
+        element_segments = np.repeat(np.arange(RANGE), [len(segment) for segment in segments])
+        if kind == 0:  # quad field errors
+            alfa_factors = np.asarray(errorfile.BET)[elements]
+            beta_factors = alfa_factors
+            element_phi = np.asarray(errorfile.MU)[elements] * TWOPI
+        elif kind == 1:  # sext transversal missalignments
+            alfa_factors = SEXT_FACT * np.asarray(errorfile.K2L)[elements] * np.asarray(errorfile.BET)[elements]
+            beta_factors = -alfa_factors
+            element_phi = np.asarray(errorfile.MU)[elements] * TWOPI
+        else:  # quad longitudinal missalignments
+            alfa_factors = np.asarray(errorfile.K1LEND)[elements] * np.asarray(errorfile.BETEND)[elements]
+            beta_factors = alfa_factors
+            element_phi = np.asarray(errorfile.MUEND)[elements] * TWOPI
+        columns = slice(K_offset, K_offset + len(elements))
+        # sin(phase advance from BPM to element) ** 2, for every BPM of the RANGE
+        sin_squared = sin(element_phi - bpm_phi[:, np.newaxis]) ** 2
+        
+        for term in range(2):
+            first_bpm, last_bpm, reference_bpm, frac, s_ij, alf_fact_1, alf_fact_2 = [
+                np.array(values)[:, np.newaxis] for values in zip(*[t_row.error_terms[kind][term] for t_row in t_rows])
+            ]
+            in_term = (element_segments >= first_bpm) & (element_segments < last_bpm)
+            sin_ratio = sin_squared[reference_bpm[:, 0]] / s_ij
+            err_beta = np.where(in_term, frac * beta_factors * sin_ratio, 0.)
+            T_Beta[:, columns] += err_beta
+            T_Alfa[:, columns] += np.where(in_term, alf_fact_1 * alfa_factors * sin_ratio, 0.)
+            T_Alfa[:, columns] += alf_fact_2 * err_beta * denomalf
+        K_offset += len(elements)
+    
+    for row, t_row in enumerate(t_rows):
+        for bpm_index, value in t_row.bpm_errors.iteritems():
+            T_Beta[row, K_offset + bpm_index] = value
+    
+    return T_Alfa, T_Beta
 
 #===================================================================================================
 #--- ac-dipole stuff
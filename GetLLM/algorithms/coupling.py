@@ -31,6 +31,7 @@ import math
 import numpy as np
 
 import utils.bpm
+from utils.dict_tools import DotDict
 import phase
 import helper
 import compensate_ac_effect
@@ -228,8 +229,6 @@ def GetCoupling1(MADTwiss, list_zero_dpp_x, list_zero_dpp_y, tune_x, tune_y, out
     Global: fwqw = [CG,QG,CG_std]
     """
 
-    # Not applicable to db=-1 for the time being...
-
     ### Prepare BPM lists ###
 
     # Check linx/liny files, if it's OK it is confirmed that ListofZeroDPPX[i] and ListofZeroDPPY[i]
@@ -243,150 +242,89 @@ def GetCoupling1(MADTwiss, list_zero_dpp_x, list_zero_dpp_y, tune_x, tune_y, out
     XplusY = list_zero_dpp_x+list_zero_dpp_y
     dbpms = utils.bpm.intersect(XplusY)
     dbpms = utils.bpm.model_intersect(dbpms, MADTwiss)
+    Numbpms = len(dbpms)
+    names = [str.upper(bpm[1]) for bpm in dbpms]
+
+    ### Calculate fw and qw for all files (rows) and BPMs (columns) at once ###
+
+    x = _get_columns(list_zero_dpp_x, names, ["AMPX", "AMP01", "NOISE", "MUX", "PHASE01"])
+    y = _get_columns(list_zero_dpp_y, names, ["AMPY", "AMP10", "NOISE", "MUY", "PHASE10"])
+    # Give warning if main amplitude is 0
+    for name in np.array(names)[np.any((x.AMPX == 0.0) | (y.AMPY == 0.0), axis=0)]:
+        print('Main amplitude(s) is/are 0 for BPM', name)
+    # Get coupled amplitude ratios, noise average values estimate secondary lines not recognized by drive
+    C01ij = x.AMP01
+    C10ij = y.AMP10
+    avg_noise_x = _get_columns(list_zero_dpp_x, names, ["AVG_NOISE"])
+    avg_noise_y = _get_columns(list_zero_dpp_y, names, ["AVG_NOISE"])
+    if avg_noise_x is None or avg_noise_y is None:
+        if np.any(C01ij == 0.0) or np.any(C10ij == 0.0):
+            print "AVG_NOISE column not found, cannot estimate C matrix."
+    else:
+        C01ij = np.where(C01ij == 0.0, avg_noise_x.AVG_NOISE, C01ij)
+        C10ij = np.where(C10ij == 0.0, avg_noise_y.AVG_NOISE, C10ij)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Propagate noise standard deviation to coupled amplitude ratios
+        std_C01ij = x.NOISE / x.AMPX * np.sqrt(1 + C01ij ** 2)
+        # Calculate coupling parameter f and propagate error
+        fij = 0.5 * np.arctan(np.sqrt(C01ij * C10ij))
+        std_fij = 0.25 * np.sqrt(C01ij * C10ij * ((std_C01ij / (C01ij * (C01ij + C10ij))) ** 2 +
+                                                  (std_C01ij / (C01ij * (C01ij + C10ij))) ** 2))
+    # Calculate phases (in units of 2pi!)
+    q1j = (x.MUX - y.PHASE10 + 0.25) % 1.0
+    q2j = (x.PHASE01 - y.MUY - 0.25) % 1.0
+    # Sign change in both, real and imag part!
+    #  - Real part: Comply with MAD output 
+    #  - Imag part: Comply with 2-BPM method and new averaging formula 
+    q1j = (1.0 - q1j) % 1.0
+    q2j = (1.0 - q2j) % 1.0
+
+    # Determine average phases
+    q1 = np.average(q1j, axis=0)
+    q2 = np.average(q2j, axis=0)
+    # Check fractional tune difference: Average for |q1-q2|<0.25 or take q1 for |q1-q2|>0.75, badbpm else
+    qi = np.where(abs(q1 - q2) < 0.25, (q1 + q2) / 2.0, q1)
+    good = (abs(q1 - q2) < 0.25) | (abs(q1 - q2) > 0.75)
+    Badbpms = np.sum(~good)
+    for n, name in enumerate(np.array(names)[~good]):
+        print "Bad Phases in BPM no ", len(list_zero_dpp_x) - 1, " (", name, "). Total so far", n + 1
+
+    # Cancel out the results with std=0, which means that the noise is flat
+    weights = np.where(std_fij == 0, 0., 1 / np.where(std_fij == 0, 1., std_fij) ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Average coupling over all files, weighted with variance, and get std of weighted average
+        # If no results are left for a BPM, its coupling is nan
+        fi = np.sum(fij * weights, axis=0) / np.sum(weights, axis=0)
+        fistd = np.sqrt(1 / np.sum(weights, axis=0))
+    fi[np.sum(weights, axis=0) == 0] = np.nan
+    fistd[np.sum(weights, axis=0) == 0] = np.nan
+    # Average phase over all files
+    qistd = np.sqrt(np.average(q1j * q1j, axis=0) - q1 ** 2.0 + 2.2e-16)  # Not very exact...
+    # Calculate complex coupling with qi
+    fi = fi * (np.cos(2.0 * np.pi * qi) + 1j * np.sin(2.0 * np.pi * qi))
+    if beam_direction == -1:
+        fi = -fi.real + 1j * fi.imag
 
-
-    ### Calculate fw and qw, exclude bpms having wrong phases ###
-
-    # Initialize dictionary of BPMs with results
     fwqw = {}
-    # Initialize list of BPMs with correct phases
-    dbpmt = []
-    # Initialize counter of BPMs with bad phases
-    Badbpms = 0
-    # Count number of BPMs in intersection of model and measurement
-    Numbpms = len(dbpms)
-    # Loop through BPMs in dbpms
-    for i in range(Numbpms):
-        # Get BPM name
-        bn1 = str.upper(dbpms[i][1])
-        # Initialize list for f, its std and the tunes
-        fij = []
-        std_fij = []
-        q1j = []
-        q2j = []
-        # Reset bad/wrong phase indicator
-        badbpm = 0
-        # Loop through data files 
-        for j in range(len(list_zero_dpp_x)):
-            # Get twiss objects (metaclass)
-            tw_x = list_zero_dpp_x[j]
-            tw_y = list_zero_dpp_y[j]
-            # Get coupled amplitude ratios
-            C01ij = tw_x.AMP01[tw_x.indx[bn1]]
-            C10ij = tw_y.AMP10[tw_y.indx[bn1]]
-            # Get main amplitudes
-            ampx = tw_x.AMPX[tw_x.indx[bn1]]
-            ampy = tw_y.AMPY[tw_y.indx[bn1]]
-            # Give warning if main amplitude is 0
-            if ampx==0.0 or ampy==0.0: # 
-                print('Main amplitude(s) is/are 0 for BPM',bn1)
-            # Get noise average values to estimate secondary lines not recognized by drive
-            try:
-                if C01ij==0.0: 
-                    C01ij = tw_x.AVG_NOISE[tw_x.indx[bn1]]
-                if C10ij==0.0:
-                    C10ij = tw_y.AVG_NOISE[tw_y.indx[bn1]]
-            except AttributeError:
-                print "AVG_NOISE column not found, cannot estimate C matrix."
-            # Get noise standard deviation to estimate uncertainty of amplitudes
-            std_noise_x = tw_x.NOISE[tw_x.indx[bn1]] 
-            std_noise_y = tw_y.NOISE[tw_y.indx[bn1]]
-            # Propagate error to coupled amplitude ratios
-            std_C01ij = std_noise_x/ampx*math.sqrt(1+C01ij**2)
-            std_C10ij = std_noise_y/ampy*math.sqrt(1+C10ij**2)
-            # Calculate coupling parameter f and append to list of BPM
-            fij.append(0.5*math.atan(math.sqrt(C01ij*C10ij)))
-            # Propagate error to coupling parameter and append to list
-            std_fij.append(0.25*math.sqrt(C01ij*C10ij*((std_C01ij/(C01ij*(C01ij+C10ij)))**2+(std_C01ij/(C01ij*(C01ij+C10ij)))**2)))
-            # Calculate phases (in units of 2pi!) and append them to lists
-            q1j.append((tw_x.MUX[tw_x.indx[bn1]]-tw_y.PHASE10[tw_y.indx[bn1]]+0.25)%1.0)
-            q2j.append((tw_x.PHASE01[tw_x.indx[bn1]]-tw_y.MUY[tw_y.indx[bn1]]-0.25)%1.0)
-            # Sign change in both, real and imag part!
-            #  - Real part: Comply with MAD output 
-            #  - Imag part: Comply with 2-BPM method and new averaging formula 
-            # (To change real part only, use - instead of +)
-            # (To change imag part only, use - instead of + and 1.0 instead of 0.5)
-            q1j[j] = (1.0-q1j[j])%1.0
-            q2j[j] = (1.0-q2j[j])%1.0
-
-        # Cast phase lists as arrays for later calculations
-        q1j = np.array(q1j)
-        q2j = np.array(q2j)
-        # Determine average phases
-        q1 = np.average(q1j)
-        q2 = np.average(q2j)
-        # Check fractional tune difference: Average for |q1-q2|<0.25 or take q1 for |q1-q2|>0.75, badbpm else
-        if abs(q1-q2)<0.25:
-            qi = (q1+q2)/2.0
-        elif abs(q1-q2)>0.75: # OK, for example q1=0.05, q2=0.95 due to measurement error
-            qi = q1 # Note that q1 and q2 are confined 0. to 1.
-        else:
-            badbpm = 1
-            print "Bad Phases in BPM no ",j, " (", bn1, "). Total so far", Badbpms+1
-
-        # If BPM tunes are OK
-        if badbpm == 0:
-            # Cast parameter lists to np.arrays for calculations
-            fij = np.array(fij)
-            std_fij = np.array(std_fij)
-            # Cancel out the results with std=0, which means that the noise is flat
-            for k, val in enumerate(std_fij):
-                if val==0:
-                    std_fij = np.delete(std_fij,k)
-            # If no results are left for this BPM, set coupling to nan
-            if not std_fij:  # TODO: Check this, python complained that you cannot stablish the true of a vector (std_fij)
-                fi = float("nan") # To be discussed
-                fistd = float("nan") # To be discussed
-            # Average coupling over all files, weighted with variance, and get std of weighted average
-            else:
-                fi = np.average(fij, weights=1/std_fij**2)
-                fistd = np.sqrt(1/sum(1/std_fij**2))
-            # Average phase over all files
-            qistd = math.sqrt(np.average(q1j*q1j)-q1**2.0+2.2e-16) # Not very exact...
-            # Calculate complex coupling with qi
-            fi = fi*complex(np.cos(2.0*np.pi*qi), np.sin(2.0*np.pi*qi))
-            if beam_direction==1:
-                fi = complex(fi.real, fi.imag)
-                if beam_direction==-1:
-                    fi = complex(-fi.real, fi.imag)
-                # Append BPM to list of BPMs with correct phase
-                dbpmt.append([dbpms[i][0],dbpms[i][1]])
-                # Trailing 0s provide compatibility with 2-BPM method
-                fwqw[bn1] = [[fi,fistd,0,0],[qi,qistd,0,0]]
-        # Count badbpms
-        Badbpms += badbpm
+    for i in np.flatnonzero(good):
+        # Trailing 0s provide compatibility with 2-BPM method
+        fwqw[names[i]] = [[fi[i], fistd[i], 0, 0], [qi[i], qistd[i], 0, 0]]
     # Only use BPMs with correct phase
-    dbpms = dbpmt
-
-    # Compute global coupling and phase
-    # Initialize global coupling parameter f
-    f = 0.0
-    # Initialize denominator for variance-weighted average 
-    denom = 0.0
-    # Initialize global phase
-    QG = 0.0
-    # Initialize counter of bad results in coupling
-    nancounter = 0
-
-    # Loop through BPMs with correct phase
-    for i in range(0,len(dbpms)):
-        # Get BPM name
-        bn1 = str.upper(dbpms[i][1])
-        # Count nan cases
-        if np.isnan(fwqw[bn1][0][0]):
-            nancounter += 1
-        # Add up f, the denominator for weighted average and the squares for the RMS, using the phases mux and muy 
-        # (new average adapted from 2-BPM method)
-        else:
-            mux = MADTwiss.MUX[MADTwiss.indx[bn1]]
-            muy = MADTwiss.MUY[MADTwiss.indx[bn1]]
-            f += (fwqw[bn1][0][0]*np.exp(complex(0,1)*2*np.pi*(mux-muy)))/fwqw[bn1][0][1]**2
-            denom += 1/fwqw[bn1][0][1]**2
-        # Add up phase 
-        tw_x = list_zero_dpp_x[j]
-        tw_y = list_zero_dpp_y[j]
-        QG += fwqw[bn1][1][0]-(tw_x.MUX[tw_x.indx[bn1]]-tw_y.MUY[tw_y.indx[bn1]])
-        
+    dbpms = [[dbpms[i][0], dbpms[i][1]] for i in np.flatnonzero(good)]
+
+    # Compute global coupling and phase, with the variance-weighted average of f
+    # using the phases mux and muy (new average adapted from 2-BPM method)
+    good_names = [names[i] for i in np.flatnonzero(good)]
+    valid = ~np.isnan(fi[good])
+    nancounter = np.sum(~valid)
+    model_indices = [MADTwiss.indx[name] for name in good_names]
+    mux = np.asarray(MADTwiss.MUX)[model_indices]
+    muy = np.asarray(MADTwiss.MUY)[model_indices]
+    f = np.sum((fi[good] * np.exp(complex(0, 1) * 2 * np.pi * (mux - muy)) / fistd[good] ** 2)[valid])
+    denom = np.sum(1 / fistd[good][valid] ** 2)
+    # Phase with the measured phases of the last file
+    QG = np.sum(qi[good] - (x.MUX[-1] - y.MUY[-1])[good])
+
     # Find operation point
     sign_QxmQy = _find_sign_QxmQy(outputpath, tune_x, tune_y)
     # Calculate C- from f with weighted average
@@ -435,220 +373,148 @@ def GetCoupling2(MADTwiss, list_zero_dpp_x, list_zero_dpp_y, tune_x, tune_y, pha
     XplusY = list_zero_dpp_x + list_zero_dpp_y
     dbpms = utils.bpm.intersect(XplusY)
     dbpms = utils.bpm.model_intersect(dbpms, MADTwiss)
+    names = [str.upper(bpm[1]) for bpm in dbpms]
 
-    ### Calculate fw and qw, exclude BPMs having wrong phases ###
+    ### Calculate fw and qw for all files (rows) and BPM-pairs (columns), exclude BPMs having wrong phases ###
 
-    # Initialize dictionary of BPMs with results
-    fwqw = {}
-    # Initialize dictionary of BPMs with results for old method
-    f_old_out = {}
-    # Initialize list of BPMs with correct phases
-    dbpmt = []
     # Count number of BPM-pairs in intersection of model and measurement
     Numbpmpairs = len(dbpms) - 1
-    # Loop through BPM-pairs
-    for i in range(Numbpmpairs):
-        # Get BPM names
-        bn1 = str.upper(dbpms[i][1])
-        bn2 = str.upper(dbpms[i + 1][1])
-        delx = phasex[bn1][0] - 0.25  # Missprint in the coupling note
-        dely = phasey[bn1][0] - 0.25
-
-        # Initialize result-lists (coupling, error on coupling and phases)
-        f1001ij = []
-        f1010ij = []
-        std_f1001ij = []
-        std_f1010ij = []
-        q1js = []
-        q2js = []
-        q1jd = []
-        q2jd = []
-        # Initialize as not bad BPM
-        badbpm = 0
-        # Loop through files to analyze
-        for j in range(0, len(list_zero_dpp_x)):
-            # Get twiss instance for current BPM and file
-            tw_x = list_zero_dpp_x[j]
-            tw_y = list_zero_dpp_y[j]
-            # Get main amplitude
-            [ampx_1, ampy_1] = [tw_x.AMPX[tw_x.indx[bn1]], tw_y.AMPY[tw_y.indx[bn1]]]
-            [ampx_2, ampy_2] = [tw_x.AMPX[tw_x.indx[bn2]], tw_y.AMPY[tw_y.indx[bn2]]]
-            # Exclude BPM if no main line was found
-            if ampx_1 == 0 or ampy_1 == 0 or ampx_2 == 0 or ampy_2 == 0:
-                badbpm = 1
-                ampx_1 = 1  # Dummy value, badbpm variable makes sure the BPM is ignored
-                ampy_1 = 1  # Dummy value, badbpm variable makes sure the BPM is ignored
-                ampx_2 = 1  # Dummy value, badbpm variable makes sure the BPM is ignored
-                ampy_2 = 1  # Dummy value, badbpm variable makes sure the BPM is ignored
-            # Get coupled amplitude ratios
-            [amp01_1, amp10_1] = [tw_x.AMP01[tw_x.indx[bn1]], tw_y.AMP10[tw_y.indx[bn1]]]
-            [amp01_2, amp10_2] = [tw_x.AMP01[tw_x.indx[bn2]], tw_y.AMP10[tw_y.indx[bn2]]]
-            # Replace secondary lines with amplitude infinity or 0 by noise average
-            try:
-                if amp01_1 == float("inf") or amp01_1 == 0:
-                    amp01_1 = tw_x.AVG_NOISE[tw_x.indx[bn1]] / ampx_1
-                if amp10_1 == float("inf") or amp10_1 == 0:
-                    amp10_1 = tw_y.AVG_NOISE[tw_y.indx[bn1]] / ampy_1
-                if amp01_2 == float("inf") or amp01_2 == 0:
-                    amp01_2 = tw_x.AVG_NOISE[tw_x.indx[bn1]] / ampx_2
-                if amp10_2 == float("inf") or amp10_2 == 0:
-                    amp10_2 = tw_y.AVG_NOISE[tw_y.indx[bn1]] / ampy_2
-            except AttributeError:
-                print "AVG_NOISE column not found, cannot use noise floor."
-
-            # Call routine in helper.py to get secondary lines for 2-BPM method
-            [SA0p1ij,phi0p1ij] = helper.ComplexSecondaryLine(delx, amp01_1, amp01_2,
-                    tw_x.PHASE01[tw_x.indx[bn1]], tw_x.PHASE01[tw_x.indx[bn2]])
-            [SA0m1ij,phi0m1ij] = helper.ComplexSecondaryLine(delx, amp01_1, amp01_2,
-                    -tw_x.PHASE01[tw_x.indx[bn1]], -tw_x.PHASE01[tw_x.indx[bn2]])
-            [TBp10ij,phip10ij] = helper.ComplexSecondaryLine(dely, amp10_1, amp10_2,
-                    tw_y.PHASE10[tw_y.indx[bn1]], tw_y.PHASE10[tw_y.indx[bn2]])
-            [TBm10ij,phim10ij] = helper.ComplexSecondaryLine(dely, amp10_1, amp10_2,
-                    -tw_y.PHASE10[tw_y.indx[bn1]], -tw_y.PHASE10[tw_y.indx[bn2]])
-
-            # Get noise standard deviation and propagate to coupled amplitude ratio
-            std_amp01_1 = tw_x.NOISE[tw_x.indx[bn1]]/ampx_1*math.sqrt(1+amp01_1**2)
-            std_amp10_1 = tw_y.NOISE[tw_y.indx[bn1]]/ampy_1*math.sqrt(1+amp10_1**2)
-            std_amp01_2 = tw_x.NOISE[tw_x.indx[bn2]]/ampx_2*math.sqrt(1+amp01_2**2)
-            std_amp10_2 = tw_y.NOISE[tw_y.indx[bn2]]/ampy_2*math.sqrt(1+amp10_2**2)
-            # Propagate to 2-BPM coupled amplitude ratio using a separate routine in helper.py
-            std_SA0p1ij = helper.ComplexSecondaryLineSTD(delx, amp01_1, amp01_2,
-                    tw_x.PHASE01[tw_x.indx[bn1]], tw_x.PHASE01[tw_x.indx[bn2]], std_amp01_1, std_amp01_2)
-            std_SA0m1ij = helper.ComplexSecondaryLineSTD(delx, amp01_1, amp01_2,
-                    -tw_x.PHASE01[tw_x.indx[bn1]], -tw_x.PHASE01[tw_x.indx[bn2]], std_amp01_1, std_amp01_2)
-            std_TBp10ij = helper.ComplexSecondaryLineSTD(dely, amp10_1, amp10_2,
-                    tw_y.PHASE10[tw_y.indx[bn1]], tw_y.PHASE10[tw_y.indx[bn2]], std_amp10_1, std_amp10_2)
-            std_TBm10ij = helper.ComplexSecondaryLineSTD(dely, amp10_1, amp10_2,
-                    -tw_y.PHASE10[tw_y.indx[bn1]], -tw_y.PHASE10[tw_y.indx[bn2]], std_amp10_1, std_amp10_2)
-
-            # Append results for the coupling parameters
-            f1001ij.append(0.5*math.sqrt(TBp10ij*SA0p1ij/2.0/2.0)) # division by 2 for each ratio as the scale of the #
-            f1010ij.append(0.5*math.sqrt(TBm10ij*SA0m1ij/2.0/2.0)) # main lines is 2 (also see appendix of the note)  #
-            # Propagate error to f1001 and f1010 if possible (no division by 0)
-            if TBp10ij==0 or SA0p1ij==0:
-                std_f1001ij.append(float("nan"))
-            else:
-                std_f1001ij.append(0.25*math.sqrt(4.0/TBp10ij/SA0p1ij)*math.sqrt((std_TBp10ij*SA0p1ij/4)**2+(TBp10ij*std_SA0p1ij/4)**2))
-            if TBm10ij==0 or SA0m1ij==0:
-                std_f1010ij.append(float("nan"))
-            else:
-                std_f1010ij.append(0.25*math.sqrt(4.0/TBm10ij/SA0m1ij)*math.sqrt((std_TBm10ij*SA0m1ij/4)**2+(TBm10ij*std_SA0m1ij/4)**2))
-
-            if beam_direction == 1:
-                q1jd.append((phi0p1ij-tw_y.MUY[tw_y.indx[bn1]]+0.25)%1.0) # note that phases are in units of 2pi
-                q2jd.append((-phip10ij+tw_x.MUX[tw_x.indx[bn1]]-0.25)%1.0)
-            elif beam_direction == -1:
-                q1jd.append((phi0p1ij-tw_y.MUY[tw_y.indx[bn1]]+0.25)%1.0) # note that phases are in units of 2pi
-                q2jd.append(-(-phip10ij+tw_x.MUX[tw_x.indx[bn1]]-0.25)%1.0)
-
-            # This sign change in the real part is to comply with MAD output
-            q1jd[j] = (0.5-q1jd[j])%1.0 
-            q2jd[j] = (0.5-q2jd[j])%1.0
-
-            if beam_direction==1:
-                q1js.append((phi0m1ij+tw_y.MUY[tw_y.indx[bn1]]+0.25)%1.0) # note that phases are in units of 2pi
-                q2js.append((phim10ij+tw_x.MUX[tw_x.indx[bn1]]+0.25)%1.0)
-            if beam_direction==-1:
-                q1js.append((phi0m1ij+tw_y.MUY[tw_y.indx[bn1]]+0.25)%1.0) # note that phases are in units of 2pi
-                q2js.append(-(phim10ij+tw_x.MUX[tw_x.indx[bn1]]+0.25)%1.0)
-            # This sign change in the real part is to comply with MAD output
-            q1js[j] = (0.5-q1js[j])%1.0
-            q2js[j] = (0.5-q2js[j])%1.0
-
-        q1jd = np.array(q1jd)
-        q2jd = np.array(q2jd)
-        q1d = phase.calc_phase_mean(q1jd,1.0)
-        q2d = phase.calc_phase_mean(q2jd,1.0)
-
-        q1js = np.array(q1js)
-        q2js = np.array(q2js)
-        q1s = phase.calc_phase_mean(q1js,1.0)
-        q2s = phase.calc_phase_mean(q2js,1.0)
-
-        if DEBUG:
-            print("\n")
-            print("i=",i," j=", j," ",bn1," <--> ",bn2)
-            print("      q1s=",q1s," q2s=",q2s," q1d=",q1d," q2d=",q2d)
-
-        # Take SPS and RHIC out of the badbpm procedure (badbpm stays 0 as initialized) and set phases 
-        if (accel == "SPS" or accel == "RHIC"):
-            print("accel is ", accel, " disabling wrong phase check")
-            
-            q1010i = q1d
-            q1010i = q1s
-
-        # Check phase and set badbpm for wrong phase (only for other accels than SPS and RHIC)
-        else:
-            if min(abs(q1d-q2d),1.0-abs(q1d-q2d))>0.25:
-                if DEBUG:
-                    print("Bad BPM because min(abs(q1d-q2d),1.0-abs(q1d-q2d))>0.25")
-                badbpm = 1
-            if min(abs(q1s-q2s),1.0-abs(q1s-q2s))>0.25:
-                if DEBUG:
-                    print("Bad BPM because min(abs(q1s-q2s),1.0-abs(q1s-q2s))>0.25")
-                    print(" i j ",i, j," q1s, q2s",q1s,q2s) 
-                badbpm = 1
-           
-
-        # If accel is SPS or RHIC or no no wrong phase was detected, process results
-        if badbpm==0:
-            # Cast coupling parameters and errors as np.arrays for later calculations
-            f1001ij = np.array(f1001ij)
-            f1010ij = np.array(f1010ij)
-            std_f1001ij = np.array(std_f1001ij)
-            std_f1010ij = np.array(std_f1010ij)
-
-            # Old cminus method: averaging abs values
-            if beam_direction==1:
-                f_old_out[bn1] = np.average(abs(f1001ij), weights=1/std_f1001ij**2)
-            elif beam_direction==-1:
-                f_old_out[bn1] = np.average(abs(f1010ij), weights=1/std_f1010ij**2)
-
-            # Use variance-weighted average to determine f and its std
-            f1001i = np.average(f1001ij, weights=1/std_f1001ij**2)
-            f1010i = np.average(f1010ij, weights=1/std_f1010ij**2)
-            # Set std of f1001 and f1010 by calculating the std of the weighted average
-            f1001istd = np.sqrt(1/sum(1/std_f1001ij**2))
-            f1010istd = np.sqrt(1/sum(1/std_f1010ij**2))
-
-            # Use routines in phase.py to get mean and std of the phase terms q1001 and q1010
-            q1001i = phase.calc_phase_mean(np.array([q1d,q2d]),1.0)
-            q1010i = phase.calc_phase_mean(np.array([q1s,q2s]),1.0)
-            q1001istd = phase.calc_phase_std(np.append(q1jd,q2jd),1.0)
-            q1010istd = phase.calc_phase_std(np.append(q1js,q2js),1.0)
-            # Calculate complex coupling terms using phases from above
-            f1001i = f1001i*complex(np.cos(2.0*np.pi*q1001i),np.sin(2.0*np.pi*q1001i))
-            f1010i = f1010i*complex(np.cos(2.0*np.pi*q1010i),np.sin(2.0*np.pi*q1010i))
-            # Add BPM to list of BPMs with correct phase
-            dbpmt.append([dbpms[i][0],dbpms[i][1]])
-
-            # Save results to BPM-results dictionary, sorted depending on beam_direction
-            if beam_direction==1:
-                fwqw[bn1] = [[f1001i,f1001istd,f1010i,f1010istd],[q1001i,q1001istd,q1010i,q1010istd]]
-            elif beam_direction==-1:
-                fwqw[bn1] = [[f1010i,f1010istd,f1001i,f1001istd],[q1010i,q1010istd,q1001i,q1001istd]]
-
-    # Count number of skipped BPMs because of wrong phase
-    Badbpms = len(dbpms)-len(dbpmt)
+    x = _get_columns(list_zero_dpp_x, names, ["AMPX", "AMP01", "NOISE", "MUX", "PHASE01"])
+    y = _get_columns(list_zero_dpp_y, names, ["AMPY", "AMP10", "NOISE", "MUY", "PHASE10"])
+    first, second = slice(0, Numbpmpairs), slice(1, Numbpmpairs + 1)
+    delx = np.array([phasex[name][0] for name in names[first]]) - 0.25  # Missprint in the coupling note
+    dely = np.array([phasey[name][0] for name in names[first]]) - 0.25
+
+    # Exclude BPM if no main line was found, its amplitudes are dummy values
+    no_main_line = ((x.AMPX[:, first] == 0) | (y.AMPY[:, first] == 0) |
+                    (x.AMPX[:, second] == 0) | (y.AMPY[:, second] == 0))
+    ampx_1 = np.where(no_main_line, 1., x.AMPX[:, first])
+    ampy_1 = np.where(no_main_line, 1., y.AMPY[:, first])
+    ampx_2 = np.where(no_main_line, 1., x.AMPX[:, second])
+    ampy_2 = np.where(no_main_line, 1., y.AMPY[:, second])
+    # Get coupled amplitude ratios
+    amp01_1, amp10_1 = x.AMP01[:, first], y.AMP10[:, first]
+    amp01_2, amp10_2 = x.AMP01[:, second], y.AMP10[:, second]
+    # Replace secondary lines with amplitude infinity or 0 by noise average (of the first BPM)
+    avg_noise_x = _get_columns(list_zero_dpp_x, names, ["AVG_NOISE"])
+    avg_noise_y = _get_columns(list_zero_dpp_y, names, ["AVG_NOISE"])
+    if avg_noise_x is None or avg_noise_y is None:
+        if any(np.any((amp == float("inf")) | (amp == 0)) for amp in (amp01_1, amp10_1, amp01_2, amp10_2)):
+            print "AVG_NOISE column not found, cannot use noise floor."
+    else:
+        amp01_1 = np.where((amp01_1 == float("inf")) | (amp01_1 == 0), avg_noise_x.AVG_NOISE[:, first] / ampx_1, amp01_1)
+        amp10_1 = np.where((amp10_1 == float("inf")) | (amp10_1 == 0), avg_noise_y.AVG_NOISE[:, first] / ampy_1, amp10_1)
+        amp01_2 = np.where((amp01_2 == float("inf")) | (amp01_2 == 0), avg_noise_x.AVG_NOISE[:, first] / ampx_2, amp01_2)
+        amp10_2 = np.where((amp10_2 == float("inf")) | (amp10_2 == 0), avg_noise_y.AVG_NOISE[:, first] / ampy_2, amp10_2)
+
+    # Secondary lines for 2-BPM method
+    phase01_1, phase01_2 = x.PHASE01[:, first], x.PHASE01[:, second]
+    phase10_1, phase10_2 = y.PHASE10[:, first], y.PHASE10[:, second]
+    SA0p1ij, phi0p1ij = _complex_secondary_line(delx, amp01_1, amp01_2, phase01_1, phase01_2)
+    SA0m1ij, phi0m1ij = _complex_secondary_line(delx, amp01_1, amp01_2, -phase01_1, -phase01_2)
+    TBp10ij, phip10ij = _complex_secondary_line(dely, amp10_1, amp10_2, phase10_1, phase10_2)
+    TBm10ij, phim10ij = _complex_secondary_line(dely, amp10_1, amp10_2, -phase10_1, -phase10_2)
+
+    # Get noise standard deviation and propagate to coupled amplitude ratio
+    std_amp01_1 = x.NOISE[:, first] / ampx_1 * np.sqrt(1 + amp01_1 ** 2)
+    std_amp10_1 = y.NOISE[:, first] / ampy_1 * np.sqrt(1 + amp10_1 ** 2)
+    std_amp01_2 = x.NOISE[:, second] / ampx_2 * np.sqrt(1 + amp01_2 ** 2)
+    std_amp10_2 = y.NOISE[:, second] / ampy_2 * np.sqrt(1 + amp10_2 ** 2)
+    # Propagate to 2-BPM coupled amplitude ratio
+    std_SA0p1ij = _complex_secondary_line_std(delx, amp01_1, amp01_2, phase01_1, phase01_2, std_amp01_1, std_amp01_2)
+    std_SA0m1ij = _complex_secondary_line_std(delx, amp01_1, amp01_2, -phase01_1, -phase01_2, std_amp01_1, std_amp01_2)
+    std_TBp10ij = _complex_secondary_line_std(dely, amp10_1, amp10_2, phase10_1, phase10_2, std_amp10_1, std_amp10_2)
+    std_TBm10ij = _complex_secondary_line_std(dely, amp10_1, amp10_2, -phase10_1, -phase10_2, std_amp10_1, std_amp10_2)
+
+    # Coupling parameters, division by 2 for each ratio as the scale of the
+    # main lines is 2 (also see appendix of the note)
+    f1001ij = 0.5 * np.sqrt(TBp10ij * SA0p1ij / 2.0 / 2.0)
+    f1010ij = 0.5 * np.sqrt(TBm10ij * SA0m1ij / 2.0 / 2.0)
+    # Propagate error to f1001 and f1010 if possible (no division by 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std_f1001ij = np.where((TBp10ij == 0) | (SA0p1ij == 0), np.nan,
+                               0.25 * np.sqrt(4.0 / TBp10ij / SA0p1ij) *
+                               np.sqrt((std_TBp10ij * SA0p1ij / 4) ** 2 + (TBp10ij * std_SA0p1ij / 4) ** 2))
+        std_f1010ij = np.where((TBm10ij == 0) | (SA0m1ij == 0), np.nan,
+                               0.25 * np.sqrt(4.0 / TBm10ij / SA0m1ij) *
+                               np.sqrt((std_TBm10ij * SA0m1ij / 4) ** 2 + (TBm10ij * std_SA0m1ij / 4) ** 2))
+
+    # Phases in units of 2pi, the sign change in the real part is to comply with MAD output
+    muy_1, mux_1 = y.MUY[:, first], x.MUX[:, first]
+    q1jd = (0.5 - (phi0p1ij - muy_1 + 0.25) % 1.0) % 1.0
+    q1js = (0.5 - (phi0m1ij + muy_1 + 0.25) % 1.0) % 1.0
+    if beam_direction == -1:
+        q2jd = (0.5 - (-(-phip10ij + mux_1 - 0.25)) % 1.0) % 1.0
+        q2js = (0.5 - (-(phim10ij + mux_1 + 0.25)) % 1.0) % 1.0
+    else:
+        q2jd = (0.5 - (-phip10ij + mux_1 - 0.25) % 1.0) % 1.0
+        q2js = (0.5 - (phim10ij + mux_1 + 0.25) % 1.0) % 1.0
+
+    # Phase averages over the files (last axis)
+    q1jd, q2jd, q1js, q2js = q1jd.T, q2jd.T, q1js.T, q2js.T
+    q1d = phase.calc_phase_mean(q1jd, 1.0)
+    q2d = phase.calc_phase_mean(q2jd, 1.0)
+    q1s = phase.calc_phase_mean(q1js, 1.0)
+    q2s = phase.calc_phase_mean(q2js, 1.0)
+
+    good = ~np.any(no_main_line, axis=0)
+    # Take SPS and RHIC out of the wrong phase check
+    if accel == "SPS" or accel == "RHIC":
+        print("accel is ", accel, " disabling wrong phase check")
+    else:
+        good &= np.minimum(abs(q1d - q2d), 1.0 - abs(q1d - q2d)) <= 0.25
+        good &= np.minimum(abs(q1s - q2s), 1.0 - abs(q1s - q2s)) <= 0.25
+    if DEBUG:
+        for i in np.flatnonzero(~good):
+            print("Bad BPM ", names[i], " <--> ", names[i + 1], " q1s=", q1s[i], " q2s=", q2s[i], " q1d=", q1d[i], " q2d=", q2d[i])
+
+    # Use variance-weighted average over the files to determine f and its std
+    weights1001 = 1 / std_f1001ij ** 2
+    weights1010 = 1 / std_f1010ij ** 2
+    f1001i = _weighted_average(f1001ij, weights1001)
+    f1010i = _weighted_average(f1010ij, weights1010)
+    f1001istd = np.sqrt(1 / np.sum(weights1001, axis=0))
+    f1010istd = np.sqrt(1 / np.sum(weights1010, axis=0))
+    # Old cminus method: averaging abs values
+    if beam_direction == -1:
+        f_old_out = _weighted_average(abs(f1010ij), weights1010)
+    else:
+        f_old_out = _weighted_average(abs(f1001ij), weights1001)
+
+    # Mean and std of the phase terms q1001 and q1010
+    q1001i = phase.calc_phase_mean(np.stack([q1d, q2d], axis=-1), 1.0)
+    q1010i = phase.calc_phase_mean(np.stack([q1s, q2s], axis=-1), 1.0)
+    q1001istd = phase.calc_phase_std(np.concatenate([q1jd, q2jd], axis=-1), 1.0)
+    q1010istd = phase.calc_phase_std(np.concatenate([q1js, q2js], axis=-1), 1.0)
+    # Calculate complex coupling terms using phases from above
+    f1001i = f1001i * (np.cos(2.0 * np.pi * q1001i) + 1j * np.sin(2.0 * np.pi * q1001i))
+    f1010i = f1010i * (np.cos(2.0 * np.pi * q1010i) + 1j * np.sin(2.0 * np.pi * q1010i))
+
+    # Save results to BPM-results dictionary, sorted depending on beam_direction
+    if beam_direction == -1:
+        results = ((f1010i, f1010istd, f1001i, f1001istd), (q1010i, q1010istd, q1001i, q1001istd))
+    else:
+        results = ((f1001i, f1001istd, f1010i, f1010istd), (q1001i, q1001istd, q1010i, q1010istd))
+    fwqw = {}
+    for i in np.flatnonzero(good):
+        fwqw[names[i]] = [[column[i] for column in results[0]], [column[i] for column in results[1]]]
+
+    # Count number of skipped BPMs because of wrong phase (the last BPM starts no pair)
+    good_indices = np.flatnonzero(good)
+    Badbpms = len(dbpms) - len(good_indices)
     # Rename list of BPMs with correct phase
-    dbpms = dbpmt
-
-    # Compute global values for coupling, error and phase
-    # Initialize coupling term f
-    f_new = complex(0,0)
-    # Initialize denominator for weighted averaging
-    denom = 0
-    # Loop through BPMs with correct phase
-    
-    for i in range(0,len(dbpms)-1):
-        # Get BPM-names
-        bn1 = str.upper(dbpms[i][1])
-        bn2 = str.upper(dbpms[i+1][1])
-        mux = MADTwiss.MUX[MADTwiss.indx[bn1]]
-        muy = MADTwiss.MUY[MADTwiss.indx[bn2]]
-        f_new += fwqw[bn2][0][0]*np.exp(complex(0,1)*2*np.pi*(mux-muy))/fwqw[bn2][0][1]**2 # Variance-weighted average for BPMs
-        denom += 1/fwqw[bn2][0][1]**2 # denominator for weighted average
-    
+    dbpms = [[dbpms[i][0], dbpms[i][1]] for i in good_indices]
+
+    # Compute global values for coupling, error and phase with the variance-weighted average over
+    # the BPMs, from the model phase of each BPM and the next one
+    model_indices = [MADTwiss.indx[names[i]] for i in good_indices]
+    mux = np.asarray(MADTwiss.MUX)[model_indices][:-1]
+    muy = np.asarray(MADTwiss.MUY)[model_indices][1:]
+    f_bpm = results[0][0][good_indices][1:]
+    std_bpm = results[0][1][good_indices][1:]
+    f_new = np.sum(f_bpm * np.exp(complex(0, 1) * 2 * np.pi * (mux - muy)) / std_bpm ** 2)
+    denom = np.sum(1 / std_bpm ** 2)
+
     N = len(dbpms)
     print("coupling.py: ",N, "denom = ",denom)
     if denom == 0:
@@ -662,17 +528,11 @@ def GetCoupling2(MADTwiss, list_zero_dpp_x, list_zero_dpp_y, tune_x, tune_y, pha
     print('NewCMINUS: {0} +/- {1}'.format(CG_new_abs, CG_new_abs_std))
     print('Skipped BPMs: {0} (badbpm) of {1}'.format(Badbpms, Numbpmpairs))
 
-    # Old formula
-    # Initialize global values coupling CG and phse QG
-    CG = 0.0
-    QG = 0.0
-    for i in range(0,len(dbpms)-1):
-        bn1 = str.upper(dbpms[i][1])
-        CG += abs(f_old_out[bn1])
-        # For more than one file, this goes wrong, loops are mixed up for the phase calculation!
-        tw_x = list_zero_dpp_x[0]
-        tw_y = list_zero_dpp_y[0]
-        QG += fwqw[bn1][1][0]-(tw_x.MUX[tw_x.indx[bn1]]-tw_y.MUY[tw_y.indx[bn1]])
+    # Old formula, global values coupling CG and phase QG
+    # For more than one file, this goes wrong, the phase is taken from the first file only!
+    old_indices = good_indices[:-1]
+    CG = np.sum(abs(f_old_out[old_indices]))
+    QG = np.sum(results[1][0][old_indices] - (x.MUX[0] - y.MUY[0])[old_indices])
 
     if len(dbpms)==0:
         print >> sys.stderr, 'Warning: There is no BPM to output linear coupling properly... leaving Getcoupling.'
@@ -688,6 +548,45 @@ def GetCoupling2(MADTwiss, list_zero_dpp_x, list_zero_dpp_y, tune_x, tune_y, pha
 
 ### END of GetCoupling2 ###
 
+def _get_columns(list_of_twiss, names, columns):
+    """Columns of the twiss files as (files x names) arrays, None if a column is missing."""
+    try:
+        arrays = DotDict()
+        for column in columns:
+            arrays[column] = np.array([
+                np.asarray(getattr(tw, column), dtype=float)[[tw.indx[name] for name in names]]
+                for tw in list_of_twiss
+            ]).reshape(len(list_of_twiss), len(names))
+    except AttributeError:
+        return None
+    return arrays
+
+def _complex_secondary_line(delta, cw, cw1, pw, pw1):
+    '''helper.ComplexSecondaryLine for arrays'''
+    tp = 2.0 * np.pi
+    a1 = 1.0 - 1j * np.tan(tp * delta)
+    a2 = cw * (np.cos(tp * pw) + 1j * np.sin(tp * pw))
+    a3 = -1.0 / np.cos(tp * delta) * 1j
+    a4 = cw1 * (np.cos(tp * pw1) + 1j * np.sin(tp * pw1))
+    SL = a1 * a2 + a3 * a4
+    sizeSL = np.sqrt(SL.real ** 2 + SL.imag ** 2)
+    phiSL = (np.arctan2(SL.imag, SL.real) / tp) % 1.0
+    return [sizeSL, phiSL]
+
+def _complex_secondary_line_std(delta, cw, cw1, pw, pw1, std, std1):
+    '''helper.ComplexSecondaryLineSTD for arrays'''
+    tp = 2.0 * np.pi
+    A12 = (1.0 - 1j * np.tan(tp * delta)) * (np.cos(tp * pw) + 1j * np.sin(tp * pw))
+    A34 = -1.0 / np.cos(tp * delta) * 1j * (np.cos(tp * pw1) + 1j * np.sin(tp * pw1))
+    return 0.5 / np.abs(A12 * cw + A34 * cw1) * np.sqrt(np.abs(
+        (std * (2 * np.abs(A12) ** 2 * cw + cw1 * (A12 * np.conj(A34) + np.conj(A12) * A34))) ** 2 +
+        ((std1 * (2 * np.abs(A34) ** 2 * cw1 + cw * (np.conj(A12) * A34 + A12 * np.conj(A34))))) ** 2))
+
+def _weighted_average(values, weights):
+    '''np.average along the files (first axis), for all BPMs'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(values * weights, axis=0) / np.sum(weights, axis=0)
+
 def getCandGammaQmin(fqwq,bpms,tunex,tuney,twiss):
     # Cut the fractional part of Q1 and Q2
     QQ1 = float( int(twiss.Q1) )
@@ -699,42 +598,37 @@ def getCandGammaQmin(fqwq,bpms,tunex,tuney,twiss):
     tunefactor=(np.cos(2*np.pi*tunex)-np.cos(2*np.pi*tuney))/(np.pi*(np.sin(2*np.pi*tunex)+np.sin(2*np.pi*tuney)))
 
     coupleterms={}
-    Qmin=[]
 
     if len(bpms)==0:
         print >> sys.stderr, "No bpms in getCandGammaQmin. Returning empty stuff"
         return coupleterms,0,0,bpms
 
-    for bpm in bpms:
-        bpmm=bpm[1].upper()
-        detC=1-(1/(1+4*(abs(fqwq[bpmm][0][0])**2-abs(fqwq[bpmm][0][2])**2)))
-        check2=0.25+abs(fqwq[bpmm][0][0])**2
-
-        if check2>abs(fqwq[bpmm][0][2])**2: # checking if sum or difference resonance is dominant!
-            gamma=math.sqrt(1/(1/(1+4*(abs(fqwq[bpmm][0][0])**2-abs(fqwq[bpmm][0][2])**2))))
-            ffactor= 2*gamma*tunefactor*math.sqrt(abs(detC)) # cannot take abs
-            C11=-(fqwq[bpmm][0][0].imag-fqwq[bpmm][0][2].imag)*2*gamma
-            C12=-(fqwq[bpmm][0][0].real+fqwq[bpmm][0][2].real)*2*gamma
-            C21=(fqwq[bpmm][0][0].real+fqwq[bpmm][0][2].real)*2*gamma
-            C22=(fqwq[bpmm][0][0].imag-fqwq[bpmm][0][2].imag)*2*gamma
-        else: # negative gamma
-            gamma=-1
-            ffactor=-1
-            C11=C12=C21=C22=-1
-
-        Qmin.append(ffactor)
-
-        if (abs(fqwq[bpmm][0][0])**2-abs(fqwq[bpmm][0][2])**2)>0.0:
-            err=(2*((abs(fqwq[bpmm][0][1])*abs(fqwq[bpmm][0][0]))+(abs(fqwq[bpmm][0][3])*abs(fqwq[bpmm][0][2]))))/(abs(fqwq[bpmm][0][0])**2-abs(fqwq[bpmm][0][2])**2)
-        else:
-            err=-1
-
-        coupleterms[bpmm]=[detC,err,gamma,err,C11,C12,C21,C22]
-
-    if gamma==-1:
+    names = [bpm[1].upper() for bpm in bpms]
+    f1001 = np.array([fqwq[name][0][0] for name in names], dtype=complex)
+    f1001std = np.array([fqwq[name][0][1] for name in names], dtype=float)
+    f1010 = np.array([fqwq[name][0][2] for name in names], dtype=complex)
+    f1010std = np.array([fqwq[name][0][3] for name in names], dtype=float)
+
+    fdiff = abs(f1001)**2-abs(f1010)**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        detC=1-(1/(1+4*fdiff))
+        # checking if sum or difference resonance is dominant, negative gamma if not
+        difference = 0.25+abs(f1001)**2 > abs(f1010)**2
+        gamma=np.where(difference, np.sqrt(1/(1/(1+4*fdiff))), -1)
+        ffactor=np.where(difference, 2*gamma*tunefactor*np.sqrt(abs(detC)), -1) # cannot take abs
+        C11=np.where(difference, -(f1001.imag-f1010.imag)*2*gamma, -1)
+        C12=np.where(difference, -(f1001.real+f1010.real)*2*gamma, -1)
+        C21=np.where(difference, (f1001.real+f1010.real)*2*gamma, -1)
+        C22=np.where(difference, (f1001.imag-f1010.imag)*2*gamma, -1)
+        err=np.where(fdiff>0.0, (2*((abs(f1001std)*abs(f1001))+(abs(f1010std)*abs(f1010))))/fdiff, -1)
+
+    for i, name in enumerate(names):
+        coupleterms[name]=[detC[i],err[i],gamma[i],err[i],C11[i],C12[i],C21[i],C22[i]]
+
+    if not difference[-1]:
         print "WARN: Sum resonance is dominant! "
 
-    Qmin=np.array(Qmin)
+    Qmin=ffactor
 
     Qminerr=math.sqrt(np.average(Qmin*Qmin)-(np.average(Qmin))**2+2.2e-16)
     Qminav=np.average(Qmin)
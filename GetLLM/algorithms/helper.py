@@ -96,6 +96,7 @@ def ComplexSecondaryLineExtended(delta,edelta, amp1,amp2, phase1,phase2):
              - amp2: amplitude of secondary line at i+1th BPM
              - phase1: phase of secondary line at ith BPM
              - phase2: phase of secondary line at i+1th BPM
+             The inputs can be numbers or numpy arrays (broadcastable together).
      Return: - amp: amplitude of the complex signal
              - phase: phase of the complex signal
              - eamp: error on amplitude of the complex signal
@@ -114,17 +115,17 @@ def ComplexSecondaryLineExtended(delta,edelta, amp1,amp2, phase1,phase2):
     cs2=cos(tp*phase2)
     ss2=sin(tp*phase2)
 
-    sig1=amp1*complex(cs1,ss1)
-    sig2=amp2*complex(cs2,ss2)
+    sig1=amp1*(cs1+1j*ss1)
+    sig2=amp2*(cs2+1j*ss2)
 
     # computing complex secondary line (h-)
-    sig=sig1*complex(1,1/T)-sig2*complex(0,1/S)
+    sig=sig1*(1+1j/T)-sig2*(1j/S)
 
     amp=abs(sig)/2.
     phase=(np.arctan2(sig.imag,sig.real)/tp) %1.0
 
     # computing error secondary line (h-)
-    esig = (sig1 * complex(0, S2_1 ) + sig2*complex(0, -S2_1*C))*edelta
+    esig = (sig1 * (1j*S2_1) + sig2*(-1j*S2_1*C))*edelta
 
     eamp=abs(esig)/2.
     ephase=(np.arctan2(esig.imag,esig.real)/tp) %1.0
@@ -483,12 +483,11 @@ def calculate_total_phase(getllm_d, twiss_d, tune_d, phase_d, mad_twiss, mad_ac,
 #===================================================================================================
 #TODO: awful name! what does this function??? (vimaier)
 def _phi_last_and_last_but_one(phi, ftune):
+    ''' Works on scalars and numpy arrays of phase advances. '''
     if ftune <= 0:
         ftune += 1
-    phi += ftune
-    if phi > 1:
-        phi -= 1
-    return phi
+    phi = phi + ftune
+    return np.where(phi > 1, phi - 1, phi)[()]
 
 def t_value_correction(num):
     ''' Calculations are based on Hill, G. W. (1970)
@@ -515,46 +514,46 @@ def t_value_correction(num):
     return t_factor
 
 def calc_phase_mean(phase0, norm):
-    ''' phases must be in [0,1) or [0,2*pi), norm = 1 or 2*pi '''
+    ''' phases must be in [0,1) or [0,2*pi), norm = 1 or 2*pi.
+    For arrays with more than one dimension the mean is taken along the last axis. '''
     phase0 = np.array(phase0)%norm
     phase1 = (phase0 + .5*norm) % norm - .5*norm
-    phase0ave = np.mean(phase0)
-    phase1ave = np.mean(phase1)
+    phase0ave = np.mean(phase0, axis=-1)
+    phase1ave = np.mean(phase1, axis=-1)
     # Since phase0std and phase1std are only used for comparing, I modified the expressions to avoid
     # math.sqrt(), np.mean() and **2.
     # Old expressions:
     #     phase0std = math.sqrt(np.mean((phase0-phase0ave)**2))
     #     phase1std = math.sqrt(np.mean((phase1-phase1ave)**2))
     # -- vimaier
-    mod_phase0std = sum(abs(phase0-phase0ave))
-    mod_phase1std = sum(abs(phase1-phase1ave))
-    if mod_phase0std < mod_phase1std:
-        return phase0ave
-    else:
-        return phase1ave % norm
+    mod_phase0std = np.sum(abs(phase0-np.expand_dims(phase0ave, -1)), axis=-1)
+    mod_phase1std = np.sum(abs(phase1-np.expand_dims(phase1ave, -1)), axis=-1)
+    return np.where(mod_phase0std < mod_phase1std, phase0ave, phase1ave % norm)[()]
 
 def calc_phase_std(phase0, norm):
-    ''' phases must be in [0,1) or [0,2*pi), norm = 1 or 2*pi '''
+    ''' phases must be in [0,1) or [0,2*pi), norm = 1 or 2*pi.
+    For arrays with more than one dimension the std is taken along the last axis. '''
     phase0 = np.array(phase0)%norm
     phase1 = (phase0 + .5*norm) % norm - .5*norm
-    phase0ave = np.mean(phase0)
-    phase1ave = np.mean(phase1)
+    phase0ave = np.mean(phase0, axis=-1)
+    phase1ave = np.mean(phase1, axis=-1)
 
     # Omitted unnecessary computations. Old expressions:
     #     phase0std=sqrt(mean((phase0-phase0ave)**2))
     #     phase1std=sqrt(mean((phase1-phase1ave)**2))
     #     return min(phase0std,phase1std)
     # -- vimaier
-    phase0std_sq = np.sum((phase0-phase0ave)**2)
-    phase1std_sq = np.sum((phase1-phase1ave)**2)
-
-    min_phase_std = min(phase0std_sq, phase1std_sq)
-    if len(phase0) > 1:
-        phase_std = math.sqrt(min_phase_std/(len(phase0)-1))
-        phase_std = phase_std * t_value_correction(len(phase0)-1)
+    phase0std_sq = np.sum((phase0-np.expand_dims(phase0ave, -1))**2, axis=-1)
+    phase1std_sq = np.sum((phase1-np.expand_dims(phase1ave, -1))**2, axis=-1)
+
+    min_phase_std = np.minimum(phase0std_sq, phase1std_sq)
+    number_of_phases = phase0.shape[-1]
+    if number_of_phases > 1:
+        phase_std = np.sqrt(min_phase_std/(number_of_phases-1))
+        phase_std = phase_std * t_value_correction(number_of_phases-1)
     else:
-        phase_std = 0
-    return phase_std
+        phase_std = np.zeros_like(min_phase_std)
+    return phase_std[()]
 
 def _get_phases_total(mad_twiss, src_files, tune, plane, beam_direction, accel, lhc_phase):
     commonbpms = utils.bpm.intersect(src_files)
@@ -617,12 +616,18 @@ def _get_phases_total(mad_twiss, src_files, tune, plane, beam_direction, accel,
 
 #IMPORTANT_PAIRS = {"BPMYA.5R6.B2": ["BPMWB.4R5.B2", "BPMWB.4R1.B2"]}
 
+NUMBER_OF_PAIRS = 10  # Every BPM is paired with the next NUMBER_OF_PAIRS BPMs
+SMALL_PHASE_ADVANCE = 1e-7
+
 
 def get_phases(getllm_d, mad_twiss, ListOfFiles, tune_q, plane):
     """
     Calculates phase.
     tune_q will be used to fix the phase shift in LHC.
     For other accelerators use 'None'.
+
+    The phases of all files are stacked in a (BPMs x files) matrix, the phase advances of every
+    BPM to its next NUMBER_OF_PAIRS BPMs are then computed at once as (BPMs x pairs x files) arrays.
     """
     commonbpms = utils.bpm.intersect(ListOfFiles)
     commonbpms = utils.bpm.model_intersect(commonbpms, mad_twiss)
@@ -634,171 +639,126 @@ def get_phases(getllm_d, mad_twiss, ListOfFiles, tune_q, plane):
         return [{}, 0, 0, []]
 
     #-- Last BPM on the same turn to fix the phase shift by tune_q for exp data of LHC
-    # this would be the elegant way:
-    
+    s_lastbpm = None
     if getllm_d.lhc_phase == "1":
-        if getllm_d.accel == "JPARC":
-            s_lastbpm = None
-        elif getllm_d.accel == "LHCB1":
+        if getllm_d.accel == "LHCB1":
             s_lastbpm = mad_twiss.S[mad_twiss.indx['BPMSW.1L2.B1']]
         elif getllm_d.accel == "LHCB2":
             s_lastbpm = mad_twiss.S[mad_twiss.indx['BPMSW.1L8.B2']]
         elif getllm_d.accel == "PETRA":
             s_lastbpm = mad_twiss.S[mad_twiss.indx['BPM_SOR_46']]
- 
-    # this is the practical way:
-    
-#     if getllm_d.lhc_phase == "1":
-#         print "phase jump is compensated [get_phases]"
-#         if "MOH.3" in mad_twiss.NAME:
-#             getllm_d.beam_direction = 1.0
-#             s_lastbpm = mad_twiss.S[mad_twiss.indx['MOH.5']]
-#             tune_q = 0
-#             print "--> for JPARC (at S = {0:f} tune_q = {1:f}, bd = {2:f})".format(s_lastbpm, tune_q, getllm_d.beam_direction)
-#             #s_lastbpm = mad_twiss.S[mad_twiss.indx['MOH.5']]
-#         elif "BPMSW.1L2.B1" in mad_twiss.NAME:
-#             print "--> for LHC"
-#             if getllm_d.accel == "LHCB1":
-#                 s_lastbpm = mad_twiss.S[mad_twiss.indx['BPMSW.1L2.B1']]
-#             elif getllm_d.accel == "LHCB2":
-#                 s_lastbpm = mad_twiss.S[mad_twiss.indx['BPMSW.1L8.B2']]
-#     
+    if tune_q is None:
+        s_lastbpm = None
+
+    if plane == 'H':
+        phase_column, tune_column, madtune = "MUX", "TUNEX", mad_twiss.Q1 % 1
+    elif plane == 'V':
+        phase_column, tune_column, madtune = "MUY", "TUNEY", mad_twiss.Q2 % 1
+    if madtune > .5:
+        madtune -= 1
 
     mu = 0.
-    tunem = []
     phase = {} # Dictionary for the output containing [average phase, rms error]
+    bpm_names = [str.upper(bpm[1]) for bpm in commonbpms]
+
+    # Note that the phase advance between the last monitor and the first monitor should be find by taking into account the fractional part of tune.
+    tunes = _get_bpm_matrix(ListOfFiles, tune_column, bpm_names)
+    tune = np.average(np.average(tunes[:-1], axis=1))
+
+    meas_phases = _get_bpm_matrix(ListOfFiles, phase_column, bpm_names)
+    model_indices = np.array([mad_twiss.indx[bpm_name] for bpm_name in bpm_names])
+    model_s = np.asarray(mad_twiss.S)[model_indices]
+    model_phases = np.asarray(getattr(mad_twiss, phase_column))[model_indices]
+
+    # To find the integer part of tune as well, the pairs of the last monitors wrap to the first ones
+    first = np.arange(length_commonbpms)[:, np.newaxis]
+    second = first + np.arange(1, NUMBER_OF_PAIRS + 1)
+    wrapped = second >= length_commonbpms
+    second %= length_commonbpms
+
+    tune_jump = getllm_d.beam_direction * tune_q if s_lastbpm is not None else 0.
+    p_i, p_std = _phase_advances_mean_and_std(
+        meas_phases[second] - meas_phases[first], model_s[first], model_s[second],
+        s_lastbpm, tune_jump, getllm_d.beam_direction
+    )
+    p_i = np.where(wrapped, _phi_last_and_last_but_one(p_i, tune), p_i)
+    p_mdl = model_phases[second] - model_phases[first]
+    p_mdl = np.where(wrapped, _phi_last_and_last_but_one(p_mdl % 1, madtune), p_mdl)
+
+    pair_names = [[bpm_names[j] for j in second_of_bpm] for second_of_bpm in second]
+    _avoid_zero_phase_advances(p_i, p_mdl, bpm_names, pair_names, plane)
+
+    best_bpm_idx = np.abs(p_i - 0.25).argmin(axis=1)
+
+    for i, bpm_name in enumerate(bpm_names):
+        for j, second_name in enumerate(pair_names[i]):
+            phase["".join([plane, bpm_name, second_name])] = [p_i[i, j], p_std[i, j], p_mdl[i, j]]
+
+        if bpm_name in getllm_d.important_pairs:
+            second_names = getllm_d.important_pairs[bpm_name]
+            second_indices = [mad_twiss.indx[second_name] for second_name in second_names]
+            important_p_i, important_p_std = _phase_advances_mean_and_std(
+                _get_important_phase_advances(ListOfFiles, phase_column, bpm_name, second_names),
+                model_s[i], np.asarray(mad_twiss.S)[second_indices], s_lastbpm, tune_jump, getllm_d.beam_direction
+            )
+            important_p_mdl = np.asarray(getattr(mad_twiss, phase_column))[second_indices] - model_phases[i]
+            _avoid_zero_phase_advances(important_p_i, important_p_mdl, [bpm_name], [second_names], plane)
+            for second_name, p_i_pair, p_std_pair, p_mdl_pair in zip(second_names, important_p_i,
+                                                                   important_p_std, important_p_mdl):
+                phase["".join([plane, bpm_name, second_name])] = [p_i_pair, p_std_pair, p_mdl_pair]
+            best_bpm_idx[i] = np.abs(np.concatenate((p_i[i], important_p_i)) - 0.25).argmin()
+
+        best_idx = best_bpm_idx[i] if best_bpm_idx[i] <= 2 else 0
+        phase[bpm_name] = [p_i[i, 0], p_std[i, 0], p_i[i, 1], p_std[i, 1], p_mdl[i, 0], p_mdl[i, 1], pair_names[i][0],
+                           pair_names[i][best_idx], p_i[i, best_idx], p_std[i, best_idx]]
 
-    for i in range(length_commonbpms): # To calculate the tune
-        bpm = str.upper(commonbpms[i % length_commonbpms][1])
+    return [phase, tune, mu, commonbpms]
 
-        tunemi = []
-        for src_twiss in ListOfFiles:
-            # Phase is in units of 2pi
-            if plane == 'H':
-                src_twiss_tune_column = src_twiss.TUNEX
-            elif plane == 'V':
-                src_twiss_tune_column = src_twiss.TUNEY
-            tunemi.append(src_twiss_tune_column[src_twiss.indx[bpm]])
-
-        tunemi = np.array(tunemi)
-        if i < length_commonbpms-1:
-            tunem.append(np.average(tunemi))
-
-        # Note that the phase advance between the last monitor and the first monitor should be find by taking into account the fractional part of tune.
-        if i == length_commonbpms-2:
-            tunem = np.array(tunem)
-            tune = np.average(tunem)
-
-    for i in range(length_commonbpms): # To find the integer part of tune as well, the loop is up to the last monitor
-        bpms = [str.upper(commonbpms[j % length_commonbpms][1]) for j in range(i, i+11)] # seven consecutive monitors
-        p_i = {1:[], 2:[], 3:[], 4:[], 5:[], 6:[], 7:[], 8:[], 9:[], 10:[]} # dict for the six bpm pairs i.e. p_i[1] is for pair bpm[0], bpm[1]
-        
-        
-        
-        if bpms[0] in getllm_d.important_pairs:
-            number = 1
-            for second_bpm in getllm_d.important_pairs[bpms[0]]:
-                p_i[10 + number] = []
-                bpms.append(second_bpm)
-                number += 1
-                   
-        for src_twiss in ListOfFiles:
-            # Phase is in units of 2pi
-            p_m = {}
-            if plane == 'H':
-                twiss_column = src_twiss.MUX
-            elif plane == 'V':
-                twiss_column = src_twiss.MUY
-            for bpm_pair in p_i:
-                try:
-                    p_m[bpm_pair] = twiss_column[src_twiss.indx[bpms[bpm_pair]]] - twiss_column[src_twiss.indx[bpms[0]]]
-                except:
-                    p_m[bpm_pair] = 10000000000
-                    
-            #-- To fix the phase shift by tune_q in LHC
-            if tune_q is not None:
-                try:
-                    for bpm_pair in p_m:
-                        if mad_twiss.S[mad_twiss.indx[bpms[0]]] <= s_lastbpm and mad_twiss.S[mad_twiss.indx[bpms[bpm_pair]]] > s_lastbpm:
-                            p_m[bpm_pair] += getllm_d.beam_direction*tune_q
-                        if mad_twiss.S[mad_twiss.indx[bpms[0]]] > s_lastbpm and mad_twiss.S[mad_twiss.indx[bpms[bpm_pair]]]<=s_lastbpm:
-                            p_m[bpm_pair] += -getllm_d.beam_direction*tune_q
-                except:
-                    pass
-            for bpm_pair in p_i:
-                if p_m[bpm_pair] < 0:
-                    p_m[bpm_pair] += 1
-                p_i[bpm_pair].append(p_m[bpm_pair])
-
-        for bpm_pair in p_i:
-            p_i[bpm_pair] = np.array(p_i[bpm_pair])
-
-        if getllm_d.beam_direction == -1: # for the beam circulating reversely to the model
-            for bpm_pair in p_i:
-                p_i[bpm_pair] = 1 - p_i[bpm_pair]
-
-        p_std = {}
-        for bpm_pair in p_i:
-            p_std[bpm_pair] = calc_phase_std(p_i[bpm_pair], 1.)
-            p_i[bpm_pair] = calc_phase_mean(p_i[bpm_pair], 1.)
-
-        if i >= length_commonbpms-10:
-            p_i[10] = _phi_last_and_last_but_one(p_i[10], tune)
-            for j in range(1,10):
-                if i >= length_commonbpms-j:
-                    p_i[j] = _phi_last_and_last_but_one(p_i[j], tune)
-
-        p_mdl = {}
-        if plane == 'H':
-            twiss_column = mad_twiss.MUX
-        elif plane == 'V':
-            twiss_column = mad_twiss.MUY
-        for bpm_pair in p_i:
-            p_mdl[bpm_pair] = twiss_column[mad_twiss.indx[bpms[bpm_pair]]] - twiss_column[mad_twiss.indx[bpms[0]]]
 
-        if i >= length_commonbpms-10:
-            if plane == 'H':
-                madtune = mad_twiss.Q1 % 1
-            elif plane == 'V':
-                madtune = mad_twiss.Q2 % 1
-            if madtune > .5:
-                madtune -= 1
-
-            p_mdl[10] = p_mdl[10] % 1
-            p_mdl[10] = _phi_last_and_last_but_one(p_mdl[10], madtune)
-            for j in range(1, len(p_i)): # iterate only over the first 5 bpm pairs
-                if i >= length_commonbpms-j:
-                    p_mdl[j] = p_mdl[j] % 1
-                    p_mdl[j] = _phi_last_and_last_but_one(p_mdl[j], madtune)
-
-        small = 1e-7
-        phase_advances_all_bpms = np.zeros(len(p_i))
-        phase_advances_all_bpms_std = np.zeros(len(p_i))
-        for bpm_pair in p_i:
-            if abs(p_mdl[bpm_pair]) < small:
-                p_mdl[bpm_pair] = small
-                print "Note: Phase advance (Plane" + plane + ") between " + bpms[0] + " and " + bpms[bpm_pair] + " in MAD model is EXACTLY n*pi. GetLLM slightly differ the phase advance here, artificially."
-                print "Beta from amplitude around this monitor will be slightly varied."
-            if abs(p_i[bpm_pair]) < small:
-                p_i[bpm_pair] = small
-                print "Note: Phase advance (Plane" + plane + ") between " + bpms[0] + " and " + bpms[bpm_pair] + " in measurement is EXACTLY n*pi. GetLLM slightly differ the phase advance here, artificially."
-                print "Beta from amplitude around this monitor will be slightly varied."
-            phase["".join([plane,bpms[0],bpms[bpm_pair]])] = [p_i[bpm_pair], p_std[bpm_pair], p_mdl[bpm_pair]]
-
-        for i in range(len(p_i)):
-            phase_advances_all_bpms[i] = p_i[i+1]
-            phase_advances_all_bpms_std[i] = p_std[i+1]
-
-        best_bpm_idx = (np.abs(phase_advances_all_bpms-0.25)).argmin()
-        if best_bpm_idx > 2:
-            best_bpm_idx = 0
-        best_90degrees_bpm = bpms[best_bpm_idx + 1]
-        best_90degrees_phase = phase_advances_all_bpms[best_bpm_idx]
-        best_90degrees_phase_std = phase_advances_all_bpms_std[best_bpm_idx]
- 
-        phase[bpms[0]] = [p_i[1], p_std[1], p_i[2], p_std[2], p_mdl[1], p_mdl[2], bpms[1], best_90degrees_bpm, best_90degrees_phase, best_90degrees_phase_std]
+def _get_bpm_matrix(twiss_files, column_name, bpm_names):
+    ''' Returns the (BPMs x files) matrix of the given column. '''
+    return np.ascontiguousarray(np.transpose([
+        np.asarray(getattr(twiss_file, column_name))[[twiss_file.indx[bpm_name] for bpm_name in bpm_names]]
+        for twiss_file in twiss_files
+    ]))
 
-    return [phase, tune, mu, commonbpms]
+
+def _get_important_phase_advances(twiss_files, column_name, bpm_name, second_names):
+    ''' Returns the (pairs x files) phase advances from bpm_name to the BPMs in second_names. '''
+    phase_advances = np.empty((len(second_names), len(twiss_files)))
+    for j, second_name in enumerate(second_names):
+        for k, twiss_file in enumerate(twiss_files):
+            twiss_column = getattr(twiss_file, column_name)
+            try:
+                phase_advances[j, k] = twiss_column[twiss_file.indx[second_name]] - twiss_column[twiss_file.indx[bpm_name]]
+            except KeyError:
+                phase_advances[j, k] = 10000000000
+    return phase_advances
+
+
+def _phase_advances_mean_and_std(phase_advances, first_s, second_s, s_lastbpm, tune_jump, beam_direction):
+    '''
+    Returns the mean and std over the files (last axis) of the measured phase advances.
+    The tune_jump is added to the pairs crossing s_lastbpm, to fix the phase shift by tune in LHC.
+    '''
+    if s_lastbpm is not None:
+        forward = (first_s <= s_lastbpm) & (second_s > s_lastbpm)
+        backward = (first_s > s_lastbpm) & (second_s <= s_lastbpm)
+        phase_advances = phase_advances + (tune_jump * forward - tune_jump * backward)[..., np.newaxis]
+    phase_advances = np.where(phase_advances < 0, phase_advances + 1, phase_advances)
+    if beam_direction == -1: # for the beam circulating reversely to the model
+        phase_advances = 1 - phase_advances
+    return calc_phase_mean(phase_advances, 1.), calc_phase_std(phase_advances, 1.)
+
+
+def _avoid_zero_phase_advances(p_i, p_mdl, bpm_names, pair_names, plane):
+    ''' Sets, in place, the phase advances that are EXACTLY n*pi to SMALL_PHASE_ADVANCE. '''
+    for phase_advances, source in ((p_mdl, "MAD model"), (p_i, "measurement")):
+        zero_advances = np.abs(phase_advances) < SMALL_PHASE_ADVANCE
+        for i, j in zip(*np.nonzero(zero_advances)):
+            print "Note: Phase advance (Plane" + plane + ") between " + bpm_names[i] + " and " + pair_names[i][j] + " in " + source + " is EXACTLY n*pi. GetLLM slightly differ the phase advance here, artificially."
+            print "Beta from amplitude around this monitor will be slightly varied."
+        phase_advances[zero_advances] = SMALL_PHASE_ADVANCE
 
 #===================================================================================================
 # ac-dipole stuff
@@ -11,16 +11,11 @@ This module is not intended to be executed. It stores only functions.
 import sys
 
 import utils.bpm
+import utils.shared_pool
+from utils.dict_tools import DotDict
 import helper
 import numpy as np
 
-exist_curve_fit = True
-
-try:
-    from scipy.optimize import curve_fit
-except ImportError:
-    exist_curve_fit = False
-
 DEBUG = sys.flags.debug # True with python option -d! ("python -d GetLLM.py...") (vimaier)
 
 
@@ -55,9 +50,12 @@ def calculate_RDTs(mad_twiss, getllm_d, twiss_d, phase_d, tune_d, files_dict, in
     Calculates line RDT amplitudes and phases and fills the following TfsFiles:
         f3000_line.out ...
 
+    The secondary lines of all the RDTs are gathered into arrays (files x BPMs) first, then the RDTs
+    are spread over getllm_d.nprocesses processes, which compute all their BPMs at once.
+
     :Parameters:
         'getllm_d': _GetllmData (In-param, values will only be read)
-            lhc_phase, accel, beam_direction and num_beams_for_coupling are used.
+            lhc_phase, accel, beam_direction, parallel and nprocesses are used.
         'twiss_d': _TwissData (In-param, values will only be read)
             Holds twiss instances of the src files.
         'tune_d': _TuneData (In-param, values will only be read)
@@ -73,142 +71,213 @@ def calculate_RDTs(mad_twiss, getllm_d, twiss_d, phase_d, tune_d, files_dict, in
         out_file in files_dict is the out file to write the data to (must be added to GetLLM.py)
         line in (int, int) is the corresponding line to the driving term
     """
-    beam = getllm_d.beam_direction
+    rdt_data = _gather_rdt_data(mad_twiss, twiss_d, phase_d, getllm_d.beam_direction)
+    processes = getllm_d.nprocesses if getllm_d.parallel and not DEBUG else 1
+    n_pairs = max(len(pairs.bpm1) for pairs in rdt_data.planes.values())
+    n_files = max(pairs.n_files for pairs in rdt_data.planes.values())
+
+    # The workers get the lines once, when they start, and write the results of their RDTs into shared arrays
+    with utils.shared_pool.SharedArrayPool(processes, initializer=_init_rdt_worker,
+                                           initargs=(rdt_data, inv_x, inv_y)) as pool:
+        line_results = pool.empty((len(RDT_LIST), n_pairs, n_files, 4), np.float64)
+        rdt_results = pool.empty((len(RDT_LIST), n_pairs, 4), np.float64)
+        pool.map_row_blocks(_process_RDT_rows, len(RDT_LIST), (line_results, rdt_results), rows_per_task=1)
+        line_results = np.array(line_results.array)
+        rdt_results = np.array(rdt_results.array)
+
+    for i, rdt in enumerate(RDT_LIST):
+        _, plane = determine_lines(rdt)
+        _write_RDT(rdt_data, rdt_data.planes[plane], rdt_data.lines[rdt] is not None,
+                   files_dict[rdt+'_line.out'], files_dict[rdt+'.out'], line_results[i], rdt_results[i])
+
+
+def _gather_rdt_data(mad_twiss, twiss_d, phase_d, beam):
+    '''
+    Collects everything the RDT calculation needs from the src files:
+        dbpms: the BPMs common to all files and the model.
+        planes: for H and V, the BPM pairs of the phase calculation (see _gather_pairs).
+        lines: for every RDT the amplitudes and phases of its secondary line (averaged with the
+            opposite line if both exist) at the first and second BPM of the pairs, as arrays
+            files x pairs, or None if no line could be found.
+    '''
+    dbpms = utils.bpm.intersect(twiss_d.zero_dpp_y+twiss_d.zero_dpp_x)
+    dbpms = utils.bpm.model_intersect(dbpms, mad_twiss)
+    rdt_data = DotDict(dbpms=dbpms, beam=beam, planes={}, lines={})
+    for plane, phase_data in (("H", phase_d.ph_x), ("V", phase_d.ph_y)):
+        rdt_data.planes[plane] = _gather_pairs(dbpms, plane, phase_data, twiss_d, beam)
+    for rdt in RDT_LIST:
+        line, plane = determine_lines(rdt)
+        rdt_data.lines[rdt] = _gather_line(line, _get_zero_dpp(twiss_d, plane), rdt_data.planes[plane])
+        if rdt_data.lines[rdt] is None:
+            print >> sys.stderr, "Could not find line for %s !" %rdt
+    return rdt_data
+
+
+def _get_zero_dpp(twiss_d, plane):
+    assert plane in ["H", "V"] # check user input plane
+    if plane == "H":
+        return twiss_d.zero_dpp_x
+    return twiss_d.zero_dpp_y
 
-    if exist_curve_fit:
-        for rdt in RDT_LIST:
-            line, plane = determine_lines(rdt)
-            _process_RDT(mad_twiss, phase_d, twiss_d, (plane, files_dict[rdt+'_line.out'], files_dict[rdt+'.out'], line), inv_x, inv_y, rdt, beam)
+
+def _gather_pairs(dbpms, plane, phase_data, twiss_d, beam):
+    '''
+    Returns the BPM pairs (bpm1, bpm2) of the phase calculation for all but the last 4 dbpms, with:
+        delta, edelta: the measured phase advances and their errors.
+        index1, index2: the indices of bpm1 and bpm2 in the src files (files x pairs).
+        mu_x, mu_y: the phases of the main lines at bpm1 (files x pairs).
+        valid: the pairs which get rows in the line files, the ones whose bpm2 is in dbpms for beam 2.
+        names, positions: the BPM of the line file rows of the pairs.
+    '''
+    list_zero_dpp = _get_zero_dpp(twiss_d, plane)
+    bpm_positions, bpm_names = zip(*dbpms)
+    bpm1s, bpm1_positions, bpm2s, deltas, edeltas = [], [], [], [], []
+    for i in range(len(dbpms)-4):
+        bpm1 = dbpms[i][1].upper()
+        try:
+            bpm_pair_data = phase_data[bpm1][7], phase_data[bpm1][8], phase_data[bpm1][9]
+        except KeyError:
+            print >> sys.stderr, "Could not find a BPM pair (%s, %s)!" % (plane, bpm1)
+            continue
+        bpm1s.append(bpm1)
+        bpm1_positions.append(dbpms[i][0])
+        bpm2s.append(bpm_pair_data[0])
+        deltas.append(bpm_pair_data[1])
+        edeltas.append(bpm_pair_data[2])
+
+    if beam == 1:
+        names = bpm1s
+        positions = bpm1_positions
+        valid = np.ones(len(bpm1s), dtype=bool)
     else:
-        print 'Curve fit not imported.. RDTs skipped'
+        valid = np.array([bpm2 in bpm_names for bpm2 in bpm2s], dtype=bool)
+        names = [bpm2 if is_valid else None for bpm2, is_valid in zip(bpm2s, valid)]
+        positions = [bpm_positions[bpm_names.index(bpm2)] if is_valid else None for bpm2, is_valid in zip(bpm2s, valid)]
 
+    return DotDict(
+        bpm1=bpm1s, bpm2=bpm2s, n_files=len(list_zero_dpp),
+        delta=np.array(deltas, dtype=float), edelta=np.array(edeltas, dtype=float),
+        index1=_get_indices(list_zero_dpp, bpm1s), index2=_get_indices(list_zero_dpp, bpm2s),
+        mu_x=_take(twiss_d.zero_dpp_x, "MUX", bpm1s), mu_y=_take(twiss_d.zero_dpp_y, "MUY", bpm1s),
+        valid=valid, names=names, positions=positions,
+    )
 
-def _process_RDT(mad_twiss, phase_d, twiss_d, (plane, out_file, rdt_out_file, line), inv_x, inv_y, rdt, beam):
-    assert plane in ["H", "V"] # check user input plane
-    
-    # get plane corresponding phase and twiss data
-    linx_data = twiss_d.zero_dpp_x
-    liny_data = twiss_d.zero_dpp_y
-    
-    if plane == "H":
-        phase_data = phase_d.ph_x
-        list_zero_dpp = twiss_d.zero_dpp_x
-    else:
-        phase_data = phase_d.ph_y
-        list_zero_dpp = twiss_d.zero_dpp_y
 
-    dbpms = utils.bpm.intersect(twiss_d.zero_dpp_y+twiss_d.zero_dpp_x)
-    dbpms = utils.bpm.model_intersect(dbpms, mad_twiss)
-    bpm_positions, bpm_names = zip(*dbpms)
+def _get_indices(list_zero_dpp, bpms):
+    return np.array([[twiss.indx[bpm] for bpm in bpms] for twiss in list_zero_dpp], dtype=int).reshape(len(list_zero_dpp), len(bpms))
 
 
-    # init out file
-    out_file.add_column_names(["NAME", "S", "COUNT", "AMP", "EAMP", "PHASE", "EPHASE"])
-    out_file.add_column_datatypes(["%s", "%le", "%le", "%le", "%le", "%le", "%le"])
+def _take(list_zero_dpp, column, bpms):
+    return np.array([np.asarray(getattr(twiss, column), dtype=float)[indices]
+                     for twiss, indices in zip(list_zero_dpp, _get_indices(list_zero_dpp, bpms))]).reshape(len(list_zero_dpp), len(bpms))
 
-    line_amplitudes = []
-    line_amplitudes_err = []
-    line_phases = []
-    line_phases_err = []
-    rdt_phases_averaged = []
-    rdt_phases_averaged_std = []
 
-    use_line = False
-    use_opposite_line = False   
-    
+def _gather_line(line, list_zero_dpp, pairs):
+    '''
+    Returns amp1, amp2, phase1, phase2: the amplitudes and phases of the line at bpm1 and bpm2 of the pairs (files x pairs).
+    If the opposite line exists as well the two are averaged, None is returned if neither of them exists.
+    '''
+    lines = []
     try:
         _, _ = _line_to_amp_and_phase_attr(line, list_zero_dpp[0])
-        use_line = True
+        lines.append((line, 1.))
     except AttributeError:
         print >> sys.stderr, "Line not found, trying opposite line.. (%s, %s)!" % line
     try:
         _, _ = _line_to_amp_and_phase_attr((-line[0],-line[1]), list_zero_dpp[0])
-        use_opposite_line = True
+        lines.append(((-line[0],-line[1]), -1.))
     except AttributeError:
         print >> sys.stderr, "Opposite line not found.. (%s, %s)!" % (-line[0],-line[1])
+    if not lines:
+        return None
 
-    if use_line or use_opposite_line:  
-        for i in range(len(dbpms)-4):
-            bpm1 = dbpms[i][1].upper()
-            try:
-                bpm_pair_data = phase_data[bpm1][7], phase_data[bpm1][8], phase_data[bpm1][9]
-            except KeyError:
-                print >> sys.stderr, "Could not find a BPM pair (%s, %s)!" % (plane, bpm1)
-                continue
-            
-            bpm2 = bpm_pair_data[0]
-            rdt_phases_per_bpm = []
-            for j in range(0,len(list_zero_dpp)):
-                
-                ph_H10 = getattr(linx_data[j], "MUX")[linx_data[j].indx[bpm1]]
-                ph_V01 = getattr(liny_data[j], "MUY")[liny_data[j].indx[bpm1]]
-    
-                if use_line and use_opposite_line:
-                    amp_line, phase_line = _line_to_amp_and_phase_attr(line, list_zero_dpp[j])
-                    amp_line_opp, phase_line_opp = _line_to_amp_and_phase_attr((-line[0],-line[1]), list_zero_dpp[j])
-                    phase_line_opp = -phase_line_opp 
-                    amp_line = (amp_line + amp_line_opp)/2.
-                    phase_line = (phase_line + phase_line_opp)/2.
-                elif use_line and not use_opposite_line:
-                    amp_line, phase_line = _line_to_amp_and_phase_attr(line, list_zero_dpp[j])
-                elif use_opposite_line and not use_line:
-                    amp_line, phase_line = _line_to_amp_and_phase_attr((-line[0],-line[1]), list_zero_dpp[j])
-                    phase_line = -phase_line 
-
-                if beam == 1:
-                    delta, edelta = bpm_pair_data[1:]
-                    amp1 = amp_line[list_zero_dpp[j].indx[bpm1]]
-                    amp2 = amp_line[list_zero_dpp[j].indx[bpm2]]
-                    phase1 = phase_line[list_zero_dpp[j].indx[bpm1]]
-                    phase2 = phase_line[list_zero_dpp[j].indx[bpm2]]
-                
-                    line_amp, line_phase, line_amp_e, line_phase_e = helper.ComplexSecondaryLineExtended(delta,edelta, amp1, amp2, phase1, phase2)
-                    out_file.add_table_row([bpm1, dbpms[i][0], len(list_zero_dpp), line_amp, line_amp_e, line_phase, line_phase_e])
-                    line_amplitudes.append(line_amp)
-                    line_amplitudes_err.append(line_amp_e)
-                    line_phases.append(line_phase)
-                    line_phases_err.append(line_phase_e)
-    
-                elif beam == -1:
-                    delta, edelta = bpm_pair_data[1:]
-                    amp1 = amp_line[list_zero_dpp[j].indx[bpm1]]
-                    amp2 = amp_line[list_zero_dpp[j].indx[bpm2]]
-                    phase1 = phase_line[list_zero_dpp[j].indx[bpm1]]
-                    phase2 = phase_line[list_zero_dpp[j].indx[bpm2]]
-
-                    try:
-                        bpm_position = bpm_positions[bpm_names.index(bpm2)]
-                        line_amp, line_phase, line_amp_e, line_phase_e = helper.ComplexSecondaryLineExtended(delta,edelta, amp2, amp1, phase2, phase1)
-                        out_file.add_table_row([bpm2, bpm_position, len(list_zero_dpp), line_amp, line_amp_e, line_phase, line_phase_e])
-                        line_amplitudes.append(line_amp)
-                        line_amplitudes_err.append(line_amp_e)
-                        line_phases.append(line_phase)
-                        line_phases_err.append(line_phase_e)
-                    except ValueError:
-                        pass
-                        
-                
-                rdt_phases_per_bpm.append(calculate_rdt_phases(rdt, line_phase, ph_H10, ph_V01)%1)
-
-            rdt_phases_averaged.append(np.average(np.array(rdt_phases_per_bpm)))
-            rdt_phases_averaged_std.append(np.std(np.array(rdt_phases_per_bpm)))
+    amp1, amp2, phase1, phase2 = 0., 0., 0., 0.
+    for this_line, sign in lines:
+        amps, phases = zip(*[_line_to_amp_and_phase_attr(this_line, twiss) for twiss in list_zero_dpp])
+        amp1 = amp1 + _take_indices(amps, pairs.index1)
+        amp2 = amp2 + _take_indices(amps, pairs.index2)
+        phase1 = phase1 + sign * _take_indices(phases, pairs.index1)
+        phase2 = phase2 + sign * _take_indices(phases, pairs.index2)
+    return amp1/len(lines), amp2/len(lines), phase1/len(lines), phase2/len(lines)
 
-    else:
-        print >> sys.stderr, "Could not find line for %s !" %rdt
+
+def _take_indices(columns, indices):
+    return np.array([np.asarray(column, dtype=float)[file_indices]
+                     for column, file_indices in zip(columns, indices)]).reshape(indices.shape)
+
+
+_rdt_data = None
+
+
+def _init_rdt_worker(*rdt_data):
+    ''' Keeps the gathered lines and the kick actions in the worker process, they are sent only once. '''
+    global _rdt_data
+    _rdt_data = rdt_data
+
+
+def _process_RDT_rows(begin, end, line_results, rdt_results):
+    '''
+    Calculates the RDTs begin to end of RDT_LIST and writes them into the shared arrays:
+        line_results[i]: pairs x files x (AMP, EAMP, PHASE, EPHASE) of the lines.
+        rdt_results[i]: pairs x (AMP, EAMP, PHASE, PHASE_STD), the fitted amplitudes are in the first rows
+            (one per valid pair), the phases averaged over the files in the rows of their pair.
+    '''
+    rdt_data, inv_x, inv_y = _rdt_data
+    line_values = line_results.array
+    rdt_values = rdt_results.array
+    for i in range(begin, end):
+        rdt = RDT_LIST[i]
+        if rdt_data.lines[rdt] is None:
+            continue
+        _, plane = determine_lines(rdt)
+        pairs = rdt_data.planes[plane]
+        n_pairs, n_files = len(pairs.bpm1), pairs.n_files
+        if n_pairs == 0:
+            continue
+
+        amp1, amp2, phase1, phase2 = rdt_data.lines[rdt]
+        if rdt_data.beam == 1:
+            line_amp, line_phase, line_amp_e, line_phase_e = helper.ComplexSecondaryLineExtended(pairs.delta, pairs.edelta, amp1, amp2, phase1, phase2)
+        else:
+            line_amp, line_phase, line_amp_e, line_phase_e = helper.ComplexSecondaryLineExtended(pairs.delta, pairs.edelta, amp2, amp1, phase2, phase1)
+        line_values[i, :n_pairs, :n_files] = np.dstack((line_amp.T, line_amp_e.T, line_phase.T, line_phase_e.T))
+
+        rdt_phases = calculate_rdt_phases(rdt, line_phase, pairs.mu_x, pairs.mu_y) % 1
+        rdt_values[i, :n_pairs, 2] = np.average(rdt_phases, axis=0)
+        rdt_values[i, :n_pairs, 3] = np.std(rdt_phases, axis=0)
+
+        res, res_err = do_fitting(line_amp.T[pairs.valid], inv_x, inv_y, rdt, plane)
+        rdt_values[i, :len(res), 0] = res[:, 0]
+        rdt_values[i, :len(res), 1] = res_err[:, 0]
+    line_results.flush()
+    rdt_results.flush()
+
+
+def _write_RDT(rdt_data, pairs, has_line, out_file, rdt_out_file, line_values, rdt_values):
+    # init out file
+    out_file.add_column_names(["NAME", "S", "COUNT", "AMP", "EAMP", "PHASE", "EPHASE"])
+    out_file.add_column_datatypes(["%s", "%le", "%le", "%le", "%le", "%le", "%le"])
     # init out file
     rdt_out_file.add_column_names(["NAME", "S", "COUNT", "AMP", "EAMP", "PHASE", "PHASE_STD", "REAL", "IMAG"])
     rdt_out_file.add_column_datatypes(["%s", "%le", "%le", "%le", "%le", "%le",  "%le", "%le", "%le"])
-
-    rdt_angles = np.mod(np.array(rdt_phases_averaged), np.ones(len(rdt_phases_averaged)))
+    if not has_line:
+        return
+
+    num_meas = pairs.n_files
+    valid_pairs = np.flatnonzero(pairs.valid)
+    for i in valid_pairs:
+        for j in range(num_meas):
+            line_amp, line_amp_e, line_phase, line_phase_e = line_values[i, j]
+            out_file.add_table_row([pairs.names[i], pairs.positions[i], num_meas, line_amp, line_amp_e, line_phase, line_phase_e])
+
+    dbpms = rdt_data.dbpms
+    rdt_angles = np.mod(rdt_values[:len(pairs.bpm1), 2], 1.)
     real_part = np.cos(2*np.pi*rdt_angles)
     imag_part = np.sin(2*np.pi*rdt_angles)
-
-    for k in range(len(line_amplitudes)/len(list_zero_dpp)):
-        num_meas = len(list_zero_dpp)
+    for k in range(len(valid_pairs)):
         bpm_name = dbpms[k][1].upper()
-        bpm_rdt_data = line_amplitudes[k*num_meas:(k+1)*num_meas]
-        res, res_err = do_fitting(bpm_rdt_data, inv_x, inv_y, rdt, plane)
-        rdt_out_file.add_table_row([bpm_name, dbpms[k][0], len(list_zero_dpp), res[0], res_err[0], rdt_angles[k], rdt_phases_averaged_std[k], res[0]*real_part[k], res[0]*imag_part[k]])
+        res, res_err = rdt_values[k, :2]
+        rdt_out_file.add_table_row([bpm_name, dbpms[k][0], num_meas, res, res_err, rdt_angles[k], rdt_values[k, 3], res*real_part[k], res*imag_part[k]])
 
 
 def calculate_rdt_phases(rdt, line_phase, ph_H10, ph_V01):
@@ -238,11 +307,24 @@ def rdt_function_gen(rdt, plane):
 
 
 def do_fitting(bpm_rdt_data, kick_x, kick_y, rdt, plane):
+    '''
+    Least squares fit of the RDT amplitude to the line amplitudes of the kicks, with the errors curve_fit would give.
+    The model of rdt_function_gen is linear in the RDT, so the fit is solved in closed form. bpm_rdt_data holds the
+    amplitudes of one BPM (one per kick) or of many BPMs at once (BPMs x kicks).
+    '''
     func = rdt_function_gen(rdt, plane)
     kick_data = np.vstack((np.transpose(kick_x)[0]**2, np.transpose(kick_y)[0]**2))
-    popt, pcov = curve_fit(func, kick_data, bpm_rdt_data)
-    perr = np.sqrt(np.diag(pcov))
-    return popt, perr
+    design = func(kick_data, 1.)
+    amplitudes = np.asarray(bpm_rdt_data, dtype=float)
+    norm = np.sum(design**2)
+    popt = np.dot(amplitudes, design) / norm
+    residuals = amplitudes - popt[..., np.newaxis] * design
+    dof = design.size - 1
+    if dof > 0:
+        perr = np.sqrt(np.sum(residuals**2, axis=-1) / dof / norm)
+    else:
+        perr = np.full_like(popt, np.inf)  # As curve_fit, the covariance cannot be estimated
+    return popt[..., np.newaxis], perr[..., np.newaxis]
 
 
 def _line_to_amp_and_phase_attr(line, zero_dpp):
@@ -13,6 +13,10 @@ The Montague W and Phi functions are output.
 What getsuper essentially does is run GetLLM on files with different dp/p and then afterwards
 interpolate the results to see how the functions vary with dp/p.
 
+The models and GetLLM runs of the different dp/p are done in parallel threads
+(one dp/p per thread, GetLLM itself then runs serially), their results are
+passed back in memory and the linear regressions are done for all BPMs at once.
+
 To run getsuper.py you need several source files(sdds files) with different DPP(delta_p/p).
 At least one of the source files must have DPP=0.0 .
 Hint: You can change DPP in the GUI application in the Analysis panel. Change the entries in the
@@ -42,6 +46,8 @@ Usage cmd line::
       -d <deltapScalingFactor>, --deltapScalingFactor=<deltapScalingFactor>
                             Scaling factor for deltap, remember final value must
                             be in MAD units
+      -p <processes>, --processes=<processes>
+                            Number of dp/p to analyse in parallel
 
 Usage in another Python module::
 
@@ -52,17 +58,19 @@ Usage in another Python module::
 """
 
 import argparse
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import sys
 import shutil
-import math
 import re
+import tempfile
 import numpy as np
 
 import __init__  # @UnusedImport init will include paths
 import Python_Classes4MAD.metaclass as metaclass
-from utils import bpm as bpm_util
 from utils import logging_tools as logtools
+from utils import tfs_pandas as tfs
 from utils.dict_tools import DotDict
 from utils import tfs_remove_nan
 from model import manager, creator
@@ -76,6 +84,8 @@ LOG = logtools.get_logger(__name__)
 # ==================================================================================================
 
 ALGO_CHOICES = ["SUSSIX", "SVD", "HA"]
+RESULT_FILES = ("getbetax", "getbetay", "getcouple",
+                "getbetax_free", "getbetay_free", "getcouple_free")
 
 
 def _parse_args(args=None):
@@ -99,6 +109,9 @@ def _parse_args(args=None):
     parser.add_argument("-d", "--deltapScalingFactor",
             help="Scaling factor for deltap, remember final value must be in MAD units",
             metavar="<deltapScalingFactor>", default=1.0, type=float, dest="deltap_scaling_factor")
+    parser.add_argument("-p", "--processes",
+            help="Number of dp/p to analyse in parallel",
+            metavar="<processes>", default=multiprocessing.cpu_count(), type=int, dest="processes")
 
     # parse arguments
     accel_cls, remain_args = manager.get_accel_class_from_args(args)
@@ -140,6 +153,8 @@ def check_input(opt):
     if not os.path.isdir(opt.output_path):
         os.makedirs(opt.output_path)
 
+    opt.processes = opt.get("processes", multiprocessing.cpu_count())
+
     opt.algorithm = opt.get("algorithm", ALGO_CHOICES[0])
     if opt.algorithm not in ALGO_CHOICES:
         raise ValueError("Algorithm needs to be either one of  '" + ALGO_CHOICES + "'")
@@ -162,6 +177,7 @@ def main(**kwargs):
         accel_cls (accelerator): Accelerator class object
         deltap_scaling_factor (float): Scaling factor for deltap,
                                        remember final value must be in MAD units
+        processes (int): Number of dp/p to analyse in parallel
     """
 
     options = check_input(DotDict(kwargs))
@@ -196,152 +212,54 @@ def main(**kwargs):
     accel_inst = _create_accel_instance(options.accel_cls, files_dict, options.output_path,
                                         options.twissfile)
 
-    _create_models_by_madx(accel_inst, files_dict.keys())
-
-    for dpp in files_dict:
-        files = files_dict[dpp]
-        twiss_dpp_path = _join_with_output_path(options.output_path, "twiss_{:f}.dat".format(dpp))
-        _rungetllm(twiss_dpp_path, files, dpp,
-                   options.output_path, accel_inst, options.algorithm)
+    results = _analyse_dpps(accel_inst, files_dict, options.output_path, options.algorithm,
+                            min(options.processes, len(files_dict)))
 
     # The GUI wants the default files to have the names without _0.0
     _copy_default_outfiles(options.output_path)
 
-    #TODO: HOPE THAT GETLLM DOES A BETTER JOB
-    LOG.warn("Cleaning files of NAN! This should not be necessary!")
-    all_files = os.listdir(options.output_path)
-    tfs_remove_nan.clean_files(
-        [os.path.join(options.output_path, f) for f in all_files], replace=True)
-
-    # adding data
-    betalistx = {}
-    betalisty = {}
-    couplelist = {}
-    betalistxf = {}
-    betalistyf = {}
-    couplelistf = {}
-
-    listx = []
-    listxf = []
-    listy = []
-    listyf = []
-    listc = []
-    listcf = []
-
-    for dpp in files_dict.keys():
-        LOG.debug("Loading driven data for dpp {:f}".format(dpp))
-        betx_path = _join_with_output_path(options.output_path, 'getbetax{ext:s}'.format(ext=_ext(dpp)))
-        bety_path = _join_with_output_path(options.output_path, 'getbetay{ext:s}'.format(ext=_ext(dpp)))
-        couple_path = _join_with_output_path(options.output_path, 'getcouple{ext:s}'.format(ext=_ext(dpp)))
-
-        betx = metaclass.twiss(betx_path)
-        bety = metaclass.twiss(bety_path)
-        couple = metaclass.twiss(couple_path)
-
-        betalistx[dpp] = betx
-        betalisty[dpp] = bety
-        couplelist[dpp] = couple
-
-        if float(dpp) == 0.0:
-            zerobx = betx
-            zeroby = bety
-
-        listx.append(betx)
-        listy.append(bety)
-        listc.append(couple)
-
-        modeld = metaclass.twiss(options.twissfile)
-
-        try:
-            betaxf_path = _join_with_output_path(options.output_path, 'getbetax_free{ext:s}'.format(ext=_ext(dpp)))
-            betxf = metaclass.twiss(betaxf_path)
-            LOG.debug("Loaded betax free data from '{:s}".format(betaxf_path))
-
-
-            betayf_path = _join_with_output_path(options.output_path, 'getbetay_free{ext:s}'.format(ext=_ext(dpp)))
-            betyf = metaclass.twiss(betayf_path)
-            LOG.debug("Loaded betay free data from '{:s}".format(betayf_path))
-
-            couplef_path = _join_with_output_path(options.output_path, 'getcouple_free{ext:s}'.format(ext=_ext(dpp)))
-            couplef = metaclass.twiss(couplef_path)
-            LOG.debug("Loaded coupling free data from '{:s}".format(couplef_path))
-        except IOError:
-            use_free = False
-            LOG.warn("WARNING: Could not open all of the free data files.")
-        else:
-            use_free = True
-            betalistxf[dpp] = betxf
-            betalistyf[dpp] = betyf
-            couplelistf[dpp] = couplef
-
-            listxf.append(betxf)
-            listyf.append(betyf)
-            listcf.append(couplef)
-
-            modelf = modeld
-
-            path_ac_file = options.twissfile.replace(".dat", "_ac.dat")
-            if not os.path.isfile(path_ac_file):
-                LOG.error("Ac file '{:s}' does not exist.".format(path_ac_file))
-                LOG.error("  -> In GUI check 'Ac dipole' box to create a model with ac dipole.")
-                sys.exit(1)
-            modeld = metaclass.twiss(path_ac_file)
-            if float(dpp) == 0.0:
-                zerobxf = betalistxf[dpp]
-                zerobyf = betalistyf[dpp]
+    dpps = sorted(files_dict.keys())
+    model_driven = tfs.read_tfs(options.twissfile, index="NAME")
+    use_free = all(results[dpp][name] is not None for dpp in dpps for name in RESULT_FILES)
+    if use_free:
+        model_free = model_driven
+        path_ac_file = options.twissfile.replace(".dat", "_ac.dat")
+        if not os.path.isfile(path_ac_file):
+            LOG.error("Ac file '{:s}' does not exist.".format(path_ac_file))
+            LOG.error("  -> In GUI check 'Ac dipole' box to create a model with ac dipole.")
+            sys.exit(1)
+        model_driven = tfs.read_tfs(path_ac_file, index="NAME")
+    else:
+        LOG.warn("WARNING: Could not open all of the free data files.")
 
     LOG.debug("Getting Driven beta")
-    # H
-    fileobj = _chromFileWriter('beta', _join_with_output_path(options.output_path, "chrombetax" + _ext()), 'H')
-    bpms = bpm_util.intersect(listx)
-    bpms = bpm_util.model_intersect(bpms, modeld)
-    _do_lin_reg_bet(fileobj, files_dict.keys(), betalistx, bpms, "H", zerobx, modeld)
-    del fileobj
-
-    # V
-    fileobj = _chromFileWriter('beta', _join_with_output_path(options.output_path, "chrombetay" + _ext()), 'V')
-    bpms = bpm_util.intersect(listy)
-    bpms = bpm_util.model_intersect(bpms, modeld)
-    _do_lin_reg_bet(fileobj, files_dict.keys(), betalisty, bpms, "V", zeroby, modeld)
-    del fileobj
+    for plane, name in (("H", "chrombetax"), ("V", "chrombetay")):
+        fileobj = _chromFileWriter('beta', _join_with_output_path(options.output_path, name + _ext()), plane)
+        betas = _get_results(results, dpps, "getbeta" + _plane_char(plane))
+        _do_lin_reg_bet(fileobj, dpps, betas, plane, model_driven)
+        del fileobj
     LOG.debug("Driven beta finished")
 
-
     LOG.debug("Getting Driven coupling")
     fileobj = _chromFileWriter('coupling', _join_with_output_path(options.output_path, "chromcoupling" + _ext()), '')
-    bpms = bpm_util.intersect(listc)
-    bpms = bpm_util.model_intersect(bpms, modeld)
-    _do_linreg_coupling(couplelist, bpms, files_dict.keys(), fileobj)
+    _do_linreg_coupling(fileobj, dpps, _get_results(results, dpps, "getcouple"), model_driven)
     del fileobj
     LOG.debug("Driven coupling finished")
 
     if use_free:
-        #
-        # free beta
-        #
         LOG.debug("Getting Free beta")
-        # H
-        fileobj = _chromFileWriter('beta',
-                                   _join_with_output_path(options.output_path, "chrombetax_free" + _ext()), 'H')
-        bpms = bpm_util.intersect(listxf)
-        bpms = bpm_util.model_intersect(bpms, modelf)
-        _do_lin_reg_bet(fileobj, files_dict.keys(), betalistxf, bpms, "H", zerobxf, modelf)
-
-        # V
-        fileobj = _chromFileWriter('beta',
-                                   _join_with_output_path(options.output_path, "chrombetay_free" + _ext()), 'V')
-        bpms = bpm_util.intersect(listyf)
-        bpms = bpm_util.model_intersect(bpms, modelf)
-        _do_lin_reg_bet(fileobj, files_dict.keys(), betalistyf, bpms, "V", zerobyf, modelf)
+        for plane, name in (("H", "chrombetax_free"), ("V", "chrombetay_free")):
+            fileobj = _chromFileWriter('beta', _join_with_output_path(options.output_path, name + _ext()), plane)
+            betas = _get_results(results, dpps, "getbeta" + _plane_char(plane) + "_free")
+            _do_lin_reg_bet(fileobj, dpps, betas, plane, model_free)
+            del fileobj
         LOG.debug("Free beta finished")
 
-
         LOG.debug("GettingFree coupling")
         fileobj = _chromFileWriter('coupling',
                                    _join_with_output_path(options.output_path, "chromcoupling_free" + _ext()), '')
-        bpms = bpm_util.intersect(listcf)
-        bpms = bpm_util.model_intersect(bpms, modelf)
-        _do_linreg_coupling(couplelistf, bpms, files_dict.keys(), fileobj)
+        _do_linreg_coupling(fileobj, dpps, _get_results(results, dpps, "getcouple_free"), model_free)
+        del fileobj
         LOG.debug("Free coupling finished")
 
 # ===================================================================================================
@@ -405,14 +323,72 @@ def _create_accel_instance(accel_cls, files_dict, output_path, twissfile):
     return accel_inst
 
 
-def _create_models_by_madx(accel_inst, dpps):
-    """ Creates the needed models """
+def _analyse_dpps(accel_inst, files_dict, output_path, algorithm, processes):
+    """ Creates the models and runs GetLLM for all dpp.
+
+    With more than one process, every thread creates the model of its dpp and
+    runs GetLLM on it (serially), as soon as it is free. Threads, as the time
+    is spent waiting for MAD-X, and the accelerator classes of e.g. the LHC
+    are created at runtime and cannot be pickled for other processes.
+
+    Returns:
+        dict dpp --> dict of the (cleaned) result tables, see _analyse_dpp
+    """
     model_creator = creator.CREATORS[accel_inst.NAME]["nominal"]
     model_creator.prepare_run(accel_inst, accel_inst.model_dir)
+    if processes > 1:
+        args = [(accel_inst, dpp, files_dict[dpp], output_path, algorithm, True, 0)
+                for dpp in files_dict]
+        pool = ThreadPool(processes=processes)
+        try:
+            results = pool.map(_analyse_dpp, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _create_models_by_madx(accel_inst, files_dict.keys())
+        results = [_analyse_dpp((accel_inst, dpp, files_dict[dpp], output_path, algorithm, False, None))
+                   for dpp in files_dict]
+    return dict(results)
+
+
+def _analyse_dpp(args):
+    """ Creates the model (if asked for) and runs GetLLM for one dpp.
+
+    Returns:
+        (dpp, dict result file name --> DataFrame without NaN rows, or None if not written)
+    """
+    accel_inst, dpp, files, output_path, algorithm, create_model, nprocesses = args
+    if create_model:
+        _create_models_by_madx(accel_inst, [dpp], log_suffix="_{:f}".format(dpp))
+    twiss_dpp_path = _join_with_output_path(output_path, "twiss_{:f}.dat".format(dpp))
+    getllm_path = tempfile.mkdtemp(prefix="getllm_{:f}_".format(dpp), dir=output_path)
+    try:
+        _rungetllm(twiss_dpp_path, files, dpp, getllm_path, accel_inst, algorithm, nprocesses)
+        # TODO: HOPE THAT GETLLM DOES A BETTER JOB
+        LOG.debug("Cleaning files of dpp {:f} of NAN! This should not be necessary!".format(dpp))
+        results = dict.fromkeys(RESULT_FILES)
+        for fname in os.listdir(getllm_path):
+            src_path = _join_with_output_path(getllm_path, fname)
+            data = tfs_remove_nan.clean_file(src_path, replace=True)
+            name = fname.replace(_ext(dpp), "")
+            if data is not None and name in results:
+                results[name] = data.set_index("NAME", drop=False)
+            shutil.move(src_path, _join_with_output_path(output_path, fname))
+    finally:
+        shutil.rmtree(getllm_path, ignore_errors=True)
+    return dpp, results
+
+
+def _create_models_by_madx(accel_inst, dpps, log_suffix=""):
+    """ Creates the needed models """
+    model_creator = creator.CREATORS[accel_inst.NAME]["nominal"]
     madx_script = accel_inst.get_multi_dpp_job(dpps)
     model_creator.run_madx(madx_script,
-                           logfile=os.path.join(accel_inst.model_dir, "w_analysis_multidpp.log"),
-                           writeto=os.path.join(accel_inst.model_dir, "w_analysis_multidpp.madx"),
+                           logfile=os.path.join(accel_inst.model_dir,
+                                                "w_analysis_multidpp{:s}.log".format(log_suffix)),
+                           writeto=os.path.join(accel_inst.model_dir,
+                                                "w_analysis_multidpp{:s}.madx".format(log_suffix)),
                            )
 
 
@@ -434,9 +410,11 @@ def _get_output_filenames(output_path, dpp=None):
     return ret
 
 
-def _rungetllm(twiss_filename, files, dpp, output_path, accel_inst, algorithm):
+def _rungetllm(twiss_filename, files, dpp, output_path, accel_inst, algorithm, nprocesses=None):
     """
     Running GetLLM...
+
+    nprocesses is passed to GetLLM if given (0: GetLLM runs serially).
     """
     import GetLLM
 
@@ -449,12 +427,14 @@ def _rungetllm(twiss_filename, files, dpp, output_path, accel_inst, algorithm):
         lhcphase = "0"
         accel_name = accel_inst.NAME.upper()  #TODO: TEST that! Should work for ESRF at least.
 
+    kwargs = {} if nprocesses is None else {"nprocesses": nprocesses}
     GetLLM.main(outputpath=output_path,
             files_to_analyse=','.join(files),
             model_filename=twiss_filename,
             accel=accel_name,
             tbtana=algorithm,
-            lhcphase=lhcphase)
+            lhcphase=lhcphase,
+            **kwargs)
     LOG.debug("GetLLM finished")
 
     for fname in _get_output_filenames(output_path):
@@ -479,79 +459,67 @@ def _ext(dpp=None):
 
 # for chromatic
 
-def _do_lin_reg_bet(fileobj, listx, listy, bpms, plane, zero, twiss):
+def _plane_char(plane):
+    return "x" if "H" in plane else "y"
+
+
+def _get_results(results, dpps, name):
+    return [results[dpp][name] for dpp in dpps]
+
+
+def _get_common_bpms(tables, model):
+    """
+    Returns the names of the BPMs in all tables and the model, sorted by S.
+    """
+    names = tables[0].index
+    for table in tables[1:]:
+        names = names[names.isin(table.index)]
+    in_model = names.str.upper().isin(model.index)
+    if not np.all(in_model):
+        LOG.debug("Not in Model: {:s}".format(", ".join(names[~in_model])))
+    names = names[in_model]
+    if len(names) == 0:
+        LOG.error("Zero intersection of Exp and Model")
+        LOG.error("Please, provide a good Dictionary or correct data")
+        sys.exit(1)
+    s_pos = tables[0].loc[names, "S"].values
+    return [names[i] for i in np.lexsort((np.asarray(names), s_pos))]
+
+
+def _get_columns(tables, bpms, column):
+    """ Returns the values of column as dpp x BPM matrix """
+    return np.array([table.loc[bpms, column].values for table in tables], dtype=np.float64)
+
+
+def _do_lin_reg_bet(fileobj, dpps, tables, plane, twiss):
     """
     Calculates stuff and writes to the file in a table
     Closes the file afterwards
 
     Args:
         fileobj: _chromFileWriter for output table
-        listx: List of variables...
-        listy: List of variables...
-        bpms: List of BPMs
+        dpps: List of dpp values
+        tables: List of getbeta tables, one per dpp
         plane: Which plane (H/V)
-        zero: Twiss for dp/p = 0
-        twiss: Twiss
+        twiss: Twiss of the model
     """
-    for bpm in bpms:
-        name = bpm[1]
-        sloc = bpm[0]
-        indx = []
-        b = []
-        a = []
-        bm = []
-        am = []
-        if "H" in plane:
-            beta0 = zero.BETX[zero.indx[name]]
-            alfa0 = zero.ALFX[zero.indx[name]]
-            try:
-                alfa0err = zero.STDALFX[zero.indx[name]]
-            except AttributeError:
-                alfa0err = zero.ERRALFX[zero.indx[name]]
-
-
-            beta0m = twiss.BETX[twiss.indx[name]]
-            alfa0m = twiss.ALFX[twiss.indx[name]]
-
-            wmo = twiss.WX[twiss.indx[name]]
-            pmo = twiss.PHIX[twiss.indx[name]]
-        else:
-
-            beta0 = zero.BETY[zero.indx[name]]
-            alfa0 = zero.ALFY[zero.indx[name]]
-            try:
-                alfa0err = zero.STDALFY[zero.indx[name]]
-            except AttributeError:
-                alfa0err = zero.ERRALFY[zero.indx[name]]
-
-            beta0m = twiss.BETY[twiss.indx[name]]
-            alfa0m = twiss.ALFY[twiss.indx[name]]
-
-            wmo = twiss.WY[twiss.indx[name]]
-            pmo = twiss.PHIY[twiss.indx[name]]
-        for dpp in listx:
-            _file = listy[dpp]
-            ix = _file.indx[name]
-            indx.append(ix)
-            if "H" in plane:
-                b.append(_file.BETX[ix])
-                a.append(_file.ALFX[ix])
-
-                bm.append(_file.BETXMDL[_file.indx[name]])
-                am.append(_file.ALFXMDL[_file.indx[name]])
-            else:
-                b.append(_file.BETY[ix])
-                a.append(_file.ALFY[ix])
-
-                bm.append(_file.BETYMDL[_file.indx[name]])
-                am.append(_file.ALFYMDL[_file.indx[name]])
-
-        bfit = linreg(listx, b)
-        afit = linreg(listx, a)
-
-        bfitm = linreg(listx, bm)
-        afitm = linreg(listx, am)
-
+    char = _plane_char(plane).upper()
+    bpms = _get_common_bpms(tables, twiss)
+    zero = tables[list(dpps).index(0)]
+    model_bpms = [bpm.upper() for bpm in bpms]
+
+    beta0 = zero.loc[bpms, "BET" + char].values
+    alfa0 = zero.loc[bpms, "ALF" + char].values
+    alfa0err = zero.loc[bpms, ("STDALF" if "STDALF" + char in zero.columns else "ERRALF") + char].values
+    beta0m = twiss.loc[model_bpms, "BET" + char].values
+    alfa0m = twiss.loc[model_bpms, "ALF" + char].values
+
+    bfit = linreg_columns(dpps, _get_columns(tables, bpms, "BET" + char))
+    afit = linreg_columns(dpps, _get_columns(tables, bpms, "ALF" + char))
+    bfitm = linreg_columns(dpps, _get_columns(tables, bpms, "BET" + char + "MDL"))
+    afitm = linreg_columns(dpps, _get_columns(tables, bpms, "ALF" + char + "MDL"))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
         # measurement
         dbb = bfit[0]/beta0
         dbberr = bfit[3]/beta0
@@ -560,11 +528,11 @@ def _do_lin_reg_bet(fileobj, listx, listy, bpms, plane, zero, twiss):
         A = dbb
         Aerr = dbberr
         B = da-alfa0*dbb
-        Berr = math.sqrt(daerr**2 + (alfa0err*dbb)**2 + (alfa0*dbberr)**2)
-        w = 0.5*math.sqrt(A**2+B**2)
-        werr = 0.5*math.sqrt( (Aerr*A/w)**2 + (Berr*B/w)**2  )
-        phi = math.atan2(B,A)/2./math.pi
-        phierr = 1./(1.+(A/B)**2)*math.sqrt( (Aerr/B)**2 + (A/B**2*Berr)**2)/2./math.pi
+        Berr = np.sqrt(daerr**2 + (alfa0err*dbb)**2 + (alfa0*dbberr)**2)
+        w = 0.5*np.sqrt(A**2+B**2)
+        werr = 0.5*np.sqrt( (Aerr*A/w)**2 + (Berr*B/w)**2  )
+        phi = np.arctan2(B,A)/2./np.pi
+        phierr = 1./(1.+(A/B)**2)*np.sqrt( (Aerr/B)**2 + (A/B**2*Berr)**2)/2./np.pi
 
         #model
         dbbm = bfitm[0]/beta0m
@@ -574,60 +542,41 @@ def _do_lin_reg_bet(fileobj, listx, listy, bpms, plane, zero, twiss):
         Am = dbbm
         Aerrm = dbberrm
         Bm = dam-alfa0m*dbbm
-        Berrm = math.sqrt(daerrm**2 + (alfa0m*dbberrm)**2)
-        wm = 0.5*math.sqrt(Am**2+Bm**2)
-        werrm = 0.5*math.sqrt( (Aerrm*Am/wm)**2 + (Berrm*Bm/wm)**2  )
-        phim = math.atan2(Bm,Am)/2./math.pi
-        phierrm = 1./(1.+(Am/Bm)**2)*math.sqrt( (Aerrm/Bm)**2 + (Am/Bm**2*Berrm)**2)/2./math.pi
-
-        fileobj.writeLine(locals().copy())
+        Berrm = np.sqrt(daerrm**2 + (alfa0m*dbberrm)**2)
+        wm = 0.5*np.sqrt(Am**2+Bm**2)
+        werrm = 0.5*np.sqrt( (Aerrm*Am/wm)**2 + (Berrm*Bm/wm)**2  )
+        phim = np.arctan2(Bm,Am)/2./np.pi
+        phierrm = 1./(1.+(Am/Bm)**2)*np.sqrt( (Aerrm/Bm)**2 + (Am/Bm**2*Berrm)**2)/2./np.pi
 
+    columns = dict(locals())
+    columns["name"] = bpms
+    columns["sloc"] = zero.loc[bpms, "S"].values
+    columns["wmo"] = twiss.loc[model_bpms, "W" + char].values
+    columns["pmo"] = twiss.loc[model_bpms, "PHI" + char].values
+    _write_columns(fileobj, columns)
 
-def _get_f(couplelist, dpplist, bpm_name, value):
-    """
-    calculates the linear regression of 'value' for each
-    dpp in dpplist
 
-    Args:
-        couplelist: list of getcouple files (for each dpp)
-        dpplist: list of all dpp values available
-        bpm_name: name of bpm
-        value: name of column (e.g. F1001R)
-    """
-    lst = []
-    x = []
-    for dpp in dpplist:
-        x.append(dpp)
-        couplefile = couplelist[dpp]
-        lst.append(getattr(couplefile, value)[couplefile.indx[bpm_name]])
-
-    lreg = linreg(x, lst)
-
-    return lreg[0], lreg[3]
-
-
-def _do_linreg_coupling(couplelist, bpms, dpplist, fileobj):
+def _do_linreg_coupling(fileobj, dpps, tables, twiss):
     """
     linreg for chromatic coupling
 
     Writes to fileobj the chromatic coupling.
     f1001, f1010 derivatives wrt dp/p, and errors.
     """
-    for bpm in bpms:
-        name = bpm[1]
-        sloc = bpm[0]
-
-        chr_f1001r, chr_err_f1001r = _get_f(couplelist, dpplist, name, 'F1001R')
-        chr_f1001i, chr_err_f1001i = _get_f(couplelist, dpplist, name, 'F1001I')
-        chr_f1010r, chr_err_f1010r = _get_f(couplelist, dpplist, name, 'F1010R')
-        chr_f1010i, chr_err_f1010i = _get_f(couplelist, dpplist, name, 'F1010I')
+    bpms = _get_common_bpms(tables, twiss)
+    columns = {"name": bpms, "sloc": tables[0].loc[bpms, "S"].values}
+    for prefix, column_prefix in (("chr", ""), ("mdl_chr", "MDL")):
+        for rdt in ("f1001r", "f1001i", "f1010r", "f1010i"):
+            fit = linreg_columns(dpps, _get_columns(tables, bpms, column_prefix + rdt.upper()))
+            columns["{:s}_{:s}".format(prefix, rdt)] = fit[0]
+            columns["{:s}_err_{:s}".format(prefix, rdt)] = fit[3]
+    _write_columns(fileobj, columns)
 
-        mdl_chr_f1001r, mdl_chr_err_f1001r = _get_f(couplelist, dpplist, name, 'MDLF1001R')
-        mdl_chr_f1001i, mdl_chr_err_f1001i = _get_f(couplelist, dpplist, name, 'MDLF1001I')
-        mdl_chr_f1010r, mdl_chr_err_f1010r = _get_f(couplelist, dpplist, name, 'MDLF1010R')
-        mdl_chr_f1010i, mdl_chr_err_f1010i = _get_f(couplelist, dpplist, name, 'MDLF1010I')
 
-        fileobj.writeLine(locals().copy())
+def _write_columns(fileobj, columns):
+    """ Writes the rows of the columns (dict column --> values per BPM) """
+    for idx in range(len(columns["name"])):
+        fileobj.writeLine({col: columns[col][idx] for col in fileobj.columns})
 
 
 def _get_tunes(model_file, fileslist):
@@ -698,6 +647,38 @@ def linreg(X, Y):
     return a, b, RR, np.sqrt(Var_a), np.sqrt(Var_b)
 
 
+def linreg_columns(X, Y):
+    """
+    Linear regressions y = ax + b for all columns of Y at once,
+    with the same formulas as linreg.
+
+    Args:
+        X: values of x (length N)
+        Y: N x M matrix, one regression per column
+
+    Returns:
+        a, b, R^2, error of a, error of b (arrays of length M)
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    if len(X) != len(Y):
+        raise ValueError('unequal length')
+    N = len(X)
+    Sx = np.sum(X)
+    Sxx = np.sum(X * X)
+    Sy = np.sum(Y, axis=0)
+    Sxy = np.dot(X, Y)
+    det = Sxx * N - Sx * Sx
+    a, b = (Sxy * N - Sy * Sx)/det, (Sxx * Sy - Sx * Sxy)/det
+    meanerror = np.sum((Y - Sy/N)**2, axis=0)
+    residual = np.sum((Y - a * X[:, None] - b)**2, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        RR = np.where((residual == 0) & (meanerror == 0), 1.0, 1 - residual/meanerror)
+    ss = residual / (N-2) if N > 2 else np.zeros_like(residual)
+    Var_a, Var_b = ss * N / det, ss * Sxx / det
+    return a, b, RR, np.sqrt(Var_a), np.sqrt(Var_b)
+
+
 def _join_with_output_path(output_path, *path_tokens):
     return os.path.join(output_path, *path_tokens)
 
@@ -58,11 +58,70 @@ from numpy.linalg import det as determinant
 from math import factorial
 
 
+import re
 import sys
+from StringIO import StringIO
+from collections import OrderedDict
+import pandas
+
+try:
+    from utils import tfs_cache
+except ImportError:
+    tfs_cache = None
 
 I = complex(0, 1)
 E = numpy.e
 PI = numpy.pi
+NAN_VALUES = ["nan", "NaN", "NAN", "-nan", "-NaN", "-NAN"]
+SKIP_ROW_CHARS = r"[@*$#]"
+_SKIP_ROW = re.compile(SKIP_ROW_CHARS)
+CACHE_READER_ID = "metaclass"
+
+class _ParsedTable(object):
+    def __init__(self, headers, columns, column_types):
+        self.headers = headers
+        self.columns = columns
+        self.column_types = column_types
+
+
+def _read_columns(table_data, labels, types):
+    """
+    Reads the whole table body with the pandas C parser. Columns of types
+    that metaclass does not understand are left empty.
+    """
+    dtypes = {}
+    for label, type_id in zip(labels, types):
+        if "%hd" in type_id or "%d" in type_id:
+            dtypes[label] = numpy.int64
+        elif "%le" in type_id:
+            dtypes[label] = numpy.float64
+        else:
+            dtypes[label] = str
+    float_labels = [label for label in labels if dtypes[label] is numpy.float64]
+    # As the line based parser did, skip lines with header characters (e.g. "S.DS.L1.B1$START")
+    table_lines = [line for line in table_data if not _SKIP_ROW.search(line)]
+    try:
+        table = pandas.read_csv(
+            StringIO("".join(table_lines)), sep=r"\s+", header=None, names=labels,
+            quotechar='"', index_col=False, dtype=dtypes,
+            keep_default_na=False,
+            na_values={label: NAN_VALUES for label in float_labels},
+            float_precision="round_trip",
+        )
+    except pandas.errors.EmptyDataError:
+        table = pandas.DataFrame({label: [] for label in labels})
+    columns = OrderedDict()
+    for label, type_id in zip(labels, types):
+        values = table[label].values
+        if "%im" in type_id:
+            values = numpy.array([complex(value) for value in values])
+        elif "s" in type_id:
+            values = numpy.array([value.replace("\"", "") for value in values], dtype=object)
+        elif not ("%hd" in type_id or "%d" in type_id or "%le" in type_id):
+            values = numpy.array([])
+        columns[label] = values
+    return columns
+
 
 class twiss:
     """Twiss parameters from madx output (with free choice of select items)"""
@@ -85,93 +144,98 @@ class twiss:
         self.__has_parsed_a_table_row = False 
         self.indx = {}
         self.keys = []
-        alllabels = []
+
+        cache_path = cached_table = None
+        if tfs_cache is not None:
+            cache_path = tfs_cache.get_cache_path(filename, CACHE_READER_ID)
+            cached_table = tfs_cache.load(cache_path)
+        if cached_table is None:
+            cached_table = self._parse_file(filename)
+            if tfs_cache is not None:
+                tfs_cache.store(cache_path, cached_table)
+        self._set_headers(cached_table.headers)
+        self._set_columns(cached_table.columns, cached_table.column_types)
+
+        if len(dictionary) > 0:
+            self.forknames(dictionary)
+
+    def _parse_file(self, filename):
+        """
+        Reads the header lines one by one and the table in bulk. Returns a
+        tfs_cache.CachedTable-like object with the raw headers and the
+        columns as numpy arrays.
+        """
+        raw_headers = []
+        alllabels = alltypes = None
 
         if filename.endswith(".gz"):
             import gzip
             f = gzip.open(filename, 'rb')
         else:
             f = open(filename, 'r')
-        for line in f:
-            is_line_parsed = False # Check if line was parsed otherwise print info (vimaier)
-            
-            if line.startswith("#"): # comment line
-                continue
-            
-            if ("@ " not in line and "@" in line):
-                line = line.replace("@" , "@ ")
-            split_line = line.split()
-            
-            if ("@ " in line and "%" in line and "s" not in split_line[2]):
+        try:
+            # readline instead of iteration, so the file position is right after the header
+            for line in iter(f.readline, ""):
+                if line.startswith("#"): # comment line
+                    continue
+                if ("@ " not in line and "@" in line):
+                    line = line.replace("@" , "@ ")
+                split_line = line.split()
+                if len(split_line) == 0:
+                    continue
+                if "@ " in line:
+                # Descriptor-line
+                    raw_headers.append((split_line[1], split_line[2], " ".join(split_line[3:])))
+                elif ("* " in line or "*\t" in line):
+                # Columns-names-line
+                    alllabels = split_line
+                elif ("$ " in line or "$\t" in line):
+                # Columns-datatypes-line
+                    alltypes = split_line
+                else:
+                    print >> sys.stderr,"Did not parse line ("," ".join(split_line),") in ",filename
+                if alllabels is not None and alltypes is not None:
+                    break
+            if alltypes is None or alllabels is None:
+                print >> sys.stderr, "From Metaclass: Bad format or empty file ", filename
+                raise ValueError
+            columns = _read_columns(f, alllabels[1:], alltypes[1:])
+        finally:
+            f.close()
+        return _ParsedTable(raw_headers, columns, alltypes[1:])
+
+    def _set_headers(self, raw_headers):
+        for label, type_id, raw_value in raw_headers:
+            if "%" in type_id and "s" not in type_id:
             # Float-Descriptor-line
-                label = split_line[1]
                 try:
-                    setattr(self, label, float(split_line[3].replace("\"", "")))
-                except:
-                    print "Problem parsing:", line, 
+                    setattr(self, label, float(raw_value.split()[0].replace("\"", "")))
+                except (ValueError, IndexError):
+                    print "Problem parsing:", label, type_id, raw_value,
                     print "Going to be parsed as string"
                     try:
-                        setattr(self, label, split_line[3].replace("\"", ""))
-                    except:
+                        setattr(self, label, raw_value.split()[0].replace("\"", ""))
+                    except IndexError:
                         print "Problem persists, let's ignore it!"
-                is_line_parsed = True
-            elif ("@ " in line and "s" in split_line[2]):
+            elif "s" in type_id:
             # String-Descriptor-line
-                label = split_line[1].replace(":", "")
-                setattr(self, label, " ".join(split_line[3:]).replace("\"", ""))
-                is_line_parsed = True
-                
-            if ("* " in line or "*\t" in line):
-            # Columns-names-line
-                alllabels = split_line
-                for alllabels_item in alllabels[1:]:
-                    setattr(self, alllabels_item, [])
-                    self.keys.append(alllabels_item)
-                is_line_parsed = True
-
-            if ("$ " in line or "$\t" in line):
-            # Columns-datatypes-line
-                alltypes = split_line
-                is_line_parsed = True
-
-            if ("@" not in line and "*" not in line and "$" not in line and "#" not in line):
-            # Table-entry-line
-                values = split_line
-                for j in range(0,len(values)):
-                    if ("%hd" in alltypes[j + 1] or "%d" in alltypes[j + 1] ):
-                        getattr(self, alllabels[j + 1]).append(int(values[j]))
-                    if ("%le" in alltypes[j + 1]):
-                        getattr(self, alllabels[j + 1]).append(float(values[j]))
-                    if ("%im" in alltypes[j + 1]):
-                        getattr(self, alllabels[j + 1]).append(complex(values[j]))
-                    if ("s" in alltypes[j+1]):
-                        getattr(self, alllabels[j + 1]).append(values[j].replace("\"", ""))
-                        if "NAME" == alllabels[j + 1]:
-                            NAME = getattr(self, "NAME")
-                            self.indx[values[j].replace("\"", "")] = len(NAME) - 1
-                            self.indx[values[j].replace("\"", "").upper()] = len(NAME) - 1
-                            self.indx[values[j].replace("\"", "").lower()] = len(NAME) - 1
-                self.__has_parsed_a_table_row = True
-                is_line_parsed = True
-            
-            if not is_line_parsed:
-                print >> sys.stderr,"Did not parse line ("," ".join(split_line),") in ",filename
-
-        f.close()
-        try:
-            alltypes
-        except:
-            print >> sys.stderr, "From Metaclass: Bad format or empty file ", filename
-            raise ValueError
-
+                setattr(self, label.replace(":", ""), raw_value.replace("\"", ""))
 
-        for j in range(1, len(alllabels)):
-            if (("%le" in alltypes[j]) | ("%hd" in alltypes[j])):
-                setattr(self, alllabels[j], numpy.array(getattr(self, alllabels[j])))
+    def _set_columns(self, columns, column_types):
+        for (label, values), type_id in zip(columns.items(), column_types):
+            self.keys.append(label)
+            if ("%le" in type_id) or ("%hd" in type_id):
+                setattr(self, label, numpy.asarray(values))
+            else:
+                setattr(self, label, values.tolist())
+            if "NAME" == label and "s" in type_id:
+                for index, name in enumerate(values.tolist()):
+                    self.indx[name] = index
+                    self.indx[name.upper()] = index
+                    self.indx[name.lower()] = index
+            if len(values) > 0:
+                self.__has_parsed_a_table_row = True
 
-        if len(dictionary) > 0:
-            self.forknames(dictionary)
-            
     def has_bpm_data(self):
         return self.__has_parsed_a_table_row
     
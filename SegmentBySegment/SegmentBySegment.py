@@ -8,7 +8,11 @@ Created on 11/09/09
 from __future__ import print_function
 import os
 import sys
+import shutil
 import argparse
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from math import sqrt
 import json
@@ -36,6 +40,8 @@ import sbs_writers.sbs_coupling_writer
 import sbs_writers.sbs_chromatic_writer
 import sbs_writers.sbs_special_element_writer
 
+PROCESSES = multiprocessing.cpu_count()
+
 
 #===================================================================================================
 # parse_args()-function
@@ -78,6 +84,9 @@ def _parse_args(args=None):
     parser.add_argument("-w", "--w",  # Path to Chromaticity functions
                         help="Path to  chromaticity functions, by default this is skiped",
                         metavar="wpath", default="0", dest="wpath")
+    parser.add_argument("-n", "--processes",
+                        help="Maximum number of MAD-X processes running at the same time",
+                        metavar="processes", default=PROCESSES, type=int, dest="processes")
     options, accel_args = parser.parse_known_args(args)
 
     accel_cls = manager.get_accel_class(accel_args)
@@ -107,7 +116,8 @@ def main(accel_cls, options):
         w_path = measurement_path
     input_data = _InputData(measurement_path, w_path)
 
-    save_path = options.save + os.path.sep
+    # MAD-X runs in a working directory per element, the paths in the scripts must be absolute
+    save_path = os.path.abspath(options.save) + os.path.sep
     utils.iotools.create_dirs(save_path)
 
     elements_data = options.segf.split(',')
@@ -125,6 +135,9 @@ def main(accel_cls, options):
 
     summaries = _Summaries(save_path)
 
+    # The elements are prepared one after the other, their MAD-X jobs run at the same time and
+    # the results are written in the input order, as soon as the jobs before are done.
+    elements = []
     for element_name in elements_names:
 
         print("Started processing", element_name)
@@ -150,49 +163,47 @@ def main(accel_cls, options):
         )
 
         if not options.madpass:
-            _run4mad(save_path,
-                     accel_instance,
-                     start_bpm_horizontal_data,
-                     start_bpm_vertical_data,
-                     end_bpm_horizontal_data,
-                     end_bpm_vertical_data,
-                     start_bpm_dispersion,
-                     end_bpm_dispersion,
-                     f_ini,
-                     f_end,
-                     chrom_ini,
-                     chrom_end,
-                     options.path,
-                     twiss_directory,
-                     input_data.couple_method,
-                     options.bb,
-                     options.mad)
+            mad_job = _prepare4mad(save_path,
+                                   accel_instance,
+                                   start_bpm_horizontal_data,
+                                   start_bpm_vertical_data,
+                                   end_bpm_horizontal_data,
+                                   end_bpm_vertical_data,
+                                   start_bpm_dispersion,
+                                   end_bpm_dispersion,
+                                   f_ini,
+                                   f_end,
+                                   chrom_ini,
+                                   chrom_end,
+                                   options.path,
+                                   twiss_directory,
+                                   input_data.couple_method,
+                                   options.bb,
+                                   options.mad)
 
         else:
             print("Just rerunning mad")
             mad_file_path, log_file_path = _get_files_for_mad(save_path,
                                                               element_name)
-            madx_wrapper.resolve_and_run_file(mad_file_path,
-                                              log_file=log_file_path)
-
-        propagated_models = _PropagatedModels(save_path, element_name)
-
-        kmod_data_file_x, kmod_data_file_y = _get_kmod_files()
-
-        getAndWriteData(element_name,
-                        input_data,
-                        input_model,
-                        propagated_models,
-                        save_path,
-                        is_element,
-                        element_has_dispersion,
-                        element_has_coupling,
-                        element_has_chrom,
-                        accel_instance,
-                        summaries,
-                        kmod_data_file_x,
-                        kmod_data_file_y)
-        print("Everything done for", element_name, "\n")
+            # Scripts of previous runs may have relative paths, they run in the current directory
+            mad_job = (madx_wrapper.resolve_and_run_file, (mad_file_path,), {"log_file": log_file_path})
+
+        elements.append((element_name, is_element, element_has_dispersion, element_has_coupling,
+                         element_has_chrom, accel_instance, mad_job))
+
+    processes = getattr(options, "processes", PROCESSES)
+    pool = ThreadPool(max(1, min(processes, len(elements))))
+    try:
+        mad_results = pool.imap(_run_mad_job, [element[-1] for element in elements])
+        for element, _ in zip(elements, mad_results):
+            (element_name, is_element, element_has_dispersion, element_has_coupling,
+             element_has_chrom, accel_instance, _) = element
+            _write_element(element_name, input_data, input_model, save_path, is_element,
+                           element_has_dispersion, element_has_coupling, element_has_chrom,
+                           accel_instance, summaries)
+    finally:
+        pool.close()
+        pool.join()
 
     summaries.write_summaries_to_files()
 
@@ -201,6 +212,34 @@ def main(accel_cls, options):
 # END main() ---------------------------------------------------------------------------------------
 
 
+def _run_mad_job(mad_job):
+    function, args, kwargs = mad_job
+    return function(*args, **kwargs)
+
+
+def _write_element(element_name, input_data, input_model, save_path, is_element,
+                   element_has_dispersion, element_has_coupling, element_has_chrom,
+                   accel_instance, summaries):
+    propagated_models = _PropagatedModels(save_path, element_name)
+
+    kmod_data_file_x, kmod_data_file_y = _get_kmod_files()
+
+    getAndWriteData(element_name,
+                    input_data,
+                    input_model,
+                    propagated_models,
+                    save_path,
+                    is_element,
+                    element_has_dispersion,
+                    element_has_coupling,
+                    element_has_chrom,
+                    accel_instance,
+                    summaries,
+                    kmod_data_file_x,
+                    kmod_data_file_y)
+    print("Everything done for", element_name, "\n")
+
+
 def structure_elements_info(elements_data):
     start_bpms = {}
     end_bpms = {}
@@ -657,7 +696,7 @@ def getAndWriteData(
                                                                        accel_instance)
 
 
-def _run4mad(save_path,
+def _prepare4mad(save_path,
              accel_instance,
              start_bpm_horizontal_data,
              start_bpm_vertical_data,
@@ -753,7 +792,7 @@ def _run4mad(save_path,
         for name, value in measurement_dict.iteritems():
             measurement_file.write(name + " = " + str(value) + ";\n")
 
-    _runmad(accel_instance, save_path, mad_file_path, log_file_path)
+    return _runmad, (accel_instance, save_path, mad_file_path, log_file_path), {}
 
 
 def _get_R_terms(betx, bety, alfx, alfy, f1001r, f1001i, f1010r, f1010i):
@@ -833,8 +872,13 @@ def _get_corrections_file_comments_for_ip(accel_instance):
 
 
 def _runmad(accel_instance, path, madx_file_path, log_file_path):
-    creator.create_model(accel_instance, "segment", path,
-                         logfile=log_file_path, writeto=madx_file_path)
+    # MADX writes some files in its working directory, every element gets its own
+    work_dir = tempfile.mkdtemp(prefix="madx_" + accel_instance.label + "_", dir=path)
+    try:
+        creator.create_model(accel_instance, "segment", path,
+                             logfile=log_file_path, writeto=madx_file_path, cwd=work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
     print("MAD done, log file:", log_file_path)
 
 
@@ -2,9 +2,12 @@ import __init__  # @UnusedImport
 import os
 import sys
 
+import numpy as np
+
 import sbs_beta_writer
-from math import sqrt
+from sbs_beta_writer import column_at
 from utils import tfs_file_writer
+from segment_by_segment import sbs_math
 
 
 def write_beta_beat(element_name,
@@ -131,83 +134,67 @@ def _write_beta_beat_from_phase_for_plane(file_beta_beat, plane, bpms_list,
                                           measured_beta_phase, model_propagation, model_cor,
                                           model_back_propagation, model_back_cor,
                                           initial_values):
+    bpm_names = [bpm[1] for bpm in bpms_list]
 
-    for bpm in bpms_list:
-        bpm_s = bpm[0]
-        bpm_name = bpm[1]
-
-        delta_phase_prop = (getattr(model_propagation, "MU" + plane)[model_propagation.indx[bpm_name]]) % 1
-        delta_phase_back = (getattr(model_back_propagation, "MU" + plane)[model_back_propagation.indx[bpm_name]]) % 1
-
-        beta_propagation = _get_from_twiss(model_propagation, bpm_name, "BET", plane)
-        beta_back_propagation = _get_from_twiss(model_back_propagation, bpm_name, "BET", plane)
-
-        # Beta from phase beating (front)
-        beta_phase = _get_from_twiss(measured_beta_phase, bpm_name, "BET", plane)
-        beta_beat_phase = (beta_phase - beta_propagation) / beta_propagation
-        syst_err_beta_phase = _get_from_twiss(measured_beta_phase, bpm_name, "ERRBET", plane)
-        stdbet_exist = True
-        try:
-            rand_err_beta_phase = _get_from_twiss(measured_beta_phase, bpm_name, "STDBET", plane)
-        except AttributeError:
-            stdbet_exist = False
-
-        prop_err_beta_phase = sbs_beta_writer._propagate_error_beta(
-            initial_values.err_beta_start,
-            initial_values.err_alfa_start,
-            delta_phase_prop,
-            beta_phase,
-            initial_values.beta_start,
-            initial_values.alfa_start
-        )
-        if stdbet_exist:
-            err_beta_beat_phase = sqrt(syst_err_beta_phase ** 2 +
-                                       rand_err_beta_phase ** 2 +
-                                       prop_err_beta_phase ** 2) / beta_propagation
-        else:
-            err_beta_beat_phase = sqrt(syst_err_beta_phase ** 2 +
-                                       prop_err_beta_phase ** 2) / beta_propagation
-        # Beta from corrected model beating (front)
-        beta_cor = _get_from_twiss(model_cor, bpm_name, "BET", plane)
-        beta_beat_cor = (beta_cor - beta_propagation) / beta_propagation
-
-        # Beta from phase beating (back)
-        beta_beat_phase_back = (beta_phase - beta_back_propagation) / beta_back_propagation
-        syst_err_beta_phase_back = _get_from_twiss(measured_beta_phase, bpm_name, "ERRBET", plane)
-        stdbet_exist = True
-        try:
-            rand_err_beta_phase_back = _get_from_twiss(measured_beta_phase, bpm_name, "STDBET", plane)
-        except AttributeError:
-            stdbet_exist = False
-        prop_err_beta_phase_back = sbs_beta_writer._propagate_error_beta(
-            initial_values.err_beta_end,
-            initial_values.err_alfa_end,
-            delta_phase_back,
-            beta_phase,
-            initial_values.beta_end,
-            initial_values.alfa_end
+    delta_phase_prop = column_at(model_propagation, "MU" + plane, bpm_names) % 1
+    delta_phase_back = column_at(model_back_propagation, "MU" + plane, bpm_names) % 1
+
+    beta_propagation = column_at(model_propagation, "BET" + plane, bpm_names)
+    beta_back_propagation = column_at(model_back_propagation, "BET" + plane, bpm_names)
+
+    # Not every beta from phase file has the STDBET columns
+    beta_phase = column_at(measured_beta_phase, "BET" + plane, bpm_names)
+    meas_err_beta_phase = column_at(measured_beta_phase, "ERRBET" + plane, bpm_names)
+    if hasattr(measured_beta_phase, "STDBET" + plane):
+        meas_err_beta_phase = np.sqrt(
+            meas_err_beta_phase ** 2 +
+            column_at(measured_beta_phase, "STDBET" + plane, bpm_names) ** 2
         )
-        if stdbet_exist:
-            err_beta_beat_phase_back = sqrt(syst_err_beta_phase_back ** 2 +
-                                            rand_err_beta_phase_back ** 2 +
-                                            prop_err_beta_phase_back) / beta_back_propagation
-        else:
-            err_beta_beat_phase_back = sqrt(syst_err_beta_phase_back ** 2 +
-                                            prop_err_beta_phase_back) / beta_back_propagation
-
-        # Beta from corrected model beating (back)
-        beta_back_cor = _get_from_twiss(model_back_cor, bpm_name, "BET", plane)
-        beta_beat_back_cor = (beta_back_cor - beta_back_propagation) / beta_back_propagation
-
-        model_s = measured_beta_phase.S[measured_beta_phase.indx[bpm_name]]
-        beta_model = _get_from_twiss(measured_beta_phase, bpm_name, "BET", plane, "MDL")
+
+    # Beta from phase beating (front)
+    beta_beat_phase = (beta_phase - beta_propagation) / beta_propagation
+    prop_err_beta_phase = sbs_math.propagate_error_beta(
+        initial_values.err_beta_start,
+        initial_values.err_alfa_start,
+        delta_phase_prop,
+        beta_phase,
+        initial_values.beta_start,
+        initial_values.alfa_start
+    )
+    err_beta_beat_phase = np.sqrt(meas_err_beta_phase ** 2 +
+                                  prop_err_beta_phase ** 2) / beta_propagation
+
+    # Beta from corrected model beating (front)
+    beta_cor = column_at(model_cor, "BET" + plane, bpm_names)
+    beta_beat_cor = (beta_cor - beta_propagation) / beta_propagation
+
+    # Beta from phase beating (back)
+    beta_beat_phase_back = (beta_phase - beta_back_propagation) / beta_back_propagation
+    prop_err_beta_phase_back = sbs_math.propagate_error_beta(
+        initial_values.err_beta_end,
+        initial_values.err_alfa_end,
+        delta_phase_back,
+        beta_phase,
+        initial_values.beta_end,
+        initial_values.alfa_end
+    )
+    err_beta_beat_phase_back = np.sqrt(meas_err_beta_phase ** 2 +
+                                       prop_err_beta_phase_back ** 2) / beta_back_propagation
+
+    # Beta from corrected model beating (back)
+    beta_back_cor = column_at(model_back_cor, "BET" + plane, bpm_names)
+    beta_beat_back_cor = (beta_back_cor - beta_back_propagation) / beta_back_propagation
+
+    model_s = column_at(measured_beta_phase, "S", bpm_names)
+    beta_model = column_at(measured_beta_phase, "BET" + plane + "MDL", bpm_names)
+    for i, (bpm_s, bpm_name) in enumerate(bpms_list):
         file_beta_beat.add_table_row([
             bpm_name, bpm_s,
-            beta_beat_phase, err_beta_beat_phase,
-            beta_beat_cor,
-            beta_beat_phase_back, err_beta_beat_phase_back,
-            beta_beat_back_cor,
-            beta_model, model_s
+            beta_beat_phase[i], err_beta_beat_phase[i],
+            beta_beat_cor[i],
+            beta_beat_phase_back[i], err_beta_beat_phase_back[i],
+            beta_beat_back_cor[i],
+            beta_model[i], model_s[i]
         ])
     file_beta_beat.write_to_file()
 
@@ -216,115 +203,75 @@ def _write_beta_beat_from_amp_for_plane(file_beta_beat, plane, bpms_list,
                                         measured_beta_amp, model_propagation, model_cor,
                                         model_back_propagation, model_back_cor,
                                         initial_values):
-
-    for bpm in bpms_list:
-        bpm_s = bpm[0]
-        bpm_name = bpm[1]
-
-        delta_phase_prop = (getattr(model_propagation, "MU" + plane)[model_propagation.indx[bpm_name]]) % 1
-        delta_phase_back = (getattr(model_back_propagation, "MU" + plane)[model_back_propagation.indx[bpm_name]]) % 1
-
-        beta_propagation = _get_from_twiss(model_propagation, bpm_name, "BET", plane)
-        beta_back_propagation = _get_from_twiss(model_back_propagation, bpm_name, "BET", plane)
-
-        # Beta from amplitude beating (front)
-        beta_amp = _get_from_twiss(measured_beta_amp, bpm_name, "BET", plane)
-        beta_beat_amp = (beta_amp - beta_propagation) / beta_propagation
-        std_beta_beat_amp = _get_from_twiss(measured_beta_amp, bpm_name, "BET", plane, "STD")
-        prop_err_beta_amp = sbs_beta_writer._propagate_error_beta(
-            initial_values.err_beta_start,
-            initial_values.err_alfa_start,
-            delta_phase_prop,
-            beta_propagation,
-            initial_values.beta_start,
-            initial_values.alfa_start
-        )
-        err_beta_beat_amp = sqrt(std_beta_beat_amp ** 2 +
-                                 prop_err_beta_amp ** 2) / beta_propagation
-
-        # Beta from amplitude beating (back)
-        beta_amp_back = _get_from_twiss(measured_beta_amp, bpm_name, "BET", plane)
-        beta_beat_amp_back = (beta_amp_back - beta_back_propagation) / beta_back_propagation
-        std_beta_beat_amp_back = _get_from_twiss(measured_beta_amp, bpm_name, "BET", plane, "STD")
-        prop_err_beta_amp_back = sbs_beta_writer._propagate_error_beta(
-            initial_values.err_beta_end,
-            initial_values.err_alfa_end,
-            delta_phase_back,
-            beta_back_propagation,
-            initial_values.beta_end,
-            initial_values.alfa_end
-        )
-        err_beta_beat_amp_back = sqrt(std_beta_beat_amp_back ** 2 +
-                                      prop_err_beta_amp_back ** 2) / beta_back_propagation
-
-        model_s = measured_beta_amp.S[measured_beta_amp.indx[bpm_name]]
-        beta_model = _get_from_twiss(measured_beta_amp, bpm_name, "BET", plane, "MDL")
-        file_beta_beat.add_table_row([
-            bpm_name, bpm_s,
-            beta_beat_amp, err_beta_beat_amp,
-            beta_beat_amp_back, err_beta_beat_amp_back,
-            beta_model, model_s
-        ])
-    file_beta_beat.write_to_file()
+    _write_beta_beat_with_std_for_plane(
+        file_beta_beat, plane, bpms_list, measured_beta_amp, "BET" + plane + "STD",
+        model_propagation, model_back_propagation, initial_values
+    )
 
 
 def _write_kmod_beta_beat_for_plane(file_kmod_beta_beat, plane, bpms_list,
                                     measured_kmod, model_propagation, model_cor,
                                     model_back_propagation, model_back_cor,
                                     initial_values):
-    for bpm in bpms_list:
-        bpm_s = bpm[0]
-        bpm_name = bpm[1]
-
-        delta_phase_prop = (getattr(model_propagation, "MU" + plane)[model_propagation.indx[bpm_name]]) % 1
-        delta_phase_back = (getattr(model_back_propagation, "MU" + plane)[model_back_propagation.indx[bpm_name]]) % 1
-
-        beta_propagation = _get_from_twiss(model_propagation, bpm_name, "BET", plane)
-        beta_back_propagation = _get_from_twiss(model_back_propagation, bpm_name, "BET", plane)
-
-        # Beta from kmod beating (front)
-        beta_kmod = _get_from_twiss(measured_kmod, bpm_name, "BET", plane)
-        beta_beat_kmod = (beta_kmod - beta_propagation) / beta_propagation
-        std_beta_beat_kmod = _get_from_twiss(measured_kmod, bpm_name, "STDBET", plane)
-        prop_err_beta_kmod = sbs_beta_writer._propagate_error_beta(
-            initial_values.err_beta_start,
-            initial_values.err_alfa_start,
-            delta_phase_prop,
-            beta_propagation,
-            initial_values.beta_start,
-            initial_values.alfa_start
-        )
-        err_beta_beat_kmod = sqrt(std_beta_beat_kmod ** 2 +
-                                  prop_err_beta_kmod ** 2) / beta_propagation
-
-        # Beta from kmod beating (back)
-        beta_kmod_back = _get_from_twiss(measured_kmod, bpm_name, "BET", plane)
-        beta_beat_kmod_back = (beta_kmod_back - beta_back_propagation) / beta_back_propagation
-        std_beta_beat_kmod_back = _get_from_twiss(measured_kmod, bpm_name, "STDBET", plane)
-        prop_err_beta_kmod_back = sbs_beta_writer._propagate_error_beta(
-            initial_values.err_beta_end,
-            initial_values.err_alfa_end,
-            delta_phase_back,
-            beta_back_propagation,
-            initial_values.beta_end,
-            initial_values.alfa_end
-        )
-        err_beta_beat_kmod_back = sqrt(std_beta_beat_kmod_back ** 2 +
-                                       prop_err_beta_kmod_back ** 2) / beta_back_propagation
+    _write_beta_beat_with_std_for_plane(
+        file_kmod_beta_beat, plane, bpms_list, measured_kmod, "STDBET" + plane,
+        model_propagation, model_back_propagation, initial_values
+    )
+
 
-        model_s = measured_kmod.S[measured_kmod.indx[bpm_name]]
-        beta_model = _get_from_twiss(measured_kmod, bpm_name, "BET", plane, "MDL")
-        file_kmod_beta_beat.add_table_row([
+def _write_beta_beat_with_std_for_plane(file_beta_beat, plane, bpms_list,
+                                        measured_beta, std_column,
+                                        model_propagation, model_back_propagation,
+                                        initial_values):
+    """Beating of a measured beta with its error in std_column, i.e. from
+    amplitude or K-modulation, against the propagated models."""
+    bpm_names = [bpm[1] for bpm in bpms_list]
+
+    delta_phase_prop = column_at(model_propagation, "MU" + plane, bpm_names) % 1
+    delta_phase_back = column_at(model_back_propagation, "MU" + plane, bpm_names) % 1
+
+    beta_propagation = column_at(model_propagation, "BET" + plane, bpm_names)
+    beta_back_propagation = column_at(model_back_propagation, "BET" + plane, bpm_names)
+
+    beta_meas = column_at(measured_beta, "BET" + plane, bpm_names)
+    std_beta_meas = column_at(measured_beta, std_column, bpm_names)
+
+    # Front
+    beta_beat = (beta_meas - beta_propagation) / beta_propagation
+    prop_err_beta = sbs_math.propagate_error_beta(
+        initial_values.err_beta_start,
+        initial_values.err_alfa_start,
+        delta_phase_prop,
+        beta_propagation,
+        initial_values.beta_start,
+        initial_values.alfa_start
+    )
+    err_beta_beat = np.sqrt(std_beta_meas ** 2 +
+                            prop_err_beta ** 2) / beta_propagation
+
+    # Back
+    beta_beat_back = (beta_meas - beta_back_propagation) / beta_back_propagation
+    prop_err_beta_back = sbs_math.propagate_error_beta(
+        initial_values.err_beta_end,
+        initial_values.err_alfa_end,
+        delta_phase_back,
+        beta_back_propagation,
+        initial_values.beta_end,
+        initial_values.alfa_end
+    )
+    err_beta_beat_back = np.sqrt(std_beta_meas ** 2 +
+                                 prop_err_beta_back ** 2) / beta_back_propagation
+
+    model_s = column_at(measured_beta, "S", bpm_names)
+    beta_model = column_at(measured_beta, "BET" + plane + "MDL", bpm_names)
+    for i, (bpm_s, bpm_name) in enumerate(bpms_list):
+        file_beta_beat.add_table_row([
             bpm_name, bpm_s,
-            beta_beat_kmod, err_beta_beat_kmod,
-            beta_beat_kmod_back, err_beta_beat_kmod_back,
-            beta_model, model_s
+            beta_beat[i], err_beta_beat[i],
+            beta_beat_back[i], err_beta_beat_back[i],
+            beta_model[i], model_s[i]
         ])
-    file_kmod_beta_beat.write_to_file()
-
-
-def _get_from_twiss(twiss_data, element, column, plane, suffix=""):
-    return getattr(twiss_data, column + plane + suffix)[twiss_data.indx[element]]
+    file_beta_beat.write_to_file()
 
 
 def intersect(list_of_files):
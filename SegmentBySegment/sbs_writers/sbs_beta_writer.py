@@ -5,6 +5,8 @@ import numpy as np
 import math
 
 from utils import tfs_file_writer
+from segment_by_segment import sbs_math
+from segment_by_segment.sbs_math import weighted_average_for_SbS_elements
 
 
 def write_beta(element_name, is_element, measured_hor_beta, measured_ver_beta, input_model, propagated_models, save_path, beta_summary_file):
@@ -97,105 +99,112 @@ def _write_beta_for_plane(file_alfa, file_beta, plane, element_name, bpms_list,
      beta_end, err_beta_end, alfa_end, err_alfa_end) = _get_start_end_betas(bpms_list, measured_beta, plane)
 
     summary_data = []
+    bpm_names = [bpm[1] for bpm in bpms_list]
 
-    for bpm in bpms_list:
-        bpm_s = bpm[0]
-        bpm_name = bpm[1]
+    beta_propagation = column_at(model_propagation, "BET" + plane, bpm_names)
+    beta_back_propagation = column_at(model_back_propagation, "BET" + plane, bpm_names)
 
-        beta_propagation = getattr(model_propagation, "BET" + plane)[model_propagation.indx[bpm_name]]
-        beta_back_propagation = getattr(model_back_propagation, "BET" + plane)[model_back_propagation.indx[bpm_name]]
+    alfa_propagation = column_at(model_propagation, "ALF" + plane, bpm_names)
+    alfa_back_propagation = column_at(model_back_propagation, "ALF" + plane, bpm_names)
 
-        alfa_propagation = getattr(model_propagation, "ALF" + plane)[model_propagation.indx[bpm_name]]
-        alfa_back_propagation = getattr(model_back_propagation, "ALF" + plane)[model_back_propagation.indx[bpm_name]]
+    delta_phase_prop = column_at(model_propagation, "MU" + plane, bpm_names) % 1
+    delta_phase_back = column_at(model_back_propagation, "MU" + plane, bpm_names) % 1
 
-        delta_phase_prop = (getattr(model_propagation, "MU" + plane)[model_propagation.indx[bpm_name]]) % 1
-        delta_phase_corr = (getattr(model_cor, "MU" + plane)[model_cor.indx[bpm_name]]) % 1
-        delta_phase_back = (getattr(model_back_propagation, "MU" + plane)[model_back_propagation.indx[bpm_name]]) % 1
-        delta_phase_back_corr = (getattr(model_back_cor, "MU" + plane)[model_back_cor.indx[bpm_name]]) % 1
+    err_beta_prop, err_alfa_prop = _propagate_errors_beta_alfa(
+        err_beta_start, err_alfa_start, delta_phase_prop,
+        beta_propagation, alfa_propagation, beta_start, alfa_start
+    )
+    err_beta_back, err_alfa_back = _propagate_errors_beta_alfa(
+        err_beta_end, err_alfa_end, delta_phase_back,
+        beta_back_propagation, alfa_back_propagation, beta_end, alfa_end
+    )
 
-        err_beta_prop = _propagate_error_beta(err_beta_start, err_alfa_start, delta_phase_prop, beta_propagation, beta_start, alfa_start)
-        err_alfa_prop = _propagate_error_alfa(err_beta_start, err_alfa_start, delta_phase_prop, alfa_propagation, beta_start, alfa_start)
-        err_beta_back = _propagate_error_beta(err_beta_end, err_alfa_end, delta_phase_back, beta_back_propagation, beta_end, alfa_end)
-        err_alfa_back = _propagate_error_beta(err_beta_end, err_alfa_end, delta_phase_back, beta_back_propagation, beta_end, alfa_end)
+    if not is_element:
+        model_s = column_at(measured_beta, "S", bpm_names)
+        beta_model = column_at(measured_beta, "BET" + plane + "MDL", bpm_names)
+        alfa_model = column_at(measured_beta, "ALF" + plane + "MDL", bpm_names)
+
+        beta_cor = column_at(model_cor, "BET" + plane, bpm_names)
+        alfa_cor = column_at(model_cor, "ALF" + plane, bpm_names)
+        delta_phase_corr = column_at(model_cor, "MU" + plane, bpm_names) % 1
+        err_beta_cor, err_alfa_cor = _propagate_errors_beta_alfa(
+            err_beta_start, err_alfa_start, delta_phase_corr,
+            beta_cor, alfa_cor, beta_start, alfa_start
+        )
+
+        beta_back_cor = column_at(model_back_cor, "BET" + plane, bpm_names)
+        alfa_back_cor = column_at(model_back_cor, "ALF" + plane, bpm_names)
+        delta_phase_back_corr = column_at(model_back_cor, "MU" + plane, bpm_names) % 1
+        err_beta_back_cor, err_alfa_back_cor = _propagate_errors_beta_alfa(
+            err_beta_end, err_alfa_end, delta_phase_back_corr,
+            beta_back_cor, alfa_back_cor, beta_end, alfa_end
+        )
 
-        if not is_element:
-            model_s = measured_beta.S[measured_beta.indx[bpm_name]]
-            beta_model = getattr(measured_beta, "BET" + plane + "MDL")[measured_beta.indx[bpm_name]]
-            alfa_model = getattr(measured_beta, "ALF" + plane + "MDL")[measured_beta.indx[bpm_name]]
+        for i, (bpm_s, bpm_name) in enumerate(bpms_list):
+            file_beta.add_table_row([bpm_name, bpm_s,
+                                     beta_propagation[i], err_beta_prop[i], beta_cor[i], err_beta_cor[i],
+                                     beta_back_propagation[i], err_beta_back[i], beta_back_cor[i], err_beta_back_cor[i],
+                                     beta_model[i], model_s[i]])
+            file_alfa.add_table_row([bpm_name, bpm_s,
+                                     alfa_propagation[i], err_alfa_prop[i], alfa_cor[i], err_alfa_cor[i],
+                                     alfa_back_propagation[i], err_alfa_back[i], alfa_back_cor[i], err_alfa_back_cor[i],
+                                     alfa_model[i], model_s[i]])
+    else:
+        model_s = column_at(input_model, "S", bpm_names)
+        beta_model = column_at(input_model, "BET" + plane, bpm_names)
+        alfa_model = column_at(input_model, "ALF" + plane, bpm_names)
 
-            beta_cor = getattr(model_cor, "BET" + plane)[model_cor.indx[bpm_name]]
-            err_beta_cor = _propagate_error_beta(err_beta_start, err_alfa_start, delta_phase_corr, beta_cor, beta_start, alfa_start)
+        reference_radius = 0.017
+        distributed_uncertainty_in_units = 1
+        relative_K1L_uncertainty = distributed_uncertainty_in_units * 1E-4 / reference_radius
 
-            alfa_cor = getattr(model_cor, "ALF" + plane)[model_cor.indx[bpm_name]]
-            err_alfa_cor = _propagate_error_alfa(err_beta_start, err_alfa_start, delta_phase_corr, alfa_cor, beta_start, alfa_start)
+        magnet_err_forward = _magnet_beta_errors(model_propagation, plane, bpm_names,
+                                                 beta_model, relative_K1L_uncertainty)
+        magnet_err_back = _magnet_beta_errors(model_back_propagation, plane, bpm_names,
+                                              beta_model, relative_K1L_uncertainty)
 
-            beta_back_cor = getattr(model_back_cor, "BET" + plane)[model_back_cor.indx[bpm_name]]
-            err_beta_back_cor = _propagate_error_beta(err_beta_start, err_alfa_start, delta_phase_back_corr, beta_back_cor, beta_start, alfa_start)
+        err_beta_prop = np.sqrt(err_beta_prop**2 + magnet_err_forward**2)
+        err_beta_back = np.sqrt(err_beta_back**2 + magnet_err_back**2)
 
-            alfa_back_cor = getattr(model_back_cor, "ALF" + plane)[model_back_cor.indx[bpm_name]]
-            err_alfa_back_cor = _propagate_error_alfa(err_beta_start, err_alfa_start, delta_phase_back_corr, alfa_back_cor, beta_start, alfa_start)
+        averaged_beta, final_beta_error = weighted_average_for_SbS_elements(beta_propagation, err_beta_prop, beta_back_propagation, err_beta_back)
+        averaged_alfa, final_alfa_error = weighted_average_for_SbS_elements(alfa_propagation, err_alfa_prop, alfa_back_propagation, err_alfa_back)
 
-            file_beta.add_table_row([bpm_name, bpm_s,
-                                     beta_propagation, err_beta_prop, beta_cor, err_beta_cor,
-                                     beta_back_propagation, err_beta_back, beta_back_cor, err_beta_back_cor,
-                                     beta_model, model_s])
-            file_alfa.add_table_row([bpm_name, bpm_s,
-                                     alfa_propagation, err_alfa_prop, alfa_cor, err_alfa_cor,
-                                     alfa_back_propagation, err_alfa_back, alfa_back_cor, err_alfa_back_cor,
-                                     alfa_model, model_s])
-        else:
-            model_s = input_model.S[input_model.indx[bpm_name]]
-            beta_model = getattr(input_model, "BET" + plane)[input_model.indx[bpm_name]]
-            alfa_model = getattr(input_model, "ALF" + plane)[input_model.indx[bpm_name]]
-
-            magnet_err_forward = []
-            magnet_err_back = []
-            if plane == 'X':
-                tune = input_model.Q1
-            elif plane == 'Y':
-                tune = input_model.Q2
-            reference_radius = 0.017
-            distributed_uncertainty_in_units = 1
-            relative_K1L_uncertainty = distributed_uncertainty_in_units * 1E-4 / reference_radius
-
-            for elem in model_propagation.NAME:
-                if abs(getattr(model_propagation, "K1L")[model_propagation.indx[elem]]) > 1E-8: # i.e. if elem == quadrupole
-                    K1L_uncertainy = abs(getattr(model_propagation, "K1L")[model_propagation.indx[elem]]) * relative_K1L_uncertainty
-                    beta_at_magnet = getattr(model_propagation, "BET" + plane)[model_propagation.indx[elem]]
-                    phase_at_magnet = getattr(model_propagation, "MU" + plane)[model_propagation.indx[elem]]
-                    phase_at_element = getattr(model_propagation, "MU" + plane)[model_propagation.indx[bpm_name]]
-                    delta_phase_from_magnet = phase_at_element - phase_at_magnet
-                    if delta_phase_from_magnet > 0:
-                        beta_uncertainty = beta_model * _relative_beta_err_from_magnet_err(K1L_uncertainy, beta_at_magnet, delta_phase_from_magnet, tune)
-                        magnet_err_forward.append(beta_uncertainty)
-
-            for elem in model_back_propagation.NAME:
-                if abs(getattr(model_back_propagation, "K1L")[model_back_propagation.indx[elem]]) > 1E-8: # i.e. if elem == quadrupole
-                    K1L_uncertainy = abs(getattr(model_back_propagation, "K1L")[model_back_propagation.indx[elem]]) * relative_K1L_uncertainty
-                    beta_at_magnet = getattr(model_back_propagation, "BET" + plane)[model_back_propagation.indx[elem]]
-                    phase_at_magnet = getattr(model_back_propagation, "MU" + plane)[model_back_propagation.indx[elem]]
-                    phase_at_element = getattr(model_back_propagation, "MU" + plane)[model_back_propagation.indx[bpm_name]]
-                    delta_phase_from_magnet = phase_at_element - phase_at_magnet
-                    if delta_phase_from_magnet > 0:
-                        beta_uncertainty = beta_model * _relative_beta_err_from_magnet_err(K1L_uncertainy, beta_at_magnet, delta_phase_from_magnet, tune)
-                        magnet_err_back.append(beta_uncertainty)
-
-            err_beta_prop = np.sqrt(err_beta_prop**2 + sum([x**2 for x in magnet_err_forward])) 
-            err_beta_back = np.sqrt(err_beta_back**2 + sum([x**2 for x in magnet_err_back])) 
-
-            averaged_beta, final_beta_error = weighted_average_for_SbS_elements(beta_propagation, err_beta_prop, beta_back_propagation, err_beta_back)
-            averaged_alfa, final_alfa_error = weighted_average_for_SbS_elements(alfa_propagation, err_alfa_prop, alfa_back_propagation, err_alfa_back)
-
-            file_alfa.add_table_row([bpm_name, bpm_s, averaged_alfa, final_alfa_error, alfa_model, model_s])
-            file_beta.add_table_row([bpm_name, bpm_s, averaged_beta, final_beta_error, beta_model, model_s])
+        for i, (bpm_s, bpm_name) in enumerate(bpms_list):
+            file_alfa.add_table_row([bpm_name, bpm_s, averaged_alfa[i], final_alfa_error[i], alfa_model[i], model_s[i]])
+            file_beta.add_table_row([bpm_name, bpm_s, averaged_beta[i], final_beta_error[i], beta_model[i], model_s[i]])
             if element_name in bpm_name:
-                summary_data = [bpm_name, bpm_s, averaged_beta, final_beta_error, averaged_alfa, final_alfa_error, beta_model, alfa_model, model_s]
+                summary_data = [bpm_name, bpm_s, averaged_beta[i], final_beta_error[i], averaged_alfa[i], final_alfa_error[i], beta_model[i], alfa_model[i], model_s[i]]
 
     file_beta.write_to_file()
     file_alfa.write_to_file()
     return summary_data
 
 
+def _propagate_errors_beta_alfa(errb0, erra0, dphi, bets, alfs, bet0, alf0):
+    jacobian = sbs_math.optics_jacobian(dphi, bet0, alf0, bets=bets, alfs=alfs)[:, :2]
+    errors = sbs_math.propagate_errors(jacobian, errb0, erra0)
+    return errors[:, 0], errors[:, 1]
+
+
+def _magnet_beta_errors(model, plane, bpm_names, beta_model, relative_K1L_uncertainty):
+    k1l = np.asarray(model.K1L)
+    is_quadrupole = np.abs(k1l) > 1E-8
+    phase = np.asarray(getattr(model, "MU" + plane))
+    return sbs_math.magnet_beta_errors(
+        beta_model,
+        column_at(model, "MU" + plane, bpm_names),
+        np.asarray(getattr(model, "BET" + plane))[is_quadrupole],
+        phase[is_quadrupole],
+        np.abs(k1l[is_quadrupole]) * relative_K1L_uncertainty,
+    )
+
+
+def column_at(tfs_file, column, names):
+    """Values of the column of the twiss instance at the given names, as an array."""
+    indices = [tfs_file.indx[name] for name in names]
+    return np.asarray(getattr(tfs_file, column))[indices]
+
+
 def _get_start_end_betas(bpms_list, measured_beta, plane):
     first_bpm = bpms_list[0][1]
 
@@ -234,18 +243,6 @@ def _get_start_end_betas(bpms_list, measured_beta, plane):
     return beta_start, err_beta_start, alfa_start, err_alfa_start, beta_end, err_beta_end, alfa_end, err_alfa_end
 
 
-def _propagate_error_beta(errb0, erra0, dphi, bets, bet0, alf0):
-    return math.sqrt((bets*np.sin(4*np.pi*dphi)*alf0/bet0 + bets*np.cos(4*np.pi*dphi)/bet0)**2*errb0**2 + (bets*np.sin(4*np.pi*dphi))**2*erra0**2)  # @IgnorePep8
-
-
-def _relative_beta_err_from_magnet_err(K1L_uncertainy, beta_at_magnet, delta_phase_from_magnet, tune):
-    return K1L_uncertainy * abs(beta_at_magnet * np.sin(4 * np.pi * delta_phase_from_magnet))
-
-
-def _propagate_error_alfa(errb0, erra0, dphi, alfs, bet0, alf0):
-    return math.sqrt(((alfs*((np.sin(4*np.pi*dphi)*alf0/bet0) + (np.cos(4*np.pi*dphi)/bet0))) - (np.cos(4*np.pi*dphi)*alf0/bet0) + (np.sin(4*np.pi*dphi)/bet0))**2*errb0**2 + ((np.cos(4*np.pi*dphi)) - (alfs*np.sin(4*np.pi*dphi)))**2*erra0**2)  # @IgnorePep8
-
-
 def intersect(list_of_files):
     '''Pure intersection of all bpm names in all files '''
     if len(list_of_files) == 0:
@@ -265,12 +262,3 @@ def intersect(list_of_files):
             str(list_of_files)
         )
     return result
-
-
-def weighted_average_for_SbS_elements(value1, sigma1, value2, sigma2):
-    weighted_average =  (1/sigma1**2 * value1 + 1/sigma2**2 * value2) / (1/sigma1**2 + 1/sigma2**2)  # @IgnorePep8
-    uncertainty_of_average = np.sqrt(1 / (1/sigma1**2 + 1/sigma2**2))  # @IgnorePep8
-    weighted_rms = np.sqrt(2 * (1/sigma1**2 * (value1 - weighted_average)**2 + 1/sigma2**2 * (value2 - weighted_average)**2) / (1/sigma1**2 + 1/sigma2**2))  # @IgnorePep8
-    final_error = np.sqrt(uncertainty_of_average**2 + weighted_rms**2)  # @IgnorePep8
-    #print "INPUT OF WeightAV FOR SBS: Value1: " + str(value1)+ " Sigma1: " + str(sigma1)+ " Value 2: " + str(value2) + " Sigma 2: "+str(sigma2)
-    return weighted_average, final_error
@@ -1,5 +1,6 @@
 from utils import tfs_file_writer
-from sbs_beta_writer import intersect, weighted_average_for_SbS_elements
+from sbs_beta_writer import intersect
+from segment_by_segment.sbs_math import weighted_average_for_SbS_elements
 import os
 
 
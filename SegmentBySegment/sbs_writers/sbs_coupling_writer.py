@@ -1,8 +1,9 @@
 import os
 import numpy as np
-import math
 from utils import tfs_file_writer
-from sbs_beta_writer import intersect, weighted_average_for_SbS_elements
+from segment_by_segment import sbs_math
+from segment_by_segment.sbs_math import weighted_average_for_SbS_elements
+from sbs_beta_writer import intersect
 
 
 def write_coupling(element_name, is_element, measured_coupling, input_model, propagated_models, save_path, coupling_summary_file):
@@ -140,24 +141,24 @@ def _write_f_terms(file_f_terms, element_name, is_element, bpms_list, measured_c
         delta_phase_prop_y = model_propagation.MUY[model_propagation.indx[bpm_name]] % 1
 
         f1001_prop = model_propagation.f1001[model_propagation.indx[bpm_name]]
-        err_f1001re_prop = _propagate_error_coupling_1001_re(f1001ab_ini, p1001_ini, delta_phase_prop_x, delta_phase_prop_y, f1001_std_ini, p1001_std_ini)
-        err_f1001im_prop = _propagate_error_coupling_1001_im(f1001ab_ini, p1001_ini, delta_phase_prop_x, delta_phase_prop_y, f1001_std_ini, p1001_std_ini)
+        err_f1001re_prop = sbs_math.propagate_error_coupling_1001_re(f1001ab_ini, p1001_ini, delta_phase_prop_x, delta_phase_prop_y, f1001_std_ini, p1001_std_ini)
+        err_f1001im_prop = sbs_math.propagate_error_coupling_1001_im(f1001ab_ini, p1001_ini, delta_phase_prop_x, delta_phase_prop_y, f1001_std_ini, p1001_std_ini)
         err_f1001abs_prop = f1001_std_ini
         f1010_prop = model_propagation.f1010[model_propagation.indx[bpm_name]]
-        err_f1010re_prop = _propagate_error_coupling_1010_re(f1010ab_ini, p1010_ini, delta_phase_prop_x, delta_phase_prop_y, f1010_std_ini, p1010_std_ini)
-        err_f1010im_prop = _propagate_error_coupling_1010_im(f1010ab_ini, p1010_ini, delta_phase_prop_x, delta_phase_prop_y, f1010_std_ini, p1010_std_ini)
+        err_f1010re_prop = sbs_math.propagate_error_coupling_1010_re(f1010ab_ini, p1010_ini, delta_phase_prop_x, delta_phase_prop_y, f1010_std_ini, p1010_std_ini)
+        err_f1010im_prop = sbs_math.propagate_error_coupling_1010_im(f1010ab_ini, p1010_ini, delta_phase_prop_x, delta_phase_prop_y, f1010_std_ini, p1010_std_ini)
         err_f1010abs_prop = f1010_std_ini
 
         delta_phase_back_x = model_back_propagation.MUX[model_back_propagation.indx[bpm_name]] % 1
         delta_phase_back_y = model_back_propagation.MUY[model_back_propagation.indx[bpm_name]] % 1
 
         f1001_back = model_back_propagation.f1001[model_back_propagation.indx[bpm_name]]
-        err_f1001re_back = _propagate_error_coupling_1001_re(f1001ab_end, p1001_end, delta_phase_back_x, delta_phase_back_y, f1001_std_end, p1001_std_end)
-        err_f1001im_back = _propagate_error_coupling_1001_im(f1001ab_end, p1001_end, delta_phase_back_x, delta_phase_back_y, f1001_std_end, p1001_std_end)
+        err_f1001re_back = sbs_math.propagate_error_coupling_1001_re(f1001ab_end, p1001_end, delta_phase_back_x, delta_phase_back_y, f1001_std_end, p1001_std_end)
+        err_f1001im_back = sbs_math.propagate_error_coupling_1001_im(f1001ab_end, p1001_end, delta_phase_back_x, delta_phase_back_y, f1001_std_end, p1001_std_end)
         err_f1001abs_back = f1001_std_end
         f1010_back = model_back_propagation.f1010[model_back_propagation.indx[bpm_name]]
-        err_f1010re_back = _propagate_error_coupling_1010_re(f1010ab_end, p1010_end, delta_phase_back_x, delta_phase_back_y, f1010_std_end, p1010_std_end)
-        err_f1010im_back = _propagate_error_coupling_1010_im(f1010ab_end, p1010_end, delta_phase_back_x, delta_phase_back_y, f1010_std_end, p1010_std_end)
+        err_f1010re_back = sbs_math.propagate_error_coupling_1010_re(f1010ab_end, p1010_end, delta_phase_back_x, delta_phase_back_y, f1010_std_end, p1010_std_end)
+        err_f1010im_back = sbs_math.propagate_error_coupling_1010_im(f1010ab_end, p1010_end, delta_phase_back_x, delta_phase_back_y, f1010_std_end, p1010_std_end)
         err_f1010abs_back = f1010_std_end
 
         if not is_element:
@@ -173,8 +174,8 @@ def _write_f_terms(file_f_terms, element_name, is_element, bpms_list, measured_c
             meas_f1001i = measured_coupling.F1001I[measured_coupling.indx[bpm_name]]
             err_meas_abs_f1001 = measured_coupling.FWSTD1[measured_coupling.indx[bpm_name]]
             err_meas_q1001 = measured_coupling.Q1001STD[measured_coupling.indx[bpm_name]]
-            err_meas_f1001r = _propagate_error_coupling_1001_re(meas_abs_f1001, meas_q1001, 0., 0., err_meas_abs_f1001, err_meas_q1001)
-            err_meas_f1001i = _propagate_error_coupling_1001_im(meas_abs_f1001, meas_q1001, 0., 0., err_meas_abs_f1001, err_meas_q1001)
+            err_meas_f1001r = sbs_math.propagate_error_coupling_1001_re(meas_abs_f1001, meas_q1001, 0., 0., err_meas_abs_f1001, err_meas_q1001)
+            err_meas_f1001i = sbs_math.propagate_error_coupling_1001_im(meas_abs_f1001, meas_q1001, 0., 0., err_meas_abs_f1001, err_meas_q1001)
 
             meas_abs_f1010 = measured_coupling.F1010W[measured_coupling.indx[bpm_name]]
             meas_q1010 = measured_coupling.Q1010[measured_coupling.indx[bpm_name]]
@@ -182,31 +183,31 @@ def _write_f_terms(file_f_terms, element_name, is_element, bpms_list, measured_c
             meas_f1010i = measured_coupling.F1010I[measured_coupling.indx[bpm_name]]
             err_meas_abs_f1010 = measured_coupling.FWSTD1[measured_coupling.indx[bpm_name]]
             err_meas_q1010 = measured_coupling.Q1010STD[measured_coupling.indx[bpm_name]]
-            err_meas_f1010r = _propagate_error_coupling_1010_re(meas_abs_f1010, meas_q1010, 0., 0., err_meas_abs_f1010, err_meas_q1010)
-            err_meas_f1010i = _propagate_error_coupling_1010_im(meas_abs_f1010, meas_q1010, 0., 0., err_meas_abs_f1010, err_meas_q1010)
+            err_meas_f1010r = sbs_math.propagate_error_coupling_1010_re(meas_abs_f1010, meas_q1010, 0., 0., err_meas_abs_f1010, err_meas_q1010)
+            err_meas_f1010i = sbs_math.propagate_error_coupling_1010_im(meas_abs_f1010, meas_q1010, 0., 0., err_meas_abs_f1010, err_meas_q1010)
 
             delta_phase_corr_x = model_cor.MUX[model_cor.indx[bpm_name]] % 1
             delta_phase_corr_y = model_cor.MUY[model_cor.indx[bpm_name]] % 1
 
             f1001_corr = model_cor.f1001[model_cor.indx[bpm_name]]
-            err_f1001re_corr = _propagate_error_coupling_1001_re(f1001ab_ini, p1001_ini, delta_phase_corr_x, delta_phase_corr_y, f1001_std_ini, p1001_std_ini)
-            err_f1001im_corr = _propagate_error_coupling_1001_im(f1001ab_ini, p1001_ini, delta_phase_corr_x, delta_phase_corr_y, f1001_std_ini, p1001_std_ini)
+            err_f1001re_corr = sbs_math.propagate_error_coupling_1001_re(f1001ab_ini, p1001_ini, delta_phase_corr_x, delta_phase_corr_y, f1001_std_ini, p1001_std_ini)
+            err_f1001im_corr = sbs_math.propagate_error_coupling_1001_im(f1001ab_ini, p1001_ini, delta_phase_corr_x, delta_phase_corr_y, f1001_std_ini, p1001_std_ini)
             err_f1001abs_corr = f1001_std_ini
             f1010_corr = model_cor.f1010[model_cor.indx[bpm_name]]
-            err_f1010re_corr = _propagate_error_coupling_1010_re(f1010ab_ini, p1010_ini, delta_phase_corr_x, delta_phase_corr_y, f1010_std_ini, p1010_std_ini)
-            err_f1010im_corr = _propagate_error_coupling_1010_im(f1010ab_ini, p1010_ini, delta_phase_corr_x, delta_phase_corr_y, f1010_std_ini, p1010_std_ini)
+            err_f1010re_corr = sbs_math.propagate_error_coupling_1010_re(f1010ab_ini, p1010_ini, delta_phase_corr_x, delta_phase_corr_y, f1010_std_ini, p1010_std_ini)
+            err_f1010im_corr = sbs_math.propagate_error_coupling_1010_im(f1010ab_ini, p1010_ini, delta_phase_corr_x, delta_phase_corr_y, f1010_std_ini, p1010_std_ini)
             err_f1010abs_corr = f1010_std_ini
 
             delta_phase_back_corr_x = model_back_cor.MUX[model_back_cor.indx[bpm_name]] % 1
             delta_phase_back_corr_y = model_back_cor.MUY[model_back_cor.indx[bpm_name]] % 1
 
             f1001_back_corr = model_back_cor.f1001[model_back_cor.indx[bpm_name]]
-            err_f1001re_back_corr = _propagate_error_coupling_1001_re(f1001ab_end, p1001_end, delta_phase_back_corr_x, delta_phase_back_corr_y, f1001_std_end, p1001_std_end)
-            err_f1001im_back_corr = _propagate_error_coupling_1001_im(f1001ab_end, p1001_end, delta_phase_back_corr_x, delta_phase_back_corr_y, f1001_std_end, p1001_std_end)
+            err_f1001re_back_corr = sbs_math.propagate_error_coupling_1001_re(f1001ab_end, p1001_end, delta_phase_back_corr_x, delta_phase_back_corr_y, f1001_std_end, p1001_std_end)
+            err_f1001im_back_corr = sbs_math.propagate_error_coupling_1001_im(f1001ab_end, p1001_end, delta_phase_back_corr_x, delta_phase_back_corr_y, f1001_std_end, p1001_std_end)
             err_f1001abs_back_corr = f1001_std_end
             f1010_back_corr = model_back_cor.f1010[model_back_cor.indx[bpm_name]]
-            err_f1010re_back_corr = _propagate_error_coupling_1010_re(f1010ab_end, p1010_end, delta_phase_back_corr_x, delta_phase_back_corr_y, f1010_std_end, p1010_std_end)
-            err_f1010im_back_corr = _propagate_error_coupling_1010_im(f1010ab_end, p1010_end, delta_phase_back_corr_x, delta_phase_back_corr_y, f1010_std_end, p1010_std_end)
+            err_f1010re_back_corr = sbs_math.propagate_error_coupling_1010_re(f1010ab_end, p1010_end, delta_phase_back_corr_x, delta_phase_back_corr_y, f1010_std_end, p1010_std_end)
+            err_f1010im_back_corr = sbs_math.propagate_error_coupling_1010_im(f1010ab_end, p1010_end, delta_phase_back_corr_x, delta_phase_back_corr_y, f1010_std_end, p1010_std_end)
             err_f1010abs_back_corr = f1010_std_end
 
             file_f_terms.add_table_row([bpm_name, bpm_s,
@@ -319,19 +320,3 @@ def _get_start_end_f1010(measured_coupling, first_bpm, last_bpm):
     p1010_std_end = measured_coupling.Q1010STD[measured_coupling.indx[last_bpm]]
 
     return f1010ab_ini, f1010_std_ini, p1010_ini, p1010_std_ini, f1010ab_end, f1010_std_end, p1010_end, p1010_std_end
-
-
-def _propagate_error_coupling_1001_re(f1001ab_ini, p1001_ini, phasex, phasey, f1001_std_ini, p1001_std_ini):
-    return math.sqrt((f1001_std_ini * np.cos(2 * np.pi * (p1001_ini - phasex + phasey)))**2 + (2 * np.pi * p1001_std_ini * f1001ab_ini * np.sin(2 * np.pi * (p1001_ini - phasex + phasey)))**2)  # @IgnorePep8
-
-
-def _propagate_error_coupling_1001_im(f1001ab_ini, p1001_ini, phasex, phasey, f1001_std_ini, p1001_std_ini):
-    return math.sqrt((f1001_std_ini * np.sin(2 * np.pi * (p1001_ini - phasex + phasey)))**2 + (2 * np.pi * p1001_std_ini * f1001ab_ini * np.cos(2 * np.pi * (p1001_ini - phasex + phasey)))**2)  # @IgnorePep8
-
-
-def _propagate_error_coupling_1010_re(f1010ab_ini, p1010_ini, phasex, phasey, f1010_std_ini, p1010_std_ini):
-    return math.sqrt((f1010_std_ini * np.cos(2 * np.pi * (p1010_ini - phasex - phasey)))**2 + (2 * np.pi * p1010_std_ini * f1010ab_ini * np.sin(2 * np.pi * (p1010_ini - phasex - phasey)))**2)  # @IgnorePep8
-
-
-def _propagate_error_coupling_1010_im(f1010ab_ini, p1010_ini, phasex, phasey, f1010_std_ini, p1010_std_ini):
-    return math.sqrt((f1010_std_ini * np.sin(2 * np.pi * (p1010_ini - phasex - phasey)))**2 + (2 * np.pi * p1010_std_ini * f1010ab_ini * np.cos(2 * np.pi * (p1010_ini - phasex - phasey)))**2)  # @IgnorePep8
@@ -5,7 +5,9 @@ import math
 
 from math import sqrt
 from utils import tfs_file_writer
-from sbs_beta_writer import intersect, weighted_average_for_SbS_elements
+from segment_by_segment import sbs_math
+from segment_by_segment.sbs_math import weighted_average_for_SbS_elements
+from sbs_beta_writer import intersect
 
 
 def write_dispersion(element_name, is_element, measured_hor_disp, measured_ver_disp, measured_norm_disp, input_model, propagated_models, save_path, dispersion_summary_file):
@@ -138,13 +140,13 @@ def _write_dispersion_for_plane(file_dispersion, plane, element_name, bpms_list,
         prop_disp_p_err = 1e-8  # TODO: Propagate?
         back_prop_disp_p_err = 1e-8  # TODO: Propagate?
 
-        normal_prop_disp_err = _propagate_error_dispersion(getattr(measured_dispersion, "STDD" + plane)[measured_dispersion.indx[first_bpm]],
+        normal_prop_disp_err = sbs_math.propagate_error_dispersion(getattr(measured_dispersion, "STDD" + plane)[measured_dispersion.indx[first_bpm]],
                                                            getattr(model_propagation, "BET" + plane)[model_propagation.indx[first_bpm]],
                                                            getattr(model_propagation, "BET" + plane)[model_propagation.indx[bpm_name]],
                                                            delta_phase,
                                                            getattr(model_propagation, "ALF" + plane)[model_propagation.indx[first_bpm]])
 
-        back_prop_disp_err = _propagate_error_dispersion(getattr(measured_dispersion, "STDD" + plane)[measured_dispersion.indx[last_bpm]],
+        back_prop_disp_err = sbs_math.propagate_error_dispersion(getattr(measured_dispersion, "STDD" + plane)[measured_dispersion.indx[last_bpm]],
                                                          getattr(model_back_propagation, "BET" + plane)[model_back_propagation.indx[last_bpm]],
                                                          getattr(model_back_propagation, "BET" + plane)[model_back_propagation.indx[bpm_name]],
                                                          delta_phase_back,
@@ -165,7 +167,7 @@ def _write_dispersion_for_plane(file_dispersion, plane, element_name, bpms_list,
             delta_phase_back_corr = (getattr(model_back_cor, "MU" + plane)[model_back_cor.indx[bpm_name]]) % 1
 
             corr_disp = getattr(model_cor, "D" + plane)[model_cor.indx[bpm_name]]
-            corr_disp_err = _propagate_error_dispersion(getattr(measured_dispersion, "STDD" + plane)[measured_dispersion.indx[last_bpm]],
+            corr_disp_err = sbs_math.propagate_error_dispersion(getattr(measured_dispersion, "STDD" + plane)[measured_dispersion.indx[last_bpm]],
                                                          getattr(model_cor, "BET" + plane)[model_cor.indx[last_bpm]],
                                                          getattr(model_cor, "BET" + plane)[model_cor.indx[bpm_name]],
                                                          delta_phase_corr,
@@ -174,7 +176,7 @@ def _write_dispersion_for_plane(file_dispersion, plane, element_name, bpms_list,
             corr_disp_diff_err = math.sqrt(measured_disp_std ** 2 + corr_disp_err ** 2)
 
             back_corr_prop_disp = getattr(model_back_cor, "D" + plane)[model_back_cor.indx[bpm_name]]
-            back_corr_prop_disp_err = _propagate_error_dispersion(getattr(measured_dispersion, "STDD" + plane)[measured_dispersion.indx[last_bpm]],
+            back_corr_prop_disp_err = sbs_math.propagate_error_dispersion(getattr(measured_dispersion, "STDD" + plane)[measured_dispersion.indx[last_bpm]],
                                                                      getattr(model_back_cor, "BET" + plane)[model_back_cor.indx[last_bpm]],
                                                                      getattr(model_back_cor, "BET" + plane)[model_back_cor.indx[bpm_name]],
                                                                      delta_phase_back_corr,
@@ -261,7 +263,3 @@ def _write_normalized_hor_dispersion(file_norm_disp_x, element_name, bpms_list,
                 summary_data = [average_norm_disp, final_norm_disp_err, model_norm_disp]
     file_norm_disp_x.write_to_file()
     return summary_data
-
-
-def _propagate_error_dispersion(std_D0, bet0, bets, dphi, alf0):
-    return np.abs(std_D0 * math.sqrt(bets/bet0) * (np.cos(2*np.pi*dphi)+alf0*np.sin(2*np.pi*dphi)))  # @IgnorePep8
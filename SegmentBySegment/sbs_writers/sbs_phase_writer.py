@@ -2,10 +2,10 @@ import __init__  # @UnusedImport
 import os
 import sbs_beta_writer
 import numpy as np
-import math
 
 from utils import tfs_file_writer
-from sbs_beta_writer import intersect
+from segment_by_segment import sbs_math
+from sbs_beta_writer import intersect, column_at
 
 FIRST_BPM_B1 = "BPMSW.1L2.B1"
 FIRST_BPM_B2 = "BPMSW.1L8.B2"
@@ -30,8 +30,6 @@ def write_phase(element_name, measured_hor_phase, measured_ver_phase, measured_h
 
 
 def _write_phase_for_plane(file_phase, element_name, plane, bpms_list, measured_phase, measured_beta, model_propagation, model_cor, model_back_propagation, model_back_cor):
-    first_bpm = bpms_list[0][1]
-    last_bpm = bpms_list[-1][1]
     (beta_start, err_beta_start, alfa_start, err_alfa_start,
      beta_end, err_beta_end, alfa_end, err_alfa_end) = sbs_beta_writer._get_start_end_betas(bpms_list, measured_beta, plane)
 
@@ -45,62 +43,54 @@ def _write_phase_for_plane(file_phase, element_name, plane, bpms_list, measured_
         elif "LHCB2" in model_propagation.SEQUENCE and first_bpm_on_ring in model_propagation.NAME:
             tune["X"], tune["Y"] = measured_phase.Q1, measured_phase.Q2
 
-    for bpm in bpms_list:
-        bpm_s = bpm[0]
-        bpm_name = bpm[1]
+    bpm_names = [bpm[1] for bpm in bpms_list]
+    bpms_s = np.array([bpm[0] for bpm in bpms_list])
 
-        model_s = measured_phase.S[measured_phase.indx[bpm_name]]
+    model_s = column_at(measured_phase, "S", bpm_names)
 
-        meas_phase = (getattr(measured_phase, "PHASE" + plane)[measured_phase.indx[bpm_name]] -
-                      getattr(measured_phase, "PHASE" + plane)[measured_phase.indx[first_bpm]]) % 1
+    meas_phase_all = column_at(measured_phase, "PHASE" + plane, bpm_names)
+    meas_phase = (meas_phase_all - meas_phase_all[0]) % 1
 
-        std_err_phase = getattr(measured_phase, "STDPH" + plane)[measured_phase.indx[bpm_name]]
+    std_err_phase = column_at(measured_phase, "STDPH" + plane, bpm_names)
 
-        model_prop_phase = (getattr(model_propagation, "MU" + plane)[model_propagation.indx[bpm_name]] -
-                            getattr(model_propagation, "MU" + plane)[model_propagation.indx[first_bpm]]) % 1
+    mu_propagation = column_at(model_propagation, "MU" + plane, bpm_names)
+    mu_cor = column_at(model_cor, "MU" + plane, bpm_names)
+    mu_back_propagation = column_at(model_back_propagation, "MU" + plane, bpm_names)
+    mu_back_cor = column_at(model_back_cor, "MU" + plane, bpm_names)
 
-        model_cor_phase = (getattr(model_cor, "MU" + plane)[model_cor.indx[bpm_name]] -
-                           getattr(model_cor, "MU" + plane)[model_cor.indx[first_bpm]]) % 1
+    model_prop_phase = (mu_propagation - mu_propagation[0]) % 1
+    model_cor_phase = (mu_cor - mu_cor[0]) % 1
 
-        meas_phase_back = (getattr(measured_phase, "PHASE" + plane)[measured_phase.indx[bpm_name]] -
-                           getattr(measured_phase, "PHASE" + plane)[measured_phase.indx[last_bpm]]) % 1
+    meas_phase_back = (meas_phase_all - meas_phase_all[-1]) % 1
 
-        model_back_propagation_phase = (getattr(model_back_propagation, "MU" + plane)[model_back_propagation.indx[last_bpm]] -
-                                        getattr(model_back_propagation, "MU" + plane)[model_back_propagation.indx[bpm_name]]) % 1
+    model_back_propagation_phase = (mu_back_propagation[-1] - mu_back_propagation) % 1
+    model_back_cor_phase = (mu_back_cor[-1] - mu_back_cor) % 1
 
-        model_back_cor_phase = (getattr(model_back_cor, "MU" + plane)[model_back_cor.indx[last_bpm]] -
-                                getattr(model_back_cor, "MU" + plane)[model_back_cor.indx[bpm_name]]) % 1
+    prop_phase_difference = _centered((meas_phase - model_prop_phase) % 1)
+    back_prop_phase_difference = _centered((meas_phase_back - model_back_propagation_phase) % 1)
 
-        prop_phase_difference = (meas_phase - model_prop_phase) % 1
-        if prop_phase_difference > 0.5:
-            prop_phase_difference = prop_phase_difference - 1
+    if not fix_start_s is None:
+        after_start = bpms_s >= fix_start_s
+        prop_phase_difference[after_start] += tune[plane]
+        back_prop_phase_difference[~after_start] -= tune[plane]
 
-        back_prop_phase_difference = (meas_phase_back - model_back_propagation_phase) % 1
-        if back_prop_phase_difference > 0.5:
-            back_prop_phase_difference = back_prop_phase_difference - 1
+    prop_cor_phase = mu_cor - mu_propagation
+    back_cor_phase = mu_back_propagation - mu_back_cor
 
-        if not fix_start_s is None:
-            if bpm_s >= fix_start_s:
-                prop_phase_difference += tune[plane]
-            elif bpm_s <= fix_start_s:
-                back_prop_phase_difference -= tune[plane]
+    prop_phase_error = sbs_math.propagate_error_phase(err_beta_start, err_alfa_start, model_prop_phase, beta_start, alfa_start)
+    cor_phase_error = sbs_math.propagate_error_phase(err_beta_start, err_alfa_start, model_cor_phase, beta_start, alfa_start)
 
-        prop_cor_phase = -getattr(model_propagation, "MU" + plane)[model_propagation.indx[bpm_name]] + getattr(model_cor, "MU" + plane)[model_cor.indx[bpm_name]]
-        back_cor_phase = getattr(model_back_propagation, "MU" + plane)[model_back_propagation.indx[bpm_name]] - getattr(model_back_cor, "MU" + plane)[model_back_cor.indx[bpm_name]]
+    back_phase_error = sbs_math.propagate_error_phase(err_beta_end, err_alfa_end, model_back_propagation_phase, beta_end, alfa_end)
+    back_cor_phase_error = sbs_math.propagate_error_phase(err_beta_end, err_alfa_end, model_back_cor_phase, beta_end, alfa_end)
 
-        prop_phase_error = _propagate_error_phase(err_beta_start, err_alfa_start, model_prop_phase, beta_start, alfa_start)
-        cor_phase_error = _propagate_error_phase(err_beta_start, err_alfa_start, model_cor_phase, beta_start, alfa_start)
+    # Error for the phase difference -> sqrt(e1**2 + e2**2 - 2cov(e1, e2)) and assuming no covariance
+    prop_meas_diff_error = np.sqrt(prop_phase_error ** 2 + std_err_phase ** 2)
+    prop_cor_diff_error = np.sqrt(prop_meas_diff_error ** 2 + cor_phase_error ** 2)
+    back_meas_diff_error = np.sqrt(back_phase_error ** 2 + std_err_phase ** 2)
+    back_cor_diff_error = np.sqrt(back_meas_diff_error ** 2 + back_cor_phase_error ** 2)
 
-        back_phase_error = _propagate_error_phase(err_beta_end, err_alfa_end, model_back_propagation_phase, beta_end, alfa_end)
-        back_cor_phase_error = _propagate_error_phase(err_beta_end, err_alfa_end, model_back_cor_phase, beta_end, alfa_end)
-
-        # Error for the phase difference -> sqrt(e1**2 + e2**2 - 2cov(e1, e2)) and assuming no covariance
-        prop_meas_diff_error = np.sqrt(prop_phase_error ** 2 + std_err_phase ** 2)
-        prop_cor_diff_error = np.sqrt(prop_meas_diff_error ** 2 + cor_phase_error ** 2)
-        back_meas_diff_error = np.sqrt(back_phase_error ** 2 + std_err_phase ** 2)
-        back_cor_diff_error = np.sqrt(back_meas_diff_error ** 2 + back_cor_phase_error ** 2)
-
-        file_phase.add_table_row([bpm_name, bpm_s, meas_phase, std_err_phase, prop_phase_difference, prop_meas_diff_error, prop_cor_phase, prop_cor_diff_error, back_prop_phase_difference, back_meas_diff_error, back_cor_phase, back_cor_diff_error, model_s])
+    for i, bpm_name in enumerate(bpm_names):
+        file_phase.add_table_row([bpm_name, bpms_s[i], meas_phase[i], std_err_phase[i], prop_phase_difference[i], prop_meas_diff_error[i], prop_cor_phase[i], prop_cor_diff_error[i], back_prop_phase_difference[i], back_meas_diff_error[i], back_cor_phase[i], back_cor_diff_error[i], model_s[i]])
 
     file_phase.write_to_file()
 
@@ -120,5 +110,6 @@ def _get_phase_tfs_files(element_name, save_path):
     return file_phase_x, file_phase_y
 
 
-def _propagate_error_phase(errb0, erra0, dphi, bet0, alf0):
-    return math.sqrt((((1/2.*np.cos(4*np.pi*dphi)*alf0/bet0)-(1/2.*np.sin(4*np.pi*dphi)/bet0)-(1/2.*alf0/bet0))*errb0)**2+((-(1/2.*np.cos(4*np.pi*dphi))+(1/2.))*erra0)**2)/(2*np.pi)  # @IgnorePep8
+def _centered(phase):
+    """Moves the phases in [0.5, 1) to [-0.5, 0)."""
+    return np.where(phase > 0.5, phase - 1, phase)
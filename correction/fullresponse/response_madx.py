@@ -7,9 +7,15 @@ accelerator class).
 
 For now, the response matrix is stored in a 'pickled' file.
 
+The sequence is loaded once per MAD-X process of a madx_wrapper.MadxPool,
+which then gets one small job per variable.
+
+If a response store directory is given, the columns of the variables already
+computed for the same model and delta_k are taken from there
+(see response_store).
+
 :author: Lukas Malina, Joschua Dilly, Jaime (...) Coello de Portugal
 """
-import math
 import multiprocessing
 import os
 
@@ -17,21 +23,25 @@ import numpy as np
 import pandas
 
 import madx_wrapper
+from correction.fullresponse import response_store
 from twiss_optics.optics_class import TwissOptics
 from utils import logging_tools
 from utils import tfs_pandas as tfs
-from utils.contexts import timeit, suppress_warnings
+from utils.contexts import timeit
 from utils.iotools import create_dirs
 
 LOG = logging_tools.get_logger(__name__)
 
+RESPONSE_KEYS = ('MUX', 'MUY', 'BETX', 'BETY', 'BBX', 'BBY', 'DX', 'DY', 'NDX', 'NDY',
+                 'F1001R', 'F1001I', 'F1010R', 'F1010I', 'Q')
+
 
 # Full Response Mad-X ##########################################################
 
 
 def generate_fullresponse(accel_inst, variable_categories,
                           delta_k=0.00002, num_proc=multiprocessing.cpu_count(),
-                          temp_dir=None):
+                          temp_dir=None, store_dir=None):
     """ Generate a dictionary containing response matrices for
         beta, phase, dispersion, tune and coupling and saves it to a file.
 
@@ -41,6 +51,8 @@ def generate_fullresponse(accel_inst, variable_categories,
             delta_k (float): delta K1L to be applied to quads for sensitivity matrix
             num_proc (int): Number of processes to use in parallel.
             temp_dir (str): temporary directory. If ``None``, uses folder of original_jobfile.
+            store_dir (str): directory of the response store. If ``None``,
+                all the variables are computed.
     """
     LOG.debug("Generating Fullresponse via Mad-X.")
     with timeit(lambda t: LOG.debug("  Total time generating fullresponse: {:f}s".format(t))):
@@ -57,48 +69,45 @@ def generate_fullresponse(accel_inst, variable_categories,
         # except AttributeError:
         #     pass
 
-        num_proc = num_proc if len(variables) > num_proc else len(variables)
-        process_pool = multiprocessing.Pool(processes=num_proc)
+        def compute_response(variables_to_compute):
+            return _compute_fullresponse(accel_inst, list(variables_to_compute),
+                                         delta_k, num_proc, temp_dir)
 
-        incr_dict = _generate_madx_jobs(accel_inst, variables,
-                                        delta_k, num_proc, temp_dir)
-        _call_madx(process_pool, temp_dir, num_proc)
-        _clean_up(temp_dir, num_proc)
-
-        var_to_twiss = _load_madx_results(variables, process_pool, incr_dict, temp_dir)
-        fullresponse = _create_fullresponse_from_dict(var_to_twiss)
+        if store_dir is None:
+            fullresponse = compute_response(variables)
+        else:
+            model_key = response_store.get_model_key(
+                "madx", "{:e}".format(delta_k), _get_madx_job(accel_inst)
+            )
+            fullresponse = response_store.get_response(store_dir, model_key, list(variables),
+                                                       RESPONSE_KEYS, compute_response)
 
     return fullresponse
 
 
-def _generate_madx_jobs(accel_inst, variables, delta_k, num_proc, temp_dir):
-    """ Generates madx job-files """
-    LOG.debug("Generating MADX jobfiles.")
-    incr_dict = {'0': 0.0}
-    vars_per_proc = int(math.ceil(float(len(variables)) / num_proc))
-
-    madx_job = _get_madx_job(accel_inst)
-
-    for proc_idx in range(num_proc):
-        jobfile_path = _get_jobfiles(temp_dir, proc_idx)
+def _compute_fullresponse(accel_inst, variables, delta_k, num_proc, temp_dir):
+    """ Runs MAD-X for the given variables and returns their fullresponse """
+    num_proc = num_proc if len(variables) > num_proc else len(variables)
+    process_pool = multiprocessing.Pool(processes=num_proc)
 
-        current_job = madx_job
-        for i in range(vars_per_proc):
-            var_idx = proc_idx * vars_per_proc + i
-            if var_idx >= len(variables):
-                break
-            var = variables[var_idx]
-            incr_dict[var] = delta_k
-            current_job += "{var:s}={var:s}{delta:+f};\n".format(var=var, delta=delta_k)
-            current_job += "twiss, file='{:s}';\n".format(os.path.join(temp_dir, "twiss." + var))
-            current_job += "{var:s}={var:s}{delta:+f};\n\n".format(var=var, delta=-delta_k)
+    incr_dict = _call_madx(accel_inst, variables, delta_k, num_proc, temp_dir)
+    var_to_twiss = _load_madx_results(variables, process_pool, incr_dict, temp_dir)
+    return _create_fullresponse_from_dict(var_to_twiss)
 
-        if proc_idx == num_proc - 1:
-            current_job += "twiss, file='{:s}';\n".format(os.path.join(temp_dir, "twiss.0"))
 
-        with open(jobfile_path, "w") as jobfile:
-            jobfile.write(current_job)
-    return incr_dict
+def _generate_madx_jobs(variables, delta_k, temp_dir):
+    """ Generates the madx jobs, one per variable and the nominal model """
+    LOG.debug("Generating MADX jobs.")
+    incr_dict = {'0': 0.0}
+    jobs = []
+    for var in variables:
+        incr_dict[var] = delta_k
+        current_job = "{var:s}={var:s}{delta:+f};\n".format(var=var, delta=delta_k)
+        current_job += "twiss, file='{:s}';\n".format(os.path.join(temp_dir, "twiss." + var))
+        current_job += "{var:s}={var:s}{delta:+f};\n".format(var=var, delta=-delta_k)
+        jobs.append((var, current_job))
+    jobs.append(('0', "twiss, file='{:s}';\n".format(os.path.join(temp_dir, "twiss.0"))))
+    return jobs, incr_dict
 
 
 def _get_madx_job(accel_inst):
@@ -111,113 +120,146 @@ def _get_madx_job(accel_inst):
     return job_content
 
 
-def _call_madx(process_pool, temp_dir, num_proc):
-    """ Call madx in parallel """
-    LOG.debug("Starting {:d} MAD-X jobs...".format(num_proc))
-    madx_jobs = [_get_jobfiles(temp_dir, index) for index in range(num_proc)]
-    process_pool.map(_launch_single_job, madx_jobs)
-    LOG.debug("MAD-X jobs done.")
-
-
-def _clean_up(temp_dir, num_proc):
-    """ Merge Logfiles and clean temporary outputfiles """
-    LOG.debug("Cleaning output and building log...")
-    full_log = ""
-    for index in range(num_proc):
-        job_path = _get_jobfiles(temp_dir, index)
-        log_path = job_path + ".log"
-        with open(log_path, "r") as log_file:
-            full_log += log_file.read()
-        os.remove(log_path)
-        os.remove(job_path)
+def _call_madx(accel_inst, variables, delta_k, num_proc, temp_dir):
+    """ Call madx in parallel, the sequence is loaded once per process """
+    jobs, incr_dict = _generate_madx_jobs(variables, delta_k, temp_dir)
+    LOG.debug("Starting {:d} MAD-X jobs in {:d} processes...".format(len(jobs), num_proc))
     full_log_path = os.path.join(temp_dir, "response_madx_full.log")
-    with open(full_log_path, "w") as full_log_file:
-        full_log_file.write(full_log)
+    with madx_wrapper.MadxPool(_get_madx_job(accel_inst), processes=num_proc,
+                               log_file=full_log_path) as madx_pool:
+        for var, job in jobs:
+            madx_pool.submit(var, job)
+        for var, return_value in madx_pool.results(len(jobs)):
+            if return_value != 0:
+                LOG.warning("MAD-X job for '{:s}' failed, see {:s}".format(var, full_log_path))
+    LOG.debug("MAD-X jobs done.")
+    return incr_dict
 
 
 def _load_madx_results(variables, process_pool, incr_dict, temp_dir):
-    """ Load the madx results in parallel and return var-tfs dictionary """
+    """ Load the madx results in parallel and assemble the fullresponse as they arrive """
     LOG.debug("Loading Madx Results.")
     vars_and_paths = []
     for value in variables + ['0']:
         vars_and_paths.append((value, temp_dir))
-    var_to_twiss = {}
-    for var, tfs_data in process_pool.map(_load_and_remove_twiss, vars_and_paths):
-        tfs_data['incr'] = incr_dict[var]
-        var_to_twiss[var] = tfs_data
-    return var_to_twiss
+    assembler = _ResponseAssembler(variables)
+    for var, tfs_data in process_pool.imap_unordered(_load_and_remove_twiss, vars_and_paths):
+        assembler.add(var, tfs_data, incr_dict[var])
+    return assembler.get_fullresponse()
 
 
 def _create_fullresponse_from_dict(var_to_twiss):
-    """ Convert var-tfs dictionary to fullresponse dictionary """
+    """ Convert var-tfs dictionary (with 'incr' columns) to fullresponse dictionary """
     var_to_twiss = _add_coupling(var_to_twiss)
-    resp = pandas.Panel.from_dict(var_to_twiss)
-    resp = resp.transpose(2, 1, 0)
-    # After transpose e.g: resp[NDX, bpm12l1.b1, kqt3]
-    # The magnet called "0" is no change (nominal model)
-    resp['NDX'] = resp.xs('DX', axis=0).div(np.sqrt(resp.xs('BETX', axis=0)), axis="index")
-    resp['NDY'] = resp.xs('DY', axis=0).div(np.sqrt(resp.xs('BETY', axis=0)), axis="index")
-    resp['BBX'] = resp.xs('BETX', axis=0).div(resp.loc['BETX', :, '0'], axis="index")
-    resp['BBY'] = resp.xs('BETY', axis=0).div(resp.loc['BETY', :, '0'], axis="index")
-    resp = resp.subtract(resp.xs('0', axis=2), axis=2)
-    # Remove difference of nominal model with itself (bunch of zeros)
-    resp.drop('0', axis=2, inplace=True)
-    resp = resp.div(resp.loc['incr', :, :])
-
-    with suppress_warnings(np.ComplexWarning):  # raised as everything is complex-type now
-        df = {'MUX': resp.xs('MUX', axis=0).astype(np.float64),
-              'MUY': resp.xs('MUY', axis=0).astype(np.float64),
-              'BETX': resp.xs('BETX', axis=0).astype(np.float64),
-              'BETY': resp.xs('BETY', axis=0).astype(np.float64),
-              'BBX': resp.xs('BBX', axis=0).astype(np.float64),
-              'BBY': resp.xs('BBY', axis=0).astype(np.float64),
-              'DX': resp.xs('DX', axis=0).astype(np.float64),
-              'DY': resp.xs('DY', axis=0).astype(np.float64),
-              'NDX': resp.xs('NDX', axis=0).astype(np.float64),
-              'NDY': resp.xs('NDY', axis=0).astype(np.float64),
-              "F1001R": tfs.TfsDataFrame(resp.xs('1001', axis=0).apply(np.real).astype(np.float64)),
-              "F1001I": tfs.TfsDataFrame(resp.xs('1001', axis=0).apply(np.imag).astype(np.float64)),
-              "F1010R": tfs.TfsDataFrame(resp.xs('1010', axis=0).apply(np.real).astype(np.float64)),
-              "F1010I": tfs.TfsDataFrame(resp.xs('1010', axis=0).apply(np.imag).astype(np.float64)),
-              'Q': resp.loc[['Q1', 'Q2'], resp.major_axis[0], :].transpose().astype(np.float64),
-              }
-    return df
-
-
-def _get_jobfiles(temp_dir, index):
-    """ Return names for jobfile and iterfile according to index """
-    jobfile_path = os.path.join(temp_dir, "job.iterate.{:d}.madx".format(index))
-    return jobfile_path
-
-
-def _launch_single_job(inputfile_path):
-    """ Function for pool to start a single madx job """
-    log_file = inputfile_path + ".log"
-    return madx_wrapper.resolve_and_run_file(inputfile_path, log_file=log_file)
+    assembler = _ResponseAssembler([var for var in var_to_twiss if var != '0'])
+    for var, tfs_data in var_to_twiss.items():
+        assembler.add(var, tfs_data, tfs_data['incr'].values[0])
+    return assembler.get_fullresponse()
+
+
+class _ResponseAssembler(object):
+    """ Assembles the fullresponse from the twiss results of the variables.
+
+    The values are written into one preallocated float64 array
+    (observable x element x variable) as each result arrives, with the
+    coupling as separate real and imaginary planes. The nominal model is
+    the variable '0'. The finite differences are computed in place at the end.
+    """
+    PLANES = ('MUX', 'MUY', 'BETX', 'BETY', 'DX', 'DY', 'NDX', 'NDY',
+              'F1001R', 'F1001I', 'F1010R', 'F1010I')
+
+    def __init__(self, variables):
+        self._variables = sorted(variables)
+        self._columns = dict((var, i) for i, var in enumerate(self._variables))
+        self._incr = np.zeros(len(self._variables))
+        self._tunes = np.zeros((2, len(self._variables)))
+        self._values = None
+        self._index = None
+        self._nominal = None
+        self._nominal_tunes = None
+
+    def add(self, var, tfs_data, incr):
+        """ Adds the twiss (with coupling) of var, which was changed by incr """
+        if self._index is None:
+            self._index = tfs_data.index
+            self._values = np.empty((len(self.PLANES), len(self._index), len(self._variables)))
+        elif not tfs_data.index.equals(self._index):
+            tfs_data = tfs_data.reindex(self._index)
+        tunes = (tfs_data['Q1'].values[0], tfs_data['Q2'].values[0])
+        if var == '0':
+            self._nominal = np.empty((len(self.PLANES), len(self._index)))
+            self._fill_planes(tfs_data, self._nominal)
+            self._nominal_tunes = tunes
+            return
+        column = self._columns[var]
+        self._fill_planes(tfs_data, self._values[:, :, column])
+        self._tunes[:, column] = tunes
+        self._incr[column] = incr
+
+    def get_fullresponse(self):
+        """ Returns the dictionary of the response DataFrames (element x variable) """
+        if self._nominal is None:
+            raise IOError("Nominal model (variable '0') missing in the MADX results.")
+        values = self._values
+        values -= self._nominal[:, :, np.newaxis]
+        values /= self._incr
+        tunes = (self._tunes - np.array(self._nominal_tunes)[:, np.newaxis]) / self._incr
+
+        planes = dict(zip(self.PLANES, values))
+        index = self._index
+        df = dict((name, pandas.DataFrame(planes[name], index=index, columns=self._variables))
+                  for name in ('MUX', 'MUY', 'BETX', 'BETY', 'DX', 'DY', 'NDX', 'NDY'))
+        for name in ('F1001R', 'F1001I', 'F1010R', 'F1010I'):
+            df[name] = tfs.TfsDataFrame(planes[name], index=index, columns=self._variables)
+        beta_index = self.PLANES.index('BETX')
+        df['BBX'] = pandas.DataFrame(planes['BETX'] / self._nominal[beta_index, :, np.newaxis],
+                                     index=index, columns=self._variables)
+        df['BBY'] = pandas.DataFrame(planes['BETY'] / self._nominal[beta_index + 1, :, np.newaxis],
+                                     index=index, columns=self._variables)
+        df['Q'] = pandas.DataFrame(tunes, index=['Q1', 'Q2'], columns=self._variables)
+        return df
+
+    @staticmethod
+    def _fill_planes(tfs_data, out):
+        for i, name in enumerate(('MUX', 'MUY', 'BETX', 'BETY', 'DX', 'DY')):
+            out[i] = tfs_data[name].values
+        out[6] = out[4] / np.sqrt(out[2])
+        out[7] = out[5] / np.sqrt(out[3])
+        for i, name in enumerate(('1001', '1010')):
+            coupling = tfs_data[name].values
+            out[8 + 2 * i] = coupling.real
+            out[9 + 2 * i] = coupling.imag
 
 
 def _load_and_remove_twiss(var_and_path):
-    """ Function for pool to retrieve results """
+    """ Function for pool to retrieve results, with the coupling """
     (var, path) = var_and_path
     twissfile = os.path.join(path, "twiss." + var)
     tfs_data = tfs.read_tfs(twissfile, index="NAME")
     tfs_data['Q1'] = tfs_data.Q1
     tfs_data['Q2'] = tfs_data.Q2
     os.remove(twissfile)
-    return var, tfs_data
+    return var, _add_coupling_to_twiss(tfs_data)
 
 
 def _add_coupling(dict_of_tfs):
     """ Adds coupling to the tfs. QUICK FIX VIA LOOP!"""
     with timeit(lambda t: LOG.debug("  Time adding coupling: {:f}s".format(t))):
         for var in dict_of_tfs:
-            twopt = TwissOptics(dict_of_tfs[var], keep_all_elem=True)
-            cpl = twopt.get_coupling("cmatrix")
-            dict_of_tfs[var]["1001"] = cpl["F1001"]
-            dict_of_tfs[var]["1010"] = cpl["F1010"]
+            dict_of_tfs[var] = _add_coupling_to_twiss(dict_of_tfs[var])
         return dict_of_tfs
 
 
+def _add_coupling_to_twiss(tfs_data):
+    """ Adds the coupling columns 1001 and 1010 to a single tfs """
+    if "1001" not in tfs_data.columns:
+        twopt = TwissOptics(tfs_data, keep_all_elem=True)
+        cpl = twopt.get_coupling("cmatrix")
+        tfs_data["1001"] = cpl["F1001"]
+        tfs_data["1010"] = cpl["F1010"]
+    return tfs_data
+
+
 # Script Mode ##################################################################
 
 
@@ -0,0 +1,177 @@
+"""
+Persistent store of response matrices, one column per variable.
+
+Computing the full response (with MAD-X or TwissResponse) for hundreds of
+variables is slow, but the column of a variable only depends on the model
+and the variable itself. The store keeps every column of every observable
+in its own .npy file, which can be memory-mapped, under a key derived from
+the model:
+
+::
+
+    store_dir/<model key>/<observable>/index.json     rows of the observable
+    store_dir/<model key>/<observable>/<variable>.npy one response column
+
+so adding a variable category to a response only computes the new columns:
+
+::
+
+    response = response_store.get_response(
+        store_dir, model_key, variables, observables,
+        lambda missing_variables: compute_response(missing_variables)
+    )
+
+The responses are dictionaries of observable -> DataFrame
+(index: elements, columns: variables), as returned by response_madx and
+response_twiss.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+from utils import logging_tools
+from utils import tfs_pandas as tfs
+
+LOG = logging_tools.get_logger(__name__)
+
+INDEX_FILE = "index.json"
+COLUMN_EXT = ".npy"
+
+
+class ResponseStore(object):
+    """ Response columns of one model, stored in store_dir.
+
+    Args:
+        store_dir: Path to the directory of the store.
+        model_key: Key of the model, e.g. from get_model_key.
+    """
+    def __init__(self, store_dir, model_key):
+        self._model_dir = os.path.join(store_dir, model_key)
+
+    def get_missing(self, variables, observables):
+        """ Returns the variables that miss the column of any of the observables. """
+        return [var for var in variables
+                if not all(os.path.isfile(self._get_column_path(obs, var)) for obs in observables)]
+
+    def add(self, response, variables=None):
+        """ Stores the columns of all the observables in response.
+
+        If variables is given, the columns of these variables are stored, with
+        zeros for the ones not in the response (they have no effect).
+        """
+        for obs, obs_response in response.items():
+            if variables is not None:
+                obs_response = obs_response.reindex(columns=variables, fill_value=0.)
+            obs_dir = self._get_observable_dir(obs)
+            if not os.path.isdir(obs_dir):
+                os.makedirs(obs_dir)
+            index = self._read_index(obs)
+            if index is None:
+                index = [str(name) for name in obs_response.index]
+                _write_atomic(os.path.join(obs_dir, INDEX_FILE),
+                              lambda index_file: index_file.write(json.dumps(index).encode("utf-8")))
+            elif list(obs_response.index) != index:
+                LOG.debug("Reindexing response '{:s}' to the stored elements.".format(obs))
+                obs_response = obs_response.reindex(index)
+            for var in obs_response.columns:
+                values = np.ascontiguousarray(obs_response[var].values, dtype=np.float64)
+                _write_atomic(self._get_column_path(obs, var),
+                              lambda column_file: np.save(column_file, values))
+
+    def load(self, variables, observables):
+        """ Returns the response dictionary of the variables and observables. """
+        response = {}
+        for obs in observables:
+            index = self._read_index(obs)
+            if index is None:
+                raise IOError("Response '{:s}' not in store '{:s}'".format(obs, self._model_dir))
+            columns = [np.load(self._get_column_path(obs, var), mmap_mode="r") for var in variables]
+            values = np.column_stack(columns) if columns else np.zeros((len(index), 0))
+            response[obs] = tfs.TfsDataFrame(values, index=index, columns=variables)
+        return response
+
+    def _read_index(self, obs):
+        try:
+            with open(os.path.join(self._get_observable_dir(obs), INDEX_FILE), "rb") as index_file:
+                return [str(name) for name in json.loads(index_file.read().decode("utf-8"))]
+        except IOError:
+            return None
+
+    def _get_observable_dir(self, obs):
+        return os.path.join(self._model_dir, quote(obs, safe=""))
+
+    def _get_column_path(self, obs, var):
+        return os.path.join(self._get_observable_dir(obs), quote(var, safe="") + COLUMN_EXT)
+
+
+def get_response(store_dir, model_key, variables, observables, compute_response):
+    """ Returns the response of the variables, computing only the ones not in the store.
+
+    Args:
+        store_dir: Path to the directory of the store.
+        model_key: Key of the model, e.g. from get_model_key.
+        variables: List of variable names.
+        observables: List of the observables (keys of the response dictionary).
+        compute_response: Function of a list of variables that returns their
+            response dictionary, for at least the given observables.
+    """
+    store = ResponseStore(store_dir, model_key)
+    missing = store.get_missing(variables, observables)
+    LOG.debug("Response store: {:d} of {:d} variables to compute.".format(
+        len(missing), len(variables)))
+    if missing:
+        store.add(compute_response(missing), missing)
+    return store.load(variables, observables)
+
+
+def get_model_key(*contents):
+    """ Returns a key for the model defined by contents.
+
+    Strings are hashed as they are, together with the content of the files
+    they call with "call, file=...;" (as MAD-X jobs do), recursively. Relative
+    paths in strings are taken from the working directory, the ones in called
+    files from the directory of the calling file. DataFrames (e.g. twiss
+    models) are hashed by columns, index and values.
+    """
+    sha1 = hashlib.sha1()
+    visited = set()
+    for content in contents:
+        if isinstance(content, pd.DataFrame):
+            sha1.update(str(list(content.columns)).encode("utf-8"))
+            sha1.update(pd.util.hash_pandas_object(content, index=True).values.tobytes())
+            continue
+        if not isinstance(content, bytes):
+            content = content.encode("utf-8")
+        _update_with_calls(sha1, content, os.getcwd(), visited)
+    return sha1.hexdigest()
+
+
+def _update_with_calls(sha1, content, directory, visited):
+    """ Hashes content and the files it calls, each of them only once. """
+    sha1.update(content)
+    for path in re.findall(br"call\s*,\s*file\s*=\s*[\"']([^\"']+)[\"']", content, re.I):
+        path = os.path.abspath(os.path.join(directory, path.decode("utf-8")))
+        if path in visited or not os.path.isfile(path):
+            continue
+        visited.add(path)
+        with open(path, "rb") as called_file:
+            called_content = called_file.read()
+        _update_with_calls(sha1, called_content, os.path.dirname(path), visited)
+
+
+def _write_atomic(path, write_function):
+    """ Writes via a temporary file, so that readers never see half files. """
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(file_descriptor, "wb") as tmp_file:
+        write_function(tmp_file)
+    os.rename(tmp_path, path)
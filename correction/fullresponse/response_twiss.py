@@ -45,12 +45,15 @@ to fit the :math:`M \cdot \delta K` orientation.
 
 """
 import cPickle as pickle
+import os
 
 import numpy as np
 import pandas as pd
+from numpy.lib.format import open_memmap
 
+from correction.fullresponse import response_store
 from correction.fullresponse.sequence_evaluation import check_varmap_file
-from twiss_optics.twiss_functions import get_phase_advances, tau, dphi
+from twiss_optics.twiss_functions import tau, dphi
 from twiss_optics.twiss_functions import regex_in, upper
 from utils import logging_tools as logtool
 from utils import tfs_pandas as tfs
@@ -59,6 +62,10 @@ from utils.contexts import timeit
 LOG = logtool.get_logger(__name__)
 
 DUMMY_ID = "DUMMY_PLACEHOLDER"
+BLOCK_ENTRIES = 2 ** 22  # entries of the (input x output elements) blocks computed at once
+
+RESPONSE_KEYS = ('Q', 'BETX', 'BETY', 'BBX', 'BBY', 'MUX', 'MUY', 'DX', 'DY', 'NDX', 'NDY',
+                 'F1001R', 'F1001I', 'F1010R', 'F1010I')
 
 
 # Twiss Response Class ########################################################
@@ -77,7 +84,16 @@ class TwissResponse(object):
             'bpms': All BPMS (Default)
             'bpms+': BPMS+ used magnets (== magnets defined by variables in varfile)
             'all': All BPMS and Magnets given in the model (Markers are removed)
-
+        block_size (int): Number of output elements computed at once.
+            Default: as many as fit in BLOCK_ENTRIES.
+        mmap_dir (str): If given, the (element x magnet) response matrices are
+            memory-mapped .npy files in this directory, instead of arrays in memory.
+        single_precision (bool): Store the (element x magnet) response matrices
+            as float32/complex64, the computation itself is in double precision.
+
+    The phase advances are computed from the MU columns only for the blocks
+    of output elements being computed, so the memory needed grows linearly
+    with the number of elements (and not quadratically).
     """
 
     ################################
@@ -85,7 +101,7 @@ class TwissResponse(object):
     ################################
 
     def __init__(self, varmap_or_path, model_or_path, variables, direction=1,
-                 at_elements='bpms'):
+                 at_elements='bpms', block_size=None, mmap_dir=None, single_precision=False):
 
         LOG.debug("Initializing TwissResponse.")
         with timeit(lambda t: LOG.debug("  Time initializing TwissResponse: {:f}s".format(t))):
@@ -97,29 +113,49 @@ class TwissResponse(object):
             self._elements_out = self._get_output_elements(at_elements)
             self._direction = self._get_direction(direction)
 
-            # calculate all phase advances
-            self._phase_advances = get_phase_advances(self._twiss)
-
-            # All responses are calcluated as needed, see getters below!
-            # slots for response matrices
-            self._beta = None
-            self._dispersion = None
-            self._phase = None
-            self._phase_adv = None
-            self._tune = None
-            self._coupling = None
-            self._beta_beat = None
-            self._norm_dispersion = None
-
-            # slots for mapped response matrices
-            self._coupling_mapped = None
-            self._beta_mapped = None
-            self._dispersion_mapped = None
-            self._phase_mapped = None
-            self._phase_adv_mapped = None
-            self._tune_mapped = None
-            self._beta_beat_mapped = None
-            self._norm_dispersion_mapped = None
+            self._block_size = block_size
+            self._mmap_dir = mmap_dir
+            self._real_type = np.float32 if single_precision else np.float64
+            self._complex_type = np.complex64 if single_precision else np.complex128
+
+            self._reset_responses()
+
+    def _reset_responses(self):
+        """ All responses are calcluated as needed, see getters below! """
+        # slots for response matrices
+        self._beta = None
+        self._dispersion = None
+        self._phase = None
+        self._phase_adv = None
+        self._tune = None
+        self._coupling = None
+        self._beta_beat = None
+        self._norm_dispersion = None
+
+        # slots for mapped response matrices
+        self._coupling_mapped = None
+        self._beta_mapped = None
+        self._dispersion_mapped = None
+        self._phase_mapped = None
+        self._phase_adv_mapped = None
+        self._tune_mapped = None
+        self._beta_beat_mapped = None
+        self._norm_dispersion_mapped = None
+
+    def update_model(self, model_or_path):
+        """ Replaces the model, e.g. by the corrected model of a correction iteration.
+
+        The model needs to contain the same elements. The variable mapping and
+        the elements are kept, only the responses are recalculated (when needed).
+        """
+        LOG.debug("Updating model of TwissResponse.")
+        twiss = self._get_model_twiss(model_or_path)
+        elements = set(self._elements_out).union(*self._elements_in.values())
+        missing = elements.difference(twiss.index)
+        if missing:
+            raise ValueError("Elements '{:s}' are not in the new model.".format(", ".join(missing)))
+        self._twiss = twiss
+        self._reset_responses()
 
     @staticmethod
     def _get_model_twiss(model_or_path):
@@ -215,6 +251,7 @@ class TwissResponse(object):
             # elements specified
             if any(el not in tw_idx for el in at_elements):
                 LOG.warning("One or more specified elements are not in the model.")
+            at_elements = set(at_elements)
             return [idx for idx in tw_idx
                     if idx in at_elements]
 
@@ -225,15 +262,49 @@ class TwissResponse(object):
 
         if at_elements == "bpms+":
             # bpms and the used magnets
-            el_in = self._elements_in
+            el_in = set().union(*self._elements_in.values())
             return [idx for idx in tw_idx
-                    if (idx.upper().startswith('B')
-                        or any(idx in el_in[order] for order in el_in))]
+                    if idx.upper().startswith('B') or idx in el_in]
 
         if at_elements == "all":
             # all, obviously
             return [idx for idx in tw_idx if idx != DUMMY_ID]
 
+    ################################
+    #       Blocks
+    ################################
+
+    def _get_phase_advances(self, plane, el_in, el_out):
+        """ Phase advances DPhi(i,j) = Phi(j) - Phi(i) from el_in (rows) to el_out (columns).
+
+        Same convention as in [#FranchiAnalyticformulasrapid2017]_ .
+        """
+        phases = self._twiss["MU" + plane]
+        return phases.loc[el_out].values[None, :] - phases.loc[el_in].values[:, None]
+
+    def _get_s_before(self, el_in, el_out):
+        """ pi(i,j) = s(i) < s(j) from el_in (rows) to el_out (columns). """
+        s_pos = self._twiss["S"]
+        return (s_pos.loc[el_in].values[:, None] < s_pos.loc[el_out].values[None, :]).astype(int)
+
+    def _calc_in_blocks(self, name, el_in, el_out, calc_block, dtype):
+        """ Returns the response (el_out x el_in), computed in blocks of output elements.
+
+        calc_block(block) returns the response of el_in (rows) at el_out[block] (columns).
+        The blocks are written into one array, memory-mapped if mmap_dir was given.
+        """
+        shape = (len(el_out), len(el_in))
+        if self._mmap_dir is None:
+            values = np.empty(shape, dtype=dtype)
+        else:
+            values = open_memmap(os.path.join(self._mmap_dir, name + ".npy"),
+                                 mode="w+", dtype=dtype, shape=shape)
+        block_size = self._block_size or max(1, BLOCK_ENTRIES // max(1, len(el_in)))
+        for start in range(0, len(el_out), block_size):
+            block = slice(start, min(start + block_size, len(el_out)))
+            values[block] = calc_block(block).transpose()
+        return tfs.TfsDataFrame(values, index=el_out, columns=el_in)
+
     ################################
     #       Response Matrix
     ################################
@@ -246,23 +317,26 @@ class TwissResponse(object):
         LOG.debug("Calculate Coupling Matrix")
         with timeit(lambda t: LOG.debug("  Time needed: {:f}s".format(t))):
             tw = self._twiss
-            adv = self._phase_advances
             el_out = self._elements_out
             k1s_el = self._elements_in["K1SL"]
             dcoupl = dict.fromkeys(["1001", "1010"])
 
             i2pi = 2j * np.pi
-            phx = dphi(adv['X'].loc[k1s_el, el_out], tw.Q1).values
-            phy = dphi(adv['Y'].loc[k1s_el, el_out], tw.Q2).values
-            bet_term = np.sqrt(tw.loc[k1s_el, "BETX"].values * tw.loc[k1s_el, "BETY"].values)
+            bet_term = (self._direction *
+                        np.sqrt(tw.loc[k1s_el, "BETX"].values * tw.loc[k1s_el, "BETY"].values))
 
             for plane in ["1001", "1010"]:
                 phs_sign = -1 if plane == "1001" else 1
-                dcoupl[plane] = tfs.TfsDataFrame(
-                    bet_term[:, None] * np.exp(i2pi * (phx + phs_sign * phy)) /
-                    (4 * (1 - np.exp(i2pi * (tw.Q1 + phs_sign * tw.Q2)))),
-                    index=k1s_el, columns=el_out).transpose()
-        return dict_mul(self._direction, dcoupl)
+
+                def calc_block(block):
+                    phx = dphi(self._get_phase_advances("X", k1s_el, el_out[block]), tw.Q1)
+                    phy = dphi(self._get_phase_advances("Y", k1s_el, el_out[block]), tw.Q2)
+                    return (bet_term[:, None] * np.exp(i2pi * (phx + phs_sign * phy)) /
+                            (4 * (1 - np.exp(i2pi * (tw.Q1 + phs_sign * tw.Q2)))))
+
+                dcoupl[plane] = self._calc_in_blocks("coupling_" + plane, k1s_el, el_out,
+                                                     calc_block, self._complex_type)
+        return dcoupl
 
     def _calc_beta_response(self):
         """ Response Matrix for delta beta.
@@ -272,7 +346,6 @@ class TwissResponse(object):
         LOG.debug("Calculate Beta Response Matrix")
         with timeit(lambda t: LOG.debug("  Time needed: {:f}s".format(t))):
             tw = self._twiss
-            adv = self._phase_advances
             el_out = self._elements_out
             k1_el = self._elements_in["K1L"]
             dbeta = dict.fromkeys(["X", "Y"])
@@ -281,16 +354,17 @@ class TwissResponse(object):
                 col_beta = "BET" + plane
                 q = tw.Q1 if plane == "X" else tw.Q2
                 coeff_sign = -1 if plane == "X" else 1
+                bet_in = tw.loc[k1_el, col_beta].values * (self._direction * coeff_sign /
+                                                            (2 * np.sin(2 * np.pi * q)))
+                bet_out = tw.loc[el_out, col_beta].values
 
-                pi2tau = 2 * np.pi * tau(adv[plane].loc[k1_el, el_out], q)
-
-                dbeta[plane] = tfs.TfsDataFrame(
-                    tw.loc[el_out, col_beta].values[None, :] *
-                    tw.loc[k1_el, col_beta].values[:, None] * np.cos(2 * pi2tau.values) *
-                    (coeff_sign / (2 * np.sin(2 * np.pi * q))),
-                    index=k1_el, columns=el_out).transpose()
+                def calc_block(block):
+                    pi2tau = 2 * np.pi * tau(self._get_phase_advances(plane, k1_el, el_out[block]), q)
+                    return bet_out[None, block] * bet_in[:, None] * np.cos(2 * pi2tau)
 
-        return dict_mul(self._direction, dbeta)
+                dbeta[plane] = self._calc_in_blocks("beta_" + plane, k1_el, el_out,
+                                                    calc_block, self._real_type)
+        return dbeta
 
     def _calc_dispersion_response(self):
         """ Response Matrix for delta dispersion
@@ -300,7 +374,6 @@ class TwissResponse(object):
         LOG.debug("Calculate Dispersion Response Matrix")
         with timeit(lambda t: LOG.debug("  Time needed: {:f}".format(t))):
             tw = self._twiss
-            adv = self._phase_advances
             el_out = self._elements_out
             els_in = self._elements_in
 
@@ -314,26 +387,32 @@ class TwissResponse(object):
                 col_disp = "DY" if plane == "X" else "DX"
 
                 if any((len(el_in_plane[0]), len(el_in_plane[1]))):
-                    coeff = np.sqrt(tw.loc[el_out, col_beta].values) / (2 * np.sin(np.pi * q))
+                    coeff = (self._direction * np.sqrt(tw.loc[el_out, col_beta].values) /
+                             (2 * np.sin(np.pi * q)))
 
                 for el_in, el_type in zip(el_in_plane, type_plane):
                     coeff_sign = -1 if el_type == "K0SL" else 1
                     out_str = "{p:s}_{t:s}".format(p=plane, t=el_type)
 
                     if len(el_in):
-                        pi2tau = 2 * np.pi * tau(adv[plane].loc[el_in, el_out], q)
                         bet_term = np.sqrt(tw.loc[el_in, col_beta].values)
                         if el_type == "K1SL":
                             bet_term *= tw.loc[el_in, col_disp].values
-                        disp_resp[out_str] = tfs.TfsDataFrame(
-                            coeff_sign * coeff[None, :] * bet_term[:, None] * np.cos(pi2tau),
-                            index=el_in, columns=el_out).transpose()
+
+                        def calc_block(block):
+                            pi2tau = 2 * np.pi * tau(
+                                self._get_phase_advances(plane, el_in, el_out[block]), q)
+                            return coeff_sign * coeff[None, block] * bet_term[:, None] * np.cos(pi2tau)
+
+                        disp_resp[out_str] = self._calc_in_blocks("dispersion_" + out_str,
+                                                                  el_in, el_out,
+                                                                  calc_block, self._real_type)
                     else:
                         LOG.debug(
                             "  No '{:s}' variables found. ".format(el_type) +
                             "Dispersion Response '{:s}' will be empty.".format(out_str))
                         disp_resp[out_str] = tfs.TfsDataFrame(None, index=el_out)
-        return dict_mul(self._direction, disp_resp)
+        return disp_resp
 
     def _calc_norm_dispersion_response(self):
         """ Response Matrix for delta normalized dispersion
@@ -344,7 +423,6 @@ class TwissResponse(object):
         LOG.debug("Calculate Normalized Dispersion Response Matrix")
         with timeit(lambda t: LOG.debug("  Time needed: {:f}".format(t))):
             tw = self._twiss
-            adv = self._phase_advances
             el_out = self._elements_out
             els_in = self._elements_in
 
@@ -368,31 +446,35 @@ class TwissResponse(object):
                 el_types = sign_map[plane].keys()
                 els_per_type = [els_in[el_type] for el_type in el_types]
 
-                coeff = 1 / (2 * np.sin(np.pi * q))
+                coeff = self._direction / (2 * np.sin(np.pi * q))
                 for el_in, el_type in zip(els_per_type, el_types):
                     coeff_sign = sign_map[plane][el_type]
                     out_str = "{p:s}_{t:s}".format(p=plane, t=el_type)
 
                     if len(el_in):
-                        pi2tau = 2 * np.pi * tau(adv[plane].loc[el_in, el_out], q)
-                        bet_term = np.sqrt(tw.loc[el_in, col_beta])
+                        bet_term = np.sqrt(tw.loc[el_in, col_beta].values)
 
                         try:
                             col_disp = col_disp_map[plane][el_type]
                         except KeyError:
                             pass
                         else:
-                            bet_term *= tw.loc[el_in, col_disp]
+                            bet_term *= tw.loc[el_in, col_disp].values
 
-                        disp_resp[out_str] = ((coeff_sign * coeff * bet_term)[:, None] *
-                                              np.cos(pi2tau)
-                                              ).transpose()
+                        def calc_block(block):
+                            pi2tau = 2 * np.pi * tau(
+                                self._get_phase_advances(plane, el_in, el_out[block]), q)
+                            return (coeff_sign * coeff * bet_term)[:, None] * np.cos(pi2tau)
+
+                        disp_resp[out_str] = self._calc_in_blocks("norm_dispersion_" + out_str,
+                                                                  el_in, el_out,
+                                                                  calc_block, self._real_type)
                     else:
                         LOG.debug(
                             "  No '{:s}' variables found. ".format(el_type) +
                             "Normalized Dispersion Response '{:s}' will be empty.".format(out_str))
                         disp_resp[out_str] = tfs.TfsDataFrame(None, index=el_out)
-        return dict_mul(self._direction, disp_resp)
+        return disp_resp
 
     def _calc_phase_advance_response(self):
         """ Response Matrix for delta DPhi.
@@ -406,7 +488,6 @@ class TwissResponse(object):
         LOG.debug("Calculate Phase Advance Response Matrix")
         with timeit(lambda t: LOG.debug("  Time needed: {:f}s".format(t))):
             tw = self._twiss
-            adv = self._phase_advances
             k1_el = self._elements_in["K1L"]
 
             el_out_all = [DUMMY_ID] + self._elements_out  # Add MU[XY] = 0.0 to the start
@@ -416,34 +497,40 @@ class TwissResponse(object):
             if len(k1_el) > 0:
                 dmu = dict.fromkeys(["X", "Y"])
 
-                pi = tfs.TfsDataFrame(tw['S'][:, None] < tw['S'][None, :],  # pi(i,j) = s(i) < s(j)
-                                      index=tw.index, columns=tw.index, dtype=int)
-
-                pi_term = (pi.loc[k1_el, el_out].values -
-                           pi.loc[k1_el, el_out_mm].values +
-                           np.diag(pi.loc[el_out, el_out_mm].values)[None, :])
+                s_pos = tw["S"]
+                # pi(i,j) = s(i) < s(j), the last term is diag(pi(el_out, el_out_mm))
+                consecutive_term = (s_pos.loc[el_out].values <
+                                    s_pos.loc[el_out_mm].values).astype(int)
 
                 for plane in ["X", "Y"]:
                     col_beta = "BET" + plane
                     q = tw.Q1 if plane == "X" else tw.Q2
                     coeff_sign = 1 if plane == "X" else -1
-
-                    pi2tau = 2 * np.pi * tau(adv[plane].loc[k1_el, el_out_all], q)
-                    brackets = (2 * pi_term +
-                                ((np.sin(2 * pi2tau.loc[:, el_out].values) -
-                                  np.sin(2 * pi2tau.loc[:, el_out_mm].values))
-                                 / np.sin(2 * np.pi * q)
-                                 ))
-                    dmu[plane] = tfs.TfsDataFrame(
-                        tw.loc[k1_el, col_beta].values[:, None] * brackets
-                        * (coeff_sign / (8 * np.pi)),
-                        index=k1_el, columns=el_out).transpose()
+                    bet_term = (tw.loc[k1_el, col_beta].values *
+                                (self._direction * coeff_sign / (8 * np.pi)))
+
+                    def calc_block(block):
+                        pi_term = (self._get_s_before(k1_el, el_out[block]) -
+                                   self._get_s_before(k1_el, el_out_mm[block]) +
+                                   consecutive_term[None, block])
+                        pi2tau = 2 * np.pi * tau(
+                            self._get_phase_advances(plane, k1_el, el_out[block]), q)
+                        pi2tau_mm = 2 * np.pi * tau(
+                            self._get_phase_advances(plane, k1_el, el_out_mm[block]), q)
+                        brackets = (2 * pi_term +
+                                    ((np.sin(2 * pi2tau) - np.sin(2 * pi2tau_mm))
+                                     / np.sin(2 * np.pi * q)
+                                     ))
+                        return bet_term[:, None] * brackets
+
+                    dmu[plane] = self._calc_in_blocks("phase_advance_" + plane, k1_el, el_out,
+                                                      calc_block, self._real_type)
             else:
                 LOG.debug("  No 'K1L' variables found. Phase Response will be empty.")
                 dmu = {"X": tfs.TfsDataFrame(None, index=el_out),
                        "Y": tfs.TfsDataFrame(None, index=el_out)}
 
-        return dict_mul(self._direction, dmu)
+        return dmu
 
     def _calc_phase_response(self):
         """ Response Matrix for delta DPhi.
@@ -458,39 +545,38 @@ class TwissResponse(object):
         LOG.debug("Calculate Phase Response Matrix")
         with timeit(lambda t: LOG.debug("  Time needed: {:f}s".format(t))):
             tw = self._twiss
-            adv = self._phase_advances
             k1_el = self._elements_in["K1L"]
             el_out = self._elements_out
 
             if len(k1_el) > 0:
                 dmu = dict.fromkeys(["X", "Y"])
 
-                pi = tfs.TfsDataFrame(tw['S'][:, None] < tw['S'][None, :],  # pi(i,j) = s(i) < s(j)
-                                      index=tw.index, columns=tw.index, dtype=int)
-
-                pi_term = pi.loc[k1_el, el_out].values
-
                 for plane in ["X", "Y"]:
                     col_beta = "BET" + plane
                     q = tw.Q1 if plane == "X" else tw.Q2
                     coeff_sign = 1 if plane == "X" else -1
-
-                    pi2tau = 2 * np.pi * tau(adv[plane].loc[k1_el, [DUMMY_ID] + el_out], q)
-                    brackets = (2 * pi_term +
-                                ((np.sin(2 * pi2tau.loc[:, el_out].values) -
-                                  np.sin(2 * pi2tau.loc[:, DUMMY_ID].values[:, None]))
-                                 / np.sin(2 * np.pi * q)
-                                 ))
-                    dmu[plane] = tfs.TfsDataFrame(
-                        tw.loc[k1_el, col_beta].values[:, None] * brackets
-                        * (coeff_sign / (8 * np.pi)),
-                        index=k1_el, columns=el_out).transpose()
+                    bet_term = (tw.loc[k1_el, col_beta].values *
+                                (self._direction * coeff_sign / (8 * np.pi)))
+                    sin_dummy = np.sin(2 * 2 * np.pi * tau(
+                        self._get_phase_advances(plane, k1_el, [DUMMY_ID]), q))
+
+                    def calc_block(block):
+                        pi2tau = 2 * np.pi * tau(
+                            self._get_phase_advances(plane, k1_el, el_out[block]), q)
+                        brackets = (2 * self._get_s_before(k1_el, el_out[block]) +
+                                    ((np.sin(2 * pi2tau) - sin_dummy)
+                                     / np.sin(2 * np.pi * q)
+                                     ))
+                        return bet_term[:, None] * brackets
+
+                    dmu[plane] = self._calc_in_blocks("phase_" + plane, k1_el, el_out,
+                                                      calc_block, self._real_type)
             else:
                 LOG.debug("  No 'K1L' variables found. Phase Response will be empty.")
                 dmu = {"X": tfs.TfsDataFrame(None, index=el_out),
                        "Y": tfs.TfsDataFrame(None, index=el_out)}
 
-        return dict_mul(self._direction, dmu)
+        return dmu
 
     def _calc_tune_response(self):
         """ Response vectors for Tune.
@@ -548,9 +634,8 @@ class TwissResponse(object):
 
     @staticmethod
     def _map_to_variables(df, mapping):
-        """ Maps from magnets to variables using self._var_to_el.
-            Could actually be done by matrix multiplication :math:'A \cdot var_to_el',
-             yet, as var_to_el is very sparsely populated, looping is easier.
+        """ Maps from magnets to variables using self._var_to_el,
+            by the matrix multiplication :math:'A \cdot var_to_el'.
 
             Args:
                 df: DataFrame or dictionary of DataFrames to map
@@ -560,12 +645,17 @@ class TwissResponse(object):
         """
         def map_fun(df, mapping):
             """ Actual mapping function """
-            df_map = tfs.TfsDataFrame(index=df.index, columns=mapping.keys())
-            for var, magnets in mapping.iteritems():
-                df_map[var] = df.loc[:, upper(magnets.index)].mul(
-                    magnets.values, axis="columns"
-                ).sum(axis="columns")
-            return df_map
+            variables = mapping.keys()
+            var_to_el = np.zeros((df.shape[1], len(variables)))
+            for idx_var, var in enumerate(variables):
+                magnets = mapping[var]
+                idx_magnets = df.columns.get_indexer(upper(magnets.index))
+                found = idx_magnets >= 0
+                np.add.at(var_to_el[:, idx_var], idx_magnets[found], magnets.values[found])
+            values = df.values
+            if np.isnan(values).any():
+                values = np.where(np.isnan(values), 0., values)  # as skipped by sum()
+            return tfs.TfsDataFrame(np.dot(values, var_to_el), index=df.index, columns=variables)
 
         # convenience wrapper for dicts
         if isinstance(df, dict):
@@ -805,20 +895,45 @@ def dict_mul(number, dictionary):
 # Wrapper ##################################################################
 
 
-def create_response(accel_inst, vars_categories, optics_params):
-    """ Wrapper to create response via TwissResponse """
-    LOG.debug("Creating response via TwissResponse.")
-    vars_list = accel_inst.get_variables(classes=vars_categories)
-    if len(vars_list) == 0:
-        raise ValueError("No variables found! Make sure your categories are valid!")
+def create_twiss_response(accel_inst, vars_categories, model=None, at_elements="bpms"):
+    """ Returns the TwissResponse of the variables.
 
-    varmap_path = check_varmap_file(accel_inst, vars_categories)
+    If model is not given, the elements model of accel_inst is used.
+    The model can be replaced with TwissResponse.update_model() later,
+    without setting up the TwissResponse again.
+    """
+    vars_list, varmap_path, sign = _get_response_setup(accel_inst, vars_categories)
+    if model is None:
+        model = accel_inst.get_elements_tfs()
+    return TwissResponse(varmap_path, model, vars_list, sign, at_elements=at_elements)
+
+
+def create_response(accel_inst, vars_categories, optics_params, store_dir=None):
+    """ Wrapper to create response via TwissResponse.
+
+    If store_dir is given, only the variables not yet in the response store
+    for this model are computed (see response_store).
+    """
+    LOG.debug("Creating response via TwissResponse.")
+    vars_list, varmap_path, sign = _get_response_setup(accel_inst, vars_categories)
 
     with timeit(lambda t:
                 LOG.debug("Total time getting TwissResponse: {:f}s".format(t))):
-        sign = 1 if accel_inst.get_beam() == 1 else -1
-        tr = TwissResponse(varmap_path, accel_inst.get_elements_tfs(), vars_list, sign)
-        response = tr.get_response_for(optics_params)
+        model = accel_inst.get_elements_tfs()
+
+        def compute_response(variables):
+            tr = TwissResponse(varmap_path, model, variables, sign)
+            return tr.get_response_for(optics_params)
+
+        if store_dir is None:
+            response = compute_response(vars_list)
+        else:
+            with open(varmap_path, "rb") as varmap_file:
+                model_key = response_store.get_model_key("twiss", str(sign),
+                                                         varmap_file.read(), model)
+            observables = optics_params if optics_params is not None else RESPONSE_KEYS
+            response = response_store.get_response(store_dir, model_key, list(vars_list),
+                                                   observables, compute_response)
 
     if not any([resp.size for resp in response.values()]):
         raise ValueError("Responses are all empty. " +
@@ -828,6 +943,16 @@ def create_response(accel_inst, vars_categories, optics_params):
     return response
 
 
+def _get_response_setup(accel_inst, vars_categories):
+    """ Returns the variables, the varmap path and the beam sign for the TwissResponse. """
+    vars_list = accel_inst.get_variables(classes=vars_categories)
+    if len(vars_list) == 0:
+        raise ValueError("No variables found! Make sure your categories are valid!")
+    varmap_path = check_varmap_file(accel_inst, vars_categories)
+    sign = 1 if accel_inst.get_beam() == 1 else -1
+    return vars_list, varmap_path, sign
+
+
 # Script Mode ##################################################################
 
 
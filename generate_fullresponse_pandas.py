@@ -74,6 +74,13 @@ def get_params():
         type=str,
         nargs="+",
     )
+    params.add_parameter(
+        flags="--response_store",
+        help=("Directory of the response store. Only the variables not yet "
+              "computed for this model are computed, the others are reused."),
+        name="store_dir",
+        type=str,
+    )
     params.add_parameter(
         flags="--debug",
         help="Print debug information.",
@@ -108,6 +115,9 @@ def create_response(opt, other_opt):
                          **Default**: ``2e-05``
         optics_params (str): List of parameters to correct upon (e.g. BBX BBY; twiss-only).
                              **Flags**: --optics_params
+        store_dir (str): Directory of the response store. Only the variables not yet
+                         computed for this model are computed, the others are reused.
+                         **Flags**: --response_store
         variable_categories: List of the variables classes to use.
                              **Flags**: --variables
                              **Default**: ``['MQM', 'MQT', 'MQTL', 'MQY']``
@@ -122,12 +132,14 @@ def create_response(opt, other_opt):
 
         if opt.creator == "madx":
             fullresponse = response_madx.generate_fullresponse(
-                accel_inst, opt.variable_categories, delta_k=opt.delta_k
+                accel_inst, opt.variable_categories, delta_k=opt.delta_k,
+                store_dir=opt.store_dir
             )
 
         elif opt.creator == "twiss":
             fullresponse = response_twiss.create_response(
-                accel_inst, opt.variable_categories, opt.optics_params
+                accel_inst, opt.variable_categories, opt.optics_params,
+                store_dir=opt.store_dir
             )
 
         LOG.debug("Saving Response into file '{:s}'".format(opt.outfile_path))
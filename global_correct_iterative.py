@@ -7,8 +7,17 @@ are loaded from a file and then the equation
 .. math:: R_{O} \cdot \delta var = O_{meas} - O_{model}
     :label: eq1
 
-is being solved for :math:`\delta var` via a chosen method (at the moment only numpys pinv,
-which creates a pseudo-inverse via svd is used).
+is being solved for :math:`\delta var` via a chosen method:
+
+ * ``pinv``: pseudo-inverse via the truncated singular value decomposition (svd).
+ * ``tikhonov``: Tikhonov (ridge) regularized least squares, via the same svd.
+ * ``lsqr``, ``lsmr``: iterative least squares solvers of scipy,
+   for large (and sparse) responses.
+ * ``micado``: greedy selection of the ``n_correctors`` most effective variables (MICADO),
+   only these are used for the correction.
+
+The svd is computed once and reused in the following iterations (and by the other methods),
+as long as the weighted response does not change.
 
 The response matrices are hereby merged into one matrix for all observables to solve vor all
 :math:`\delta var` at the same time.
@@ -46,12 +55,15 @@ treated as zeros
 """
 import cPickle
 import datetime
+import hashlib
 import os
 import pickle
 import time
 
 import numpy as np
 import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import lsqr, lsmr
 
 import madx_wrapper
 from correction.fullresponse import response_twiss
@@ -67,6 +79,7 @@ from utils.logging_tools import log_pandas_settings_with_copy
 LOG = logging_tools.get_logger(__name__)
 
 DEV_NULL = os.devnull
+SPARSE_DENSITY = 0.25  # responses with less non-zero entries are sparse for lsqr and lsmr
 
 
 # Configuration ##################################################################
@@ -76,6 +89,8 @@ DEFAULT_ARGS = {
     "output_path": None,
     "output_filename": "changeparameters_iter",
     "svd_cut": 0.01,
+    "tikhonov": 0.01,
+    "n_correctors": 10,
     "optics_params": ['MUX', 'MUY', 'BBX', 'BBY', 'NDX', 'Q'],
     "variables": ["MQM", "MQT", "MQTL", "MQY"],
     "beta_file_name": "getbeta",
@@ -180,6 +195,12 @@ def _get_params():
         name="update_response",
         action="store_true",
     )
+    params.add_parameter(
+        flags="--response_store",
+        help=("Directory of the response store for the analytical response. "
+              "Responses already computed for the same model are reused."),
+        name="store_dir",
+    )
     params.add_parameter(
         flags="--optics_params",
         help="List of parameters to correct upon (e.g. BBX BBY)",
@@ -210,11 +231,27 @@ def _get_params():
     params.add_parameter(
         flags="--svd_cut",
         help=("Cutoff for small singular values of the pseudo inverse. (Method: 'pinv')"
-              "Singular values smaller than rcond*largest_singular_value are set to zero"),
+              "Singular values smaller than rcond*largest_singular_value are set to zero."
+              "(Methods 'lsqr' and 'lsmr': stop at a condition number of 1/svd_cut)"),
         name="svd_cut",
         type=float,
         default=DEFAULT_ARGS["svd_cut"],
     )
+    params.add_parameter(
+        flags="--tikhonov",
+        help=("Regularization parameter relative to the largest singular value. "
+              "(Method: 'tikhonov')"),
+        name="tikhonov",
+        type=float,
+        default=DEFAULT_ARGS["tikhonov"],
+    )
+    params.add_parameter(
+        flags="--n_correctors",
+        help="Number of variables to use. (Method: 'micado')",
+        name="n_correctors",
+        type=int,
+        default=DEFAULT_ARGS["n_correctors"],
+    )
     params.add_parameter(
         flags="--model_cut",
         help=("Reject BPMs whose deviation to the model is higher than the "
@@ -267,11 +304,11 @@ def _get_params():
     )
     params.add_parameter(
         flags="--method",
-        help="Optimization method to use. (Not implemented yet)",
+        help="Optimization method to use.",
         name="method",
         type=str,
         default=DEFAULT_ARGS["method"],
-        choices=["pinv"]
+        choices=["pinv", "tikhonov", "lsqr", "lsmr", "micado"]
     )
     params.add_parameter(
         flags="--max_iter",
@@ -334,13 +371,16 @@ def global_correction(opt, accel_opt):
                         (like in the old days).
                         **Flags**: --max_iter
                         **Default**: ``3``
-        method (str): Optimization method to use. (Not implemented yet)
+        method (str): Optimization method to use.
                       **Flags**: --method
-                      **Choices**: ['pinv']
+                      **Choices**: ['pinv', 'tikhonov', 'lsqr', 'lsmr', 'micado']
                       **Default**: ``pinv``
         modelcut (float): Reject BPMs whose deviation to the model is higher than the
                           correspoding input. Input in order of optics_params.
                           **Flags**: --model_cut
+        n_correctors (int): Number of variables to use. (Method: 'micado')
+                            **Flags**: --n_correctors
+                            **Default**: ``10``
         optics_file: Path to the optics file to use, usually modifiers.madx.
                      If not present will default to model_path/modifiers.madx
                      **Flags**: --optics_file
@@ -351,11 +391,19 @@ def global_correction(opt, accel_opt):
                      will default to the --meas input path.
                      **Flags**: --output_dir
                      **Default**: ``None``
+        store_dir: Directory of the response store for the analytical response.
+                   Responses already computed for the same model are reused.
+                   **Flags**: --response_store
         svd_cut (float): Cutoff for small singular values of the pseudo inverse. (Method: 'pinv')
                          Singular values smaller than
-                         :math:`rcond \cdot largest_singular_value` are set to zero
+                         :math:`rcond \cdot largest_singular_value` are set to zero.
+                         (Methods 'lsqr' and 'lsmr': stop at a condition number of 1/svd_cut)
                          **Flags**: --svd_cut
                          **Default**: ``0.01``
+        tikhonov (float): Regularization parameter relative to the largest singular value.
+                          (Method: 'tikhonov')
+                          **Flags**: --tikhonov
+                          **Default**: ``0.01``
         use_errorbars: If True, it will take into account the measured errorbars in the correction.
                        **Flags**: --use_errorbars
                        **Action**: ``store_true``
@@ -408,7 +456,7 @@ def global_correction(opt, accel_opt):
             resp_dict = _load_fullresponse(opt.fullresponse_path, vars_list)
         else:
             resp_dict = response_twiss.create_response(
-                accel_inst, opt.variable_categories, optics_params
+                accel_inst, opt.variable_categories, optics_params, store_dir=opt.store_dir
             )
 
         # the model in accel_inst is modified later, so save nominal model here to variables
@@ -420,11 +468,13 @@ def global_correction(opt, accel_opt):
             opt.use_errorbars, w_dict, ecut_dict, mcut_dict
         )
         meas_dict = _append_model_to_measurement(nominal_model, meas_dict, optics_params)
-        resp_dict = _filter_response_index(resp_dict, meas_dict, optics_params)
-        resp_matrix = _join_responses(resp_dict, optics_params, vars_list)
+        resp_index = _get_response_index(resp_dict, meas_dict, optics_params, vars_list)
+        resp_matrix = _join_responses(resp_dict, optics_params, resp_index)
+        twiss_response = None
 
         # _dump(os.path.join(opt.output_path, "measurement_dict.bin"), meas_dict)
         delta = tfs.TfsDataFrame(0, index=vars_list, columns=["DELTA"])
+        solver_cache = {}
 
         # ######### Iteration Phase ######### #
 
@@ -448,18 +498,26 @@ def global_correction(opt, accel_opt):
                 meas_dict = _append_model_to_measurement(corr_model, meas_dict, optics_params)
                 if opt.update_response:
                     LOG.debug("Updating response.")
-                    # please look away for the next two lines.
-                    accel_inst._model = corr_model
-                    accel_inst._elements = corr_model_elements
-                    resp_dict = response_twiss.create_response(
-                        accel_inst, opt.variable_categories, optics_params
-                    )
-                    resp_dict = _filter_response_index(resp_dict, meas_dict, optics_params)
-                    resp_matrix = _join_responses(resp_dict, optics_params, vars_list)
+                    # the TwissResponse is set up once, for the measured elements only,
+                    # and then only recalculated from the corrected models
+                    if twiss_response is None:
+                        twiss_response = response_twiss.create_twiss_response(
+                            accel_inst, opt.variable_categories, model=corr_model_elements,
+                            at_elements=_get_measured_elements(meas_dict, optics_params)
+                        )
+                        resp_index = None
+                    else:
+                        twiss_response.update_model(corr_model_elements)
+                    resp_dict = twiss_response.get_response_for(optics_params)
+                    if resp_index is None:
+                        resp_index = _get_response_index(resp_dict, meas_dict,
+                                                         optics_params, vars_list)
+                    resp_matrix = _join_responses(resp_dict, optics_params, resp_index)
 
             # ######### Actual optimization ######### #
             delta += _calculate_delta(
-                resp_matrix, meas_dict, optics_params, vars_list, opt.method, meth_opt)
+                resp_matrix, meas_dict, optics_params, vars_list, opt.method, meth_opt,
+                solver_cache)
 
             writeparams(opt.change_params_path, delta)
             writeparams(opt.change_params_correct_path, -delta)
@@ -512,6 +570,8 @@ def _get_method_opt(opt):
     for easier debugging and readability """
     meth_opt = DotDict(
         svd_cut=opt.svd_cut,
+        tikhonov=opt.tikhonov,
+        n_correctors=opt.n_correctors,
     )
     return meth_opt
 
@@ -796,31 +856,52 @@ def _get_errorbased_weights(key, weights, errors):
 # Response filtering ##########################################################
 
 
-def _filter_response_index(response, measurement, keys):
+def _get_response_index(response, measurement, keys, vars_list):
+    """ Returns the positions of the measured elements and of the variables in the responses.
+
+    The positions are computed once and then used to join (and filter) responses
+    with the same index and columns, see _join_responses.
+    """
     not_in_response = [k for k in keys if k not in response]
     if len(not_in_response) > 0:
         raise KeyError("The following optical parameters are not present in current"
                        "response matrix: {:s}".format(not_in_response))
 
     filters = _get_response_filters()
-    new_resp = {}
+    resp_index = {}
     for key in keys:
-        new_resp[key] = filters[key](response[key], measurement[key])
-    return new_resp
+        rows = filters[key](response[key], measurement[key])
+        if any(np.any(idx_rows < 0) for idx_rows in rows):
+            LOG.warning("Not all measured elements of '{:s}' are in the response, "
+                        "their response is set to zero.".format(key))
+        resp_index[key] = DotDict(rows=rows,
+                                  columns=response[key].columns.get_indexer(vars_list))
+    return resp_index
 
 
 def _get_generic_response(resp, meas):
-    return resp.loc[meas.index.values, :]
+    return (resp.index.get_indexer(meas.index.values),)
 
 
 def _get_phase_response(resp, meas):
-    phase1 = resp.loc[meas.index.values, :]
-    phase2 = resp.loc[meas.loc[:, 'NAME2'].values, :]
-    return -phase1.sub(phase2.values)  # phs2-phs1 but with idx of phs1
+    # phs2-phs1 but with idx of phs1
+    return (resp.index.get_indexer(meas.loc[:, 'NAME2'].values),
+            resp.index.get_indexer(meas.index.values))
 
 
 def _get_tune_response(resp, meas):
-    return resp
+    return (np.arange(len(resp.index)),)
+
+
+def _get_measured_elements(meas, keys):
+    """ Returns the names of all elements needed for the response of the measurement """
+    elements = set()
+    for key in keys:
+        if key != "Q":
+            elements.update(meas[key].index.values)
+            if "NAME2" in meas[key].columns:
+                elements.update(meas[key].loc[:, "NAME2"].values)
+    return list(elements)
 
 
 # Model appending #############################################################
@@ -880,17 +961,23 @@ def _get_model_tunes(model, meas, key):
 # Main Calculation ################################################################
 
 
-def _calculate_delta(resp_matrix, meas_dict, keys, vars_list, method, meth_opt):
+def _calculate_delta(resp_matrix, meas_dict, keys, vars_list, method, meth_opt, cache=None):
     """ Get the deltas for the variables.
 
+    cache is a dictionary kept between the iterations,
+    in which the methods store what can be reused (e.g. the svd).
+
     Output is Dataframe with one column 'DELTA' and vars_list index. """
     weight_vector = _join_columns('WEIGHT', meas_dict, keys)
     diff_vector = _join_columns('DIFF', meas_dict, keys)
 
-    resp_weighted = resp_matrix.mul(weight_vector, axis="index")
+    resp_weighted = resp_matrix * weight_vector[:, None]
     diff_weighted = diff_vector * weight_vector
 
-    delta = _get_method_fun(method)(resp_weighted, diff_weighted, meth_opt)
+    if cache is None:
+        cache = {}
+    _check_cache(cache, resp_weighted)
+    delta = _get_method_fun(method)(resp_weighted, diff_weighted, meth_opt, cache)
     delta = tfs.TfsDataFrame(delta, index=vars_list, columns=["DELTA"])
 
     update = np.dot(resp_weighted, delta["DELTA"])
@@ -900,14 +987,109 @@ def _calculate_delta(resp_matrix, meas_dict, keys, vars_list, method, meth_opt):
 
 def _get_method_fun(method):
     funcs = {
-        "pinv": _pseudo_inverse
+        "pinv": _pseudo_inverse,
+        "tikhonov": _tikhonov,
+        "lsqr": _lsqr,
+        "lsmr": _lsmr,
+        "micado": _micado,
     }
     return funcs[method]
 
 
-def _pseudo_inverse(response_mat, diff_vec, opt):
-    """ Calculates the pseudo-inverse of the response via svd. (numpy) """
-    return np.dot(np.linalg.pinv(response_mat, opt.svd_cut), diff_vec)
+def _check_cache(cache, response_mat):
+    """ Empties the cache if the response is not the one it was filled for. """
+    key = hashlib.sha1(np.ascontiguousarray(response_mat)).hexdigest()
+    if cache.get("key") != key:
+        if "key" in cache:
+            LOG.debug("Response changed, solver cache is reset.")
+        cache.clear()
+        cache["key"] = key
+
+
+def _get_svd(response_mat, cache):
+    """ Singular value decomposition of the response, computed once per response. """
+    if "svd" not in cache:
+        LOG.debug("Calculating singular value decomposition.")
+        cache["svd"] = np.linalg.svd(response_mat, full_matrices=False)
+    return cache["svd"]
+
+
+def _largest(sing_vals):
+    return sing_vals[0] if len(sing_vals) else 0.  # sorted by svd
+
+
+def _pseudo_inverse(response_mat, diff_vec, opt, cache):
+    """ Calculates the pseudo-inverse of the response via (truncated) svd. """
+    u_mat, sing_vals, vt_mat = _get_svd(response_mat, cache)
+    keep = sing_vals > opt.svd_cut * _largest(sing_vals)
+    return np.dot(vt_mat[keep].T, np.dot(u_mat[:, keep].T, diff_vec) / sing_vals[keep])
+
+
+def _tikhonov(response_mat, diff_vec, opt, cache):
+    """ Tikhonov regularized least squares, via the svd.
+
+    The regularization parameter is tikhonov * largest singular value. """
+    u_mat, sing_vals, vt_mat = _get_svd(response_mat, cache)
+    reg = opt.tikhonov * _largest(sing_vals)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        filtered = np.nan_to_num(sing_vals / (sing_vals ** 2 + reg ** 2))
+    return np.dot(vt_mat.T, np.dot(u_mat.T, diff_vec) * filtered)
+
+
+def _get_operator(response_mat, cache):
+    """ Response as sparse matrix, if it is mostly zeros. """
+    if "operator" not in cache:
+        density = np.count_nonzero(response_mat) / float(max(response_mat.size, 1))
+        cache["operator"] = (sparse.csr_matrix(response_mat) if density < SPARSE_DENSITY
+                             else response_mat)
+    return cache["operator"]
+
+
+def _lsqr(response_mat, diff_vec, opt, cache):
+    """ Iterative least squares (scipy's lsqr), stopped at a condition number of 1/svd_cut. """
+    result = lsqr(_get_operator(response_mat, cache), diff_vec, conlim=1. / opt.svd_cut)
+    LOG.debug("lsqr stopped after {:d} iterations (reason {:d}).".format(result[2], result[1]))
+    return result[0]
+
+
+def _lsmr(response_mat, diff_vec, opt, cache):
+    """ Iterative least squares (scipy's lsmr), stopped at a condition number of 1/svd_cut. """
+    result = lsmr(_get_operator(response_mat, cache), diff_vec, conlim=1. / opt.svd_cut)
+    LOG.debug("lsmr stopped after {:d} iterations (reason {:d}).".format(result[2], result[1]))
+    return result[0]
+
+
+def _micado(response_mat, diff_vec, opt, cache):
+    """ MICADO: greedy selection of the variables.
+
+    In each step the variable which reduces the residual most is selected and the
+    response of the remaining variables is orthogonalized to it.
+    The deltas are then the least squares solution for the selected variables only.
+    """
+    n_vars = response_mat.shape[1]
+    orth_resp = np.array(response_mat, dtype=np.float64)
+    min_norms = np.sum(orth_resp ** 2, axis=0) * np.finfo(np.float64).eps * n_vars
+    residual = np.array(diff_vec, dtype=np.float64)
+    selected = []
+    for _ in range(min(opt.n_correctors, n_vars)):
+        norms = np.sum(orth_resp ** 2, axis=0)
+        usable = norms > min_norms
+        usable[selected] = False
+        if not np.any(usable):
+            break
+        reduction = np.zeros(n_vars)
+        reduction[usable] = np.dot(residual, orth_resp[:, usable]) ** 2 / norms[usable]
+        best = int(np.argmax(reduction))
+        selected.append(best)
+        unit = orth_resp[:, best] / np.sqrt(norms[best])
+        residual -= unit * np.dot(unit, residual)
+        orth_resp -= np.outer(unit, np.dot(unit, orth_resp))
+
+    LOG.debug("MICADO selected {:d} variables.".format(len(selected)))
+    delta = np.zeros(n_vars)
+    if selected:
+        delta[selected] = np.linalg.lstsq(response_mat[:, selected], diff_vec, rcond=-1)[0]
+    return delta
 
 
 # MADX related ###############################################################
@@ -958,13 +1140,27 @@ def _dump(path_to_dump, content):
         cPickle.Pickler(dump_file, -1).dump(content)
 
 
-def _join_responses(resp, keys, varslist):
-    """ Returns matrix #BPMs * #Parameters x #variables """
-    return pd.concat([resp[k] for k in keys],  # dataframes
-                     axis="index",  # axis to join along
-                     join_axes=[pd.Index(varslist)]
-                     # other axes to use (pd Index obj required)
-                     ).fillna(0.0)
+def _join_responses(resp, keys, resp_index):
+    """ Returns matrix #BPMs * #Parameters x #variables
+
+    The rows are the measured elements, as in resp_index (see _get_response_index).
+    Elements and variables missing in the response are set to zero. """
+    n_rows = sum(len(resp_index[k].rows[0]) for k in keys)
+    n_vars = len(resp_index[keys[0]].columns) if keys else 0
+    joined = np.zeros((n_rows, n_vars))
+    start = 0
+    for key in keys:
+        values = resp[key].values
+        rows, columns = resp_index[key].rows, resp_index[key].columns
+        stop = start + len(rows[0])
+        found_cols = columns >= 0
+        for sign, idx_rows in zip((1, -1), rows):
+            found_rows = idx_rows >= 0
+            joined[start + np.flatnonzero(found_rows)[:, None], np.flatnonzero(found_cols)] += (
+                sign * values[np.ix_(idx_rows[found_rows], columns[found_cols])])
+        start = stop
+    joined[np.isnan(joined)] = 0.
+    return joined
 
 
 def _join_columns(col, meas, keys):
@@ -49,11 +49,12 @@ MAIN_LINES = {"X": (1, 0, 0), "Y": (0, 1, 0), "Z": (0, 0, 1)}
 Z_TOLERANCE = 0.0001
 NUM_HARMS = 300
 NUM_HARMS_SVD = 100
+BATCH_ROWS = 64
 
 PROCESSES = multiprocessing.cpu_count()
 
 
-def harpy(harpy_input, bpm_matrix_x, usv_x, bpm_matrix_y, usv_y):
+def harpy(harpy_input, bpm_matrix_x, usv_x, bpm_matrix_y, usv_y, pool=None):
     """
     """
     all_frequencies = {}
@@ -71,6 +72,7 @@ def harpy(harpy_input, bpm_matrix_x, usv_x, bpm_matrix_y, usv_y):
             usv=usv,
             mode=harpy_input.harpy_mode,
             sequential=harpy_input.sequential,
+            pool=pool,
         )
         spectr[plane] = _get_bpms_spectr(bpm_matrix,
                                          coefficients,
@@ -134,7 +136,8 @@ def _get_bpms_spectr(bpm_matrix, coefficients, frequencies):
     return all_bpms_spectr
 
 
-def harmonic_analysis(bpm_matrix=None, usv=None, mode="bpm", sequential=False):
+def harmonic_analysis(bpm_matrix=None, usv=None, mode="bpm", sequential=False,
+                      pool=None):
     """
     Performs the laskar method on every of the BPMs signals contained in each
     row of the bpm_matrix pandas DataFame.
@@ -145,11 +148,14 @@ def harmonic_analysis(bpm_matrix=None, usv=None, mode="bpm", sequential=False):
         usv: Truncated SVD decomposition of the bpm matrix. It must contain a
             tuple (U, S, V), where U must be a DataFrame with the bpm names
             as index.
-        mode: one of 'bpm', 'svd', or 'fast'. Check 'harmonic_analysis_bpm'
-            documentation for 'bpm' mode and 'harmonic_analysis_svd" for 'svd'
-            and 'fast'.
+        mode: one of 'bpm', 'batch', 'svd', or 'fast'. Check
+            'harmonic_analysis_bpm' documentation for 'bpm' mode,
+            'harmonic_analysis_batch' for 'batch' mode and
+            'harmonic_analysis_svd" for 'svd' and 'fast'.
         sequential: If true, it will run all the computations in a single
             core.
+        pool: Optional utils.shared_pool.SharedArrayPool, if given it will
+            be used instead of starting a new pool of processes.
     Returns:
         frequencies: A numpy array with the frequencies found per BPM.
         bpm_coefficients: A numpy array containing the complex coefficients
@@ -163,6 +169,15 @@ def harmonic_analysis(bpm_matrix=None, usv=None, mode="bpm", sequential=False):
             bpm_matrix,
             sequential=sequential,
             num_harms=NUM_HARMS,
+            pool=pool,
+        )
+    elif mode == "batch":
+        if bpm_matrix is None:
+            raise ValueError("bpm_matrix has to be provided "
+                             "for the batch mode")
+        frequencies, bpm_coefficients = harmonic_analysis_batch(
+            bpm_matrix,
+            num_harms=NUM_HARMS,
         )
     elif mode in ("svd", "fast"):
         if usv is None:
@@ -174,6 +189,7 @@ def harmonic_analysis(bpm_matrix=None, usv=None, mode="bpm", sequential=False):
             fast=mode == "fast",
             sequential=sequential,
             num_harms=num_harms,
+            pool=pool,
         )
     else:
         raise ValueError("Invalid harpy mode: {}".format(mode))
@@ -181,7 +197,7 @@ def harmonic_analysis(bpm_matrix=None, usv=None, mode="bpm", sequential=False):
 
 
 def harmonic_analysis_bpm(bpm_matrix,
-                          sequential=False, num_harms=NUM_HARMS):
+                          sequential=False, num_harms=NUM_HARMS, pool=None):
     """
     Performs the laskar method on every of the BPMs signals contained in each
     row of the bpm_matrix pandas DataFame. This method will run the full
@@ -193,19 +209,53 @@ def harmonic_analysis_bpm(bpm_matrix,
         sequential: If true, it will run all the computations in a single
             core.
         num_harms: Number of harmonics to compute per BPM.
+        pool: Optional utils.shared_pool.SharedArrayPool to run the
+            analysis in.
     Returns:
         frequencies: A numpy array with the frequencies found per BPM.
         bpm_coefficients: A numpy array containing the complex coefficients
             found per BPM.
     """
     frequencies, bpm_coefficients = _parallel_laskar(
-        bpm_matrix, sequential, num_harms,
+        bpm_matrix, sequential, num_harms, pool=pool,
     )
     return frequencies, bpm_coefficients
 
 
+def harmonic_analysis_batch(bpm_matrix, num_harms=NUM_HARMS,
+                            batch_rows=BATCH_ROWS):
+    """
+    Performs the same laskar method as 'harmonic_analysis_bpm' but on blocks
+    of BPMs at once, using 2D FFTs and vectorized interpolation and
+    subtraction steps. No subprocesses are spawned, which avoids the
+    pickling of every BPM signal.
+
+    Args:
+        bpm_matrix: Pandas DataFrame containing the signals of each bpm in
+            each row.
+        num_harms: Number of harmonics to compute per BPM.
+        batch_rows: Maximum number of BPMs to analyse together, it limits
+            the memory used by the intermediate complex arrays.
+    Returns:
+        frequencies: A numpy array with the frequencies found per BPM.
+        bpm_coefficients: A numpy array containing the complex coefficients
+            found per BPM.
+    """
+    samples = bpm_matrix.values
+    freqs = np.zeros((samples.shape[0], num_harms), dtype=np.float64)
+    coefs = np.zeros((samples.shape[0], num_harms), dtype=np.complex128)
+    for start in range(0, samples.shape[0], batch_rows):
+        end = start + batch_rows
+        freqs[start:end], coefs[start:end] = _laskar_method_batch(
+            samples[start:end], num_harms
+        )
+    frequencies = pd.DataFrame(index=bpm_matrix.index, data=freqs)
+    bpm_coefficients = pd.DataFrame(index=bpm_matrix.index, data=coefs)
+    return frequencies, bpm_coefficients
+
+
 def harmonic_analysis_svd(usv, fast=False,
-                          sequential=False, num_harms=NUM_HARMS):
+                          sequential=False, num_harms=NUM_HARMS, pool=None):
     """
     Performs the laskar method on every of the BPMs signals contained in each
     row of the bpm_matrix pandas DataFame. It takes advantage of the
@@ -222,6 +272,8 @@ def harmonic_analysis_svd(usv, fast=False,
         sequential: If true, it will run all the computations in a single
             core.
         num_harms: Number of harmonics to compute per BPM.
+        pool: Optional utils.shared_pool.SharedArrayPool to run the
+            analysis in.
     Returns:
         frequencies: A numpy array with the frequencies found per BPM.
         bpm_coefficients: A numpy array containing the complex coefficients
@@ -234,7 +286,7 @@ def harmonic_analysis_svd(usv, fast=False,
         frequencies, _ = _laskar_per_mode(np.mean(sv, axis=0), num_harms)
     else:
         frequencies, _ = _parallel_laskar(
-            sv, sequential, num_harms,
+            sv, sequential, num_harms, pool=pool,
         )
         frequencies = np.ravel(frequencies)
     svd_coefficients = _compute_coefs_for_freqs(sv, frequencies)
@@ -278,7 +330,9 @@ def _get_bad_bpms_summary(not_tune_bpms, cleaned_by_tune_bpms):
     return bad_bpms_summary
 
 
-def _parallel_laskar(samples, sequential, num_harms):
+def _parallel_laskar(samples, sequential, num_harms, pool=None):
+    if pool is not None and not sequential:
+        return _shared_pool_laskar(samples, num_harms, pool)
     freqs = pd.DataFrame(
         index=samples.index,
         data=np.zeros((samples.shape[0], num_harms), dtype=np.float)
@@ -307,6 +361,38 @@ def _parallel_laskar(samples, sequential, num_harms):
     return freqs, coefs
 
 
+def _shared_pool_laskar(samples, num_harms, pool):
+    shared_samples = pool.share(samples.values)
+    shared_freqs = pool.empty((samples.shape[0], num_harms), np.float64)
+    shared_coefs = pool.empty((samples.shape[0], num_harms), np.complex128)
+    try:
+        pool.map_row_blocks(
+            _laskar_rows, samples.shape[0],
+            (shared_samples, shared_freqs, shared_coefs, num_harms),
+        )
+        freqs = pd.DataFrame(index=samples.index,
+                             data=np.array(shared_freqs.array))
+        coefs = pd.DataFrame(index=samples.index,
+                             data=np.array(shared_coefs.array))
+    finally:
+        pool.free(shared_samples, shared_freqs, shared_coefs)
+    return freqs, coefs
+
+
+def _laskar_rows(start, end, samples, freqs, coefs, num_harms):
+    """
+    Worker side of _shared_pool_laskar, runs the laskar method on the
+    rows [start, end) of the shared samples buffer and writes the results
+    into the shared output buffers.
+    """
+    for row in range(start, end):
+        freq, coef = _laskar_method(samples.array[row], num_harms)
+        freqs.array[row] = freq
+        coefs.array[row] = coef
+    freqs.flush()
+    coefs.flush()
+
+
 def _laskar_per_mode(samples, number_of_harmonics):
     freqs, coefs = _laskar_method(samples.values, number_of_harmonics)
     return np.array(freqs), np.array(coefs)
@@ -453,6 +539,32 @@ def _laskar_method(tbt, num_harmonics):
     return frequencies, coefficients
 
 
+def _laskar_method_batch(tbt_matrix, num_harmonics):
+    """
+    Vectorized version of '_laskar_method', every row of tbt_matrix is
+    a signal.
+    """
+    samples = np.array(tbt_matrix, dtype=np.complex128)
+    n_rows, n = samples.shape
+    rows = np.arange(n_rows)
+    int_range = np.arange(n)
+    coefficients = np.zeros((n_rows, num_harmonics), dtype=np.complex128)
+    frequencies = np.zeros((n_rows, num_harmonics), dtype=np.float64)
+    for harm in range(num_harmonics):
+        dft_data = _fft(samples, axis=1)
+        frequency = _jacobsen_batch(dft_data, n)
+        exponents = np.exp(PI2I * np.outer(frequency, int_range))
+        coefficient = np.sum(samples * np.conj(exponents), axis=1) / n
+
+        coefficients[:, harm] = coefficient
+        frequencies[:, harm] = frequency
+
+        samples -= coefficient[:, np.newaxis] * exponents
+
+    order = np.argsort(-np.abs(coefficients), axis=1, kind="mergesort")
+    return frequencies[rows[:, np.newaxis], order], coefficients[rows[:, np.newaxis], order]
+
+
 def _jacobsen(dft_values, n):
     """
     This method interpolates the real frequency of the
@@ -467,6 +579,21 @@ def _jacobsen(dft_values, n):
     return (k + delta) / n
 
 
+def _jacobsen_batch(dft_values, n):
+    """
+    Vectorized version of '_jacobsen', it interpolates the frequency
+    of every row of the dft_values matrix.
+    """
+    rows = np.arange(dft_values.shape[0])
+    k = np.argmax(np.abs(dft_values), axis=1)
+    r_k = dft_values[rows, k]
+    r_kp = dft_values[rows, (k + 1) % n]
+    r_km = dft_values[rows, (k - 1) % n]
+    delta = np.tan(np.pi / n) / (np.pi / n)
+    delta = delta * np.real((r_km - r_kp) / (2 * r_k - r_km - r_kp))
+    return (k + delta) / n
+
+
 def _fft_method(tbt, num_harmonics):
     samples = tbt[:]  # Copy the samples array.
     n = float(len(samples))
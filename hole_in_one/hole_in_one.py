@@ -14,6 +14,7 @@ from io_handlers import input_handler, output_handler
 
 from utils import tfs_pandas as tfs
 from utils.contexts import timeit
+from utils.shared_pool import SharedArrayPool
 from model import manager
 from sdds_files import turn_by_turn_reader
 
@@ -32,15 +33,35 @@ def run_all(main_input, clean_input, harpy_input, to_log):
         _setup_file_log_handler(main_input)
         LOGGER.debug(to_log)
         
-        tbt_files = turn_by_turn_reader.read_tbt_file(main_input.file)
-        for tbt_file in tbt_files:
-            run_all_for_file(tbt_file, main_input, clean_input, harpy_input)
+        tbt_files = turn_by_turn_reader.read_tbt_file(
+            main_input.file,
+            start_turn=main_input.startturn,
+            end_turn=main_input.endturn,
+            bunch_ids=main_input.bunch_ids,
+        )
+        with _get_pool(harpy_input) as pool:
+            for tbt_file in tbt_files:
+                run_all_for_file(tbt_file, main_input, clean_input, harpy_input,
+                                 pool=pool)
+
+
+def _get_pool(harpy_input):
+    """
+    A single pool of processes is shared by every file and bunch, the
+    sequential analysis and the batch mode run in the main process.
+    """
+    processes = harpy.PROCESSES
+    if (harpy_input is None or harpy_input.sequential or
+            harpy_input.harpy_mode in ("batch", "fast")):
+        processes = 1
+    return SharedArrayPool(processes=processes)
 
 
-def run_all_for_file(tbt_file, main_input, clean_input, harpy_input):
-    tbt_file = _cut_tbt_file(tbt_file,
-                             main_input.startturn,
-                             main_input.endturn)
+def run_all_for_file(tbt_file, main_input, clean_input, harpy_input, pool=None):
+    """
+    Runs the analysis on tbt_file, which is expected to be already cut to
+    the turns in main_input (see turn_by_turn_reader.read_tbt_file).
+    """
     file_date = tbt_file.date
        
     bpm_datas = {"x": tbt_file.samples_matrix_x,
@@ -69,7 +90,8 @@ def run_all_for_file(tbt_file, main_input, clean_input, harpy_input):
 
     if harpy_input is not None:
         all_bad_bpms = _do_harpy(main_input, harpy_input, bpm_datas, usvs,
-                                 model_tfs, bpm_ress, dpp, all_bad_bpms)
+                                 model_tfs, bpm_ress, dpp, all_bad_bpms,
+                                 pool=pool)
 
     for plane in ("x", "y"):
         output_handler.write_bad_bpms(
@@ -118,7 +140,8 @@ def _do_clean(main_input, clean_input, bpm_datas, file_date, model_tfs):
     return usvs, all_bad_bpms, bpm_ress, dpp
 
 
-def _do_harpy(main_input, harpy_input, bpm_datas, usvs, model_tfs, bpm_ress, dpp, all_bad_bpms):
+def _do_harpy(main_input, harpy_input, bpm_datas, usvs, model_tfs, bpm_ress, dpp, all_bad_bpms,
+              pool=None):
     lin_frames = {}
     for plane in ("x", "y"):
         bpm_data, usv = bpm_datas[plane], usvs[plane]
@@ -138,6 +161,7 @@ def _do_harpy(main_input, harpy_input, bpm_datas, usvs, model_tfs, bpm_ress, dpp
             harpy_input,
             bpm_datas["x"], usvs["x"],
             bpm_datas["y"], usvs["y"],
+            pool=pool,
         )
 
     for plane in ("x", "y"):
@@ -171,24 +195,6 @@ def _prepare_data_for_harpy(bpm_data, usv):
     return bpm_data, usv
 
 
-def _cut_tbt_file(tbt_file, start_turn, end_turn):
-    bpm_data_x = tbt_file.samples_matrix_x
-    bpm_data_y = tbt_file.samples_matrix_y
-    start = max(0, start_turn)
-    end = min(end_turn, bpm_data_x.shape[1])
-    num_turns = end - start
-    tbt_file.samples_matrix_x = pd.DataFrame(
-        index=bpm_data_x.index,
-        data=bpm_data_x.iloc[:, start:end].values
-    )
-    tbt_file.samples_matrix_y = pd.DataFrame(
-        index=bpm_data_y.index,
-        data=bpm_data_y.iloc[:, start:end].values
-    )
-    tbt_file.num_turns = num_turns
-    return tbt_file
-
-
 def _get_only_model_bpms(bpm_data, model):
     model_indx = model.set_index("NAME").index
     bpm_data_in_model = bpm_data.loc[model_indx.intersection(bpm_data.index)]
@@ -50,6 +50,7 @@ class MainInput(object):
         "startturn": 0,
         "endturn": 50000,
         "skip_files": False,
+        "bunch_ids": None,
     }
 
     def __init__(self):
@@ -60,6 +61,7 @@ class MainInput(object):
         self.startturn = MainInput.DEFAULTS["startturn"]
         self.endturn = MainInput.DEFAULTS["endturn"]
         self.skip_files = MainInput.DEFAULTS["skip_files"]
+        self.bunch_ids = MainInput.DEFAULTS["bunch_ids"]
 
     @staticmethod
     def init_from_options(options):
@@ -74,6 +76,8 @@ class MainInput(object):
             self.outputdir = outdir
         self.startturn = options.startturn
         self.endturn = options.endturn
+        if options.bunch_ids is not None:
+            self.bunch_ids = [int(bunch_id) for bunch_id in options.bunch_ids.strip("\"").split(",")]
         return self
 
 
@@ -128,6 +132,13 @@ def _get_main_parser():
         default=MainInput.DEFAULTS["endturn"],
         dest="endturn", type=int
     )
+    parser.add_argument(
+        "--bunch_ids",
+        help="""Comma separated ids of the bunches to analyse.
+                Default is to analyse all the bunches in the file.""",
+        default=MainInput.DEFAULTS["bunch_ids"],
+        dest="bunch_ids", type=str
+    )
     return parser
     ################################
 
@@ -341,7 +352,7 @@ def _get_harpy_parser():
     parser.add_argument(
         "--harpy_mode", help="Harpy resonance computation mode.",
         dest="harpy_mode", type=str,
-        choices=("bpm", "svd", "fast"),
+        choices=("bpm", "batch", "svd", "fast"),
         default=HarpyInput.DEFAULTS["harpy_mode"],
     )
     parser.add_argument(
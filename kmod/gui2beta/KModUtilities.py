@@ -3,6 +3,8 @@ import math
 import scipy.optimize
 import argparse
 
+N_CASES = 17  # nominal and the perturbed inputs of the error propagation
+MAX_ITERATIONS = 100
 
 def equations(x, cminus, q1, q2):
     qx, qy = x
@@ -44,8 +46,8 @@ def func_beta_foc_av(b, L, w, KL, K):
     """
     beta0 = b + ((L - w) ** 2 / (b))
     alpha0 = (L - w) / b
-    sin2KL = ((math.sin(2 * KL)) / (2 * KL))
-    beta_foc_av = 0.5 * beta0 * (1 + sin2KL) + alpha0 * ((math.sin(KL) ** 2) / (KL * K)) + (1 - sin2KL) / (
+    sin2KL = ((np.sin(2 * KL)) / (2 * KL))
+    beta_foc_av = 0.5 * beta0 * (1 + sin2KL) + alpha0 * ((np.sin(KL) ** 2) / (KL * K)) + (1 - sin2KL) / (
         2 * b * K ** 2)
     return beta_foc_av
 
@@ -60,12 +62,31 @@ def func_beta_def_av(b, L, w, KL, K):
     """
     beta0 = b + ((L - w) ** 2 / (b))
     alpha0 = (L - w) / b
-    sinh2KL = ((math.sinh(2 * KL)) / (2 * KL))
-    beta_def_av = 0.5 * beta0 * (1 + sinh2KL) + alpha0 * ((math.sinh(KL) ** 2) / (KL * K)) + (sinh2KL - 1) / (
+    sinh2KL = ((np.sinh(2 * KL)) / (2 * KL))
+    beta_def_av = 0.5 * beta0 * (1 + sinh2KL) + alpha0 * ((np.sinh(KL) ** 2) / (KL * K)) + (sinh2KL - 1) / (
         2 * b * K ** 2)
     return beta_def_av
 
 
+def _beta_av_gradient(b, L, w, KL, K, focussing):
+    """derivatives of func_beta_foc_av (focussing) or func_beta_def_av by b and w"""
+    if focussing:
+        sin2KL = np.sin(2 * KL) / (2 * KL)
+        sinKL2 = np.sin(KL) ** 2 / (KL * K)
+        last = 1 - sin2KL
+    else:
+        sin2KL = np.sinh(2 * KL) / (2 * KL)
+        sinKL2 = np.sinh(KL) ** 2 / (KL * K)
+        last = sin2KL - 1
+    dbeta0_db = 1 - ((L - w) / b) ** 2
+    dbeta0_dw = -2 * (L - w) / b
+    dalpha0_db = -(L - w) / b ** 2
+    dalpha0_dw = -1 / b
+    d_db = 0.5 * dbeta0_db * (1 + sin2KL) + dalpha0_db * sinKL2 - last / (2 * b ** 2 * K ** 2)
+    d_dw = 0.5 * dbeta0_dw * (1 + sin2KL) + dalpha0_dw * sinKL2
+    return d_db, d_dw
+
+
 def chi2(d, L_star_left, L_star_right, KL_foc, K_foc, KL_def, K_def, betaavfocquad, betaavdefquad):
     """error function for simplex algorithm"""
     b = d[0]
@@ -76,7 +97,7 @@ def chi2(d, L_star_left, L_star_right, KL_foc, K_foc, KL_def, K_def, betaavfocqu
 
 def beta_from_Tune(Q, TdQ, l, Dk):
     """Calculates average beta function in quadrupole from Tunechange TdQ and delta K """
-    beta_av = 2 * (1 / math.tan(2 * math.pi * Q) * (1 - math.cos(2 * math.pi * TdQ)) + math.sin(2 * math.pi * TdQ)) / (
+    beta_av = 2 * (1 / np.tan(2 * np.pi * Q) * (1 - np.cos(2 * np.pi * TdQ)) + np.sin(2 * np.pi * TdQ)) / (
         l * Dk)
     return abs(beta_av)
 
@@ -92,6 +113,75 @@ def simplex(Q, dq_foc, dq_def, l_foc, l_def, k_foc, k_def, dk_foc, dk_def, L_sta
     return res.x[0], res.x[1], beta_av_foc, beta_av_def
 
 
+def solve_cases(Q, dq_foc, dq_def, l_foc, l_def, k_foc, k_def, dk_foc, dk_def, L_star_left, L_star_right, guess):
+    """Same as simplex, for arrays of input cases at once.
+
+    The chi2 of all cases is minimized together with Levenberg-Marquardt steps, using the
+    analytic derivatives of the average betas. Cases which do not converge are solved with simplex.
+    """
+    dq_foc, dq_def, k_foc, k_def, L_star_left, L_star_right = np.broadcast_arrays(
+        *[np.asarray(arg, dtype=np.float64) for arg in (dq_foc, dq_def, k_foc, k_def, L_star_left, L_star_right)])
+    beta_av_foc = beta_from_Tune(Q, dq_foc, l_foc, dk_foc)
+    beta_av_def = beta_from_Tune(abs(Q), abs(dq_def), abs(l_def), abs(dk_def))
+    K_foc = np.sqrt(abs(k_foc))
+    K_def = np.sqrt(abs(k_def))
+    KL_foc = K_foc * l_foc
+    KL_def = K_def * l_def
+
+    def residuals(b, w):
+        return (func_beta_foc_av(b, L_star_left, w, KL_foc, K_foc) - beta_av_foc,
+                func_beta_def_av(b, L_star_right, -w, KL_def, K_def) - beta_av_def)
+
+    b = np.full(dq_foc.shape, float(guess[0]))
+    w = np.full(dq_foc.shape, float(guess[1]))
+    damping = np.full(dq_foc.shape, 1e-3)
+    converged = np.zeros(dq_foc.shape, dtype=bool)
+    with np.errstate(all='ignore'):
+        r_foc, r_def = residuals(b, w)
+        c2 = r_foc ** 2 + r_def ** 2
+        for _ in range(MAX_ITERATIONS):
+            foc_db, foc_dw = _beta_av_gradient(b, L_star_left, w, KL_foc, K_foc, True)
+            def_db, def_dw = _beta_av_gradient(b, L_star_right, -w, KL_def, K_def, False)
+            def_dw = -def_dw
+            # normal equations (J^T J + damping * diag(J^T J)) step = -J^T r
+            a11 = (foc_db ** 2 + def_db ** 2) * (1 + damping)
+            a22 = (foc_dw ** 2 + def_dw ** 2) * (1 + damping)
+            a12 = foc_db * foc_dw + def_db * def_dw
+            g1 = -(foc_db * r_foc + def_db * r_def)
+            g2 = -(foc_dw * r_foc + def_dw * r_def)
+            det = a11 * a22 - a12 ** 2
+            step_b = (a22 * g1 - a12 * g2) / det
+            step_w = (a11 * g2 - a12 * g1) / det
+
+            new_b = b + step_b
+            new_w = w + step_w
+            new_r_foc, new_r_def = residuals(new_b, new_w)
+            new_c2 = new_r_foc ** 2 + new_r_def ** 2
+            better = (new_c2 <= c2) & (new_b > 0) & ~converged
+            converged |= better & (abs(step_b) <= 1e-12 * abs(b)) & (abs(step_w) <= 1e-12 * (abs(w) + abs(b)))
+            converged |= c2 == 0
+            b = np.where(better, new_b, b)
+            w = np.where(better, new_w, w)
+            r_foc = np.where(better, new_r_foc, r_foc)
+            r_def = np.where(better, new_r_def, r_def)
+            c2 = np.where(better, new_c2, c2)
+            damping = np.where(better, damping / 10, damping * 10)
+            if np.all(converged):
+                break
+    converged &= np.isfinite(b) & np.isfinite(w)
+
+    for i in np.flatnonzero(~converged):
+        b[i], w[i], _, _ = simplex(Q, dq_foc[i], dq_def[i], l_foc, l_def, k_foc[i], k_def[i], dk_foc, dk_def,
+                                   L_star_left[i], L_star_right[i], guess)
+    return b, w, beta_av_foc, beta_av_def
+
+
+def _propagated_error(results):
+    """error from the maximum deviation of the pairs of perturbed cases to the nominal case"""
+    deviations = abs(results[1:] - results[0]).reshape(-1, 2).max(axis=1)
+    return math.sqrt(np.sum(deviations ** 2))
+
+
 def analysis(Q1, Q2, L_star, m, k_foc, dk_foc, l_foc, k_def, dk_def, l_def, dq_foc, edq_foc, dq_def, edq_def, ek_foc, ek_def, cminus, beta_star_guess, waist_guess, label, log, logfile):
 
     guess = [beta_star_guess, waist_guess]
@@ -105,7 +195,7 @@ def analysis(Q1, Q2, L_star, m, k_foc, dk_foc, l_foc, k_def, dk_def, l_def, dq_f
         logfile.write('Betastar guess: %s, Waistshift guess: %s \n' %(beta_star_guess, waist_guess))
         logfile.write('\n')
 
-    DQs = np.zeros([17, 6])
+    DQs = np.zeros([N_CASES, 6])
 
     DQs[0] = dq_foc, dq_def, k_foc, k_def, L_star, L_star
     DQs[1] = dq_foc + edq_foc, dq_def, k_foc, k_def, L_star, L_star
@@ -128,51 +218,13 @@ def analysis(Q1, Q2, L_star, m, k_foc, dk_foc, l_foc, k_def, dk_def, l_def, dq_f
     DQs[15] = dq_foc, dq_def + dq_def * tune_error_from_coupling(cminus, Q1, Q2, abs(dq_def)), k_foc, k_def, L_star, L_star 
     DQs[16] = dq_foc, dq_def - dq_def * tune_error_from_coupling(cminus, Q1, Q2, abs(dq_def)), k_foc, k_def, L_star, L_star 
 
-    resb = np.zeros(17)
-    resw = np.zeros(17)
-
-    resbavf = np.zeros(17)
-    resbavd = np.zeros(17)
-
-    for i in range(17):
-        resb[i], resw[i], resbavf[i], resbavd[i] = simplex(Q1, DQs[i, 0], DQs[i, 1], l_foc, l_def, DQs[i, 2], DQs[i, 3],
-                                                           dk_foc, dk_def, DQs[i, 4], DQs[i, 5], guess)
-
-    stdb = math.sqrt(max(abs(resb[1] - resb[0]), abs(resb[2] - resb[0])) ** 2 +
-                     max(abs(resb[3] - resb[0]), abs(resb[4] - resb[0])) ** 2 +
-                     max(abs(resb[5] - resb[0]), abs(resb[6] - resb[0])) ** 2 +
-                     max(abs(resb[7] - resb[0]), abs(resb[8] - resb[0])) ** 2 +
-                     max(abs(resb[9] - resb[0]), abs(resb[10] - resb[0])) ** 2 +
-                     max(abs(resb[11] - resb[0]), abs(resb[12] - resb[0])) ** 2 +
-                     max(abs(resb[13] - resb[0]), abs(resb[14] - resb[0])) ** 2 +
-                     max(abs(resb[15] - resb[0]), abs(resb[16] - resb[0])) ** 2 )
-
-    stdw = math.sqrt(max(abs(resw[1] - resw[0]), abs(resw[2] - resw[0])) ** 2 +
-                     max(abs(resw[3] - resw[0]), abs(resw[4] - resw[0])) ** 2 +
-                     max(abs(resw[5] - resw[0]), abs(resw[6] - resw[0])) ** 2 +
-                     max(abs(resw[7] - resw[0]), abs(resw[8] - resw[0])) ** 2 +
-                     max(abs(resw[9] - resw[0]), abs(resw[10] - resw[0])) ** 2 +
-                     max(abs(resw[11] - resw[0]), abs(resw[12] - resw[0])) ** 2 +
-                     max(abs(resw[13] - resw[0]), abs(resw[14] - resw[0])) ** 2 +
-                     max(abs(resw[15] - resw[0]), abs(resw[16] - resw[0])) ** 2 )
-
-    stdbavf = math.sqrt(max(abs(resbavf[1] - resbavf[0]), abs(resbavf[2] - resbavf[0])) ** 2 +
-                        max(abs(resbavf[3] - resbavf[0]), abs(resbavf[4] - resbavf[0])) ** 2 +
-                        max(abs(resbavf[5] - resbavf[0]), abs(resbavf[6] - resbavf[0])) ** 2 +
-                        max(abs(resbavf[7] - resbavf[0]), abs(resbavf[8] - resbavf[0])) ** 2 +
-                        max(abs(resbavf[9] - resbavf[0]), abs(resbavf[10] - resbavf[0])) ** 2 +
-                        max(abs(resbavf[11] - resbavf[0]), abs(resbavf[12] - resbavf[0])) ** 2 +
-                        max(abs(resbavf[13] - resbavf[0]), abs(resbavf[14] - resbavf[0])) ** 2 +
-                        max(abs(resbavf[15] - resbavf[0]), abs(resbavf[16] - resbavf[0])) ** 2 )
-
-    stdbavd = math.sqrt(max(abs(resbavd[1] - resbavd[0]), abs(resbavd[2] - resbavd[0])) ** 2 +
-                        max(abs(resbavd[3] - resbavd[0]), abs(resbavd[4] - resbavd[0])) ** 2 +
-                        max(abs(resbavd[5] - resbavd[0]), abs(resbavd[6] - resbavd[0])) ** 2 +
-                        max(abs(resbavd[7] - resbavd[0]), abs(resbavd[8] - resbavd[0])) ** 2 +
-                        max(abs(resbavd[9] - resbavd[0]), abs(resbavd[10] - resbavd[0])) ** 2 +
-                        max(abs(resbavd[11] - resbavd[0]), abs(resbavd[12] - resbavd[0])) ** 2 +
-                        max(abs(resbavd[13] - resbavd[0]), abs(resbavd[14] - resbavd[0])) ** 2 +
-                        max(abs(resbavd[15] - resbavd[0]), abs(resbavd[16] - resbavd[0])) ** 2 )
+    resb, resw, resbavf, resbavd = solve_cases(Q1, DQs[:, 0], DQs[:, 1], l_foc, l_def, DQs[:, 2], DQs[:, 3],
+                                               dk_foc, dk_def, DQs[:, 4], DQs[:, 5], guess)
+
+    stdb = _propagated_error(resb)
+    stdw = _propagated_error(resw)
+    stdbavf = _propagated_error(resbavf)
+    stdbavd = _propagated_error(resbavd)
 
     return label, resb[0], stdb, resw[0], stdw, resbavf[0], stdbavf, resbavd[0], stdbavd
 
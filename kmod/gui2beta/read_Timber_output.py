@@ -42,39 +42,50 @@ def write_tfs_files(K, Qx, Qxrms, Qy, Qyrms, working_directory, magnet, beam):
     result.write_to_file()  
 
 
-def pair(tdatax,tdatay,kdata, tunemeasprecision):
-    Qx    = []
-    Qxrms = []
-    Qy    = []
-    Qyrms = []
-    K = []
-    
-    if len(tdatax.TIME) > len(kdata.TIME):
-        step = 300
-        for i in range(len(kdata.TIME)):
-            if kdata.TIME[i] > tdatax.TIME[0] and kdata.TIME[i] < tdatax.TIME[len(tdatax.TIME)-1]:
-                new_timex = tdatax.TIME - kdata.TIME[i]
-                maskx  = (new_timex**2<step**2)
-                tunex_mask= tdatax.TUNE[maskx]
-                aveQx = np.average(tunex_mask)
-                Qrmsx = np.std(tunex_mask)
-                
-                new_timey = tdatay.TIME - kdata.TIME[i]
-                masky  = (new_timey**2<step**2)
-                tuney_mask= tdatay.TUNE[masky]
-                aveQy = np.average(tuney_mask)
-                Qrmsy = np.std(tuney_mask)
-
-                if len(tunex_mask)>0 and len(tuney_mask)>0:
-                    Qx.append(aveQx)
-                    Qxrms.append(Qrmsx)
-                    Qy.append(aveQy)
-                    Qyrms.append(Qrmsy)
-                    K.append(kdata.K[i])
-
-    Qxrms = np.sqrt(np.array(Qxrms) ** 2 + tunemeasprecision ** 2);
-    Qyrms = np.sqrt(np.array(Qyrms) ** 2 + tunemeasprecision ** 2);
-    return K, Qx, Qxrms, Qy, Qyrms
-
+TIME_WINDOW = 300  # tune samples around each K sample, in the units of TIME
 
 
+def pair(tdatax,tdatay,kdata, tunemeasprecision):
+    """average and rms of the tunes within TIME_WINDOW of each K sample inside the tune measurement"""
+    if len(tdatax.TIME) > len(kdata.TIME):
+        tunes_x = _Tunes(tdatax.TIME, tdatax.TUNE)
+        tunes_y = _Tunes(tdatay.TIME, tdatay.TUNE)
+        return _pair_tunes(tunes_x, tunes_y, np.asarray(kdata.TIME, dtype=float), np.asarray(kdata.K, dtype=float),
+                           tdatax.TIME[0], tdatax.TIME[len(tdatax.TIME) - 1], tunemeasprecision)
+    return [], [], np.array([]), [], np.array([])
+
+
+class _Tunes(object):
+    """tune samples sorted by time, with cumulative sums for the statistics of time windows"""
+    def __init__(self, time, tune):
+        time = np.asarray(time, dtype=float)
+        tune = np.asarray(tune, dtype=float)
+        order = np.argsort(time, kind='mergesort')
+        self.time = time[order]
+        self.tune = tune[order]
+        # sums relative to the first tune, as the spread is tiny compared to the tune itself
+        self._offset = self.tune[0] if len(self.tune) else 0.
+        self._sum = np.concatenate(([0.], np.cumsum(self.tune - self._offset)))
+        self._sum2 = np.concatenate(([0.], np.cumsum((self.tune - self._offset) ** 2)))
+
+    def window_stats(self, times):
+        """number, average and std of the tunes strictly within TIME_WINDOW of times"""
+        start = np.searchsorted(self.time, times - TIME_WINDOW, side='right')
+        end = np.searchsorted(self.time, times + TIME_WINDOW, side='left')
+        count = np.maximum(end - start, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            average = (self._sum[end] - self._sum[start]) / count
+            variance = (self._sum2[end] - self._sum2[start]) / count - average ** 2
+        return count, average + self._offset, np.sqrt(np.maximum(variance, 0.))
+
+
+def _pair_tunes(tunes_x, tunes_y, k_time, k, first_time, last_time, tunemeasprecision):
+    inside = (k_time > first_time) & (k_time < last_time)
+    k_time, k = k_time[inside], k[inside]
+    count_x, Qx, Qxrms = tunes_x.window_stats(k_time)
+    count_y, Qy, Qyrms = tunes_y.window_stats(k_time)
+    mask = (count_x > 0) & (count_y > 0)
+
+    Qxrms = np.sqrt(Qxrms[mask] ** 2 + tunemeasprecision ** 2)
+    Qyrms = np.sqrt(Qyrms[mask] ** 2 + tunemeasprecision ** 2)
+    return list(k[mask]), list(Qx[mask]), Qxrms, list(Qy[mask]), Qyrms
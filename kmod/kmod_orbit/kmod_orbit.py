@@ -5,6 +5,7 @@ import numpy as np
 import time
 import datetime
 import argparse
+from multiprocessing.pool import ThreadPool
 sys.path.append(os.path.abspath(os.path.join(
     os.path.dirname(__file__),
     ".."
@@ -21,6 +22,7 @@ BEAM_STR = {BEAM1: "1", BEAM2: "2"}
 SIDE_STR = {LEFT: "L", RIGHT: "R"}
 
 CUTOFF = 0.15  # BPMs we ignor
+THREADS = len(BEAMS) * len(SIDES) * len(PLANES)
 # CUTOFF = 1.5 * np.max(v[0,:])
 
 
@@ -70,18 +72,31 @@ def _parse_args():
         type=int,
         dest="ip",
     )
+    parser.add_argument(
+        "--thick",
+        help="Use thick quadrupole transfer matrices for the K steps.",
+        action="store_true",
+        dest="thick",
+    )
+    parser.add_argument(
+        "--threads",
+        help="Number of beam, side and plane combinations computed at once.",
+        type=int,
+        default=THREADS,
+        dest="threads",
+    )
     options = parser.parse_args()
     input = (options.model1_path, options.model2_path,
              options.orbit_path_left, options.orbit_path_right,
              options.kleft_path, options.kright_path,
-             options.ip)
+             options.ip, options.thick, options.threads)
     return input
 
 
 def compute_offset(model1_path, model2_path,
                    orbit_path_left, orbit_path_right,
                    kleft_path, kright_path,
-                   ip):
+                   ip, thick=False, threads=THREADS):
 
     ks, orbits = _collect_orbit_data(orbit_path_left, orbit_path_right,
                                      kleft_path, kright_path)
@@ -96,8 +111,9 @@ def compute_offset(model1_path, model2_path,
 
     results = _apply_to_beam_side_plane(
         lambda beam, side, plane: _compute_and_clean(
-            ip, beam, side, plane, models, bpm_names, ks, orbits
-        )
+            ip, beam, side, plane, models, bpm_names, ks, orbits, thick
+        ),
+        threads
     )
     return results
 
@@ -164,39 +180,44 @@ def _get_bpm_names(orbit_path_left, orbit_path_right):
     }
 
 
-def _compute_and_clean(ip, beam, side, plane, models, bpm_names, ks, orbits):
+def _compute_and_clean(ip, beam, side, plane, models, bpm_names, ks, orbits,
+                       thick=False):
     this_orbit = orbits[(beam, side, plane)]
     this_model = models[beam]
     this_bpm_names = bpm_names[(beam, side)]
     this_bpm_model = this_model.loc[this_bpm_names, :]
 
     quadname = "MQXA.1" + SIDE_STR[side] + str(ip)
-    this_k = _compute_kl(ks[(beam, side, plane)], this_model, quadname, plane)
 
     orb = np.array(this_orbit)
 
     # Work out transfer matrix for given beam and quad
-    model_data = _compute_transfer_matrix(this_model, this_bpm_model,
-                                          quadname, this_k, plane, beam)
+    if thick:
+        model_data = _compute_thick_transfer_matrix(
+            this_model, this_bpm_model, quadname,
+            np.array(ks[(beam, side, plane)], dtype=float), plane, beam
+        )
+    else:
+        this_k = _compute_kl(ks[(beam, side, plane)], this_model, quadname,
+                             plane)
+        model_data = _compute_transfer_matrix(this_model, this_bpm_model,
+                                              quadname, this_k, plane, beam)
 
-    # SVD on model and data
-    u, s, v = np.linalg.svd(model_data)
+    # SVD on data
     ud, sd, vd = np.linalg.svd(orb, full_matrices=False)
 
     # Remove offset
     sd[0] = 0
-    orb = np.dot(np.dot(ud, np.diag(sd)), vd)
-    ud, sd, vd = np.linalg.svd(orb)
+    orb = np.dot(ud * sd, vd)
+    ud, sd, vd = np.linalg.svd(orb, full_matrices=False)
 
     # SVD clean on data
-
-    while max(vd[0, :]) > CUTOFF or min(vd[0, :]) < -CUTOFF:
-        for j in reversed(range(0, len(vd[0, :]))):
-            if abs(vd[0, j]) > CUTOFF:
-                orb = np.delete(orb, (j), axis=1)
-                model_data = np.delete(model_data, (j), axis=1)
-        u, s, v = np.linalg.svd(model_data)
-        ud, sd, vd = np.linalg.svd(orb)
+    while np.any(np.abs(vd[0, :]) > CUTOFF):
+        keep = np.abs(vd[0, :]) <= CUTOFF
+        orb = orb[:, keep]
+        model_data = model_data[:, keep]
+        ud, sd, vd = np.linalg.svd(orb, full_matrices=False)
+    u, s, v = np.linalg.svd(model_data, full_matrices=False)
 
     # Work out offset using matrix multiplication
     offset = np.dot(np.dot(np.transpose(u[:, 0]), orb),
@@ -208,11 +229,14 @@ def _compute_and_clean(ip, beam, side, plane, models, bpm_names, ks, orbits):
 
 
 def _compute_kl(ks, model, quadname, ip):
-    quad_length = (model.loc[quadname, "S"] -
-                   model.ix[model.index.get_loc(quadname) - 1, "S"]),
-
+    quad_length = _get_quad_length(model, quadname)
     avg_k = np.mean(ks)
-    return (ks - avg_k) * quad_length
+    return (np.asarray(ks) - avg_k) * quad_length
+
+
+def _get_quad_length(model, quadname):
+    quad_index = model.index.get_loc(quadname)
+    return model["S"].iloc[quad_index] - model["S"].iloc[quad_index - 1]
 
 
 def _compute_transfer_matrix(model, bpm_model, quadname, ks, plane, beam):
@@ -243,13 +267,83 @@ def _compute_transfer_matrix(model, bpm_model, quadname, ks, plane, beam):
     return np.outer(F, m11) + np.outer(G, m12)
 
 
-def _apply_to_beam_side_plane(function):
-    results = {}
-    for beam in BEAMS:
-        for side in SIDES:
-            for plane in PLANES:
-                results[(beam, side, plane)] = function(beam, side, plane)
-    return results
+def _compute_thick_transfer_matrix(model, bpm_model, quadname, ks, plane,
+                                   beam):
+    """ Same as _compute_transfer_matrix, with the quadrupole as thick lens.
+
+    The orbit changes at the quad exit for all the K steps are solved
+    together, from the stacked one-turn matrices. Like in the thin lens
+    formula, the offset is the one of the beam at the quad entrance.
+    """
+    mu_m = bpm_model.loc[:, "MU" + PLANE_STR[plane]]
+    b_m = bpm_model.loc[:, "BET" + PLANE_STR[plane]]
+
+    mu_q = model.loc[quadname, "MU" + PLANE_STR[plane]]
+    b_q = model.loc[quadname, "BET" + PLANE_STR[plane]]
+    a_q = model.loc[quadname, "ALF" + PLANE_STR[plane]]
+
+    tune = model.headers["Q" + BEAM_STR[beam]]
+    quad_length = _get_quad_length(model, quadname)
+
+    phase = (tune - np.abs(mu_m - mu_q)) * 2 * np.pi
+    m11 = np.sqrt(b_m / b_q) * (np.cos(phase) + a_q * np.sin(phase))
+    m12 = np.sqrt(b_m * b_q) * np.sin(phase)
+
+    one_turn = _get_one_turn_matrix(b_q, a_q, tune)
+    quad_matrices = _get_quad_matrices(ks, quad_length)
+    nominal_quad = _get_quad_matrices(np.array([np.mean(ks)]), quad_length)[0]
+    # From the quad exit around the ring to the quad entrance
+    rest_of_ring = np.dot(np.linalg.inv(nominal_quad), one_turn)
+
+    # (1 - Mq(K) R) dz = (Mq(K) - Mq(K0)) (1, 0) for a 1m offset
+    lhs = np.eye(2) - np.matmul(quad_matrices, rest_of_ring)
+    rhs = quad_matrices[:, :, 0] - nominal_quad[:, 0]
+    orbit_change = np.linalg.solve(lhs, rhs[:, :, np.newaxis])[:, :, 0]
+
+    return (np.outer(orbit_change[:, 0], m11) +
+            np.outer(orbit_change[:, 1], m12))
+
+
+def _get_one_turn_matrix(beta, alpha, tune):
+    mu = 2 * np.pi * tune
+    gamma = (1 + alpha ** 2) / beta
+    return np.array([
+        [np.cos(mu) + alpha * np.sin(mu), beta * np.sin(mu)],
+        [-gamma * np.sin(mu), np.cos(mu) - alpha * np.sin(mu)],
+    ])
+
+
+def _get_quad_matrices(ks, length):
+    """ Stacked (len(ks), 2, 2) transfer matrices of thick quadrupoles. """
+    sqrt_k = np.sqrt(ks.astype(complex))
+    phi = sqrt_k * length
+    cos_phi = np.cos(phi).real
+    # sin(phi) / sqrt(k) and sqrt(k) sin(phi), also where k -> 0
+    sin_over_sqrt_k = np.where(np.abs(phi) > 1e-8,
+                               (np.sin(phi) / np.where(phi == 0, 1, sqrt_k)).real,
+                               length)
+    sqrt_k_sin = (sqrt_k * np.sin(phi)).real
+    matrices = np.empty((len(ks), 2, 2))
+    matrices[:, 0, 0] = cos_phi
+    matrices[:, 0, 1] = sin_over_sqrt_k
+    matrices[:, 1, 0] = -sqrt_k_sin
+    matrices[:, 1, 1] = cos_phi
+    return matrices
+
+
+def _apply_to_beam_side_plane(function, threads=1):
+    combinations = [(beam, side, plane)
+                    for beam in BEAMS for side in SIDES for plane in PLANES]
+    if threads > 1:
+        # numpy releases the GIL in the SVDs and solves
+        pool = ThreadPool(min(threads, len(combinations)))
+        try:
+            values = pool.map(lambda args: function(*args), combinations)
+        finally:
+            pool.close()
+    else:
+        values = [function(*args) for args in combinations]
+    return dict(zip(combinations, values))
 
 
 # TODO: Replace with dict
@@ -3,14 +3,25 @@
 
 Runs MADX with a file or a string as an input, it processes @required macros.
 If defined, writes the processed MADX script and logging output into files.
+
+MadxPool keeps some MADX processes alive, with the sequence already loaded,
+and streams many small jobs to them.
 TODO: write tests
 TODO: Possibly more anotation from MADX...
 """
 from os.path import abspath, join, dirname
 import sys
 import re
+import time
+import shutil
+import tempfile
+import threading
 import subprocess
 import optparse
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 LIB = abspath(join(dirname(__file__), "madx", "lib"))
 if "darwin" in sys.platform:
@@ -39,7 +50,8 @@ def _parse_args():
     return options.file, options.output, options.log, options.madx_path
 
 
-def resolve_and_run_file(input_file, output_file=None, log_file=None, madx_path=MADX_PATH):
+def resolve_and_run_file(input_file, output_file=None, log_file=None, madx_path=MADX_PATH,
+                         cwd=None):
     """Runs MADX in a subprocess.
 
     Attributes:
@@ -47,13 +59,16 @@ def resolve_and_run_file(input_file, output_file=None, log_file=None, madx_path=
         output_file: If given writes resolved MADX script.
         log_file: If given writes MADX logging output.
         madx_path: Path to MADX executable
+        cwd: If given, MADX runs in this directory (e.g. to keep the files it
+            writes relative to it apart from other MADX runs).
     """
     input_string = _read_input_file(input_file)
     return resolve_and_run_string(input_string, output_file=output_file, log_file=log_file,
-                                  madx_path=madx_path)
+                                  madx_path=madx_path, cwd=cwd)
 
 
-def resolve_and_run_string(input_string, output_file=None, log_file=None, madx_path=MADX_PATH):
+def resolve_and_run_string(input_string, output_file=None, log_file=None, madx_path=MADX_PATH,
+                           cwd=None):
     """Runs MADX in a subprocess.
 
     Attributes:
@@ -61,10 +76,11 @@ def resolve_and_run_string(input_string, output_file=None, log_file=None, madx_p
         output_file: If given writes resolved MADX script.
         log_file: If given writes MADX logging output.
         madx_path: Path to MADX executable
+        cwd: If given, MADX runs in this directory.
     """
     _check_log_and_output_files(output_file, log_file)
     full_madx_script = _resolve(input_string, output_file)
-    return _run(full_madx_script, log_file, madx_path)
+    return _run(full_madx_script, log_file, madx_path, cwd)
 
 
 def _resolve(input_string, output_file=None):
@@ -77,21 +93,184 @@ def _resolve(input_string, output_file=None):
     return full_madx_script
 
 
-def _run(full_madx_script, log_file=None, madx_path=MADX_PATH):
+def _run(full_madx_script, log_file=None, madx_path=MADX_PATH, cwd=None):
     if log_file is None:
-        ret_value = _run_for_input_string(full_madx_script, madx_path)
+        ret_value = _run_for_input_string(full_madx_script, madx_path, cwd=cwd)
     else:
         with open(log_file, "w") as output:
-            ret_value = _run_for_input_string(full_madx_script, madx_path, logs=output)
+            ret_value = _run_for_input_string(full_madx_script, madx_path, logs=output, cwd=cwd)
     return ret_value
 
 
-def _run_for_input_string(input_string, madx, logs=sys.stdout):
-    process = subprocess.Popen(madx, shell=False, stdin=subprocess.PIPE, stdout=logs, stderr=logs)
+def _run_for_input_string(input_string, madx, logs=sys.stdout, cwd=None):
+    process = subprocess.Popen(madx, shell=False, stdin=subprocess.PIPE, stdout=logs, stderr=logs,
+                               cwd=cwd)
     process.communicate(input_string.encode("utf-8"))
     return process.wait()
 
 
+class MadxPool(object):
+    """Pool of long-lived MADX processes, for many jobs on the same machine.
+
+    Every process runs setup_script (e.g. loading the sequence and the optics)
+    once, when it starts. Then the jobs are streamed through its stdin, one
+    after the other, each followed by reset_script, which has to bring the
+    process back to the state after the setup (e.g. resetting the changed
+    knobs). Jobs should leave the state as they found it, or be undone by
+    reset_script.
+
+    After every job MADX writes the job number into a marker file, so the
+    pool knows it is done without relying on the buffering of the MADX
+    output. If a job kills MADX, its result is the exit code of the process
+    and the process is restarted, with the setup, for the next jobs.
+
+    The results come back through a bounded queue, (job_id, return_value)
+    pairs in order of completion, with return_value 0 for success:
+
+        with MadxPool(sequence_job, processes=4) as pool:
+            for job_id, job in jobs:
+                pool.submit(job_id, job)
+            for job_id, return_value in pool.results(len(jobs)):
+                ...
+
+    Attributes:
+        setup_script: MADX input run once in every process, can use !@require.
+        processes: number of MADX processes.
+        reset_script: MADX input run after every job.
+        log_file: If given, the MADX output of all processes is written here
+            when the pool is closed.
+        madx_path: MADX executable, or command list (e.g. a mock MADX).
+        max_results: maximum number of finished results waiting to be read.
+    """
+    POLL_INTERVAL = 0.005
+
+    def __init__(self, setup_script, processes=1, reset_script="", log_file=None,
+                 madx_path=MADX_PATH, max_results=None):
+        self._setup_script = _resolve(setup_script)
+        self._reset_script = reset_script
+        self._log_file = log_file
+        self._madx_path = madx_path
+        self._tmp_dir = tempfile.mkdtemp(prefix="madx_pool_")
+        self._jobs = queue.Queue()
+        self._results = queue.Queue(maxsize=max_results or 2 * processes)
+        self._workers = []
+        for index in range(processes):
+            worker = threading.Thread(target=self._work, args=(index,))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, job_id, job_script):
+        """Queues job_script, its result will have the given job_id."""
+        self._jobs.put((job_id, job_script))
+
+    def results(self, number_of_jobs):
+        """Yields the (job_id, return_value) of the next number_of_jobs finished jobs."""
+        for _ in range(number_of_jobs):
+            result = self._results.get()
+            if isinstance(result, _SetupError):
+                raise IOError("MADX setup failed in the pool, see " + str(self._log_file))
+            yield result
+
+    def close(self):
+        """Stops all the processes, after finishing the queued jobs, and writes the log.
+
+        Results that have not been read are discarded, so that no worker stays
+        blocked on the full results queue.
+        """
+        for _ in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            while worker.is_alive():
+                self._discard_results()
+                worker.join(0.1)
+        self._discard_results()
+        if self._log_file is not None:
+            with open(self._log_file, "w") as full_log:
+                for index in range(len(self._workers)):
+                    with open(self._get_log_path(index)) as worker_log:
+                        full_log.write(worker_log.read())
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _discard_results(self):
+        while True:
+            try:
+                self._results.get_nowait()
+            except queue.Empty:
+                return
+
+    def _work(self, index):
+        with open(self._get_log_path(index), "w") as log:
+            process = self._start_process(index, log)
+            job_count = 0
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    break
+                job_id, job_script = job
+                if process is None:
+                    self._results.put(_SetupError())
+                    continue
+                job_count += 1
+                return_value = self._run_job(process, index, job_count,
+                                             job_script + "\n" + self._reset_script)
+                self._results.put((job_id, return_value))
+                if return_value != 0:
+                    process = self._start_process(index, log)
+            if process is not None:
+                _write_to_process(process, "exit;\n")
+                process.wait()
+
+    def _start_process(self, index, log):
+        process = subprocess.Popen(self._madx_path, shell=False, stdin=subprocess.PIPE,
+                                   stdout=log, stderr=log)
+        if self._run_job(process, index, 0, self._setup_script) != 0:
+            return None
+        return process
+
+    def _run_job(self, process, index, job_number, job_script):
+        """Sends the job to process and waits until it is done, returns 0 or the exit code."""
+        done_path = join(self._tmp_dir, "done.{:d}".format(index))
+        if not _write_to_process(process, "{}\nsystem, \"echo {:d} > {}\";\n".format(
+                job_script, job_number, done_path)):
+            return process.wait() or 1
+        while _read_done_file(done_path) != str(job_number):
+            if process.poll() is not None:
+                return process.returncode or 1
+            time.sleep(self.POLL_INTERVAL)
+        return 0
+
+    def _get_log_path(self, index):
+        return join(self._tmp_dir, "madx.{:d}.log".format(index))
+
+
+class _SetupError(object):
+    pass
+
+
+def _write_to_process(process, input_string):
+    try:
+        process.stdin.write(input_string.encode("utf-8"))
+        process.stdin.flush()
+    except (IOError, OSError):  # MADX died
+        return False
+    return True
+
+
+def _read_done_file(done_path):
+    try:
+        with open(done_path) as done_file:
+            return done_file.read().strip()
+    except IOError:
+        return None
+
+
 def _resolve_required_macros(file_content):
     """
     Recursively searches for "!@require lib" MADX annotations in the input script,
@@ -17,7 +17,8 @@ class ModelCreator(object):
         creator.prepare_run(instance, output_path)
         writeto = kwargs.get("writeto", None)
         logfile = kwargs.get("logfile", None)
-        creator.run_madx(madx_script, logfile, writeto)
+        cwd = kwargs.get("cwd", None)
+        creator.run_madx(madx_script, logfile, writeto, cwd)
 
     @classmethod
     def prepare_run(cls, acc_instance, output_path):
@@ -25,11 +26,12 @@ class ModelCreator(object):
             cls._prepare_fullresponse(acc_instance, output_path)
             
     @staticmethod
-    def run_madx(madx_script, logfile=None, writeto=None):
+    def run_madx(madx_script, logfile=None, writeto=None, cwd=None):
         madx_wrapper.resolve_and_run_string(
             madx_script,
             output_file=writeto,
-            log_file=logfile
+            log_file=logfile,
+            cwd=cwd,
         )
 
 
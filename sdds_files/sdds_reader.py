@@ -27,8 +27,14 @@ END_TAG = "&end"
 DEBUG = False
 
 
-def read_sdds_file(file_path):
-    return SddsReader(file_path).sdds_file
+def read_sdds_file(file_path, memmap=False):
+    """
+    Reads the SDDS file in file_path and returns an SddsFile instance.
+    If memmap is True, the numeric arrays and columns of binary files are
+    returned as read-only np.memmap views over the file instead of being
+    loaded into memory, so that only the accessed slices are read.
+    """
+    return SddsReader(file_path, memmap=memmap).sdds_file
 
 
 class SddsTypes(object):
@@ -98,8 +104,10 @@ class SddsElementDescriptor(object):
 
 class SddsReader(object):
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, memmap=False):
         self._line_num = 0
+        self._file_path = file_path
+        self._memmap = memmap
         self._sdds_file = SddsFile()
         self._data_tag_read = False
         with open(file_path, "rb") as lines:
@@ -264,87 +272,128 @@ class SddsReader(object):
             self._read_ascii_data()
 
     def _read_binary_data(self):
-        self._sdds_file.row_count = self._read_binary_int()
+        self._sdds_file.row_count = self._read_binary_values(
+            SddsTypes.Types.INT, 1
+        )[0]
         for _, parameter in self._sdds_file.get_parameters().iteritems():
             self._read_binary_parameter_value(parameter)
         for _, array in self._sdds_file.get_arrays().iteritems():
             self._read_binary_array_values(array)
-        for _, column in self._sdds_file.get_columns().iteritems():
-            pass  # TODO
-
-    def _binary_read_functions(self):
-        return {
-            SddsTypes.Types.BOOLEAN: self._read_binary_boolean,
-            SddsTypes.Types.BYTE: self._read_binary_byte,
-            SddsTypes.Types.CHAR: self._read_binary_char,
-            SddsTypes.Types.DOUBLE: self._read_binary_double,
-            SddsTypes.Types.FLOAT: self._read_binary_float,
-            SddsTypes.Types.INT: self._read_binary_int,
-            SddsTypes.Types.LONG: self._read_binary_long,
-            SddsTypes.Types.SHORT: self._read_binary_short,
-            SddsTypes.Types.STRING: self._read_binary_string,
-        }
+        if self._sdds_file.get_columns():
+            self._read_binary_columns_values()
+
+    def _dtype(self, sdds_type):
+        """
+        Returns the numpy dtype for the given SddsTypes.Types, taking into
+        account the byte order defined in the header (big-endian if not
+        specified).
+        """
+        if sdds_type == SddsTypes.Types.BOOLEAN:
+            return np.dtype(np.bool_)
+        if sdds_type == SddsTypes.Types.CHAR:
+            return np.dtype("S1")
+        endian = "<" if self._sdds_file.big_endian is False else ">"
+        return np.dtype(endian + {
+            SddsTypes.Types.BYTE: "i1",
+            SddsTypes.Types.DOUBLE: "f8",
+            SddsTypes.Types.FLOAT: "f4",
+            SddsTypes.Types.INT: "i4",
+            SddsTypes.Types.LONG: "i8",
+            SddsTypes.Types.SHORT: "i2",
+        }[sdds_type])
+
+    def _read_binary_values(self, sdds_type, count):
+        """
+        Reads count values of the given type at the current position into
+        memory. Used for single values, as lengths and dimensions.
+        """
+        return self._read_buffer(self._dtype(sdds_type), count)
+
+    def _read_binary_bulk(self, dtype, count):
+        """
+        Reads count values of the given numpy dtype at the current position.
+        In memory-map mode the data is not copied: a read-only np.memmap view
+        over the file is returned and the position is moved after it.
+        """
+        if not self._memmap or count == 0:
+            return self._read_buffer(dtype, count)
+        offset = self._lines.tell()
+        values = np.memmap(self._file_path, dtype=dtype, mode="r",
+                           offset=offset, shape=(count,))
+        self._lines.seek(offset + count * dtype.itemsize)
+        return values
+
+    def _read_buffer(self, dtype, count):
+        num_bytes = count * dtype.itemsize
+        data = bytearray(self._lines.read(num_bytes))
+        if len(data) != num_bytes:
+            raise IOError("Unexpected end of file in binary data.")
+        return np.frombuffer(data, dtype=dtype)
+
+    def _read_binary_string(self, modifier=None):
+        if modifier == "u1":
+            length_dtype = np.dtype("u1")
+        elif modifier == "i2":
+            length_dtype = self._dtype(SddsTypes.Types.SHORT)
+        else:
+            length_dtype = self._dtype(SddsTypes.Types.INT)
+        length = self._read_buffer(length_dtype, 1)[0]
+        return self._lines.read(length)
 
     def _read_binary_parameter_value(self, parameter):
-        read_function = self._binary_read_functions()[parameter.type]
-        parameter.value = read_function()[0]
+        if parameter.type == SddsTypes.Types.STRING:
+            parameter.value = self._read_binary_string(parameter.modifier)
+        else:
+            # Single values are always read, never mapped.
+            dtype = self._dtype(parameter.type)
+            parameter.value = np.frombuffer(
+                self._lines.read(dtype.itemsize), dtype=dtype
+            )[0]
         LOGGER.debug(" ".join(["Value for parameter",
                                parameter.name, str(parameter.value)]))
 
-    # TODO: > or < depending on the endianess in the header
-    # > Big-endian
-    # < Little-endian
-    def _read_binary_boolean(self, bytes=SddsTypes.TYPES_SIZES[SddsTypes.Types.BOOLEAN]):
-        return np.fromstring(self._lines.read(bytes), dtype=np.bool)
-
-    def _read_binary_byte(self):
-        return np.fromstring(self._lines.read(bytes), dtype=np.dtype(">i1"))
-
-    def _read_binary_char(self, bytes=SddsTypes.TYPES_SIZES[SddsTypes.Types.CHAR]):
-        return self._lines.read(bytes)
-
-    def _read_binary_double(self, bytes=SddsTypes.TYPES_SIZES[SddsTypes.Types.DOUBLE]):
-        return np.fromstring(self._lines.read(bytes), dtype=np.dtype(">d"))
-
-    def _read_binary_float(self, bytes=SddsTypes.TYPES_SIZES[SddsTypes.Types.FLOAT]):
-        return np.fromstring(self._lines.read(bytes), dtype=np.dtype(">f"))
-
-    def _read_binary_int(self, bytes=SddsTypes.TYPES_SIZES[SddsTypes.Types.INT]):
-        return np.fromstring(self._lines.read(bytes), dtype=np.dtype(">i"))
-
-    def _read_binary_long(self, bytes=SddsTypes.TYPES_SIZES[SddsTypes.Types.LONG]):
-        return np.fromstring(self._lines.read(bytes), dtype=np.dtype(">i8"))
-
-    def _read_binary_short(self, bytes=SddsTypes.TYPES_SIZES[SddsTypes.Types.SHORT]):
-        return np.fromstring(self._lines.read(bytes), dtype=np.dtype(">i2"))
-
-    def _read_binary_string(self, bytes=SddsTypes.TYPES_SIZES[SddsTypes.Types.CHAR]):
-        return self._lines.read(bytes)
-
     def _read_binary_array_values(self, array):
         dimensions = array.dimensions
+        if not isinstance(dimensions, list):
+            dimensions = [0] * dimensions
         for i in range(len(dimensions)):
-            dimensions[i] = self._read_binary_int()[0]
-        array_size = 1
-        for dimension in dimensions:
-            array_size *= dimension
+            dimensions[i] = self._read_binary_values(SddsTypes.Types.INT, 1)[0]
+        array.dimensions = dimensions
+        array_size = int(np.prod(dimensions))
         if array.type == SddsTypes.Types.STRING:
-            values = []
-            for str_index in range(array_size):
-                if "u1" == array.modifier:
-                    str_len = self._read_binary_byte()
-                elif "i2" == array.modifier:
-                    str_len = self._read_binary_short()
-                str_len = self._read_binary_int()
-                values.append(self._read_binary_string(bytes=str_len))
-            array.values = values
+            array.values = [self._read_binary_string(array.modifier)
+                            for _ in range(array_size)]
         else:
-            bytes = array_size * SddsTypes.TYPES_SIZES[array.type]
-            values = self._binary_read_functions()[array.type](bytes=bytes)
-            array.values = values
+            array.values = self._read_binary_bulk(self._dtype(array.type),
+                                                  array_size)
         LOGGER.debug(" ".join(["Values for array", array.name,
-                               "length", str(len(array.values)),
-                               str(array.values)]))
+                               "length", str(len(array.values))]))
+
+    def _read_binary_columns_values(self):
+        """
+        Column data is stored row by row. If no column is a string, every
+        row has the same size and the whole table is read (or mapped) at
+        once as a structured array, otherwise it is read row by row.
+        """
+        columns = self._sdds_file.get_columns().values()
+        row_count = int(self._sdds_file.row_count)
+        if any(column.type == SddsTypes.Types.STRING for column in columns):
+            rows = []
+            for _ in range(row_count):
+                rows.append([
+                    self._read_binary_string(column.modifier)
+                    if column.type == SddsTypes.Types.STRING else
+                    self._read_binary_values(column.type, 1)[0]
+                    for column in columns
+                ])
+            for index, column in enumerate(columns):
+                column.values = [row[index] for row in rows]
+            return
+        row_dtype = np.dtype([(column.name, self._dtype(column.type))
+                              for column in columns])
+        table = self._read_binary_bulk(row_dtype, row_count)
+        for column in columns:
+            column.values = table[column.name]
 
     def _read_ascii_data(self):
         raise NotImplementedError("ASCII file reading has not been implemented...")
@@ -391,6 +440,7 @@ class SddsColumn(object):
 class SddsFile(object):
 
     def __init__(self):
+        self.big_endian = None
         self._parameters = OrderedDict()
         self._arrays = OrderedDict()
         self._columns = OrderedDict()
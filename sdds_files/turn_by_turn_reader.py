@@ -3,6 +3,7 @@ import sys
 import os
 import logging
 from datetime import datetime
+from functools import partial
 import sdds_reader
 import ascii_reader
 import numpy as np
@@ -30,12 +31,26 @@ FORMAT_STRING = " {:." + str(PRINT_PRECISION) + "f}"
 
 # Public ###################
 
-def read_tbt_file(file_path):
+def read_tbt_file(file_path, start_turn=None, end_turn=None, bunch_ids=None):
+    """
+    Reads the turn by turn file in file_path and returns a list of TbtFile,
+    one per bunch.
+
+    Args:
+        file_path: Path to the binary SDDS or ASCII turn by turn file.
+        start_turn: Index of the first turn to load, first turn if None.
+        end_turn: First turn index to be ignored, last turn if None.
+        bunch_ids: Iterable with the ids of the bunches to load, all if None.
+    For binary files only the selected bunches and turns are read from
+    disk, and only when the samples matrices are accessed.
+    """
     if ascii_reader.is_ascii_file(file_path):
-        return [TbtFile.create_from_matrices(
+        tbt_file = TbtFile.create_from_matrices(
             *ascii_reader.read_ascii_file(file_path)
-        )]  # If ASCII return only one TbtFile
-    tbt_files = _TbtReader(file_path).read_file()
+        )
+        _cut_turns(tbt_file, start_turn, end_turn)
+        return [tbt_file]  # If ASCII return only one TbtFile
+    tbt_files = _TbtReader(file_path, start_turn, end_turn, bunch_ids).read_file()
     return tbt_files
 
 
@@ -69,6 +84,7 @@ class TbtFile(object):
         self.num_turns = num_turns
         self.bunch_id = bunch_id
         self._samples_matrix = {HOR: {}, VER: {}}
+        self._samples_loaders = {}
 
     @staticmethod
     def create_from_matrices(bpm_names_x, matrix_x,
@@ -115,11 +131,11 @@ class TbtFile(object):
         names as index.
         E.g.: a.samples_matrix_y.loc["BPM12", 3] -> Sample 3 of monitor BPM12.
         """
-        return self._samples_matrix[HOR]
+        return self._get_matrix(HOR)
 
     @samples_matrix_x.setter
     def samples_matrix_x(self, value):
-        self._samples_matrix[HOR] = value
+        self._set_matrix(HOR, value)
 
     @property
     def samples_matrix_y(self):
@@ -128,15 +144,25 @@ class TbtFile(object):
         names as index.
         E.g.: a.samples_matrix_x.loc["BPM12", 3] -> Sample 3 of monitor BPM12.
         """
-        return self._samples_matrix[VER]
+        return self._get_matrix(VER)
 
     @samples_matrix_y.setter
     def samples_matrix_y(self, value):
-        self._samples_matrix[VER] = value
+        self._set_matrix(VER, value)
+
+    def _get_matrix(self, plane):
+        loader = self._samples_loaders.pop(plane, None)
+        if loader is not None:
+            self._samples_matrix[plane] = loader()
+        return self._samples_matrix[plane]
+
+    def _set_matrix(self, plane, value):
+        self._samples_loaders.pop(plane, None)
+        self._samples_matrix[plane] = value
 
     def _get(self, bpm_name, plane):
         try:
-            samples = self._samples_matrix[plane].loc[bpm_name]
+            samples = self._get_matrix(plane).loc[bpm_name]
         except KeyError:
             return None
         return samples
@@ -145,8 +171,8 @@ class TbtFile(object):
 # Private ###################
 
 class _TbtReader(object):
-    def __init__(self, file_path):
-        sdds_file = sdds_reader.read_sdds_file(file_path)
+    def __init__(self, file_path, start_turn=None, end_turn=None, bunch_ids=None):
+        sdds_file = sdds_reader.read_sdds_file(file_path, memmap=True)
         parameters = sdds_file.get_parameters()
         arrays = sdds_file.get_arrays()
         self._timestamp = parameters[TIMESTAMP_NAME].value
@@ -172,11 +198,17 @@ class _TbtReader(object):
                                 self._num_turns)
         self._all_samples[HOR].shape = samples_matrix_shape
         self._all_samples[VER].shape = samples_matrix_shape
+        self._turns = _turns_slice(start_turn, end_turn, self._num_turns)
+        num_turns = self._turns.stop - self._turns.start
+        self._bunch_indices = []
         self._tbt_files = []
         for index in range(self._num_bunches):
+            bunch_id = self._bunch_id[HOR][index]  # TODO: does plane matter?
+            if bunch_ids is not None and bunch_id not in bunch_ids:
+                continue
+            self._bunch_indices.append(index)
             self._tbt_files.append(
-                TbtFile(self._date, self._num_bunches, self._num_turns,
-                        self._bunch_id[HOR][index])  # TODO: does plane matter?
+                TbtFile(self._date, self._num_bunches, num_turns, bunch_id)
             )
 
     def _timestamp_to_date(self):
@@ -190,16 +222,38 @@ class _TbtReader(object):
         return self._tbt_files
 
     def _read_bpms(self, plane):
-        num_bunches = self._num_bunches
-        all_samples = self._all_samples[plane]
-        for bunch_index in range(num_bunches):
-            tbt_file = self._tbt_files[bunch_index]
-            tbt_file._samples_matrix[plane] = pd.DataFrame(
-                index=self._bpm_names,
-                data=all_samples[:, bunch_index, :],
-                dtype=float,
+        for bunch_index, tbt_file in zip(self._bunch_indices, self._tbt_files):
+            tbt_file._samples_loaders[plane] = partial(
+                self._load_samples, plane, bunch_index
             )
 
+    def _load_samples(self, plane, bunch_index):
+        # Only this slice is read from the memory-mapped file.
+        return pd.DataFrame(
+            index=self._bpm_names,
+            data=self._all_samples[plane][:, bunch_index, self._turns],
+            dtype=float,
+        )
+
+
+def _cut_turns(tbt_file, start_turn, end_turn):
+    if start_turn is None and end_turn is None:
+        return
+    turns = _turns_slice(start_turn, end_turn, tbt_file.num_turns)
+    for plane in (HOR, VER):
+        samples = tbt_file._get_matrix(plane)
+        tbt_file._set_matrix(plane, pd.DataFrame(
+            index=samples.index,
+            data=samples.iloc[:, turns].values,
+        ))
+    tbt_file.num_turns = turns.stop - turns.start
+
+
+def _turns_slice(start_turn, end_turn, num_turns):
+    start = 0 if start_turn is None else max(0, start_turn)
+    end = num_turns if end_turn is None else min(end_turn, num_turns)
+    return slice(start, max(start, end))
+
 
 class _TbtAsciiWriter(object):
     def __init__(self, tbt_files, model_path, output_path, headers_dict=None):
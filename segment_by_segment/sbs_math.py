@@ -47,70 +47,101 @@ def get_r_terms(name, meas):
     return r11, r12, r21, r22
 
 
-def propagate_error_beta(errb0, erra0, dphi, bets, bet0, alf0):
-    return np.sqrt(
-        (
-            bets*np.sin(4*np.pi*dphi)*alf0/bet0 +
-            bets*np.cos(4*np.pi*dphi)/bet0
-        )**2*errb0**2 +
-        (bets*np.sin(4*np.pi*dphi))**2*erra0**2
-    )
-
-
-def propagate_error_alfa(errb0, erra0, dphi, alfs, bet0, alf0):
-    return np.sqrt(
-        (
-            (alfs*((np.sin(4*np.pi*dphi)*alf0/bet0) + (np.cos(4*np.pi*dphi)/bet0))) -
-            (np.cos(4*np.pi*dphi)*alf0/bet0) + (np.sin(4*np.pi*dphi)/bet0)
-        )**2*errb0**2 +
-        ((np.cos(4*np.pi*dphi)) - (alfs*np.sin(4*np.pi*dphi)))**2*erra0**2
-    )
-
-
-def propagate_error_phase(errb0, erra0, dphi, bet0, alf0):
-    return np.sqrt(
-        (
-            ((1/2.*np.cos(4*np.pi*dphi)*alf0/bet0)-
-             (1/2.*np.sin(4*np.pi*dphi)/bet0)
-             -(1/2.*alf0/bet0)
-            )*errb0
-        )**2+
-        ((-(1/2.*np.cos(4*np.pi*dphi))+(1/2.))*erra0)**2
-    )/(2*np.pi)
+def optics_jacobian(dphi, bet0, alf0, bets=None, alfs=None):
+    """Derivatives of the propagated optics on the initial beta and alfa.
+
+    All arguments are broadcast against each other, they can be arrays over
+    the BPMs of a segment or scalars.
+
+    Arguments:
+        dphi: Phase advance from the initial point, in units of 2pi.
+        bet0, alf0: Beta and alfa at the initial point.
+        bets, alfs: Propagated beta and alfa, only needed for the beta and
+            alfa rows.
+    Returns:
+        An array (n, 3, 2) with the beta, alfa and phase rows and the
+        derivatives on the initial beta and alfa as columns. The rows for
+        which bets or alfs is not given are NaN.
+    """
+    dphi, bet0, alf0, bets, alfs = np.broadcast_arrays(*[
+        np.atleast_1d(np.asarray(value, dtype=float))
+        for value in (dphi, bet0, alf0,
+                      np.nan if bets is None else bets,
+                      np.nan if alfs is None else alfs)
+    ])
+    sin4, cos4 = np.sin(4 * np.pi * dphi), np.cos(4 * np.pi * dphi)
+    jacobian = np.empty(dphi.shape + (3, 2))
+    jacobian[..., 0, 0], jacobian[..., 0, 1] = _beta_derivatives(sin4, cos4, bets, bet0, alf0)
+    jacobian[..., 1, 0], jacobian[..., 1, 1] = _alfa_derivatives(sin4, cos4, alfs, bet0, alf0)
+    jacobian[..., 2, 0], jacobian[..., 2, 1] = _phase_derivatives(sin4, cos4, bet0, alf0)
+    return jacobian
+
+
+def propagate_covariance(jacobian, errb0, erra0, cov0=0.):
+    """Propagates the covariance of the initial conditions to every BPM.
+
+    Arguments:
+        jacobian: Array (n, k, 2) as returned by optics_jacobian.
+        errb0, erra0: Errors of the initial beta and alfa, scalars or one
+            per BPM.
+        cov0: Covariance between the initial beta and alfa.
+    Returns:
+        An array (n, k, k) with the covariance matrix at every BPM.
+    """
+    errb0, erra0, cov0 = [np.asarray(value, dtype=float)[..., np.newaxis, np.newaxis]
+                          for value in (errb0, erra0, cov0)]
+    d_bet, d_alf = jacobian[..., :, 0:1], jacobian[..., :, 1:2]
+    d_bet_t, d_alf_t = np.swapaxes(d_bet, -1, -2), np.swapaxes(d_alf, -1, -2)
+    return (d_bet * d_bet_t * errb0 ** 2 + d_alf * d_alf_t * erra0 ** 2 +
+            (d_bet * d_alf_t + d_alf * d_bet_t) * cov0)
+
+
+def propagate_errors(jacobian, errb0, erra0, cov0=0.):
+    """Errors of the propagated optics, the square root of the covariance
+    diagonal, as an array (n, k).
+    """
+    errb0, erra0, cov0 = [np.asarray(value, dtype=float)[..., np.newaxis]
+                          for value in (errb0, erra0, cov0)]
+    return _error((jacobian[..., 0], jacobian[..., 1]), errb0, erra0, cov0)
+
+
+def propagate_error_beta(errb0, erra0, dphi, bets, bet0, alf0, cov0=0.):
+    sin4, cos4 = np.sin(4 * np.pi * dphi), np.cos(4 * np.pi * dphi)
+    return _error(_beta_derivatives(sin4, cos4, bets, bet0, alf0), errb0, erra0, cov0)
+
+
+def propagate_error_alfa(errb0, erra0, dphi, alfs, bet0, alf0, cov0=0.):
+    sin4, cos4 = np.sin(4 * np.pi * dphi), np.cos(4 * np.pi * dphi)
+    return _error(_alfa_derivatives(sin4, cos4, alfs, bet0, alf0), errb0, erra0, cov0)
+
+
+def propagate_error_phase(errb0, erra0, dphi, bet0, alf0, cov0=0.):
+    sin4, cos4 = np.sin(4 * np.pi * dphi), np.cos(4 * np.pi * dphi)
+    return _error(_phase_derivatives(sin4, cos4, bet0, alf0), errb0, erra0, cov0)
 
 
 def propagate_error_coupling_1001_re(f1001ab_ini, p1001_ini, phasex, phasey, f1001_std_ini, p1001_std_ini):
-    return np.sqrt(
-        (f1001_std_ini * np.cos(2 * np.pi * (p1001_ini - phasex + phasey)))**2 +
-        (2 * np.pi * p1001_std_ini * f1001ab_ini *
-         np.sin(2 * np.pi * (p1001_ini - phasex + phasey)))**2
-    )
+    angle = 2 * np.pi * (p1001_ini - phasex + phasey)
+    return _quadratic_add(f1001_std_ini * np.cos(angle),
+                          2 * np.pi * p1001_std_ini * f1001ab_ini * np.sin(angle))
 
 
 def propagate_error_coupling_1001_im(f1001ab_ini, p1001_ini, phasex, phasey, f1001_std_ini, p1001_std_ini):
-    return np.sqrt(
-        (f1001_std_ini * np.sin(2 * np.pi * (p1001_ini - phasex + phasey)))**2 +
-        (2 * np.pi * p1001_std_ini * f1001ab_ini *
-         np.cos(2 * np.pi * (p1001_ini - phasex + phasey)))**2
-    )
-
+    angle = 2 * np.pi * (p1001_ini - phasex + phasey)
+    return _quadratic_add(f1001_std_ini * np.sin(angle),
+                          2 * np.pi * p1001_std_ini * f1001ab_ini * np.cos(angle))
 
 
 def propagate_error_coupling_1010_re(f1010ab_ini, p1010_ini, phasex, phasey, f1010_std_ini, p1010_std_ini):
-    return np.sqrt(
-        (f1010_std_ini * np.cos(2 * np.pi * (p1010_ini - phasex - phasey)))**2 +
-        (2 * np.pi * p1010_std_ini * f1010ab_ini *
-         np.sin(2 * np.pi * (p1010_ini - phasex - phasey)))**2
-    )
-
+    angle = 2 * np.pi * (p1010_ini - phasex - phasey)
+    return _quadratic_add(f1010_std_ini * np.cos(angle),
+                          2 * np.pi * p1010_std_ini * f1010ab_ini * np.sin(angle))
 
 
 def propagate_error_coupling_1010_im(f1010ab_ini, p1010_ini, phasex, phasey, f1010_std_ini, p1010_std_ini):
-    return np.sqrt(
-        (f1010_std_ini * np.sin(2 * np.pi * (p1010_ini - phasex - phasey)))**2 +
-        (2 * np.pi * p1010_std_ini * f1010ab_ini *
-         np.cos(2 * np.pi * (p1010_ini - phasex - phasey)))**2
-    )
+    angle = 2 * np.pi * (p1010_ini - phasex - phasey)
+    return _quadratic_add(f1010_std_ini * np.sin(angle),
+                          2 * np.pi * p1010_std_ini * f1010ab_ini * np.cos(angle))
 
 
 def propagate_error_dispersion(std_D0, bet0, bets, dphi, alf0):
@@ -120,6 +151,30 @@ def propagate_error_dispersion(std_D0, bet0, bets, dphi, alf0):
     )
 
 
+def magnet_beta_errors(bets, phase_bpms, beta_magnets, phase_magnets, err_k1l):
+    """Beta errors at the BPMs from the K1L uncertainty of the magnets.
+
+    Only the magnets with a smaller phase than the BPM contribute.
+
+    Arguments:
+        bets: Model beta at the BPMs.
+        phase_bpms: Phase of the BPMs, in units of 2pi.
+        beta_magnets, phase_magnets, err_k1l: Beta, phase and absolute K1L
+            uncertainty of the magnets.
+    Returns:
+        The beta error at every BPM, the magnet contributions added in
+        quadrature.
+    """
+    dphi = (np.asarray(phase_bpms)[:, np.newaxis] -
+            np.asarray(phase_magnets)[np.newaxis, :])
+    rel_errors = np.where(
+        dphi > 0,
+        err_k1l * np.abs(beta_magnets * np.sin(4 * np.pi * dphi)),
+        0.
+    )
+    return bets * np.sqrt(np.sum(rel_errors ** 2, axis=1))
+
+
 def weighted_average_for_SbS_elements(value1, sigma1, value2, sigma2):
     weighted_average = ((1/sigma1**2 * value1 + 1/sigma2**2 * value2) /
                         (1/sigma1**2 + 1/sigma2**2))
@@ -129,3 +184,32 @@ def weighted_average_for_SbS_elements(value1, sigma1, value2, sigma2):
                            (1/sigma1**2 + 1/sigma2**2))
     final_error = np.sqrt(uncertainty_of_average**2 + weighted_rms**2)
     return weighted_average, final_error
+
+
+def _quadratic_add(*values):
+    result = 0.
+    for value in values:
+        result += value ** 2
+    return np.sqrt(result)
+
+
+def _beta_derivatives(sin4, cos4, bets, bet0, alf0):
+    return bets * (sin4 * alf0 + cos4) / bet0, bets * sin4
+
+
+def _alfa_derivatives(sin4, cos4, alfs, bet0, alf0):
+    return ((alfs * (sin4 * alf0 + cos4) - cos4 * alf0 + sin4) / bet0,
+            cos4 - alfs * sin4)
+
+
+def _phase_derivatives(sin4, cos4, bet0, alf0):
+    return ((.5 * cos4 * alf0 - .5 * sin4 - .5 * alf0) / bet0 / (2 * np.pi),
+            (.5 - .5 * cos4) / (2 * np.pi))
+
+
+def _error(derivatives, errb0, erra0, cov0):
+    """Error from the derivatives on the initial beta and alfa, broadcast
+    over any argument."""
+    d_bet, d_alf = derivatives
+    return np.sqrt((d_bet * errb0) ** 2 + (d_alf * erra0) ** 2 +
+                   2 * d_bet * d_alf * cov0)
@@ -78,12 +78,10 @@ class Phase(Propagable):
 
     def __init__(self, segment, meas):
         super(Phase, self).__init__(segment, meas)
-        self.bet0, self.alf0, self.errbet0, self.erralf0 = {}, {}, {}, {}
-        for plane in PLANES:
-            self.bet0[plane], self.errbet0[plane] =\
-                BetaPhase.get_at(self._segment.start, meas, plane)
-            self.alf0[plane], self.erralf0[plane] =\
-                AlfaPhase.get_at(self._segment.start, meas, plane)
+        (self.bet0, self.alf0,
+         self.errbet0, self.erralf0) = _start_conditions(segment, meas)
+        (self.bet_end, self.alf_end,
+         self.errbet_end, self.erralf_end) = _end_conditions(segment, meas)
 
     def init_conds_dict(self):
         # The phase is not necessary for the initial conditions.
@@ -104,7 +102,7 @@ class Phase(Propagable):
     def corr_front(self, plane):
         return self._comp_corr(plane,
                                self.segment_models.front,
-                               self.segment_models.front_corrected)
+                               self.segment_models.front_corrected, 1)
 
     @_buffered
     def meas_back(self, plane):
@@ -114,7 +112,7 @@ class Phase(Propagable):
     def corr_back(self, plane):
         return self._comp_corr(plane,
                                self.segment_models.back,
-                               self.segment_models.back_corrected)
+                               self.segment_models.back_corrected, -1)
 
     def write_to_file(self, seg_beats):
         for plane in ("x", "y"):
@@ -148,6 +146,7 @@ class Phase(Propagable):
     def _comp_meas(self, plane, seg_model, sign):
         uplane = plane.upper()
         model_ph = seg_model.loc[:, "MU{}".format(uplane)]
+        bet0, errbet0, alf0, erralf0 = self._init_conds(plane, sign)
         if not self._segment.element:
             meas_ph, meas_err = Phase.get_at(slice(None, None, None),
                                              self._meas, plane)
@@ -155,8 +154,6 @@ class Phase(Propagable):
             seg_meas_ph = sign * (meas_ph.loc[names] - meas_ph.loc[names[0]]) % 1.
             ph_beating = (seg_meas_ph[names] - model_ph[names]) % 1.
             ph_beating[ph_beating > 0.5] = ph_beating[ph_beating > 0.5] - 1
-            bet0, errbet0 = self.bet0[plane], self.errbet0[plane]
-            alf0, erralf0 = self.alf0[plane], self.erralf0[plane]
             prop_err = sbs_math.propagate_error_phase(errbet0, erralf0,
                                                       model_ph[names],
                                                       bet0, alf0)
@@ -164,34 +161,39 @@ class Phase(Propagable):
             return ph_beating, err_ph
         else:
             prop_ph = model_ph[model_ph.index[0]]
-            bet0, errbet0 = self.bet0[plane], self.errbet0[plane]
-            alf0, erralf0 = self.alf0[plane], self.erralf0[plane]
             prop_err = sbs_math.propagate_error_phase(errbet0, erralf0,
                                                       model_ph[model_ph.index[0]],
                                                       bet0, alf0)
             return prop_ph, prop_err
 
-    def _comp_corr(self, plane, seg_model, seg_model_corr):
+    def _comp_corr(self, plane, seg_model, seg_model_corr, sign):
         uplane = plane.upper()
         model_ph = seg_model.loc[:, "MU{}".format(uplane)]
         corr_ph = seg_model_corr.loc[:, "MU{}".format(uplane)]
+        bet0, errbet0, alf0, erralf0 = self._init_conds(plane, sign)
         if not self._segment.element:
             ph_beating = (corr_ph - model_ph) % 1.
-            bet0, errbet0 = self.bet0[plane], self.errbet0[plane]
-            alf0, erralf0 = self.alf0[plane], self.erralf0[plane]
             prop_err = sbs_math.propagate_error_phase(errbet0, erralf0,
                                                       model_ph,
                                                       bet0, alf0)
             return ph_beating, prop_err
         else:
             prop_ph = model_ph.iloc[0]
-            bet0, errbet0 = self.bet0[plane], self.errbet0[plane]
-            alf0, erralf0 = self.alf0[plane], self.erralf0[plane]
             prop_err = sbs_math.propagate_error_phase(errbet0, erralf0,
                                                       model_ph[model_ph.index[0]],
                                                       bet0, alf0)
             return prop_ph, prop_err
 
+    def _init_conds(self, plane, sign):
+        """Conditions the model was propagated from: the start of the
+        segment for the front propagation (sign 1), the end for the back one
+        (sign -1)."""
+        if sign < 0:
+            return (self.bet_end[plane], self.errbet_end[plane],
+                    self.alf_end[plane], self.erralf_end[plane])
+        return (self.bet0[plane], self.errbet0[plane],
+                self.alf0[plane], self.erralf0[plane])
+
 
 class BetaPhase(Propagable):
 
@@ -199,6 +201,8 @@ class BetaPhase(Propagable):
 
     def __init__(self, segment, meas):
         super(BetaPhase, self).__init__(segment, meas)
+        (self.bet0, self.alf0,
+         self.errbet0, self.erralf0) = _start_conditions(segment, meas)
 
     def init_conds_dict(self):
         init_dict = {}
@@ -257,9 +261,10 @@ class BetaPhase(Propagable):
             prop_beta = model_beta[model_beta.index[0]]
             bet0, errbet0 = self.bet0[plane], self.errbet0[plane]
             alf0, erralf0 = self.alf0[plane], self.erralf0[plane]
-            prop_err = sbs_math.propagate_error_phase(errbet0, erralf0,
-                                                      model_beta[model_beta.index[0]],
-                                                      bet0, alf0)
+            prop_err = sbs_math.propagate_error_beta(errbet0, erralf0,
+                                                     model_ph[model_ph.index[0]],
+                                                     prop_beta,
+                                                     bet0, alf0)
             return prop_beta, prop_err
 
 
@@ -305,6 +310,30 @@ class AlfaPhase(Propagable):
         pass
 
 
+def _start_conditions(segment, meas):
+    """Measured beta and alfa, with errors, at the start of the segment."""
+    bet0, alf0, errbet0, erralf0 = {}, {}, {}, {}
+    for plane in PLANES:
+        bet0[plane], errbet0[plane] =\
+            BetaPhase.get_at(segment.start, meas, plane)
+        alf0[plane], erralf0[plane] =\
+            AlfaPhase.get_at(segment.start, meas, plane)
+    return bet0, alf0, errbet0, erralf0
+
+
+def _end_conditions(segment, meas):
+    """Measured beta and alfa, with errors, at the end of the segment, with
+    the alfa sign of the back propagation (reflected segment)."""
+    bet_end, alf_end, errbet_end, erralf_end = {}, {}, {}, {}
+    for plane in PLANES:
+        bet_end[plane], errbet_end[plane] =\
+            BetaPhase.get_at(segment.end, meas, plane)
+        alf_end[plane], erralf_end[plane] =\
+            AlfaPhase.get_at(segment.end, meas, plane)
+        alf_end[plane] = -alf_end[plane]
+    return bet_end, alf_end, errbet_end, erralf_end
+
+
 def _common_indices(*indices):
     """ Common indices with indicies[0] order
     """
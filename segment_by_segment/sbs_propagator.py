@@ -0,0 +1,192 @@
+"""
+Linear propagation of the optics through a segment, without MAD-X.
+
+The transfer matrices from the start of the segment to every element in it
+are built at once, as a (n_elements, 3, 3) stack per plane, from the Twiss
+functions of the model (usually twiss_elements.dat): the (x, px) block is
+given by the betas, alfas and phases and the third column holds the
+dispersion generated inside the segment. These are the same matrices MAD-X
+would compute for the model optics, whatever the element types and lengths.
+
+The measured initial conditions are then propagated through the stack, front
+(from the start) and back (from the end, on the reflected segment). The
+result is a DataFrame with the same columns and conventions as the twiss
+files of the segment.madx MAD-X job, so the rest of segment-by-segment does
+not care where the models come from.
+
+The propagation is uncoupled: the R-matrix initial conditions are not used.
+"""
+import numpy as np
+import pandas as pd
+
+PLANES = ("x", "y")
+COLUMNS = ("NAME", "S", "BETX", "ALFX", "BETY", "ALFY",
+           "MUX", "MUY", "DX", "DY", "DPX", "DPY")
+_REFLECT = np.diag([1., -1., 1.])
+
+
+class SegmentPropagator(object):
+    """Propagates initial conditions through the elements of a segment.
+
+    Arguments:
+        model: DataFrame of the whole accelerator model, indexed by NAME and
+            with S, BET, ALF, MU, D and DP columns for both planes. If the
+            segment goes through the end of the model, the LENGTH, Q1 and Q2
+            headers are needed.
+        start: Name of the first element of the segment.
+        end: Name of the last element of the segment.
+    """
+    def __init__(self, model, start, end):
+        rows, wrapped = _segment_rows(list(model.index), start, end)
+        self.names = np.asarray(model.index)[rows]
+        s_pos = model.S.values[rows]
+        if np.any(wrapped):
+            s_pos = s_pos + wrapped * model.headers["LENGTH"]
+        self.s = s_pos - s_pos[0]
+        self.matrices = {}
+        for plane, tune in zip(PLANES, ("Q1", "Q2")):
+            uplane = plane.upper()
+            phase = model.loc[:, "MU" + uplane].values[rows]
+            if np.any(wrapped):
+                phase = phase + wrapped * model.headers[tune]
+            self.matrices[plane] = transfer_matrices(
+                model.loc[:, "BET" + uplane].values[rows],
+                model.loc[:, "ALF" + uplane].values[rows],
+                phase,
+                model.loc[:, "D" + uplane].values[rows],
+                model.loc[:, "DP" + uplane].values[rows],
+            )
+
+    def front(self, init_conds):
+        """Propagates the conditions at the start to the end of the segment.
+
+        Arguments:
+            init_conds: Dictionary with the initial conditions, as given by
+                the init_conds_dict() of the propagables (betx_ini, alfx_ini,
+                ...). The dispersion (dx_ini, dpx_ini, ...) defaults to zero,
+                as in MAD-X.
+        Returns:
+            A DataFrame with the propagated optics at every element, as in the
+            front twiss file of MAD-X.
+        """
+        return self._propagate(self.matrices, init_conds, "ini",
+                               self.names, self.s)
+
+    def back(self, init_conds):
+        """Propagates the conditions at the end back to the segment start.
+
+        Arguments:
+            init_conds: Dictionary with the conditions at the end of the
+                segment (betx_end, alfx_end, ...), in the direction of the
+                beam.
+        Returns:
+            A DataFrame with the propagated optics at every element, in
+            reversed order and with the alfas and dispersion derivatives of
+            the reflected segment, as in the back twiss file of MAD-X.
+        """
+        back_matrices = {}
+        for plane in PLANES:
+            matrices = self.matrices[plane]
+            # end -> element = (start -> element) (start -> end)^-1:
+            to_elements = np.matmul(matrices, _inverse(matrices[-1]))
+            back_matrices[plane] = np.matmul(
+                np.matmul(_REFLECT, to_elements), _REFLECT
+            )[::-1]
+        end_conds = dict(init_conds)
+        for plane in PLANES:
+            for name in ("alf{}_end", "dp{}_end"):
+                key = name.format(plane)
+                end_conds[key] = -end_conds.get(key, 0.)
+        return self._propagate(back_matrices, end_conds, "end",
+                               self.names[::-1], self.s[-1] - self.s[::-1])
+
+    @staticmethod
+    def _propagate(matrices, init_conds, suffix, names, s_pos):
+        columns = {"NAME": names, "S": s_pos}
+        for plane in PLANES:
+            uplane = plane.upper()
+            bet, alf, phase, disp, dispp = propagate(
+                matrices[plane],
+                init_conds["bet{}_{}".format(plane, suffix)],
+                init_conds["alf{}_{}".format(plane, suffix)],
+                init_conds.get("d{}_{}".format(plane, suffix), 0.),
+                init_conds.get("dp{}_{}".format(plane, suffix), 0.),
+            )
+            columns["BET" + uplane] = bet
+            columns["ALF" + uplane] = alf
+            columns["MU" + uplane] = phase
+            columns["D" + uplane] = disp
+            columns["DP" + uplane] = dispp
+        return pd.DataFrame(columns, index=names, columns=list(COLUMNS))
+
+
+def transfer_matrices(beta, alfa, phase, disp, dispp):
+    """Transfer matrices from the first element to every element.
+
+    Arguments:
+        beta, alfa, phase, disp, dispp: Arrays with the model Twiss functions
+            of one plane at the elements, phase in units of 2pi.
+    Returns:
+        A (n_elements, 3, 3) array, acting on (x, px, dp/p).
+    """
+    dphi = 2 * np.pi * (phase - phase[0])
+    cos, sin = np.cos(dphi), np.sin(dphi)
+    bet0, alf0 = beta[0], alfa[0]
+    sqrt_ratio = np.sqrt(beta / bet0)
+    sqrt_prod = np.sqrt(beta * bet0)
+    matrices = np.zeros((len(beta), 3, 3))
+    matrices[:, 0, 0] = sqrt_ratio * (cos + alf0 * sin)
+    matrices[:, 0, 1] = sqrt_prod * sin
+    matrices[:, 1, 0] = ((alf0 - alfa) * cos - (1 + alf0 * alfa) * sin) / sqrt_prod
+    matrices[:, 1, 1] = (cos - alfa * sin) / sqrt_ratio
+    # Dispersion generated between the first element and the others:
+    matrices[:, 0, 2] = (disp - matrices[:, 0, 0] * disp[0]
+                         - matrices[:, 0, 1] * dispp[0])
+    matrices[:, 1, 2] = (dispp - matrices[:, 1, 0] * disp[0]
+                         - matrices[:, 1, 1] * dispp[0])
+    matrices[:, 2, 2] = 1.
+    return matrices
+
+
+def propagate(matrices, bet0, alf0, disp0=0., dispp0=0.):
+    """Propagates the Twiss functions of one plane through the matrices.
+
+    Arguments:
+        matrices: (n_elements, 3, 3) array, as given by transfer_matrices.
+        bet0, alf0, disp0, dispp0: Conditions at the first element.
+    Returns:
+        Arrays beta, alfa, phase (in units of 2pi, starting at 0), dispersion
+        and its derivative at every element.
+    """
+    m11, m12 = matrices[:, 0, 0], matrices[:, 0, 1]
+    m21, m22 = matrices[:, 1, 0], matrices[:, 1, 1]
+    gam0 = (1 + alf0 ** 2) / bet0
+    beta = m11 ** 2 * bet0 - 2 * m11 * m12 * alf0 + m12 ** 2 * gam0
+    alfa = (-m11 * m21 * bet0 + (m11 * m22 + m12 * m21) * alf0
+            - m12 * m22 * gam0)
+    angle = np.arctan2(m12, m11 * bet0 - m12 * alf0)
+    phase = np.unwrap(np.mod(angle, 2 * np.pi)) / (2 * np.pi)
+    phase = phase - phase[0]
+    disp = m11 * disp0 + m12 * dispp0 + matrices[:, 0, 2]
+    dispp = m21 * disp0 + m22 * dispp0 + matrices[:, 1, 2]
+    return beta, alfa, phase, disp, dispp
+
+
+def _inverse(matrix):
+    """Inverse of a symplectic (x, px, dp/p) transfer matrix."""
+    inverse = np.array([[matrix[1, 1], -matrix[0, 1], 0.],
+                        [-matrix[1, 0], matrix[0, 0], 0.],
+                        [0., 0., 1.]])
+    inverse[:2, 2] = -np.dot(inverse[:2, :2], matrix[:2, 2])
+    return inverse
+
+
+def _segment_rows(names, start, end):
+    """Positions of the segment elements in names, wrapping at the end."""
+    i_start, i_end = names.index(start), names.index(end)
+    if i_end >= i_start:
+        rows = np.arange(i_start, i_end + 1)
+    else:
+        rows = np.concatenate((np.arange(i_start, len(names)),
+                               np.arange(0, i_end + 1)))
+    return rows, (rows < i_start).astype(float)
@@ -1,7 +1,10 @@
 import sys
 import os
 import argparse
-from shutil import copyfile
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from shutil import copyfile, rmtree
 from collections import OrderedDict
 
 sys.path.append(
@@ -13,6 +16,7 @@ from utils import tfs_pandas, logging_tools
 from utils.dict_tools import DotDict
 from tfs_files import TfsCollection, Tfs
 import sbs_propagables
+import sbs_propagator
 
 # TODO: Remove debug and set up log file
 import logging
@@ -20,6 +24,8 @@ DEBUG = logging.DEBUG
 LOGGER = logging_tools.get_logger(__name__, level_console=DEBUG)
 
 PLANES = ("x", "y")
+PROCESSES = multiprocessing.cpu_count()
+PROPAGATORS = ("madx", "python")
 
 
 def _parse_args(args=None):
@@ -58,6 +64,20 @@ def _parse_args(args=None):
     parser.add_argument("--output",
                         help=("Directory where to put the output files."),
                         dest="output", required=True)
+    parser.add_argument("--processes",
+                        help=("Maximum number of segments to evaluate "
+                              "at the same time."),
+                        dest="processes", type=int, default=PROCESSES)
+    parser.add_argument("--propagator",
+                        help=("How to propagate the measured initial "
+                              "conditions: running MAD-X or in Python, "
+                              "from the optics of --model (uncoupled, "
+                              "ignores the corrections). Only for this "
+                              "script, the older "
+                              "SegmentBySegment/SegmentBySegment.py "
+                              "always runs MAD-X."),
+                        dest="propagator", choices=PROPAGATORS,
+                        default="madx")
     options, accel_args = parser.parse_known_args(args)
     accel_cls = manager.get_accel_class(accel_args)
     return accel_cls, options
@@ -76,13 +96,52 @@ def segment_by_segment(accel_cls, options):
     model = tfs_pandas.read_tfs(options.model).set_index("NAME", drop=False)
     meas = GetLlmMeasurement(options.measurement)
     elem_segments = [Segment.init_from_element(name) for name in elements]
-    for segment in elem_segments + segments:
-        propagable = run_for_segment(accel_cls, segment, model, meas,
-                                     options.optics, options.output)
-        write_beatings(segment, propagable, options.output)
-
-
-def run_for_segment(accel_cls, segment, model, meas, optics, output):
+    # MAD-X runs in a working directory per segment, the paths in the
+    # scripts must not be relative to the current one:
+    output = os.path.abspath(options.output)
+    optics = os.path.abspath(options.optics)
+    processes = getattr(options, "processes", PROCESSES)
+    propagator = getattr(options, "propagator", "madx")
+    for segment, propagables in run_segments(accel_cls,
+                                             elem_segments + segments,
+                                             model, meas, optics,
+                                             output, processes, propagator):
+        write_beatings(segment, propagables, output)
+
+
+def run_segments(accel_cls, segments, model, meas, optics, output,
+                 processes=PROCESSES, propagator="madx"):
+    """Evaluates the segments concurrently, see run_for_segment.
+
+    The segments are independent, up to 'processes' of them are evaluated at
+    the same time in threads (the time is spent waiting for MAD-X), all of
+    them sharing the model and measurement, which are only read.
+    With the "python" propagator there is nothing to wait for and the
+    segments are evaluated one after the other.
+
+    Yields:
+        (segment, propagables) tuples, as soon as each segment is done, not
+        necessarily in the input order. The exception of a failed segment is
+        raised when it is reached.
+    """
+    def run_one(segment):
+        return segment, run_for_segment(accel_cls, segment, model, meas,
+                                        optics, output, propagator=propagator)
+    if processes <= 1 or len(segments) <= 1 or propagator == "python":
+        for segment in segments:
+            yield run_one(segment)
+        return
+    pool = ThreadPool(min(processes, len(segments)))
+    try:
+        for result in pool.imap_unordered(run_one, segments):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_for_segment(accel_cls, segment, model, meas, optics, output,
+                    propagator="madx"):
     """
     TODO
     """
@@ -91,16 +150,20 @@ def run_for_segment(accel_cls, segment, model, meas, optics, output):
     propagables = [propg(new_segment, meas)
                    for propg in sbs_propagables.get_all_propagables()]
     propagables = [measbl for measbl in propagables if measbl]
-    segment_inst = accel_cls.get_segment(
-        new_segment.name, new_segment.start, new_segment.end,
-        optics,
-    )
     LOGGER.info("Evaluating segment {} ({}, {}). Was input as {} ({}, {})."
                 .format(new_segment.name, new_segment.start, new_segment.end,
                         segment.name, segment.start, segment.end))
-    _prepare_for_madx(new_segment, propagables, optics, output)
-    _run_madx(new_segment, segment_inst, output)
-    seg_models = SegmentModels(output, new_segment)
+    if propagator == "python":
+        seg_models = _run_python_propagator(new_segment, propagables,
+                                            model, output)
+    else:
+        segment_inst = accel_cls.get_segment(
+            new_segment.name, new_segment.start, new_segment.end,
+            optics,
+        )
+        _prepare_for_madx(new_segment, propagables, optics, output)
+        _run_madx(new_segment, segment_inst, output)
+        seg_models = SegmentModels(output, new_segment)
     for propagable in propagables:
         propagable.segment_models = seg_models
     return propagables
@@ -229,7 +292,12 @@ def _bpm_is_in_beta_meas(bpm_name, meas):
 
 
 def _prepare_for_madx(segment, measurables, optics, output):
-    copyfile(optics, os.path.join(output, "modifiers.madx"))
+    # Copy and rename, the segments running at the same time can copy it
+    # concurrently:
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=output, suffix=".tmp")
+    os.close(file_descriptor)
+    copyfile(optics, tmp_path)
+    os.rename(tmp_path, os.path.join(output, "modifiers.madx"))
     meas_file_content = _prepare_meas_file(measurables)
     meas_file_path = os.path.join(
         output,
@@ -260,11 +328,42 @@ def _run_madx(segment, segment_inst, output):
     log_file_name = segment.name + "_mad.log"
     madx_file_path = os.path.join(output, mad_file_name)
     log_file_path = os.path.join(output, log_file_name)
-    creator.create_model(segment_inst, "segment", output,
-                         logfile=log_file_path, writeto=madx_file_path)
+    # MAD-X writes some files (e.g. fort.18) in its working directory, every
+    # segment gets its own so that they can run at the same time:
+    work_dir = tempfile.mkdtemp(prefix="madx_{}_".format(segment.name),
+                                dir=output)
+    try:
+        creator.create_model(segment_inst, "segment", output,
+                             logfile=log_file_path, writeto=madx_file_path,
+                             cwd=work_dir)
+    finally:
+        rmtree(work_dir, ignore_errors=True)
     LOGGER.info("MAD-X done, log file: {}".format(log_file_path))
 
 
+def _run_python_propagator(segment, propagables, model, output):
+    """Creates the segment models with sbs_propagator instead of MAD-X.
+
+    The models are written to the same files the MAD-X job would create. No
+    corrections are applied, the corrected models are the nominal ones.
+    """
+    propagator = sbs_propagator.SegmentPropagator(model, segment.start,
+                                                  segment.end)
+    init_conds = {}
+    for propagable in propagables:
+        init_conds.update(propagable.init_conds_dict())
+    seg_models = SegmentModels(output, segment)
+    seg_models.allow_write = True
+    seg_models.front = propagator.front(init_conds)
+    seg_models.back = propagator.back(init_conds)
+    seg_models.front_corrected = seg_models.front
+    seg_models.back_corrected = seg_models.back
+    seg_models.allow_write = False
+    LOGGER.info("Python propagation done for segment {}."
+                .format(segment.name))
+    return seg_models
+
+
 class Segment(object):
 
     def __init__(self, name, start, end):
@@ -1,6 +1,7 @@
 from __future__ import print_function
 import sys
 import os
+import threading
 
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -77,6 +78,8 @@ class TfsCollection(object):
     the loaded DataFrame will be buffered, thus the user should expect an
     IOError if the requested file is not in the provided directory (only the
     first time but is better to always take it into account!).
+    The files are loaded under a lock, so one instance can be shared by
+    several threads, each file is still read only once.
     When a DataFrame is assigned to one attribute it will be set as the buffer
     value. If the self.allow_write attribute is set to true, an assignment on
     one of the attributes will trigger the corresponding file write.
@@ -88,6 +91,7 @@ class TfsCollection(object):
         self.allow_write = allow_write
         self.maybe_call = _MaybeCall(self)
         self._buffer = {}
+        self._load_lock = threading.Lock()
 
     def get_filename(self, *args, **kwargs):
         """Returns the filename to be loaded or written.
@@ -145,14 +149,15 @@ class TfsCollection(object):
                              .format(self.__class__.__name__, attr))
 
     def _load_tfs(self, filename):
-        try:
-            return self._buffer[filename]
-        except KeyError:
-            tfs_data = self.read_tfs(filename)
-            if "NAME" in tfs_data:
-                tfs_data = tfs_data.set_index("NAME", drop=False)
-            self._buffer[filename] = tfs_data
-            return self._buffer[filename]
+        with self._load_lock:
+            try:
+                return self._buffer[filename]
+            except KeyError:
+                tfs_data = self.read_tfs(filename)
+                if "NAME" in tfs_data:
+                    tfs_data = tfs_data.set_index("NAME", drop=False)
+                self._buffer[filename] = tfs_data
+                return self._buffer[filename]
 
     def _write_tfs(self, filename, data_frame):
         if self.allow_write:
@@ -0,0 +1,12 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def _session_tfs_cache_dir(tmpdir_factory):
+    return str(tmpdir_factory.mktemp("tfs_cache"))
+
+
+@pytest.fixture(autouse=True)
+def _tfs_cache_in_tmpdir(_session_tfs_cache_dir, monkeypatch):
+    """ Keeps the TFS cache of the tests out of the cache of the user. """
+    monkeypatch.setenv("BETA_BEAT_TFS_CACHE", _session_tfs_cache_dir)
@@ -0,0 +1,57 @@
+"""
+Minimal stand-in for the MADX executable, to test the MADX wrappers without
+MADX. It reads statements from stdin and understands:
+
+    name = expression;      with the defined names as variables
+    value, name;            prints "name = value"
+    twiss, file="path";     writes "name value" lines of all the variables
+    call, file="path";      prints "call path"
+    system, "command";      runs the shell command
+    crash;                  exits with code 3
+    exit; / stop; / quit;
+"""
+import re
+import os
+import sys
+
+
+def main():
+    variables = {}
+    statement = ""
+    for line in iter(sys.stdin.readline, ""):
+        line = line.split("!")[0]
+        statement += line
+        while ";" in statement:
+            current, statement = statement.split(";", 1)
+            _run_statement(current.strip(), variables)
+            sys.stdout.flush()
+
+
+def _run_statement(statement, variables):
+    command = statement.split(",")[0].strip().lower()
+    argument = statement.split(",", 1)[1].strip() if "," in statement else ""
+    if command in ("exit", "stop", "quit"):
+        sys.exit(0)
+    elif command == "crash":
+        sys.exit(3)
+    elif command == "system":
+        os.system(argument.strip("\"'"))
+    elif command == "call":
+        print("call " + _get_file(argument))
+    elif command == "value":
+        print("{} = {!r}".format(argument, variables[argument]))
+    elif command == "twiss":
+        with open(_get_file(argument), "w") as twiss_file:
+            for name in sorted(variables):
+                twiss_file.write("{} {!r}\n".format(name, variables[name]))
+    elif "=" in statement and "," not in statement:
+        name, expression = statement.split("=", 1)
+        variables[name.strip()] = float(eval(expression, {}, dict(variables)))
+
+
+def _get_file(argument):
+    return re.search(r"file\s*=\s*[\"']([^\"']*)[\"']", argument).group(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+
+from GetLLM.algorithms import phase, beta  # As in GetLLM, phase is imported before beta
+
+
+def test_list_of_Ks():
+    errorfile = _ErrorFile(20, bpm_indices=(2, 7, 11, 16))
+    commonbpms = [(float(i), "BPM{}".format(i)) for i in (2, 7, 11, 16)]
+    list_of_Ks = beta._get_list_of_Ks(errorfile, commonbpms, 3)
+    assert len(list_of_Ks) == 4 + 3 + 1
+    for n, ks in enumerate(list_of_Ks):
+        index_n = errorfile.indx[commonbpms[n % 4][1]]
+        index_nplus1 = errorfile.indx[commonbpms[(n + 1) % 4][1]]
+        if index_n < index_nplus1:
+            between = range(index_n + 1, index_nplus1)
+        else:  # Around the ring
+            between = range(index_n + 1, 20) + range(index_nplus1)
+        for errors, k in zip((errorfile.dK1, errorfile.dX, errorfile.dS), ks):
+            assert list(k) == [i for i in between if errors[i] != 0]
+
+
+def test_T_matrices_of_combinations():
+    errorfile = _ErrorFile(20, bpm_indices=(2, 7, 11, 16))
+    errorfile.BET = errorfile.BETEND = np.linspace(10., 20., 20)
+    errorfile.MU = errorfile.MUEND = np.linspace(0., 1., 20)
+    errorfile.K2L = errorfile.K1LEND = np.full(20, 0.1)
+    mad_twiss = _ErrorFile(20, bpm_indices=(2, 7, 11, 16))
+    mad_twiss.MUX = errorfile.MU
+    commonbpms = [(float(i), "BPM{}".format(i)) for i in (2, 7, 11, 16)]
+    list_of_Ks = beta._get_list_of_Ks(errorfile, commonbpms, 3)
+    bpm_name = ["BPM2", "BPM7", "BPM11"]
+    t_row = beta._TRow((0, 1, 2), (1., 2., 3.), (4., 5., 6.), 0.5)
+    t_row.error_terms = (((0, 1, 1, -1., 0.25, .5, .5), (0, 2, 2, 1., 0.5, .5, .5)),
+                         ((0, 1, 1, 1., 0.25, -.5, .5), (0, 2, 2, -1., 0.5, -.5, .5)),
+                         ((0, 1, 1, -1., 0.25, .5, .5), (0, 2, 2, 1., 0.5, .5, .5)))
+    t_row.bpm_errors = {1: 7.}
+    size = 3 + sum(len(list_of_Ks[k][kind]) for k in range(3) for kind in range(3)) + 3
+    T_Alfa, T_Beta = beta._build_T_matrices([t_row, t_row], bpm_name, mad_twiss, errorfile, "H",
+                                            list_of_Ks, 0, size, 3)
+    assert T_Beta.shape == T_Alfa.shape == (2, size)
+    assert list(T_Beta[0, :3]) == [1., 2., 3.] and list(T_Alfa[0, :3]) == [4., 5., 6.]
+    assert T_Beta[1, -2] == 7.
+    # First quad error, between BPM2 and BPM7: in both terms of the combination
+    quad = list_of_Ks[0][0][0]
+    sin_2 = np.sin((errorfile.MU[quad] - mad_twiss.MUX[7]) * beta.TWOPI) ** 2
+    sin_3 = np.sin((errorfile.MU[quad] - mad_twiss.MUX[11]) * beta.TWOPI) ** 2
+    expected = errorfile.BET[quad] * (-sin_2 / 0.25 + sin_3 / 0.5)
+    assert np.isclose(T_Beta[0, 3], expected)
+    # The quad errors after BPM11 are outside of the combination
+    assert np.all(T_Beta[:, 3 + len(list_of_Ks[0][0]) + len(list_of_Ks[1][0]):][:, :len(list_of_Ks[2][0])] == 0)
+
+
+class _ErrorFile(object):
+    def __init__(self, length, bpm_indices):
+        self.NAME = ["ELEMENT{}".format(i) for i in range(length)]
+        for index in bpm_indices:
+            self.NAME[index] = "BPM{}".format(index)
+        self.indx = {name: i for i, name in enumerate(self.NAME)}
+        self.dK1 = np.where(np.arange(length) % 2 == 0, 1e-3, 0.)
+        self.dX = np.where(np.arange(length) % 3 == 0, 1e-4, 0.)
+        self.dS = np.where(np.arange(length) % 5 == 1, 1e-3, 0.)
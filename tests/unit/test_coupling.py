@@ -0,0 +1,73 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+
+from GetLLM.algorithms import helper, coupling
+
+
+def test_complex_secondary_line_as_helper():
+    rng = np.random.RandomState(0)
+    delta, amp1, amp2, phase1, phase2, std1, std2 = rng.rand(7, 20)
+    size, phi = coupling._complex_secondary_line(delta, amp1, amp2, phase1, phase2)
+    std = coupling._complex_secondary_line_std(delta, amp1, amp2, phase1, phase2, std1, std2)
+    for i in range(20):
+        expected = helper.ComplexSecondaryLine(delta[i], amp1[i], amp2[i], phase1[i], phase2[i])
+        assert np.allclose([size[i], phi[i]], expected, rtol=1e-12)
+        assert np.isclose(std[i], helper.ComplexSecondaryLineSTD(
+            delta[i], amp1[i], amp2[i], phase1[i], phase2[i], std1[i], std2[i]), rtol=1e-12)
+
+
+def test_get_coupling2_beam_directions():
+    model, files_x, files_y, phase_x, phase_y = _measurement(n_bpms=40, n_files=3)
+    fwqw, bpms = coupling.GetCoupling2(model, files_x, files_y, 0.28, 0.31, phase_x, phase_y,
+                                       1, "LHCB1", "")
+    assert 0 < len(bpms) < 40  # Random phases, most BPMs are bad
+    # Without the wrong phase check
+    fwqw, bpms = coupling.GetCoupling2(model, files_x, files_y, 0.28, 0.31, phase_x, phase_y,
+                                       1, "SPS", "")
+    fwqw_b2, bpms_b2 = coupling.GetCoupling2(model, files_x, files_y, 0.28, 0.31, phase_x, phase_y,
+                                             -1, "SPS", "")
+    assert [name for _, name in bpms] == [name for _, name in bpms_b2] == model.NAME[:-1]
+    for _, name in bpms:
+        # The sum and difference terms swap places
+        assert np.isclose(abs(fwqw[name][0][2]), abs(fwqw_b2[name][0][0]), rtol=1e-14)
+        assert fwqw[name][0][3] == fwqw_b2[name][0][1]
+    coupleterms, _, _, _ = coupling.getCandGammaQmin(fwqw, bpms, 0.28, 0.31, model)
+    for _, name in bpms:
+        f1001, f1010 = fwqw[name][0][0], fwqw[name][0][2]
+        det_c = 1 - 1 / (1 + 4 * (abs(f1001) ** 2 - abs(f1010) ** 2))
+        assert np.isclose(coupleterms[name][0], det_c)
+        assert np.isclose(coupleterms[name][4], -(f1001.imag - f1010.imag) * 2 * coupleterms[name][2])
+
+
+def _measurement(n_bpms, n_files):
+    rng = np.random.RandomState(1)
+    names = ["BPM{}".format(i) for i in range(n_bpms)]
+    model = _Twiss(names)
+    model.MUX = np.cumsum(rng.uniform(0.05, 0.3, n_bpms))
+    model.MUY = 0.95 * model.MUX
+    model.Q1, model.Q2 = 64.28, 59.31
+    files_x, files_y = [], []
+    for _ in range(n_files):
+        twiss_x, twiss_y = _Twiss(names), _Twiss(names)
+        twiss_x.AMPX, twiss_y.AMPY = rng.uniform(0.5, 1., (2, n_bpms))
+        twiss_x.AMP01, twiss_y.AMP10 = rng.uniform(0.01, 0.05, (2, n_bpms))
+        twiss_x.PHASE01, twiss_y.PHASE10 = rng.rand(2, n_bpms)
+        twiss_x.MUX, twiss_y.MUY = model.MUX, model.MUY
+        twiss_x.NOISE, twiss_y.NOISE = rng.uniform(1e-4, 1e-3, (2, n_bpms))
+        files_x.append(twiss_x)
+        files_y.append(twiss_y)
+    phase_x = {name: [rng.uniform(0.1, 0.4)] for name in names}
+    phase_y = {name: [rng.uniform(0.1, 0.4)] for name in names}
+    return model, files_x, files_y, phase_x, phase_y
+
+
+class _Twiss(object):
+    def __init__(self, names):
+        self.NAME = names
+        self.S = np.arange(len(names)) * 10.
+        self.indx = {name: i for i, name in enumerate(names)}
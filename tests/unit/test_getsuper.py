@@ -0,0 +1,59 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+
+from GetLLM import getsuper
+from model.accelerators import lhc
+
+
+def test_linreg_columns_as_linreg():
+    rng = np.random.RandomState(0)
+    dpps = [0., -1e-3, 1e-3, 2e-3]
+    values = rng.rand(4, 20)
+    values[:, 3] = 2.  # constant
+    fits = getsuper.linreg_columns(dpps, values)
+    for bpm in range(values.shape[1]):
+        expected = getsuper.linreg(dpps, list(values[:, bpm]))
+        assert np.allclose([fit[bpm] for fit in fits], expected, rtol=1e-10, atol=1e-14)
+    assert fits[2][3] == 1.
+
+
+def test_linreg_columns_two_points():
+    fits = getsuper.linreg_columns([0., 1.], np.array([[1., 2.], [3., 2.]]))
+    assert np.allclose(fits[0], [2., 0.]) and np.allclose(fits[1], [1., 2.])
+    assert np.all(fits[3] == 0.)
+
+
+def test_analyse_dpps_in_parallel_with_lhc(tmpdir, monkeypatch):
+    accel_cls = lhc.Lhc.get_class(lhc_mode="lhc_runII_2017", beam=1)
+    optics = tmpdir.join("modifiers.madx")
+    optics.write("")
+    accel_inst = accel_cls(nat_tune_x=0.31, nat_tune_y=0.32, optics=str(optics))
+    accel_inst.model_dir = str(tmpdir)
+    analysed = []
+
+    def fake_create_models(accel, dpps, log_suffix=""):
+        assert accel is accel_inst
+        analysed.extend(dpps)
+
+    def fake_rungetllm(twiss_filename, files, dpp, output_path, accel, algorithm, nprocesses=None):
+        assert accel is accel_inst and nprocesses == 0
+
+    monkeypatch.setattr(getsuper.creator, "CREATORS", {"lhc": {"nominal": _FakeCreator}})
+    monkeypatch.setattr(getsuper, "_create_models_by_madx", fake_create_models)
+    monkeypatch.setattr(getsuper, "_rungetllm", fake_rungetllm)
+    files_dict = {0.: ["file0"], 1e-3: ["file1"], -1e-3: ["file2"]}
+    results = getsuper._analyse_dpps(accel_inst, files_dict, str(tmpdir), "SUSSIX", 2)
+    assert sorted(results) == sorted(files_dict)
+    assert sorted(analysed) == sorted(files_dict)
+
+
+class _FakeCreator(object):
+    @staticmethod
+    def prepare_run(accel_inst, output_path):
+        pass
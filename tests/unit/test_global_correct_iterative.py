@@ -0,0 +1,92 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+
+import global_correct_iterative as gci
+from utils.dict_tools import DotDict
+
+OPT = DotDict(svd_cut=0.01, tikhonov=0.01, n_correctors=3)
+
+
+def test_pinv_reuses_svd():
+    response, diff = _problem()
+    cache = {}
+    gci._check_cache(cache, response)
+    delta = gci._pseudo_inverse(response, diff, OPT, cache)
+    assert np.allclose(delta, np.dot(np.linalg.pinv(response, OPT.svd_cut), diff))
+    svd = cache["svd"]
+    gci._check_cache(cache, response.copy())
+    gci._tikhonov(response, diff, OPT, cache)
+    assert cache["svd"] is svd
+    gci._check_cache(cache, 2 * response)
+    assert "svd" not in cache
+
+
+def test_tikhonov_and_iterative_solvers():
+    response, diff = _problem()
+    reg = OPT.tikhonov * np.linalg.norm(response, 2)
+    expected = np.linalg.solve(np.dot(response.T, response) + reg ** 2 * np.eye(response.shape[1]),
+                               np.dot(response.T, diff))
+    assert np.allclose(gci._tikhonov(response, diff, OPT, {}), expected)
+    least_squares = np.linalg.lstsq(response, diff, rcond=-1)[0]
+    sparse_response = np.where(np.abs(response) > 1., response, 0.)
+    for solver in (gci._lsqr, gci._lsmr):
+        assert np.allclose(solver(response, diff, OPT, {}), least_squares, atol=1e-4)
+        sparse_delta = solver(sparse_response, diff, OPT, {})
+        assert np.allclose(sparse_delta,
+                           np.linalg.lstsq(sparse_response, diff, rcond=-1)[0], atol=1e-4)
+
+
+def test_micado_selects_the_used_variables():
+    response, _ = _problem()
+    true_delta = np.zeros(response.shape[1])
+    true_delta[[2, 7, 11]] = [1., -2., .5]
+    delta = gci._micado(response, np.dot(response, true_delta), OPT, {})
+    assert np.allclose(delta, true_delta)
+
+
+def test_calculate_delta_with_weights():
+    response, diff = _problem()
+    variables = ["kq{}".format(i) for i in range(response.shape[1])]
+    meas = {"MUX": pd.DataFrame({"WEIGHT": np.ones(len(diff)), "DIFF": diff})}
+    delta = gci._calculate_delta(response, meas, ["MUX"], variables, "pinv", OPT)
+    assert np.allclose(delta["DELTA"], gci._pseudo_inverse(response, diff, OPT, {}))
+
+
+def test_join_responses():
+    elements = ["BPM{}".format(i) for i in range(6)]
+    variables = ["kq1", "kq2", "kq3"]
+    response = {
+        "MUX": pd.DataFrame(np.arange(12.).reshape(6, 2), index=elements, columns=["kq2", "kq1"]),
+        "BBX": pd.DataFrame(np.arange(18.).reshape(6, 3), index=elements, columns=variables),
+        "Q": pd.DataFrame([[1., 2., 3.], [4., 5., 6.]], index=["Q1", "Q2"], columns=variables),
+    }
+    response["BBX"].iloc[4, 0] = np.nan
+    meas = {
+        "MUX": pd.DataFrame({"NAME2": ["BPM3", "BPM5"]}, index=["BPM1", "BPM2"]),
+        "BBX": pd.DataFrame(index=["BPM4", "BPM0"]),
+        "Q": pd.DataFrame(index=["Q1", "Q2"]),
+    }
+    keys = ["MUX", "BBX", "Q"]
+    resp_index = gci._get_response_index(response, meas, keys, variables)
+    joined = gci._join_responses(response, keys, resp_index)
+    assert joined.flags["C_CONTIGUOUS"]
+    assert np.array_equal(joined, [[4., 4., 0.],  # phase advance BPM1 -> BPM3
+                                   [6., 6., 0.],  # BPM2 -> BPM5
+                                   [0., 13., 14.],
+                                   [0., 1., 2.],
+                                   [1., 2., 3.],
+                                   [4., 5., 6.]])
+    assert sorted(gci._get_measured_elements(meas, keys)) == ["BPM0", "BPM1", "BPM2",
+                                                              "BPM3", "BPM4", "BPM5"]
+
+
+def _problem():
+    rng = np.random.RandomState(0)
+    return rng.randn(60, 15), rng.randn(60)
@@ -9,6 +9,7 @@ sys.path.append(os.path.abspath(
     os.path.join(os.path.dirname(__file__), "..", "..")
 ))
 from hole_in_one import harpy
+from utils.shared_pool import SharedArrayPool
 
 
 @given(integers(min_value=1, max_value=200),
@@ -82,6 +83,49 @@ def test_harmonic_analysis_raises_on_svd_with_none_usv():
         harpy.harmonic_analysis(None, usv=None, mode="svd")
 
 
+def test_harmonic_analysis_raises_on_batch_with_none_matrix():
+    with pytest.raises(ValueError):
+        harpy.harmonic_analysis(None, usv=None, mode="batch")
+
+
+def test_batch_laskar_matches_per_bpm_laskar():
+    n_turns = 256
+    turns = np.arange(n_turns)
+    bpm_matrix = _get_fake_df(4, n_turns).astype(np.complex128)
+    for i, bpm_name in enumerate(bpm_matrix.index):
+        bpm_matrix.loc[bpm_name, :] = (
+            (i + 1) * np.exp(harpy.PI2I * (0.28 * turns + i)) +
+            0.1 * np.exp(harpy.PI2I * 0.31 * turns)
+        )
+    freqs, coefs = harpy.harmonic_analysis_batch(bpm_matrix, num_harms=5,
+                                                 batch_rows=3)
+    for bpm_name in bpm_matrix.index:
+        single_freqs, single_coefs = harpy._laskar_method(
+            bpm_matrix.loc[bpm_name, :].values, 5
+        )
+        assert np.allclose(freqs.loc[bpm_name].values, single_freqs)
+        assert np.allclose(coefs.loc[bpm_name].values, single_coefs)
+
+
+def test_shared_pool_laskar_matches_sequential_laskar():
+    n_turns = 128
+    turns = np.arange(n_turns)
+    bpm_matrix = _get_fake_df(5, n_turns)
+    for i, bpm_name in enumerate(bpm_matrix.index):
+        bpm_matrix.loc[bpm_name, :] = (i + 1) * np.cos(2 * np.pi * 0.27 * turns + i)
+    seq_freqs, seq_coefs = harpy.harmonic_analysis_bpm(
+        bpm_matrix, sequential=True, num_harms=4
+    )
+    with SharedArrayPool(processes=2) as pool:
+        for _ in range(2):  # The same pool is reused between calls
+            freqs, coefs = harpy.harmonic_analysis_bpm(
+                bpm_matrix, num_harms=4, pool=pool
+            )
+            assert (freqs.index == bpm_matrix.index).all()
+            assert np.allclose(freqs.values, seq_freqs.values)
+            assert np.allclose(coefs.values, seq_coefs.values)
+
+
 def _get_fake_df(n_bpms, n_samples):
     index = ["BPM{}".format(i) for i in range(n_bpms)]
     df = pd.DataFrame(index=index, data=np.zeros((n_bpms, n_samples)))
@@ -0,0 +1,43 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "kmod", "kmod_orbit"))
+)
+
+import kmod_orbit
+from utils import tfs_pandas
+
+
+def test_quad_matrices():
+    matrices = kmod_orbit._get_quad_matrices(np.array([0.0087, -0.0087, 0.]), 6.37)
+    assert matrices.shape == (3, 2, 2)
+    assert np.allclose(np.linalg.det(matrices), 1.)
+    assert np.allclose(matrices[2], [[1., 6.37], [0., 1.]])
+    # Focusing and defocusing half quads make the full quad
+    half = kmod_orbit._get_quad_matrices(np.array([0.0087, -0.0087]), 6.37 / 2)
+    assert np.allclose(np.matmul(half, half), matrices[:2])
+
+
+def test_thick_transfer_matrix_thin_limit():
+    names = ["ELEMENT{}".format(i) for i in range(20)]
+    names[10] = "MQXA.1L1"
+    model = tfs_pandas.TfsDataFrame({
+        "S": np.arange(20.), "MUX": np.linspace(0., 64.3, 20),
+        "BETX": np.linspace(30., 2000., 20), "ALFX": np.linspace(-40., 40., 20),
+    }, index=names)
+    model.headers = {"Q1": 64.31}
+    length = 1e-4
+    model.loc["MQXA.1L1", "S"] = model.loc["ELEMENT9", "S"] + length
+    ks = (0.0087 + 2e-5 * np.sin(np.arange(40) / 3.)) * 6.37 / length
+    thin = kmod_orbit._compute_transfer_matrix(
+        model, model, "MQXA.1L1", kmod_orbit._compute_kl(ks, model, "MQXA.1L1", kmod_orbit.HOR),
+        kmod_orbit.HOR, kmod_orbit.BEAM1)
+    thick = kmod_orbit._compute_thick_transfer_matrix(
+        model, model, "MQXA.1L1", ks, kmod_orbit.HOR, kmod_orbit.BEAM1)
+    assert thick.shape == (40, 20)
+    assert np.abs(thin - thick).max() < 1e-5 * np.abs(thin).max()
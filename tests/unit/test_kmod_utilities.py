@@ -0,0 +1,29 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "kmod", "gui2beta"))
+)
+
+import KModUtilities
+
+
+def test_solve_cases_as_simplex():
+    L_star, l, k, dk, Q = 22.965, 6.37, 0.0087, 8.7e-6, 0.31
+    beta_star = np.array([0.25, 0.4, 2., 10.])
+    waist = np.array([0.05, -0.2, 0.3, 0.])
+    K = np.sqrt(k)
+    beta_av_foc = KModUtilities.func_beta_foc_av(beta_star, L_star, waist, K * l, K)
+    beta_av_def = KModUtilities.func_beta_def_av(beta_star, L_star, -waist, K * l, K)
+    # First order inversion of beta_from_Tune is good enough, the simplex gets the same input
+    dq_foc = beta_av_foc * l * dk / (4 * np.pi)
+    dq_def = -beta_av_def * l * dk / (4 * np.pi)
+    guess = [0.5, 0.]
+    b, w, bavf, bavd = KModUtilities.solve_cases(Q, dq_foc, dq_def, l, l, k, -k, dk, dk,
+                                                 L_star, L_star, guess)
+    for i in range(len(beta_star)):
+        expected = KModUtilities.simplex(Q, dq_foc[i], dq_def[i], l, l, k, -k, dk, dk,
+                                         L_star, L_star, guess)
+        assert np.allclose([b[i], w[i]], expected[:2], rtol=1e-6, atol=1e-6)
+        assert np.allclose([bavf[i], bavd[i]], expected[2:], rtol=1e-12)
@@ -0,0 +1,64 @@
+import os
+import sys
+import threading
+import pytest
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+
+import madx_wrapper
+
+MOCK_MADX = [sys.executable, os.path.join(os.path.dirname(__file__), "mock_madx.py")]
+
+
+def test_pool_runs_setup_once_per_process(tmpdir):
+    log_file = str(tmpdir.join("madx.log"))
+    with madx_wrapper.MadxPool("call, file='sequence.madx';\nknob = 1;\n", processes=2,
+                               log_file=log_file, madx_path=MOCK_MADX, max_results=1) as pool:
+        for i in range(10):
+            twiss_path = str(tmpdir.join("twiss.{}".format(i)))
+            pool.submit(i, "knob = knob + {0}; twiss, file='{1}'; knob = knob - {0};".format(i, twiss_path))
+        results = dict(pool.results(10))
+    assert results == {i: 0 for i in range(10)}
+    for i in range(10):
+        assert tmpdir.join("twiss.{}".format(i)).read() == "knob {!r}\n".format(1. + i)
+    with open(log_file) as log:
+        assert log.read().count("call sequence.madx") == 2
+
+
+def test_pool_restarts_crashed_process(tmpdir):
+    with madx_wrapper.MadxPool("knob = 1;", reset_script="knob = 1;",
+                               madx_path=MOCK_MADX) as pool:
+        pool.submit("crash", "knob = 5; crash;")
+        pool.submit("twiss", "twiss, file='{}';".format(tmpdir.join("twiss")))
+        results = dict(pool.results(2))
+    assert results == {"crash": 3, "twiss": 0}
+    assert tmpdir.join("twiss").read() == "knob 1.0\n"
+
+
+def test_pool_setup_failure():
+    with madx_wrapper.MadxPool("crash;", madx_path=MOCK_MADX) as pool:
+        pool.submit(0, "knob = 1;")
+        with pytest.raises(IOError):
+            list(pool.results(1))
+
+
+def test_pool_setup_failure_with_more_jobs_than_results():
+    pool = madx_wrapper.MadxPool("crash;", processes=2, madx_path=MOCK_MADX, max_results=2)
+    for i in range(10):
+        pool.submit(i, "knob = 1;")
+    with pytest.raises(IOError):
+        list(pool.results(10))
+    closer = threading.Thread(target=pool.close)
+    closer.daemon = True
+    closer.start()
+    closer.join(10)
+    assert not closer.is_alive()
+
+
+def test_run_in_working_directory(tmpdir):
+    work_dir = tmpdir.mkdir("work")
+    madx_wrapper.resolve_and_run_string('system, "pwd > where";', madx_path=MOCK_MADX,
+                                        cwd=str(work_dir))
+    assert os.path.realpath(work_dir.join("where").read().strip()) == os.path.realpath(str(work_dir))
@@ -0,0 +1,54 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+
+from GetLLM.algorithms import phase
+
+
+def test_phase_mean_and_std_along_last_axis():
+    phases = np.random.rand(5, 4, 3)
+    phases[0, 0] = [0.98, 0.01, 0.03]  # Around the 0 / 1 discontinuity
+    means = phase.calc_phase_mean(phases, 1.)
+    stds = phase.calc_phase_std(phases, 1.)
+    assert means.shape == stds.shape == (5, 4)
+    for i in range(5):
+        for j in range(4):
+            assert means[i, j] == phase.calc_phase_mean(list(phases[i, j]), 1.)
+            assert stds[i, j] == phase.calc_phase_std(list(phases[i, j]), 1.)
+    assert abs(means[0, 0] - (0.98 + 1.01 + 1.03) / 3 % 1) < 1e-12
+
+
+def test_get_phases_pairs():
+    names = ["BPM{}".format(i) for i in range(15)]
+    model_phases = np.cumsum(np.full(15, 0.08))
+    model = _Twiss(names, model_phases)
+    model.Q1, model.Q2 = 64.5, 59.5
+    files = [_Twiss(names, model_phases + 0.001 * i) for i in range(3)]
+    phases, tune, _, commonbpms = phase.get_phases(_GetllmData(), model, files, None, "H")
+    assert np.isclose(tune, 0.28)
+    assert len(commonbpms) == 15
+    assert np.allclose(phases["HBPM0BPM3"], [0.24, 0., 0.24])
+    # The pairs of the last BPMs wrap around the ring, adding the tune
+    assert np.isclose(phases["HBPM14BPM1"][0], ((0.16 - 1.2) % 1 + 0.28) % 1)
+    assert np.isclose(phases["HBPM14BPM1"][2], ((0.16 - 1.2) % 1 + 0.5) % 1)
+    assert phases["BPM0"][6:8] == ["BPM1", "BPM3"]
+
+
+class _Twiss(object):
+    def __init__(self, names, phases):
+        self.NAME = names
+        self.S = np.arange(len(names), dtype=float)
+        self.MUX = self.MUY = phases
+        self.TUNEX = self.TUNEY = np.full(len(names), 0.28)
+        self.indx = {name: i for i, name in enumerate(names)}
+
+
+class _GetllmData(object):
+    accel = "LHCB1"
+    lhc_phase = "0"
+    beam_direction = 1
+    important_pairs = {}
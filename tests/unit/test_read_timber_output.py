@@ -0,0 +1,45 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "kmod", "gui2beta"))
+)
+
+import read_Timber_output
+
+
+def test_pair_as_loop():
+    tune_x, tune_y, k_data = _modulation()
+    K, Qx, Qxrms, Qy, Qyrms = read_Timber_output.pair(tune_x, tune_y, k_data, 2.5e-5)
+    expected = [[] for _ in range(5)]
+    for time, k in zip(k_data.TIME, k_data.K):
+        if not tune_x.TIME[0] < time < tune_x.TIME[-1]:
+            continue
+        in_x = tune_x.TUNE[(tune_x.TIME - time) ** 2 < read_Timber_output.TIME_WINDOW ** 2]
+        in_y = tune_y.TUNE[(tune_y.TIME - time) ** 2 < read_Timber_output.TIME_WINDOW ** 2]
+        for values, value in zip(expected, (k, np.average(in_x), np.std(in_x), np.average(in_y), np.std(in_y))):
+            values.append(value)
+    assert np.allclose(K, expected[0], rtol=0, atol=0)
+    assert np.allclose(Qx, expected[1], rtol=1e-14) and np.allclose(Qy, expected[3], rtol=1e-14)
+    assert np.allclose(Qxrms, np.sqrt(np.array(expected[2]) ** 2 + 2.5e-5 ** 2), rtol=1e-10)
+    assert np.allclose(Qyrms, np.sqrt(np.array(expected[4]) ** 2 + 2.5e-5 ** 2), rtol=1e-10)
+
+
+def _modulation():
+    rng = np.random.RandomState(1)
+    tune_x, tune_y, k_data = _Data(), _Data(), _Data()
+    tune_x.TIME = np.arange(0., 1000., 0.1)
+    tune_x.TUNE = 0.31 + 1e-4 * np.sin(tune_x.TIME / 60.) + 1e-5 * rng.randn(len(tune_x.TIME))
+    tune_y.TIME = tune_x.TIME + 0.05
+    tune_y.TUNE = 0.32 + 1e-5 * rng.randn(len(tune_y.TIME))
+    k_data.TIME = np.arange(-50., 1050., 1.)
+    k_data.K = 0.0087 + 1e-5 * np.sin(k_data.TIME / 60.)
+    return tune_x, tune_y, k_data
+
+
+class _Data(object):
+    pass
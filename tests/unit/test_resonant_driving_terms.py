@@ -0,0 +1,40 @@
+import sys
+import os
+import numpy as np
+from scipy.optimize import curve_fit
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+
+from GetLLM.algorithms import helper, resonant_driving_terms
+
+
+def test_fitting_all_bpms_as_curve_fit():
+    kick_x = np.array([[1.1, 0.1], [1.6, 0.1], [2.2, 0.1], [2.9, 0.1]])
+    kick_y = np.array([[0.9, 0.1], [1.4, 0.1], [2.1, 0.1], [2.5, 0.1]])
+    for rdt in ("f3000H", "f1012V"):
+        _, plane = resonant_driving_terms.determine_lines(rdt)
+        func = resonant_driving_terms.rdt_function_gen(rdt, plane)
+        kick_data = np.vstack((kick_x[:, 0]**2, kick_y[:, 0]**2))
+        amplitudes = np.outer(np.linspace(0.01, 0.1, 6), func(kick_data, 1.)) + np.random.normal(0., 1e-3, (6, 4))
+        res, res_err = resonant_driving_terms.do_fitting(amplitudes, kick_x, kick_y, rdt, plane)
+        assert res.shape == res_err.shape == (6, 1)
+        for i in range(6):
+            popt, pcov = curve_fit(func, kick_data, amplitudes[i])
+            assert np.allclose(res[i], popt, rtol=1e-6)
+            assert np.allclose(res_err[i], np.sqrt(np.diag(pcov)), rtol=1e-6)
+            single_res, single_res_err = resonant_driving_terms.do_fitting(amplitudes[i], kick_x, kick_y, rdt, plane)
+            assert single_res.shape == (1,) and single_res == res[i] and single_res_err == res_err[i]
+
+
+def test_complex_secondary_line_of_arrays():
+    delta, edelta = np.random.uniform(0.05, 0.45, 5), np.random.uniform(0., 1e-3, 5)
+    amps1, amps2 = np.random.rand(3, 5), np.random.rand(3, 5)
+    phases1, phases2 = np.random.rand(3, 5), np.random.rand(3, 5)
+    results = helper.ComplexSecondaryLineExtended(delta, edelta, amps1, amps2, phases1, phases2)
+    for i in range(3):
+        for j in range(5):
+            expected = helper.ComplexSecondaryLineExtended(delta[j], edelta[j], amps1[i, j], amps2[i, j],
+                                                           phases1[i, j], phases2[i, j])
+            assert [result[i, j] for result in results] == expected
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+
+from correction.fullresponse import response_madx
+from utils import tfs_pandas as tfs
+
+CURRENT_DIR = os.path.dirname(__file__)
+COLUMNS = ["S", "BETX", "ALFX", "BETY", "ALFY", "DX", "DY", "DPX", "DPY", "X", "Y", "K1L",
+           "MUX", "MUY", "R11", "R12", "R21", "R22"]
+
+
+def test_fullresponse_finite_differences():
+    model = tfs.read_tfs(os.path.join(CURRENT_DIR, "..", "inputs", "models",
+                                      "flat_beam1", "twiss.dat"), index="NAME")
+    model = model.loc[model.index.str.startswith("BPM"), COLUMNS]
+    incr = 2e-5
+    var_to_twiss = {}
+    for i, var in enumerate(("0", "kq2", "kq1")):
+        twiss = model.copy()
+        twiss["BETX"] = model["BETX"] * (1 + i * incr)
+        twiss["MUY"] = model["MUY"] + i * incr * np.arange(len(model))
+        twiss["DX"] = model["DX"] + i * incr
+        twiss["Q1"], twiss["Q2"] = 64.28 + i * incr, 59.31 - i * incr
+        twiss["incr"] = 0. if var == "0" else incr
+        var_to_twiss[var] = twiss
+
+    response = response_madx._create_fullresponse_from_dict(var_to_twiss)
+    assert set(response) == set(response_madx.RESPONSE_KEYS)
+    for key in response_madx.RESPONSE_KEYS:
+        assert list(response[key].columns) == ["kq1", "kq2"]
+        assert response[key].values.dtype == np.float64
+    assert list(response["BETX"].index) == list(model.index)
+    assert np.allclose(response["BBX"]["kq1"], 2.)
+    assert np.allclose(response["BETX"]["kq2"], model["BETX"])
+    assert np.allclose(response["MUY"]["kq1"], 2 * np.arange(len(model)))
+    assert np.allclose(response["DX"]["kq2"], 1.)
+    ndx = (var_to_twiss["kq2"]["DX"] / np.sqrt(var_to_twiss["kq2"]["BETX"])
+           - model["DX"] / np.sqrt(model["BETX"])) / incr
+    assert np.allclose(response["NDX"]["kq2"], ndx)
+    assert np.allclose(response["BETY"], 0.) and np.allclose(response["F1001R"], 0.)
+    assert np.allclose(response["Q"].loc["Q1"], [2., 1.])
+    assert np.allclose(response["Q"].loc["Q2"], [-2., -1.])
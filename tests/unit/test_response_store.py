@@ -0,0 +1,76 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+
+from correction.fullresponse import response_store
+
+ELEMENTS = ["BPM{}".format(i) for i in range(5)]
+
+
+def test_store_computes_only_missing_variables(tmpdir):
+    computed = []
+
+    def compute_response(variables):
+        computed.append(list(variables))
+        return _response(variables)
+
+    store_dir = str(tmpdir)
+    first = response_store.get_response(store_dir, "model", ["kq1", "kq2"], ["BETX", "Q"],
+                                        compute_response)
+    second = response_store.get_response(store_dir, "model", ["kq2", "kq3", "kq1"],
+                                         ["BETX", "Q"], compute_response)
+    assert computed == [["kq1", "kq2"], ["kq3"]]
+    for obs in ("BETX", "Q"):
+        expected = _response(["kq2", "kq3", "kq1"])[obs]
+        pd.testing.assert_frame_equal(pd.DataFrame(second[obs]), expected)
+        assert list(first[obs].columns) == ["kq1", "kq2"]
+    response_store.get_response(store_dir, "other_model", ["kq1"], ["BETX"], compute_response)
+    assert computed[-1] == ["kq1"]
+
+
+def test_variables_without_response_are_zero(tmpdir):
+    def compute_response(variables):
+        return _response([var for var in variables if var != "kq_unused"])
+
+    response = response_store.get_response(str(tmpdir), "model", ["kq1", "kq_unused"],
+                                           ["BETX"], compute_response)
+    assert np.all(response["BETX"]["kq_unused"] == 0.)
+
+
+def test_model_key_depends_on_called_files(tmpdir):
+    optics = tmpdir.join("optics.madx")
+    optics.write("kq1 = 1;")
+    job = "call, file='{}';".format(optics)
+    model = pd.DataFrame({"BETX": [1., 2.]}, index=["BPM1", "BPM2"])
+    key = response_store.get_model_key(job, model)
+    assert response_store.get_model_key(job, model) == key
+    assert response_store.get_model_key(job, model * 2) != key
+    optics.write("kq1 = 2;")
+    assert response_store.get_model_key(job, model) != key
+
+
+def test_model_key_follows_nested_calls(tmpdir):
+    tmpdir.mkdir("optics")
+    strengths = tmpdir.join("optics", "strengths.madx")
+    strengths.write("kq1 = 1;")
+    tmpdir.join("optics", "main.madx").write(
+        "call, file='strengths.madx';\ncall, file='main.madx';")
+    job = "call, file='{}';".format(tmpdir.join("optics", "main.madx"))
+    key = response_store.get_model_key(job)
+    strengths.write("kq1 = 2;")
+    assert response_store.get_model_key(job) != key
+
+
+def _response(variables):
+    return {
+        "BETX": pd.DataFrame([[hash(var) % 100 + i for var in variables] for i in range(5)],
+                             index=ELEMENTS, columns=variables, dtype=float),
+        "Q": pd.DataFrame([[len(var), -len(var)] for var in variables],
+                          index=variables, columns=["Q1", "Q2"], dtype=float).T,
+    }
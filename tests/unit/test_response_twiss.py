@@ -0,0 +1,73 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+
+from correction.fullresponse.response_twiss import TwissResponse
+from utils import tfs_pandas as tfs
+
+CURRENT_DIR = os.path.dirname(__file__)
+MODEL_PATH = os.path.join(CURRENT_DIR, "..", "inputs", "models", "flat_beam1", "twiss.dat")
+
+
+def test_response_in_blocks_is_the_same(tmpdir):
+    model = tfs.read_tfs(MODEL_PATH, index="NAME")
+    varmap = _varmap(model.index)
+    variables = sorted(var for order in varmap for var in varmap[order])
+    full = TwissResponse(_copy(varmap), model, variables, at_elements="all")
+    blocks = TwissResponse(_copy(varmap), model, variables, at_elements="all",
+                           block_size=7, mmap_dir=str(tmpdir))
+    single = TwissResponse(_copy(varmap), model, variables, at_elements="all",
+                           single_precision=True)
+    expected = full.get_response_for()
+    in_blocks = blocks.get_response_for()
+    in_single = single.get_response_for()
+    for obs in expected:
+        assert np.allclose(in_blocks[obs].values, expected[obs].values, rtol=1e-12, atol=0)
+        assert np.allclose(in_single[obs].values, expected[obs].values, rtol=1e-5,
+                           atol=1e-5 * np.abs(expected[obs].values).max())
+    assert os.path.isfile(os.path.join(str(tmpdir), "beta_X.npy"))
+    assert blocks.get_coupling(mapped=False)["1001"].values.dtype == np.complex128
+    assert single.get_beta(mapped=False)["X"].values.dtype == np.float32
+
+
+def test_update_model():
+    model = tfs.read_tfs(MODEL_PATH, index="NAME")
+    corrected = model.copy()
+    corrected.loc[:, "BETX"] *= 1.1
+    corrected.loc[:, "MUY"] *= 1.01
+    varmap = _varmap(model.index)
+    variables = sorted(var for order in varmap for var in varmap[order])
+    at_elements = list(model.index[::3])
+    updated = TwissResponse(_copy(varmap), model, variables, at_elements=at_elements)
+    updated.get_response_for()
+    updated.update_model(corrected)
+    expected = TwissResponse(_copy(varmap), corrected, variables,
+                             at_elements=at_elements).get_response_for()
+    response = updated.get_response_for()
+    for obs in expected:
+        assert np.allclose(response[obs].values, expected[obs].values, rtol=1e-14, atol=0)
+        assert list(response[obs].index) == list(expected[obs].index)
+        assert list(response[obs].columns) == list(expected[obs].columns)
+
+
+def _varmap(elements):
+    rng = np.random.RandomState(0)
+    varmap = {}
+    for order, n_vars in (("K1L", 6), ("K1SL", 3), ("K0L", 2), ("K0SL", 2)):
+        varmap[order] = {
+            "{}_{}".format(order.lower(), i): pd.Series(
+                rng.rand(3) + .5, index=[el.lower() for el in rng.choice(elements, 3, replace=False)]
+            )
+            for i in range(n_vars)
+        }
+    return varmap
+
+
+def _copy(varmap):
+    return {order: dict(varmap[order]) for order in varmap}
@@ -0,0 +1,97 @@
+import sys
+import os
+import pytest
+import numpy as np
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+)
+
+from sdds_files import (sdds_reader, sdds_writer,
+                        turn_by_turn_writer, turn_by_turn_reader)
+
+
+CURRENT_DIR = os.path.dirname(__file__)
+
+
+def test_memmap_read_equals_normal_read(_test_file):
+    names = np.array(["BPM{}".format(i) for i in range(4)])
+    matrix = np.random.rand(2, 4, 3, 10)
+    turn_by_turn_writer.write_tbt_file(names, matrix, _test_file)
+    normal = sdds_reader.read_sdds_file(_test_file)
+    mapped = sdds_reader.read_sdds_file(_test_file, memmap=True)
+    for param_name in normal.get_parameters():
+        assert (normal.get_parameters()[param_name].value ==
+                mapped.get_parameters()[param_name].value)
+    for array_name in normal.get_arrays():
+        assert np.all(normal.get_arrays()[array_name].values ==
+                      mapped.get_arrays()[array_name].values)
+    positions = mapped.get_arrays()[turn_by_turn_reader.ALL_HOR_POSITIONS_NAME]
+    assert isinstance(positions.values, np.memmap)
+    assert np.allclose(positions.values.reshape(4, 3, 10), matrix[0])
+    assert list(mapped.get_arrays()[turn_by_turn_reader.BPM_NAMES_NAME].values) == list(names)
+
+
+@pytest.mark.parametrize("memmap", (False, True))
+def test_read_binary_columns(_test_file, memmap):
+    header = ("SDDS1\n!# little-endian\n"
+              "&column name=S, type=double, &end\n"
+              "&column name=IDX, type=long, &end\n"
+              "&data mode=binary, &end\n")
+    rows = np.array([(0.5, 1), (1.5, 2), (2.5, 3)],
+                    dtype=[("S", "<f8"), ("IDX", "<i4")])
+    with open(_test_file, "wb") as data:
+        data.write(header.encode("latin-1"))
+        data.write(np.array(len(rows), dtype="<i4").tobytes())
+        data.write(rows.tobytes())
+    columns = sdds_reader.read_sdds_file(_test_file, memmap=memmap).get_columns()
+    assert np.all(columns["S"].values == rows["S"])
+    assert np.all(columns["IDX"].values == rows["IDX"])
+
+
+@pytest.mark.parametrize("memmap", (False, True))
+def test_read_binary_u1_string(_test_file, memmap):
+    header = ("SDDS1\n!# little-endian\n"
+              "&parameter name=TITLE, type=string, modifier=u1, &end\n"
+              "&data mode=binary, &end\n")
+    title = b"T" * 200  # Longer than a signed byte
+    with open(_test_file, "wb") as data:
+        data.write(header.encode("latin-1"))
+        data.write(np.array(0, dtype="<i4").tobytes())
+        data.write(np.array(len(title), dtype="u1").tobytes())
+        data.write(title)
+    parameters = sdds_reader.read_sdds_file(_test_file, memmap=memmap).get_parameters()
+    assert parameters["TITLE"].value == title
+
+
+def test_tbt_turn_range_and_bunch_selection(_test_file):
+    names = np.array(["BPM{}".format(i) for i in range(4)])
+    matrix = np.random.rand(2, 4, 3, 20)
+    turn_by_turn_writer.write_tbt_file(names, matrix, _test_file)
+    sdds_file = sdds_reader.read_sdds_file(_test_file)
+    for bunch_id_name in (turn_by_turn_reader.HOR_BUNCH_ID_NAME,
+                          turn_by_turn_reader.VER_BUNCH_ID_NAME):
+        sdds_file.get_arrays()[bunch_id_name].values = np.array([5, 7, 9], dtype=">i")
+    sdds_writer.write_sdds_file(sdds_file, _test_file)
+
+    tbt_files = turn_by_turn_reader.read_tbt_file(
+        _test_file, start_turn=5, end_turn=15, bunch_ids=[7, 9]
+    )
+    assert [tbt_file.bunch_id for tbt_file in tbt_files] == [7, 9]
+    for tbt_file, bunch_index in zip(tbt_files, (1, 2)):
+        assert tbt_file.num_turns == 10
+        assert list(tbt_file.samples_matrix_x.columns) == list(range(10))
+        assert np.allclose(tbt_file.samples_matrix_x.values,
+                           matrix[0, :, bunch_index, 5:15])
+        assert np.allclose(tbt_file.samples_matrix_y.values,
+                           matrix[1, :, bunch_index, 5:15])
+
+
+@pytest.fixture()
+def _test_file():
+    test_file = os.path.join(CURRENT_DIR, "test_reader_file.sdds")
+    try:
+        yield test_file
+    finally:
+        if os.path.isfile(test_file):
+            os.remove(test_file)
@@ -1,14 +1,20 @@
 import sys
 import os
+import time
 import shutil
+import argparse
+import threading
 import pytest
+import numpy as np
 import pandas as pd
 
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
 )
 
-from segment_by_segment import segment_by_segment
+from utils import tfs_pandas
+from segment_by_segment import (segment_by_segment, sbs_propagator,
+                                sbs_propagables, sbs_math)
 from segment_by_segment.segment_by_segment import (
     SbsDefinitionError,
     Segment,
@@ -210,6 +216,242 @@ def test_improve_segment_for_elements():
     assert new_seg.end == "BPM4"
 
 
+# run_segments() ##############################################################
+
+def test_run_segments_streams_as_they_finish(monkeypatch):
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def fake_run_for_segment(accel_cls, segment, model, meas, optics, output,
+                             propagator="madx"):
+        with lock:
+            running.append(segment.name)
+            max_running.append(len(running))
+        time.sleep(0.3 if segment.name == "slow" else 0.05)
+        with lock:
+            running.remove(segment.name)
+        return [segment.name]
+
+    monkeypatch.setattr(segment_by_segment, "run_for_segment",
+                        fake_run_for_segment)
+    segments = [Segment(name, "", "")
+                for name in ("slow", "fast1", "fast2", "fast3")]
+    results = list(segment_by_segment.run_segments(
+        None, segments, None, None, None, None, processes=2
+    ))
+    assert [segment.name for segment, _ in results] == ["fast1", "fast2",
+                                                        "fast3", "slow"]
+    assert all([segment.name] == propagables
+               for segment, propagables in results)
+    assert max(max_running) == 2
+
+
+def test_segment_by_segment_runs_with_absolute_paths(monkeypatch, _meas_dir):
+    received = {}
+
+    def fake_run_segments(accel_cls, segments, model, meas, optics, output,
+                          processes, propagator):
+        received["optics"], received["output"] = optics, output
+        return []
+
+    monkeypatch.setattr(segment_by_segment, "run_segments", fake_run_segments)
+    monkeypatch.setattr(segment_by_segment.tfs_pandas, "read_tfs",
+                        lambda path: pd.DataFrame({"NAME": []}))
+    options = argparse.Namespace(
+        segments="IP1,BPM1,BPM2", elements=None, model="twiss.dat",
+        measurement=_meas_dir, optics="modifiers.madx", output="sbs",
+    )
+    segment_by_segment.segment_by_segment(None, options)
+    assert received["optics"] == os.path.abspath("modifiers.madx")
+    assert received["output"] == os.path.abspath("sbs")
+
+
+# sbs_propagator ##############################################################
+
+_SEG_START, _SEG_END = "BPM.12L1.B1", "BPM.12R1.B1"
+
+
+def test_propagator_front_reproduces_model(_segment_models_dir):
+    model = _read_segment_model(_segment_models_dir, "twiss_IP1.dat")
+    propagator = sbs_propagator.SegmentPropagator(model, _SEG_START, _SEG_END)
+    front = propagator.front(_conds_at(model, _SEG_START, "ini"))
+    assert list(front.index) == list(model.index)
+    for column in ("BETX", "BETY"):
+        assert np.allclose(front[column], model[column], rtol=1e-9)
+    for column in ("ALFX", "ALFY", "MUX", "MUY", "DX", "DPX"):
+        assert np.allclose(front[column], model[column], atol=1e-9)
+
+
+def test_propagator_back_matches_madx(_segment_models_dir):
+    model = _read_segment_model(_segment_models_dir, "twiss_IP1.dat")
+    madx_back = _read_segment_model(_segment_models_dir, "twiss_IP1_back.dat")
+    propagator = sbs_propagator.SegmentPropagator(model, _SEG_START, _SEG_END)
+    back = propagator.back(_conds_at(model, _SEG_END, "end"))
+    assert list(back.index) == list(madx_back.index)
+    assert np.allclose(back.S, madx_back.S, atol=1e-6)
+    for column in ("BETX", "BETY"):
+        assert np.allclose(back[column], madx_back[column], rtol=1e-6)
+    for column in ("ALFX", "ALFY", "MUX", "MUY", "DX", "DPX"):
+        assert np.allclose(back[column], madx_back[column], atol=1e-6)
+
+
+def test_propagator_wraps_around_model_end(_segment_models_dir):
+    model = _read_segment_model(_segment_models_dir, "twiss_IP1.dat")
+    cut = len(model.index) // 2
+    tunes = {"X": model.headers["Q1"], "Y": model.headers["Q2"]}
+    rotated = pd.concat([model.iloc[cut:], model.iloc[:cut]])
+    rotated.headers = model.headers
+    for column in ("S", "MUX", "MUY"):
+        total = model.headers["LENGTH"] if column == "S" else tunes[column[-1]]
+        rotated[column] = np.concatenate((model[column].values[cut:] - total,
+                                          model[column].values[:cut]))
+    propagator = sbs_propagator.SegmentPropagator(rotated,
+                                                  _SEG_START, _SEG_END)
+    front = propagator.front(_conds_at(model, _SEG_START, "ini"))
+    assert list(front.index) == list(model.index)
+    assert np.allclose(front.S, model.S)
+    assert np.allclose(front.MUX, model.MUX, atol=1e-9)
+    assert np.allclose(front.BETY, model.BETY, rtol=1e-9)
+
+
+def test_run_for_segment_with_python_propagator(tmpdir, _meas_dir):
+    model = tfs_pandas.read_tfs(
+        os.path.join(CURRENT_DIR, "..", "inputs", "models", "flat_beam1",
+                     "twiss.dat")
+    ).set_index("NAME", drop=False)
+    meas = GetLlmMeasurement(_meas_dir)
+    segment = Segment("IP5", "BPM.12L5.B1", "BPM.12R5.B1")
+    output = str(tmpdir)
+    propagables = segment_by_segment.run_for_segment(
+        None, segment, model, meas, None, output, propagator="python"
+    )
+    assert propagables
+    for suffix in ("", "_back", "_cor", "_cor_back"):
+        assert os.path.isfile(os.path.join(output,
+                                           "twiss_IP5{}.dat".format(suffix)))
+    front = propagables[0].segment_models.front
+    assert front.NAME.iloc[0] == "BPM.12L5.B1"
+    assert front.NAME.iloc[-1] == "BPM.12R5.B1"
+    assert np.isclose(front.BETX.iloc[0],
+                      meas.beta_x.loc["BPM.12L5.B1", "BETX"])
+    segment_by_segment.write_beatings(segment, propagables, output)
+    assert os.path.isfile(os.path.join(output, "sbsphasext_IP5.dat"))
+
+
+def _read_segment_model(directory, filename):
+    model = tfs_pandas.read_tfs(os.path.join(directory, filename))
+    model = model[~model.NAME.str.contains("\\$")]
+    return model.set_index("NAME", drop=False)
+
+
+def _conds_at(model, name, suffix):
+    init_conds = {}
+    for plane in ("x", "y"):
+        for column in ("bet", "alf", "d", "dp"):
+            init_conds["{}{}_{}".format(column, plane, suffix)] =\
+                model.loc[name, "{}{}".format(column, plane).upper()]
+    return init_conds
+
+
+# sbs_math ####################################################################
+
+def test_error_kernels_match_scalar_formulas():
+    dphi = np.linspace(0., 1.7, 25)
+    bets, alfs = 30. + 20. * np.sin(dphi), 1.5 * np.cos(dphi)
+    errb0, erra0, bet0, alf0 = 1.3, 0.04, 42., -0.7
+    sin4, cos4 = np.sin(4 * np.pi * dphi), np.cos(4 * np.pi * dphi)
+    beta_err = np.sqrt(
+        (bets * sin4 * alf0 / bet0 + bets * cos4 / bet0) ** 2 * errb0 ** 2 +
+        (bets * sin4) ** 2 * erra0 ** 2
+    )
+    alfa_err = np.sqrt(
+        ((alfs * (sin4 * alf0 / bet0 + cos4 / bet0)) -
+         cos4 * alf0 / bet0 + sin4 / bet0) ** 2 * errb0 ** 2 +
+        (cos4 - alfs * sin4) ** 2 * erra0 ** 2
+    )
+    phase_err = np.sqrt(
+        ((.5 * cos4 * alf0 / bet0 - .5 * sin4 / bet0 - .5 * alf0 / bet0)
+         * errb0) ** 2 +
+        ((-.5 * cos4 + .5) * erra0) ** 2
+    ) / (2 * np.pi)
+    assert np.allclose(sbs_math.propagate_error_beta(
+        errb0, erra0, dphi, bets, bet0, alf0), beta_err)
+    assert np.allclose(sbs_math.propagate_error_alfa(
+        errb0, erra0, dphi, alfs, bet0, alf0), alfa_err)
+    assert np.allclose(sbs_math.propagate_error_phase(
+        errb0, erra0, dphi, bet0, alf0), phase_err)
+    scalar = sbs_math.propagate_error_phase(errb0, erra0, dphi[3], bet0, alf0)
+    assert np.ndim(scalar) == 0
+    assert np.isclose(scalar, phase_err[3])
+
+
+def test_error_kernels_keep_series_index():
+    dphi = pd.Series([0.1, 0.2], index=["BPM1", "BPM2"])
+    errors = sbs_math.propagate_error_phase(1., 0.1, dphi, 30., 1.)
+    assert list(errors.index) == ["BPM1", "BPM2"]
+
+
+def test_propagate_covariance_diagonal_is_errors():
+    dphi = np.linspace(0., 1., 10)
+    jacobian = sbs_math.optics_jacobian(dphi, 40., 0.5,
+                                        bets=np.full(10, 35.),
+                                        alfs=np.full(10, -0.3))
+    cov = sbs_math.propagate_covariance(jacobian, 1.2, 0.05, cov0=0.03)
+    errors = sbs_math.propagate_errors(jacobian, 1.2, 0.05, cov0=0.03)
+    assert cov.shape == (10, 3, 3)
+    assert np.allclose(np.sqrt(np.diagonal(cov, axis1=1, axis2=2)), errors)
+    assert np.allclose(cov, np.transpose(cov, (0, 2, 1)))
+    uncorrelated = sbs_math.propagate_errors(jacobian, 1.2, 0.05)
+    assert not np.allclose(errors, uncorrelated)
+
+
+def test_error_kernels_broadcast_all_inputs():
+    dphi, bets = 0.3, np.array([30., 40., 50.])
+    errb0, erra0 = np.array([1., 2., 3.]), np.array([0.1, 0.2, 0.3])
+    jacobian = sbs_math.optics_jacobian(dphi, 42., -0.7, bets=bets)
+    assert jacobian.shape == (3, 3, 2)
+    errors = sbs_math.propagate_errors(jacobian[:, :1], errb0, erra0)
+    assert np.allclose(errors[:, 0], sbs_math.propagate_error_beta(
+        errb0, erra0, dphi, bets, 42., -0.7))
+    for i in range(3):
+        assert np.isclose(errors[i, 0], sbs_math.propagate_error_beta(
+            errb0[i], erra0[i], dphi, bets[i], 42., -0.7))
+    cov = sbs_math.propagate_covariance(jacobian, errb0, erra0, cov0=0.01)
+    assert cov.shape == (3, 3, 3)
+    assert np.allclose(np.sqrt(cov[:, 0, 0]), sbs_math.propagate_error_beta(
+        errb0, erra0, dphi, bets, 42., -0.7, cov0=0.01))
+
+
+def test_magnet_beta_errors_only_from_previous_magnets():
+    bets = np.array([10., 20.])
+    phase_bpms = np.array([0.1, 0.3])
+    beta_magnets = np.array([50., 60., 70.])
+    phase_magnets = np.array([0.05, 0.2, 0.4])
+    err_k1l = np.array([1e-3, 2e-3, 3e-3])
+    errors = sbs_math.magnet_beta_errors(bets, phase_bpms, beta_magnets,
+                                         phase_magnets, err_k1l)
+    first = 10. * 1e-3 * abs(50. * np.sin(4 * np.pi * 0.05))
+    second = 20. * np.sqrt(
+        (1e-3 * 50. * np.sin(4 * np.pi * 0.25)) ** 2 +
+        (2e-3 * 60. * np.sin(4 * np.pi * 0.1)) ** 2
+    )
+    assert np.allclose(errors, [first, second])
+
+
+def test_phase_back_errors_propagated_from_end(_meas_dir):
+    meas = GetLlmMeasurement(_meas_dir)
+    names = meas.beta_x.index.intersection(meas.beta_y.index)
+    start, end = names[0], names[10]
+    phase = sbs_propagables.Phase(Segment("test", start, end), meas)
+    bet_end, errbet_end, alf_end, erralf_end = phase._init_conds("x", -1)
+    assert bet_end == meas.beta_x.loc[end, "BETX"]
+    assert errbet_end == meas.beta_x.loc[end, "ERRBETX"]
+    assert alf_end == -meas.beta_x.loc[end, "ALFX"]
+    assert erralf_end == meas.beta_x.loc[end, "ERRALFX"]
+    assert phase._init_conds("x", 1)[0] == meas.beta_x.loc[start, "BETX"]
+
+
 # GetLlmMeasurement ###########################################################
 
 def test_measurement_empty_dir(_meas_dir_empty):
@@ -0,0 +1,133 @@
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "..")
+))
+
+from utils import tfs_pandas, tfs_cache
+from Python_Classes4MAD import metaclass
+
+CURRENT_DIR = os.path.dirname(__file__)
+
+
+def test_tfs_write_read(_dataframe, _test_file):
+    tfs_pandas.write_tfs(_test_file, _dataframe)
+    new = tfs_pandas.read_tfs(_test_file)
+    assert new.headers["TITLE"] == "test"
+    assert new.headers["Q1"] == 62.28
+    assert list(new.columns) == list(_dataframe.columns)
+    assert new.NAME.tolist() == _dataframe.NAME.tolist()
+    assert new.IDX.astype(int).tolist() == [1, 2, 3]
+    assert np.allclose(new.S, _dataframe.S)
+    assert np.isnan(new.BETX[1])
+
+
+def test_tfs_read_model():
+    model = tfs_pandas.read_tfs(os.path.join(
+        CURRENT_DIR, "..", "inputs", "models", "flat_beam1", "twiss.dat"
+    ))
+    assert model.headers["SEQUENCE"] == "LHCB1"
+    assert model.NAME[0] == "BPMYB.5L2.B1"
+    assert model.S.dtype == np.float64
+    assert len(model.index) == 553
+
+
+def test_tfs_cache_reads_same_data(_cache_dir):
+    model_path = os.path.join(CURRENT_DIR, "..", "inputs", "models",
+                              "flat_beam1", "twiss.dat")
+    parsed = tfs_pandas.read_tfs(model_path)
+    assert len(_cache_entries(_cache_dir)) == 1
+    cached = tfs_pandas.read_tfs(model_path)
+    pd.testing.assert_frame_equal(pd.DataFrame(parsed), pd.DataFrame(cached))
+    assert parsed.headers == cached.headers
+
+    parsed_twiss = metaclass.twiss(model_path)
+    assert len(_cache_entries(_cache_dir)) == 2  # One entry per reader
+    cached_twiss = metaclass.twiss(model_path)
+    assert len(_cache_entries(_cache_dir)) == 2
+    assert cached_twiss.NAME == parsed_twiss.NAME
+    assert cached_twiss.indx == parsed_twiss.indx
+    assert cached_twiss.SEQUENCE == parsed_twiss.SEQUENCE
+    assert cached_twiss.Q1 == parsed_twiss.Q1
+    assert np.all(cached_twiss.BETX == parsed_twiss.BETX)
+
+
+def test_metaclass_skips_rows_and_indexes_all_cases(_test_file):
+    with open(_test_file, "w") as tfs_file:
+        tfs_file.write(
+            '@ Q1 %le 62.28\n'
+            '* NAME S BETX\n'
+            '$ %s %le %le\n'
+            ' "BPM1" 0.1 1.0\n'
+            ' "S.DS.L1$START" 0.2 2.0\n'
+            ' "Ip1" 0.3 3.0\n'
+        )
+    twiss = metaclass.twiss(_test_file)
+    assert twiss.NAME == ["BPM1", "Ip1"]
+    assert np.all(twiss.BETX == [1., 3.])
+    assert twiss.indx == {"BPM1": 0, "bpm1": 0, "Ip1": 1, "IP1": 1, "ip1": 1}
+
+
+def test_tfs_cache_hashes_only_changed_files(_cache_dir, _test_file):
+    with open(_test_file, "w") as tfs_file:
+        tfs_file.write("@ Q1 %le 62.28\n* NAME S\n$ %s %le\n BPM1 0.1\n")
+    os.utime(_test_file, (1000, 1000))
+    cache_path = tfs_cache.get_cache_path(_test_file, "test")
+    assert cache_path == tfs_cache.get_cache_path(_test_file, "test")
+    with open(_test_file, "w") as tfs_file:  # Same size and time, from the index
+        tfs_file.write("@ Q1 %le 62.31\n* NAME S\n$ %s %le\n BPM1 0.1\n")
+    os.utime(_test_file, (1000, 1000))
+    assert tfs_cache.get_cache_path(_test_file, "test") == cache_path
+    os.utime(_test_file, (2000, 2000))
+    assert tfs_cache.get_cache_path(_test_file, "test") != cache_path
+
+
+def test_tfs_cache_evicts_least_recently_used(_cache_dir):
+    for i, mtime in enumerate((30, 10, 20)):
+        path = os.path.join(_cache_dir, "{}.npz".format(i))
+        with open(path, "wb") as cache_file:
+            cache_file.write(b"0" * 100)
+        os.utime(path, (mtime, mtime))
+    tfs_cache._evict(_cache_dir, max_size=200)
+    assert sorted(os.listdir(_cache_dir)) == ["0.npz", "2.npz"]
+
+
+def _cache_entries(cache_dir):
+    return [name for name in os.listdir(cache_dir) if name.endswith(".npz")]
+
+
+@pytest.fixture()
+def _cache_dir(tmpdir, monkeypatch):
+    monkeypatch.setenv(tfs_cache.CACHE_ENV_VAR, str(tmpdir))
+    monkeypatch.setattr(tfs_cache, "MIN_FILE_SIZE", 0)
+    return str(tmpdir)
+
+
+@pytest.fixture()
+def _dataframe():
+    return tfs_pandas.TfsDataFrame(
+        index=range(3),
+        data=OrderedDict([
+            ("NAME", ["BPM1", "BPM2", "NAN"]),
+            ("S", [0.1, 1e-7, 3.]),
+            ("BETX", [1., np.nan, -2.]),
+            ("IDX", [1, 2, 3]),
+        ]),
+        headers=OrderedDict([("TITLE", "test"), ("Q1", 62.28)]),
+    )
+
+
+@pytest.fixture()
+def _test_file():
+    test_file = os.path.join(CURRENT_DIR, "test_file.tfs")
+    try:
+        yield test_file
+    finally:
+        if os.path.isfile(test_file):
+            os.remove(test_file)
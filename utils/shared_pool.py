@@ -0,0 +1,165 @@
+r'''
+..module: utils.shared_pool
+
+Persistent process pool that exchanges data with its workers through
+memory-mapped numpy buffers instead of pickling it.
+
+The pool is meant to live for a whole analysis (e.g. every file and bunch
+in hole_in_one.run_all): the worker processes are started only once, the
+input matrices are written once to a shared buffer and the workers write
+their results directly into preallocated output buffers.
+
+Usage::
+
+    with SharedArrayPool() as pool:
+        samples = pool.share(bpm_matrix.values)
+        results = pool.empty(samples.shape, np.float64)
+        pool.map_row_blocks(_row_function, samples.shape[0],
+                            (samples, results))
+        values = results.array
+
+'''
+import os
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+import numpy as np
+
+
+SHM_DIR = "/dev/shm"
+ROWS_PER_TASK = 16
+
+
+class SharedArray(object):
+    """
+    Light, picklable handle to a memory-mapped numpy array.
+    Only the file path, shape and dtype travel to the workers, the data
+    itself is mapped by every process from the same file.
+    """
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._array = None
+
+    @property
+    def array(self):
+        """ The numpy.memmap view of the buffer, opened lazily. """
+        if self._array is None:
+            self._array = np.memmap(self.path, dtype=self.dtype,
+                                    mode="r+", shape=self.shape)
+        return self._array
+
+    def flush(self):
+        if self._array is not None:
+            self._array.flush()
+
+    def release(self):
+        self._array = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
+
+
+class SharedArrayPool(object):
+    """
+    Pool of worker processes that operate on SharedArray buffers.
+
+    Args:
+        processes: Number of worker processes, defaults to the number of
+            cpus. If it is 1 no subprocess is started and every task runs
+            in the calling process.
+        tmp_dir: Directory where the buffers are created, defaults to
+            /dev/shm if available (memory backed) or the system temporary
+            directory otherwise.
+        initializer: If given, initializer(*initargs) is called once in
+            every worker (or in the calling process if processes is 1).
+            It can be used to hand big read-only objects to the workers
+            once, instead of with every task.
+    """
+    def __init__(self, processes=None, tmp_dir=None,
+                 initializer=None, initargs=()):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        if tmp_dir is None and os.path.isdir(SHM_DIR):
+            tmp_dir = SHM_DIR
+        self._tmp_dir = tempfile.mkdtemp(prefix="shared_pool_", dir=tmp_dir)
+        self._counter = itertools.count()
+        self._shared = []
+        self._pool = None
+        if processes > 1:
+            self._pool = multiprocessing.Pool(processes, initializer, initargs)
+        elif initializer is not None:
+            initializer(*initargs)
+
+    @property
+    def sequential(self):
+        return self._pool is None
+
+    def empty(self, shape, dtype):
+        """ Creates a zero initialized shared buffer. """
+        path = os.path.join(self._tmp_dir,
+                            "array_{}.dat".format(next(self._counter)))
+        shared = SharedArray(path, shape, dtype)
+        np.memmap(path, dtype=shared.dtype, mode="w+", shape=shared.shape).flush()
+        self._shared.append(shared)
+        return shared
+
+    def share(self, array):
+        """ Copies array into a new shared buffer. """
+        array = np.ascontiguousarray(array)
+        shared = self.empty(array.shape, array.dtype)
+        shared.array[...] = array
+        shared.flush()
+        return shared
+
+    def free(self, *shared_arrays):
+        """ Deletes the given buffers, they cannot be used afterwards. """
+        for shared in shared_arrays:
+            shared.release()
+            if shared in self._shared:
+                self._shared.remove(shared)
+            if os.path.exists(shared.path):
+                os.remove(shared.path)
+
+    def map_row_blocks(self, function, n_rows, args=(),
+                       rows_per_task=ROWS_PER_TASK):
+        """
+        Calls function(start, end, *args) for consecutive blocks of rows
+        covering range(n_rows) and waits for all of them to finish.
+        The function must be defined at module level, it should read and
+        write its data through the SharedArray instances in args.
+        """
+        blocks = [(start, min(start + rows_per_task, n_rows))
+                  for start in range(0, n_rows, rows_per_task)]
+        if self.sequential:
+            for start, end in blocks:
+                function(start, end, *args)
+        else:
+            results = [self._pool.apply_async(function, (start, end) + tuple(args))
+                       for start, end in blocks]
+            for result in results:
+                result.get()  # Re-raises the exceptions of the workers.
+        for arg in args:
+            if isinstance(arg, SharedArray):
+                arg.release()  # Drop the old mapping to see worker writes.
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for shared in self._shared:
+            shared.release()
+        self._shared = []
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
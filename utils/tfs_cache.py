@@ -0,0 +1,242 @@
+r'''
+..module: utils.tfs_cache
+
+On-disk cache of parsed TFS tables.
+
+The first time a big TFS file (e.g. twiss_elements.dat) is parsed, its
+headers and columns are stored in a compact binary .npz file, named after
+the SHA1 of the file content and of the reader that parsed it. Later reads
+of the same content, by the same reader (tfs_pandas.read_tfs or
+metaclass.twiss), load the arrays from there instead of parsing the text
+again. The readers do not share entries, as they do not keep the same rows.
+
+The header values are stored as raw strings together with their TFS type,
+so that every reader keeps its own conversion rules. The least recently
+used entries are deleted when the cache grows above MAX_CACHE_SIZE.
+
+Hashing a big file takes a good part of the time of loading it from the
+cache, the digests are then kept in an index by path, modification time
+and size, and a file is only hashed again when one of these changes.
+
+The cache lives in ~/.cache/beta_beat/tfs, the environment variable
+BETA_BEAT_TFS_CACHE can be used to change this directory or, if set to an
+empty string, to disable the cache.
+'''
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+CACHE_ENV_VAR = "BETA_BEAT_TFS_CACHE"
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "beta_beat", "tfs")
+MIN_FILE_SIZE = 512 * 1024  # Smaller files are parsed faster than hashed and loaded
+MAX_CACHE_SIZE = 2 * 1024 ** 3
+FORMAT_VERSION = "1"
+MAX_INDEX_ENTRIES = 1000
+
+_HEADERS_KEY = "__headers__"
+_COLUMNS_KEY = "__columns__"
+_COLUMN_KEY = "column_{}"
+_READ_CHUNK = 4 * 1024 * 1024
+_DIGEST_INDEX_FILE = "digests.json"
+_RACY_SECONDS = 2.  # Files modified this recently could change again unnoticed
+
+_digest_indexes = {}  # cache dir -> OrderedDict path -> [mtime, size, digest]
+
+
+class CachedTable(object):
+    """
+    Content of a TFS file as stored in the cache.
+
+    Attributes:
+        headers: list of (name, type_id, raw_value) tuples, raw_value is the
+            string after the type in the header line, quotes included.
+        columns: OrderedDict column name -> numpy array.
+        column_types: list of the type ids of the columns, as in the $ line.
+    """
+    def __init__(self, headers, columns, column_types):
+        self.headers = headers
+        self.columns = columns
+        self.column_types = column_types
+
+
+def get_cache_dir():
+    return os.environ.get(CACHE_ENV_VAR, DEFAULT_CACHE_DIR)
+
+
+def is_cacheable(tfs_path):
+    """ True if the cache is enabled and tfs_path is worth caching. """
+    if not get_cache_dir():
+        return False
+    try:
+        return os.path.getsize(tfs_path) >= MIN_FILE_SIZE
+    except OSError:
+        return False
+
+
+def get_cache_path(tfs_path, reader):
+    """
+    Returns the path of the cache entry for the current content of tfs_path
+    as parsed by reader, or None if the cache is disabled or the file is not
+    worth caching. The file is hashed here, unless its digest is in the
+    index, so the result should be given to both load and store.
+    """
+    if not is_cacheable(tfs_path):
+        return None
+    sha1 = hashlib.sha1(FORMAT_VERSION.encode("ascii"))
+    sha1.update(reader.encode("ascii") + b"\0")
+    sha1.update(_get_digest(tfs_path).encode("ascii"))
+    return os.path.join(get_cache_dir(), sha1.hexdigest() + ".npz")
+
+
+def load(cache_path):
+    """
+    Returns the CachedTable stored in cache_path, as given by
+    get_cache_path, or None if it is not in the cache.
+    """
+    if cache_path is None or not os.path.isfile(cache_path):
+        return None
+    try:
+        with np.load(cache_path, allow_pickle=False) as data:
+            headers = [tuple(_to_str(item) for item in header)
+                       for header in json.loads(str(data[_HEADERS_KEY]))]
+            names_and_types = [(_to_str(name), _to_str(type_id))
+                               for name, type_id in json.loads(str(data[_COLUMNS_KEY]))]
+            columns = OrderedDict(
+                (name, data[_COLUMN_KEY.format(i)])
+                for i, (name, _) in enumerate(names_and_types)
+            )
+    except (IOError, OSError, ValueError, KeyError) as error:
+        LOGGER.debug("Ignoring broken cache file {}: {}".format(cache_path, error))
+        return None
+    _touch(cache_path)
+    LOGGER.debug("Loaded cache {}".format(cache_path))
+    return CachedTable(headers, columns,
+                       [type_id for _, type_id in names_and_types])
+
+
+def store(cache_path, cached_table):
+    """
+    Stores the parsed content of a TFS file in cache_path, as given by
+    get_cache_path. Errors are logged and ignored, the cache is only an
+    optimization.
+    """
+    if cache_path is None:
+        return
+    if len(set(len(values) for values in cached_table.columns.values())) > 1:
+        return  # Some column could not be parsed
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        arrays = {
+            _HEADERS_KEY: np.array(json.dumps([list(header) for header in cached_table.headers])),
+            _COLUMNS_KEY: np.array(json.dumps(
+                [[name, type_id] for name, type_id
+                 in zip(cached_table.columns.keys(), cached_table.column_types)]
+            )),
+        }
+        for i, values in enumerate(cached_table.columns.values()):
+            values = np.asarray(values)
+            if values.dtype == object:
+                values = values.astype(str)
+            arrays[_COLUMN_KEY.format(i)] = values
+        # Write to a temporary file first, so that readers never see half files
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(file_descriptor, "wb") as tmp_file:
+            np.savez(tmp_file, **arrays)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError, ValueError, TypeError) as error:
+        LOGGER.debug("Could not store cache {}: {}".format(cache_path, error))
+        return
+    LOGGER.debug("Stored cache {}".format(cache_path))
+    _evict(cache_dir)
+
+
+def _get_digest(tfs_path):
+    """ SHA1 of the content of tfs_path, from the index if the file did not change. """
+    tfs_path = os.path.abspath(tfs_path)
+    stat = os.stat(tfs_path)
+    index = _get_digest_index(get_cache_dir())
+    entry = index.get(tfs_path)
+    if entry is not None and entry[:2] == [stat.st_mtime, stat.st_size]:
+        return entry[2]
+    sha1 = hashlib.sha1()
+    with open(tfs_path, "rb") as tfs_data:
+        for chunk in iter(lambda: tfs_data.read(_READ_CHUNK), b""):
+            sha1.update(chunk)
+    digest = sha1.hexdigest()
+    if stat.st_mtime < time.time() - _RACY_SECONDS:
+        index.pop(tfs_path, None)
+        index[tfs_path] = [stat.st_mtime, stat.st_size, digest]
+        while len(index) > MAX_INDEX_ENTRIES:
+            index.popitem(last=False)
+        _write_digest_index(get_cache_dir(), index)
+    return digest
+
+
+def _get_digest_index(cache_dir):
+    if cache_dir not in _digest_indexes:
+        try:
+            with open(os.path.join(cache_dir, _DIGEST_INDEX_FILE), "r") as index_file:
+                index = json.load(index_file, object_pairs_hook=OrderedDict)
+        except (IOError, OSError, ValueError):
+            index = OrderedDict()
+        _digest_indexes[cache_dir] = index
+    return _digest_indexes[cache_dir]
+
+
+def _write_digest_index(cache_dir, index):
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(file_descriptor, "w") as tmp_file:
+            json.dump(index, tmp_file)
+        os.rename(tmp_path, os.path.join(cache_dir, _DIGEST_INDEX_FILE))
+    except (IOError, OSError) as error:
+        LOGGER.debug("Could not store the digest index in {}: {}".format(cache_dir, error))
+
+
+def _touch(cache_path):
+    try:
+        os.utime(cache_path, None)
+    except OSError:
+        pass
+
+
+def _evict(cache_dir, max_size=None):
+    """ Deletes the least recently used entries until the cache fits max_size. """
+    if max_size is None:
+        max_size = MAX_CACHE_SIZE
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        if not file_name.endswith(".npz"):
+            continue
+        path = os.path.join(cache_dir, file_name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+        except OSError:
+            pass
+
+
+def _to_str(value):
+    # json gives unicode in python 2
+    return str(value)
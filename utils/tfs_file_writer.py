@@ -172,6 +172,17 @@ class TfsFileWriter(object):
         """
         self.__tfs_table.add_table_row(list_row_entries)
 
+    def add_table_columns(self, list_columns):
+        """
+        Adds whole columns of data at once, much faster than calling add_table_row for every
+        row of a big table.
+
+        Args:
+            list_columns (list): One sequence of values per column, all of the same length.
+                                 Datatypes will not be checked.
+        """
+        self.__tfs_table.add_table_columns(list_columns)
+
     def get_absolute_file_name_path(self):
         return os.path.join(self.__outputpath, self.__file_name)
 
@@ -478,6 +489,21 @@ class _TfsTable(object):
 
         self.__list_of_table_rows.append(list_row_entries)
 
+    def add_table_columns(self, list_columns):
+        """
+        Adds the entries of several rows given column by column.
+        """
+        if not (self.__column_names_are_set() and self.__column_data_types_are_set()):
+            raise TypeError("Before filling the table, set the names and datatypes(" +
+                            self.__tfs_file_writer.get_file_name() + ").")
+        if self.__num_of_columns != len(list_columns):
+            raise TypeError("Number of columns does not match the column number of the table.("
+                            + self.__tfs_file_writer.get_file_name() + ")")
+        if len(set(len(column) for column in list_columns)) > 1:
+            raise TypeError("Columns have different lengths.("
+                            + self.__tfs_file_writer.get_file_name() + ")")
+        self.__list_of_table_rows.extend(zip(*list_columns))
+
     def get_column_names(self):
         return self.__list_of_column_names
 
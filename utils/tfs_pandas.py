@@ -5,6 +5,7 @@ import logging
 import pandas
 import numpy as np
 from utils import tfs_file_writer
+from utils import tfs_cache
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
@@ -14,6 +15,8 @@ NAMES = "*"
 TYPES = "$"
 COMMENTS = "#"
 INDEX_ID = "INDEX&&&"
+CACHE_READER_ID = "tfs_pandas"
+NAN_VALUES = ["nan", "NaN", "NAN", "-nan", "-NaN", "-NAN"]
 
 ID_TO_TYPE = {
     "%s": np.str,
@@ -89,20 +92,55 @@ def read_tfs(tfs_path, index=None):
     """
     Parses the TFS table present in tfs_path and returns a custom Pandas
     DataFrame (TfsDataFrame).
+    The header block is parsed line by line, the table body is handed to
+    the pandas C parser in one go, with the dtypes taken from the $ line.
+    Big files are stored after parsing in the binary cache (see
+    utils.tfs_cache) and loaded from there on later reads.
     :param tfs_path: Input filepath
     :param index: Name of the column to set as index. If not given looks for INDEX_ID-column
     :return: TFS_DataFrame object
     """
     LOGGER.debug("Reading path: " + tfs_path)
+    cache_path = tfs_cache.get_cache_path(tfs_path, CACHE_READER_ID)
+    cached_table = tfs_cache.load(cache_path)
+    if cached_table is not None:
+        data_frame = _data_frame_from_cache(cached_table)
+    else:
+        data_frame = _parse_tfs_file(tfs_path, cache_path)
+    headers = data_frame.headers
+
+    if index is not None:
+        # Use given column as index
+        data_frame = data_frame.set_index(index)
+    else:
+        # Try to find Index automatically
+        index_column = [c for c in data_frame.columns if c.startswith(INDEX_ID)]
+        if len(index_column) > 0:
+            data_frame = data_frame.set_index(index_column)
+            idx_name = index_column[0].replace(INDEX_ID, "")
+            if idx_name == "":
+                idx_name = None  # to remove it completely (Pandas makes a difference)
+            data_frame = data_frame.rename_axis(idx_name)
+
+    # not sure if this is needed in general but some of GetLLM's funstions try to access this
+    headers["filename"] = tfs_path
+
+    _validate(data_frame, "from file '{:s}'".format(tfs_path))
+    return data_frame
+
+
+def _parse_tfs_file(tfs_path, cache_path=None):
     headers = OrderedDict()
-    column_names = column_types = None
-    rows_list = []
+    raw_headers = []
+    column_names = column_types = column_type_ids = None
     with open(tfs_path, "r") as tfs_data:
-        for line in tfs_data:
+        # readline instead of iteration, so the file position is right after the header
+        for line in iter(tfs_data.readline, ""):
             parts = line.split()
             if len(parts) == 0:
                 continue
             if parts[0] == HEADER:
+                raw_headers.append((parts[1], parts[2], " ".join(parts[3:])))
                 headers[parts[1]] = _parse_header(
                     parts[2], " ".join(parts[3:]))
             elif parts[0] == NAMES:
@@ -110,36 +148,44 @@ def read_tfs(tfs_path, index=None):
                 column_names = np.array(parts[1:])
             elif parts[0] == TYPES:
                 LOGGER.debug("Setting column types.")
-                column_types = _compute_types(parts[1:])
+                column_type_ids = parts[1:]
+                column_types = _compute_types(column_type_ids)
             elif parts[0] == COMMENTS:
                 continue
             else:
                 if column_names is None:
                     raise TfsFormatError("Column names have not been set.")
-                if column_types is None:
-                    raise TfsFormatError("Column types have not been set.")
-                parts = [part.strip('"') for part in parts]
-                rows_list.append(parts)
-    data_frame = _create_data_frame(column_names, column_types, rows_list, headers)
-
-    if index is not None:
-        # Use given column as index
-        data_frame = data_frame.set_index(index)
-    else:
-        # Try to find Index automatically
-        index_column = [c for c in data_frame.columns if c.startswith(INDEX_ID)]
-        if len(index_column) > 0:
-            data_frame = data_frame.set_index(index_column)
-            idx_name = index_column[0].replace(INDEX_ID, "")
-            if idx_name == "":
-                idx_name = None  # to remove it completely (Pandas makes a difference)
-            data_frame = data_frame.rename_axis(idx_name)
+                raise TfsFormatError("Column types have not been set.")
+            if column_names is not None and column_types is not None:
+                break
+        if column_names is None:
+            raise TfsFormatError("Column names have not been set.")
+        if column_types is None:
+            raise TfsFormatError("Column types have not been set.")
+        data_frame = _read_table_body(tfs_data, column_names, column_types, headers)
+    if len(set(column_names)) < len(column_names):
+        return data_frame  # Repeated column names cannot be cached
+    tfs_cache.store(cache_path, tfs_cache.CachedTable(
+        raw_headers,
+        OrderedDict((name, data_frame[name].values) for name in column_names),
+        column_type_ids,
+    ))
+    return data_frame
 
-    # not sure if this is needed in general but some of GetLLM's funstions try to access this
-    headers["filename"] = tfs_path
 
-    _validate(data_frame, "from file '{:s}'".format(tfs_path))
-    return data_frame
+def _data_frame_from_cache(cached_table):
+    headers = OrderedDict(
+        (name, _parse_header(type_id, raw_value))
+        for name, type_id, raw_value in cached_table.headers
+    )
+    data = OrderedDict()
+    for (name, values), type_id in zip(cached_table.columns.items(),
+                                       cached_table.column_types):
+        if _id_to_type(type_id) in (np.str, str):
+            values = np.array(values.tolist(), dtype=object)
+        data[name] = values
+    return TfsDataFrame(data=data, columns=list(cached_table.columns.keys()),
+                        headers=headers)
 
 
 def write_tfs(tfs_path, data_frame, headers_dict={}, save_index=False):
@@ -189,8 +235,9 @@ def write_tfs(tfs_path, data_frame, headers_dict={}, save_index=False):
             tfs_writer.add_float_descriptor(head_name, headers_dict[head_name])
     tfs_writer.add_column_names(column_names)
     tfs_writer.add_column_datatypes(column_types)
-    for _, row in data_frame.iterrows():
-        tfs_writer.add_table_row(row)
+    tfs_writer.add_table_columns(
+        [data_frame.iloc[:, i].values.tolist() for i in range(len(data_frame.columns))]
+    )
     tfs_writer.write_to_file()
 
 
@@ -242,12 +289,22 @@ class TfsFormatError(Exception):
     pass
 
 
-def _create_data_frame(column_names, column_types, rows_list, headers):
-    data_frame = TfsDataFrame(data=np.array(rows_list),
-                              columns=column_names,
-                              headers=headers)
-    _assign_column_types(data_frame, column_names, column_types)
-    return data_frame
+def _read_table_body(tfs_data, column_names, column_types, headers):
+    float_columns = [name for name, type_f in zip(column_names, column_types)
+                     if type_f is np.float64]
+    try:
+        table = pandas.read_csv(
+            tfs_data, sep=r"\s+", header=None, names=column_names,
+            quotechar='"', index_col=False,
+            dtype=dict(zip(column_names, column_types)),
+            keep_default_na=False,
+            na_values={name: NAN_VALUES for name in float_columns},
+            float_precision="round_trip",
+        )
+    except pandas.errors.EmptyDataError:
+        table = pandas.DataFrame(columns=column_names)
+        _assign_column_types(table, column_names, column_types)
+    return TfsDataFrame(table, headers=headers)
 
 
 def _assign_column_types(data_frame, column_names, column_types):
@@ -6,16 +6,22 @@ LOG = logtools.get_logger(__name__)
 
 def clean_files(list_of_files, replace=False):
     for filepath in list_of_files:
-        try:
-            df = tfs.read_tfs(filepath)
-            LOG.info("Read file {:s}".format(filepath))
-        except (IOError, tfs.TfsFormatError):
-            LOG.info("Skipped file {:s}".format(filepath))
-        else:
-            df = df.dropna(axis='index')
-            if not replace:
-                filepath += ".dropna"
-            tfs.write_tfs(filepath, df)
+        clean_file(filepath, replace=replace)
+
+
+def clean_file(filepath, replace=False):
+    """ Removes the rows with NaN and returns the cleaned DataFrame (None if no TFS file). """
+    try:
+        df = tfs.read_tfs(filepath)
+        LOG.info("Read file {:s}".format(filepath))
+    except (IOError, tfs.TfsFormatError):
+        LOG.info("Skipped file {:s}".format(filepath))
+        return None
+    df = df.dropna(axis='index')
+    if not replace:
+        filepath += ".dropna"
+    tfs.write_tfs(filepath, df)
+    return df
 
 
 # Script Mode ##################################################################